@@ -1 +1,2 @@
-from consistent_hash import ConsistentHash
\ No newline at end of file
+from consistent_hash import ConsistentHash
+from hash_functions import HashFunction, HASH_FUNCTIONS, get_hash_function
\ No newline at end of file
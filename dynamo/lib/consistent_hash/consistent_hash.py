@@ -1,12 +1,19 @@
 # -------------------------------------------------
 # Imports
 # -------------------------------------------------    
-import md5
 import exceptions
 import logging
 import random
+from bisect import bisect_left
 from collections import defaultdict
 
+from dynamo.lib.consistent_hash.hash_functions import get_hash_function
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # -------------------------------------------------
 # Consistent Hash
 # -------------------------------------------------    
@@ -16,27 +23,86 @@ class ConsistentHash(object):
     
     Adapted from: http://amix.dk/blog/viewEntry/19367
     
+    The ring, its sorted tokens and the tokens of each node are replaced 
+    together by every membership change rather than modified, so a lookup
+    that reads them once sees a single version of the ring.  Changes must
+    come from one thread at a time.
+    
     :Parameters:
         replication : int
-            Number of times a node is replicated
+            Number of times a node of weight 1 is replicated
+        strategy : str
+            The strategy for mapping nodes to hash values
+        hash_function : str
+            Name of the hash function mapping keys and nodes onto the ring,
+            see hash_functions.HASH_FUNCTIONS.  md5 is the original.
+        partitions : int
+            Number of equal partitions with STRATEGY3, a power of two
     """
     REPLICATION_STR = '%s-%s'
     DETERMINISTIC = 'deterministic'
     STRATEGY1 = 'strategy1'
+    STRATEGY3 = 'strategy3'
+    
+    # Batches smaller than this are cheaper to route without numpy
+    NUMPY_MIN_BATCH = 64
     
-    def __init__(self, replication=5, strategy=DETERMINISTIC):
+    def __init__(self, replication=5, strategy=DETERMINISTIC, hash_function='md5',
+                 partitions=1024):
         """
         :Parameters:
             replication : int
-                Number of virtual instances per node
+                Number of virtual instances per node of weight 1, unused by
+                STRATEGY3
             strategy : str
                 The strategy for mapping nodes to hash values
+            hash_function : str
+                The hash function mapping keys and nodes onto the ring
+            partitions : int
+                Number of equal partitions of the ring with STRATEGY3, a 
+                power of two
         """
         self.replication_factor = replication
-        self.ring = dict()
-        self.sorted_keys = []
-        self.node_tokens = defaultdict(list)
         self.strategy = strategy
+        self.hash_function = get_hash_function(hash_function)
+        self.partition_shift = None
+        self._partition_tokens = None
+        if strategy == self.STRATEGY3:
+            bits = self.hash_function.bits
+            if partitions < 1 or partitions & (partitions - 1) or partitions > 2 ** bits:
+                raise exceptions.ValueError('partitions must be a power of two up to '
+                                            '2**%s, not %s' % (bits, partitions))
+            
+            # Partition i holds the hashes whose high bits are i and its token
+            # is the last of them, so a key's position is its hash shifted
+            size = 2 ** bits // partitions
+            self.partition_shift = bits - (partitions.bit_length() - 1)
+            self._partition_tokens = [(i + 1) * size - 1 for i in xrange(partitions)]
+        self.version = 0
+        self.weights = {}
+        self._snapshot = ({}, [], {})
+        self._batch_table = None
+        
+    @property
+    def ring(self):
+        """
+        The node of each token
+        """
+        return self._snapshot[0]
+    
+    @property
+    def sorted_keys(self):
+        """
+        The tokens in ring order
+        """
+        return self._snapshot[1]
+    
+    @property
+    def node_tokens(self):
+        """
+        The tokens of each node
+        """
+        return self._snapshot[2]
 
     def __len__(self):
         """
@@ -50,9 +116,21 @@ class ConsistentHash(object):
     # -------------------------------------------------
     # Public methods
     # -------------------------------------------------
-    def add(self, node, strategy='deterministic'):
+    def snapshot(self):
+        """
+        Gets the current version of the ring.  The returned objects are 
+        never modified by later membership changes.
+        
+        :rtype: tuple(dict, list, dict)
+        :returns: The node of each token, the sorted tokens and the tokens 
+                  of each node
+        """
+        return self._snapshot
+    
+    def add(self, node, strategy=None, weight=1):
         """
-        Adds a node to the hash.  
+        Adds a node to the hash.  A node of weight w gets w times as many 
+        tokens, or w times the share of the partitions with STRATEGY3.
         
         Partitioning strategies:
             DETERMINISTC : token is created from the node name.  Note that this can
@@ -62,44 +140,176 @@ class ConsistentHash(object):
                            to the hash with the keys randomly chosen from the hash 
                            space.  This represents partition strategy 1 from
                            "Dynamo : amazons highly available key-value store"
+            STRATEGY3    : The hash space is split into Q equal partitions that 
+                           are dealt out to the nodes, each getting Q / S of 
+                           them times its weight.  This represents partition 
+                           strategy 3 from the same paper.  A node's partitions
+                           depend only on the nodes and their weights, so every
+                           storage node builds the same ring.
         
         Note that the node must support str().  
         
         :Parameters:
             node : object
                 Any object that you wish to add to the hash
+            strategy : str
+                Must be None or the strategy the hash was created with
+            weight : float
+                The node's capacity relative to the other nodes
         """
-        if self.node_tokens.get(node):
-            raise exceptions.ValueError('Node %s already in the consistent hash' % node) 
-        
-        for i in xrange(0, self.replication_factor):
-            hash_key = self._get_node_hash_key(node, i)
-            self.node_tokens[node].append(hash_key)
-            self.ring[hash_key] = node
+        if strategy is not None and strategy != self.strategy:
+            raise exceptions.ValueError('Cannot add %s with %s to a %s hash' % 
+                                        (node, strategy, self.strategy))
+        self.add_nodes([node], {node: weight})
 
-            # Add the key to the sorted list.  If the position is 0 must 
-            # disambiguate between this being the largest and smallest key            
-            pos = self._get_pos(hash_key)
-            if pos == 0 and self.sorted_keys and hash_key > self.sorted_keys[-1]:
-                self.sorted_keys.append(hash_key)
-            else:
-                self.sorted_keys.insert(pos, hash_key)
+    def add_nodes(self, nodes, weights=None):
+        """
+        Adds a number of nodes to the hash.  The k new tokens are sorted and
+        merged into a copy of the n sorted tokens with a bisect per token, 
+        so a change costs O(k log n) comparisons plus a copy of the ring.
+        
+        :Parameters:
+            nodes : list(object)
+                The nodes to add
+            weights : dict(object, float)
+                The weight of each node, 1 for nodes it leaves out
+        :rtype: list(long)
+        :returns: The tokens added, with STRATEGY3 the partitions the new 
+                  nodes took over
+        """
+        ring, sorted_keys, node_tokens = self._snapshot
+        for node in nodes:
+            if node in node_tokens:
+                raise exceptions.ValueError('Node %s already in the consistent hash' % node) 
+        if len(set(nodes)) != len(nodes):
+            raise exceptions.ValueError('Duplicate nodes in %s' % nodes)
+        new_weights = dict(self.weights)
+        for node in nodes:
+            new_weights[node] = self._check_weight(node, (weights or {}).get(node, 1))
+        if self.strategy == self.STRATEGY3:
+            ring, node_tokens = self._assign_partitions(new_weights)
+            self._swap(ring, self._partition_tokens, node_tokens, new_weights)
+            return sorted(token for node in nodes for token in node_tokens[node])
+        
+        ring = dict(ring)
+        node_tokens = dict(node_tokens)
+        added = []
+        for node in nodes:
+            tokens = self._add_tokens(ring, node, 0, self._get_token_count(new_weights[node]))
+            node_tokens[node] = tokens
+            added.extend(tokens)
+        added.sort()
+        
+        self._swap(ring, _merge_tokens(sorted_keys, added), node_tokens, new_weights)
+        return added
         
     def remove(self, node):
         """
         Removes a node from the hash
         
         :Parameters:
-            obj : object
-                Any object that you wish to delete from the hash
+            node : object
+                The node to remove
         """
-        for token in self.node_tokens.get(node, []):
-            if token in self.ring:
-                del self.ring[token]
-                self.sorted_keys.remove(token)
+        self.remove_nodes([node])
+        
+    def remove_nodes(self, nodes):
+        """
+        Removes a number of nodes from the hash.  Their tokens are found 
+        with a bisect each and cut out of a copy of the sorted tokens.
+        
+        :Parameters:
+            nodes : list(object)
+                The nodes to remove
+        :rtype: list(long)
+        :returns: The tokens removed, with STRATEGY3 the partitions the 
+                  nodes gave up
+        """
+        ring, sorted_keys, node_tokens = self._snapshot
+        ring = dict(ring)
+        node_tokens = dict(node_tokens)
+        removed = []
+        for node in nodes:
+            if node not in node_tokens:
+                logging.info('%s not found in the consistent hash' % node)
+                continue
+            for token in node_tokens.pop(node):
+                del ring[token]
+                removed.append(token)
+        removed.sort()
+        new_weights = dict((node, weight) for node, weight in self.weights.iteritems()
+                           if node in node_tokens)
+        
+        if self.strategy == self.STRATEGY3:
+            if node_tokens:
+                ring, node_tokens = self._assign_partitions(new_weights)
+                self._swap(ring, self._partition_tokens, node_tokens, new_weights)
             else:
-                logging.info('%s not found in the consistent hash' % str(obj))
-        del self.node_tokens[node]
+                self._swap({}, [], {}, {})
+            return removed
+        self._swap(ring, _delete_tokens(sorted_keys, removed), node_tokens, new_weights)
+        return removed
+    
+    def set_weights(self, weights):
+        """
+        Changes the weights of nodes.  A node whose weight grows gets new 
+        tokens and one whose weight shrinks loses its last tokens, so only 
+        the ranges of those tokens move.  With STRATEGY3 the partitions are
+        dealt out again and mostly move to or from the reweighted nodes.
+        
+        :Parameters:
+            weights : dict(object, float)
+                The new weight of each node
+        :rtype: list(long)
+        :returns: The tokens added and removed, with STRATEGY3 the 
+                  partitions that changed nodes
+        """
+        ring, sorted_keys, node_tokens = self._snapshot
+        new_weights = dict(self.weights)
+        for node, weight in weights.iteritems():
+            if node not in node_tokens:
+                raise exceptions.ValueError('Node %s not in the consistent hash' % node)
+            new_weights[node] = self._check_weight(node, weight)
+        if self.strategy == self.STRATEGY3:
+            new_ring, node_tokens = self._assign_partitions(new_weights)
+            self._swap(new_ring, self._partition_tokens, node_tokens, new_weights)
+            return [token for token in self._partition_tokens 
+                    if ring[token] != new_ring[token]]
+        
+        ring = dict(ring)
+        node_tokens = dict(node_tokens)
+        added = []
+        removed = []
+        for node in weights:
+            old_count = self._get_token_count(self.weights[node])
+            new_count = self._get_token_count(new_weights[node])
+            tokens = list(node_tokens[node])
+            if new_count > old_count:
+                new_tokens = self._add_tokens(ring, node, old_count, new_count)
+                tokens.extend(new_tokens)
+                added.extend(new_tokens)
+                
+            # Random tokens are kept in the order they were added, while 
+            # deterministic ones are found again from their numbers
+            elif self.strategy == self.STRATEGY1:
+                old_tokens = tokens[new_count:]
+                tokens = tokens[:new_count]
+            else:
+                old_tokens = [self._get_node_hash_key(node, i) 
+                              for i in xrange(new_count, old_count)]
+                old_tokens = [token for token in old_tokens if ring.get(token) == node]
+                tokens = [token for token in tokens if token not in old_tokens]
+            if new_count < old_count:
+                for token in old_tokens:
+                    del ring[token]
+                removed.extend(old_tokens)
+            node_tokens[node] = tokens
+        added.sort()
+        removed.sort()
+        
+        sorted_keys = _merge_tokens(_delete_tokens(sorted_keys, removed), added)
+        self._swap(ring, sorted_keys, node_tokens, new_weights)
+        return sorted(added + removed)
          
     def get_node(self, key):
         """
@@ -111,54 +321,320 @@ class ConsistentHash(object):
         :rtype: object
         :returns: The node corresponding to the key
         """
-        logging.debug('getting the node key=%s sorted keys=%s' % (key,self.sorted_keys))
-        if len(self.sorted_keys) == 0:
+        logging.debug('getting the node key=%s', key)
+        ring, sorted_keys, node_tokens = self._snapshot
+        if len(sorted_keys) == 0:
             raise exceptions.ValueError('ring is empty cannot get %s' % key)
         
         # Find the first key greater than the key of the input string
-        hash_key = self._gen_key(key)
-        pos = self._get_pos(hash_key)
+        hash_key = self.hash_function.hash(key)
+        pos = self._get_pos(hash_key, sorted_keys)
         
-        return self.ring[self.sorted_keys[pos]]
+        return ring[sorted_keys[pos]]
+    
+    def get_preference_list(self, key, n):
+        """
+        Gets the n distinct nodes responsible for a key.  Starting at the 
+        key's position the ring is walked clockwise, skipping the tokens of 
+        nodes that have already been chosen.  The first node is always the
+        one returned by get_node.
+        
+        :Parameters:
+            key : str
+                The key name
+            n : int
+                The number of replicas
+        :rtype: list(object)
+        :returns: Up to n distinct nodes, fewer if the ring has fewer nodes
+        """
+        ring, sorted_keys, node_tokens = self._snapshot
+        if len(sorted_keys) == 0:
+            raise exceptions.ValueError('ring is empty cannot get %s' % key)
+        
+        n = min(n, len(node_tokens))
+        num_keys = len(sorted_keys)
+        start = self._get_pos(self.hash_function.hash(key), sorted_keys)
+        nodes = []
+        for i in xrange(num_keys):
+            node = ring[sorted_keys[(start + i) % num_keys]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        return nodes
+    
+    def get_nodes(self, keys):
+        """
+        Gets the node that each of a batch of keys maps to.  The keys are 
+        hashed in one pass and, when numpy is available and the batch is 
+        large enough, all of the ring positions are resolved with a single 
+        searchsorted call over the digests.
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: list(object)
+        :returns: The node corresponding to each key, in the order of keys
+        """
+        ring, sorted_keys, node_tokens = self._snapshot
+        if len(sorted_keys) == 0:
+            raise exceptions.ValueError('ring is empty cannot get %s' % keys)
+        
+        if numpy is not None and len(keys) >= self.NUMPY_MIN_BATCH and \
+                self.partition_shift is None:
+            digest = self.hash_function.digest
+            positions = self._get_positions_numpy([digest(key) for key in keys], 
+                                                  sorted_keys)
+        else:
+            hash_key = self.hash_function.hash
+            positions = self._get_positions_of([hash_key(key) for key in keys], 
+                                               sorted_keys)
+        return [ring[sorted_keys[pos]] for pos in positions]
+    
+    def group_keys(self, keys):
+        """
+        Groups a batch of keys by the node they map to
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: dict(object, list(str))
+        :returns: A mapping from node to the keys it is responsible for 
+        """
+        groups = defaultdict(list)
+        for key, node in zip(keys, self.get_nodes(keys)):
+            groups[node].append(key)
+        return dict(groups)
         
     # -------------------------------------------------
     # Protected methods
     # -------------------------------------------------    
-    def _get_pos(self, hash_key):
+    def _swap(self, ring, sorted_keys, node_tokens, weights):
+        """
+        Replaces the ring and the node weights with a new version
+        """
+        self._snapshot = (ring, sorted_keys, node_tokens)
+        self.weights = weights
+        self.version += 1
+        
+    def _get_pos(self, hash_key, sorted_keys=None):
         """
         Gets the position of a ring in the consistent hash
         
         :Parameters:
             key : long
                 The hash key
+            sorted_keys : list(long)
+                The tokens to search, defaults to the current ones
         :rtype: int
         :returns: The position of the key in the hash ring  
         """
-        pos = None
-        # Find the first key greater than the key of the input string        
-        for ring_pos, pos_val in enumerate(self.sorted_keys):
-            if pos_val >= hash_key:
-                pos = ring_pos
-                break
+        if self.partition_shift is not None:
+            return hash_key >> self.partition_shift
+        if sorted_keys is None:
+            sorted_keys = self.sorted_keys
+            
+        # Find the first key greater than or equal to the key of the input string
+        pos = bisect_left(sorted_keys, hash_key)
 
         # If nothing is greater than loop around and go with the first            
-        if pos is None:
+        if pos == len(sorted_keys):
             pos = 0
         return pos
             
+    def _get_positions(self, digests, sorted_keys=None):
+        """
+        Gets the ring positions of a list of digests one at a time
+        
+        :Parameters:
+            digests : list(str)
+                Digests from the hash function
+            sorted_keys : list(long)
+                The tokens to search, defaults to the current ones
+        :rtype: list(int)
+        :returns: The position of each digest in the hash ring
+        """
+        to_int = self.hash_function.to_int
+        return self._get_positions_of([to_int(digest) for digest in digests], 
+                                      sorted_keys)
+    
+    def _get_positions_of(self, hash_keys, sorted_keys=None):
+        """
+        Gets the ring positions of a list of hash keys one at a time
+        
+        :Parameters:
+            hash_keys : list(int)
+                The hash keys
+            sorted_keys : list(long)
+                The tokens to search, defaults to the current ones
+        :rtype: list(int)
+        :returns: The position of each hash key in the hash ring
+        """
+        if self.partition_shift is not None:
+            shift = self.partition_shift
+            return [hash_key >> shift for hash_key in hash_keys]
+        if sorted_keys is None:
+            sorted_keys = self.sorted_keys
+        num_keys = len(sorted_keys)
+        positions = []
+        for hash_key in hash_keys:
+            pos = bisect_left(sorted_keys, hash_key)
+            positions.append(pos if pos != num_keys else 0)
+        return positions
+    
+    def _get_positions_numpy(self, digests, sorted_keys=None):
+        """
+        Gets the ring positions of a list of digests with numpy.  Tokens and 
+        digests are compared on their high 64 bits, which for hashes of up to
+        64 bits is the whole hash.  For wider hashes the rare digest whose 
+        high bits equal those of its candidate token is resolved exactly.
+        
+        :Parameters:
+            digests : list(str)
+                Digests from the hash function
+            sorted_keys : list(long)
+                The tokens to search, defaults to the current ones
+        :rtype: list(int)
+        :returns: The position of each digest in the hash ring
+        """
+        if not digests:
+            return []
+        if sorted_keys is None:
+            sorted_keys = self.sorted_keys
+        bits = self.hash_function.bits
+        shift = max(bits - 64, 0)
+        
+        # The table is rebuilt the first time a new version of the ring is read
+        batch_table = self._batch_table
+        if batch_table is None or batch_table[0] is not sorted_keys:
+            batch_table = (sorted_keys, 
+                           numpy.array([token >> shift for token in sorted_keys],
+                                       dtype=numpy.uint64))
+            self._batch_table = batch_table
+        token_highs = batch_table[1]
+        num_keys = len(token_highs)
+        
+        width = min(bits // 8, 8)
+        words = numpy.frombuffer(''.join(digests), dtype='>u%s' % width)
+        highs = words.reshape(len(digests), -1)[:, 0].astype(numpy.uint64)
+        positions = numpy.searchsorted(token_highs, highs, side='left')
+
+        # Resolve ties on the high 64 bits against the full token 
+        ties = []
+        if shift:
+            candidates = numpy.minimum(positions, num_keys - 1)
+            ties = numpy.nonzero(token_highs[candidates] == highs)[0].tolist()
+        positions[positions == num_keys] = 0
+        positions = positions.tolist()
+        for i in ties:
+            positions[i] = self._get_positions([digests[i]], sorted_keys)[0]
+        return positions
+            
     def _gen_key(self, key):
         """
-        Given a key returns its long using the md5 hash
+        Given a key returns its hash key
         
         :Parameters:
             key : str
                 A key
         :rtype: long
-        :returns: A long
+        :returns: The hash of the key as an integer
+        """
+        return self.hash_function.hash(key)
+    
+    def _assign_partitions(self, weights):
+        """
+        Deals the partitions out to nodes in proportion to their weights.  
+        Each node ranks every partition by the hash of its name and the 
+        partition number, and the highest ranked (node, partition) pairs are
+        taken first while the node has fewer than its share of Q, rounded 
+        down.  The partitions left over are then taken the same way by nodes
+        holding no more than their share rounded up.  The result depends 
+        only on the nodes and their weights, and a node joining or leaving 
+        moves few partitions beyond its share.
+        
+        :Parameters:
+            weights : dict(object, float)
+                The weight of each node
+        :rtype: tuple(dict, dict)
+        :returns: The node of each partition token and the partition tokens
+                  of each node
+        """
+        tokens = self._partition_tokens
+        if len(weights) > len(tokens):
+            logging.warning('%s nodes share %s partitions, some get none' % 
+                            (len(weights), len(tokens)))
+        total = sum(weights.itervalues())
+        shares = dict((node, int(len(tokens) * weight // total))
+                      for node, weight in weights.iteritems())
+        counts = dict((node, 0) for node in weights)
+        
+        hash_key = self.hash_function.hash
+        ranked = [(hash_key(self.REPLICATION_STR % (node, i)), i, node)
+                  for node in weights for i in xrange(len(tokens))]
+        ranked.sort(reverse=True)
+        
+        owners = [None] * len(tokens)
+        remaining = len(tokens)
+        for extra in (0, 1):
+            for score, i, node in ranked:
+                if not remaining:
+                    break
+                if owners[i] is not None or counts[node] >= shares[node] + extra:
+                    continue
+                owners[i] = node
+                counts[node] += 1
+                remaining -= 1
+        
+        ring = dict(zip(tokens, owners))
+        node_tokens = dict((node, []) for node in weights)
+        for token, node in zip(tokens, owners):
+            node_tokens[node].append(token)
+        return ring, node_tokens
+    
+    def _add_tokens(self, ring, node, start, end):
+        """
+        Places tokens start to end - 1 of a node in a ring
+        
+        :Parameters:
+            ring : dict
+                The ring copy to add the tokens to
+            node : object
+                The node
+            start : int
+            end : int
+                The token numbers
+        :rtype: list(long)
+        :returns: The tokens added, skipping ones that collide
+        """
+        tokens = []
+        for i in xrange(start, end):
+            hash_key = self._get_node_hash_key(node, i)
+            if hash_key in ring:
+                logging.warning('Token of %s collides with %s, skipping it' % 
+                                (node, ring[hash_key]))
+                continue
+            ring[hash_key] = node
+            tokens.append(hash_key)
+        return tokens
+    
+    def _get_token_count(self, weight):
+        """
+        Gets the number of tokens of a node of a given weight, at least one
         """
-        m = md5.new()
-        m.update(key)
-        return long(m.hexdigest(), 16)
+        return max(1, int(round(self.replication_factor * weight)))
+    
+    def _check_weight(self, node, weight):
+        """
+        Ensures a node's weight is a positive number
+        
+        :rtype: float
+        :returns: The weight
+        """
+        if not isinstance(weight, (int, long, float)) or weight <= 0:
+            raise exceptions.ValueError('Weight of %s must be positive, not %r' % 
+                                        (node, weight))
+        return weight
     
     def _is_consistent(self):
         """
@@ -187,7 +663,50 @@ class ConsistentHash(object):
                 The replication number
         """
         if self.strategy == self.STRATEGY1:
-            hash_key = random.randint(0, 2**128)
+            hash_key = random.randint(0, 2**self.hash_function.bits - 1)
         else:             
             hash_key = self._gen_key(self.REPLICATION_STR % (node, rep_num))
         return hash_key           
+
+def _merge_tokens(sorted_keys, tokens):
+    """
+    Merges sorted tokens into a copy of the sorted ring tokens
+    
+    :Parameters:
+        sorted_keys : list(long)
+            The ring's tokens
+        tokens : list(long)
+            The sorted tokens to insert
+    :rtype: list(long)
+    :returns: The merged tokens
+    """
+    merged = []
+    start = 0
+    for token in tokens:
+        pos = bisect_left(sorted_keys, token, start)
+        merged.extend(sorted_keys[start:pos])
+        merged.append(token)
+        start = pos
+    merged.extend(sorted_keys[start:])
+    return merged
+
+def _delete_tokens(sorted_keys, tokens):
+    """
+    Copies the sorted ring tokens without the given tokens
+    
+    :Parameters:
+        sorted_keys : list(long)
+            The ring's tokens
+        tokens : list(long)
+            The sorted tokens to delete, all of which are in the ring
+    :rtype: list(long)
+    :returns: The remaining tokens
+    """
+    remaining = []
+    start = 0
+    for token in tokens:
+        pos = bisect_left(sorted_keys, token, start)
+        remaining.extend(sorted_keys[start:pos])
+        start = pos + 1
+    remaining.extend(sorted_keys[start:])
+    return remaining
@@ -0,0 +1,199 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import exceptions
+import hashlib
+import struct
+import zlib
+
+# -------------------------------------------------
+# Hash functions
+# -------------------------------------------------
+_md5 = hashlib.md5
+_crc32 = zlib.crc32
+_unpack_u32 = struct.Struct('>I').unpack
+_unpack_u64 = struct.Struct('>Q').unpack_from
+_unpack_u128 = struct.Struct('>QQ').unpack
+_pack_u32 = struct.Struct('>I').pack
+
+class HashFunction(object):
+    """
+    A hash function mapping keys onto a ring of 2**bits tokens.  digest 
+    returns the hash as a fixed width big endian string, which sorts like
+    the integer returned by hash.
+    """
+    name = None
+    bits = None
+    
+    def digest(self, key):
+        """
+        :Parameters:
+            key : str
+        :rtype: str
+        :returns: The hash of the key as bits / 8 big endian bytes
+        """
+        raise NotImplementedError()
+    
+    def hash(self, key):
+        """
+        :Parameters:
+            key : str
+        :rtype: int
+        :returns: The hash of the key as an integer below 2**bits
+        """
+        return self.to_int(self.digest(key))
+    
+    def to_int(self, digest):
+        """
+        Converts a digest to its integer
+        """
+        value = 0
+        for word in struct.unpack('>%sI' % (len(digest) // 4), digest):
+            value = (value << 32) | word
+        return value
+    
+    def to_bytes(self, value):
+        """
+        Converts an integer below 2**bits to its digest
+        """
+        return ('%0*x' % (self.bits // 4, value)).decode('hex')
+    
+class MD5(HashFunction):
+    """
+    The 128 bit md5 digest.  The original hash of the ring, kept so 
+    existing rings route keys the same way.
+    """
+    name = 'md5'
+    bits = 128
+    
+    def digest(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        return _md5(key).digest()
+    
+    def hash(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        high, low = _unpack_u128(_md5(key).digest())
+        return (high << 64) | low
+    
+    def to_int(self, digest):
+        high, low = _unpack_u128(digest)
+        return (high << 64) | low
+    
+class MD5_64(HashFunction):
+    """
+    The high 64 bits of the md5 digest.  Tokens fit in a machine word.
+    """
+    name = 'md5_64'
+    bits = 64
+    
+    def digest(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        return _md5(key).digest()[:8]
+    
+    def hash(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        return _unpack_u64(_md5(key).digest())[0]
+    
+    def to_int(self, digest):
+        return _unpack_u64(digest)[0]
+    
+class CRC32(HashFunction):
+    """
+    zlib's crc32.  The cheapest hash, spread well enough for rings of up to
+    a few thousand tokens.
+    """
+    name = 'crc32'
+    bits = 32
+    
+    def digest(self, key):
+        return _pack_u32(self.hash(key))
+    
+    def hash(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        return _crc32(key) & 0xffffffff
+    
+    def to_int(self, digest):
+        return _unpack_u32(digest)[0]
+    
+class Murmur3(HashFunction):
+    """
+    The 32 bit x86 MurmurHash3 with a zero seed, in pure python, so rings 
+    can be shared with clients in other languages.  Slower than the C hashes.
+    """
+    name = 'murmur3'
+    bits = 32
+    
+    def digest(self, key):
+        return _pack_u32(self.hash(key))
+    
+    def hash(self, key):
+        if key.__class__ is unicode:
+            key = key.encode('utf-8')
+        return murmur3_32(key)
+    
+    def to_int(self, digest):
+        return _unpack_u32(digest)[0]
+
+HASH_FUNCTIONS = dict((hash_function.name, hash_function) 
+                      for hash_function in (MD5(), MD5_64(), CRC32(), Murmur3()))
+
+def get_hash_function(name):
+    """
+    Gets a hash function by name
+    
+    :Parameters:
+        name : str
+            md5, md5_64, crc32 or murmur3
+    :rtype: HashFunction
+    :returns: The hash function
+    """
+    if name not in HASH_FUNCTIONS:
+        raise exceptions.ValueError('Unknown hash function %s' % name)
+    return HASH_FUNCTIONS[name]
+
+def murmur3_32(data, seed=0):
+    """
+    The 32 bit x86 MurmurHash3 of a string
+    
+    :Parameters:
+        data : str
+        seed : int
+    :rtype: int
+    :returns: The hash
+    """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    length = len(data)
+    num_blocks = length // 4
+    h = seed
+    
+    for k in struct.unpack('<%sI' % num_blocks, data[:num_blocks * 4]):
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    
+    tail = data[num_blocks * 4:]
+    if tail:
+        k = 0
+        for i in xrange(len(tail) - 1, -1, -1):
+            k = (k << 8) | ord(tail[i])
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+    
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return int(h)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import timeit
+import uuid
+
+from dynamo.lib.consistent_hash.consistent_hash import ConsistentHash
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+TOKEN_COUNTS = [10, 1000, 100000]
+NUM_KEYS = 10000
+REPLICATION = 10
+
+# -------------------------------------------------
+# Benchmark
+# -------------------------------------------------
+def build_ring(num_tokens):
+    """
+    Builds a ring with num_tokens virtual nodes
+    
+    :Parameters:
+        num_tokens : int
+            The number of tokens in the ring
+    :rtype: ConsistentHash
+    :returns: The consistent hash
+    """
+    cons_hash = ConsistentHash(REPLICATION)
+    cons_hash.add_nodes(['10.0.0.%s:20000' % i 
+                         for i in xrange(num_tokens // REPLICATION)])
+    return cons_hash
+    
+def linear_get_node(cons_hash, key):
+    """
+    The original linear scan lookup, used as a baseline
+    """
+    hash_key = cons_hash._gen_key(key)
+    for pos_val in cons_hash.sorted_keys:
+        if pos_val >= hash_key:
+            return cons_hash.ring[pos_val]
+    return cons_hash.ring[cons_hash.sorted_keys[0]]
+
+def run():
+    keys = [str(uuid.uuid4()) for i in xrange(NUM_KEYS)]
+    print '%10s %12s %16s %16s' % ('tokens', 'build (s)', 'bisect keys/s', 
+                                    'linear keys/s')
+    for num_tokens in TOKEN_COUNTS:
+        start = timeit.default_timer()
+        cons_hash = build_ring(num_tokens)
+        build_time = timeit.default_timer() - start
+        
+        start = timeit.default_timer()
+        for key in keys:
+            cons_hash.get_node(key)
+        bisect_rate = NUM_KEYS / (timeit.default_timer() - start)
+
+        # The linear scan is far too slow to run over every key on big rings
+        linear_keys = keys[:max(10, NUM_KEYS * 10 // num_tokens)]
+        start = timeit.default_timer()
+        for key in linear_keys:
+            linear_get_node(cons_hash, key)
+        linear_rate = len(linear_keys) / (timeit.default_timer() - start)
+        
+        print '%10d %12.3f %16.0f %16.0f' % (len(cons_hash), build_time,
+                                              bisect_rate, linear_rate)
+
+if __name__ == '__main__':
+    run()
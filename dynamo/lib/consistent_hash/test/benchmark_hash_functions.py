@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import timeit
+import uuid
+
+from dynamo.lib.consistent_hash import ConsistentHash, HASH_FUNCTIONS
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+NUM_KEYS = 50000
+NUM_NODES = 100
+
+# -------------------------------------------------
+# Benchmark
+# -------------------------------------------------
+def rate(func, keys):
+    start = timeit.default_timer()
+    for key in keys:
+        func(key)
+    return len(keys) / (timeit.default_timer() - start)
+
+def spread(cons_hash, keys):
+    """
+    The share of keys held by the busiest node relative to a perfect split
+    """
+    counts = {}
+    for node in cons_hash.get_nodes(keys):
+        counts[node] = counts.get(node, 0) + 1
+    return max(counts.values()) * NUM_NODES / float(len(keys))
+
+def run():
+    keys = [str(uuid.uuid4()) for i in xrange(NUM_KEYS)]
+    print '%10s %6s %14s %14s %14s %8s' % ('hash', 'bits', 'hash keys/s', 
+                                           'get_node/s', 'get_nodes/s', 'max/avg')
+    for name in sorted(HASH_FUNCTIONS):
+        hash_function = HASH_FUNCTIONS[name]
+        cons_hash = ConsistentHash(hash_function=name)
+        cons_hash.add_nodes(['10.0.0.%s:20000' % i for i in xrange(NUM_NODES)])
+        
+        start = timeit.default_timer()
+        cons_hash.get_nodes(keys)
+        batch_rate = NUM_KEYS / (timeit.default_timer() - start)
+        print '%10s %6d %14.0f %14.0f %14.0f %8.2f' % (
+            name, hash_function.bits, rate(hash_function.hash, keys), 
+            rate(cons_hash.get_node, keys), batch_rate, spread(cons_hash, keys))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import uuid
+from collections import defaultdict
+
+from dynamo.lib.consistent_hash.consistent_hash import ConsistentHash
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+NUM_NODES = 20
+NUM_KEYS = 20000
+REPLICAS = [1, 3]
+TOKENS_PER_NODE = [5, 50]
+PARTITIONS = [256, 1024]
+
+# -------------------------------------------------
+# Load skew
+# -------------------------------------------------
+def build_rings():
+    """
+    Builds a ring for each strategy and setting
+
+    :rtype: list(tuple(str, ConsistentHash))
+    :returns: A description and an empty consistent hash for each ring
+    """
+    rings = []
+    for tokens in TOKENS_PER_NODE:
+        for strategy in (ConsistentHash.DETERMINISTIC, ConsistentHash.STRATEGY1):
+            rings.append(('%s T=%s' % (strategy, tokens),
+                          ConsistentHash(tokens, strategy)))
+    for partitions in PARTITIONS:
+        rings.append(('%s Q=%s' % (ConsistentHash.STRATEGY3, partitions),
+                      ConsistentHash(strategy=ConsistentHash.STRATEGY3,
+                                     partitions=partitions)))
+    return rings
+
+def get_skew(cons_hash, keys, replicas):
+    """
+    Counts the keys each node stores
+
+    :Parameters:
+        cons_hash : ConsistentHash
+            The ring
+        keys : list(str)
+            The keys
+        replicas : int
+            Number of nodes each key is stored on
+    :rtype: tuple(float, float)
+    :returns: The max / mean and min / mean keys per node
+    """
+    counts = defaultdict(int)
+    for key in keys:
+        for node in cons_hash.get_preference_list(key, replicas):
+            counts[node] += 1
+    mean = float(len(keys) * replicas) / len(cons_hash.node_tokens)
+    loads = [counts[node] for node in cons_hash.node_tokens]
+    return max(loads) / mean, min(loads) / mean
+
+def get_moved(cons_hash, keys, node):
+    """
+    Adds a node and counts the keys whose node changed
+
+    :rtype: float
+    :returns: The keys moved over the keys the new node should hold
+    """
+    before = cons_hash.get_nodes(keys)
+    cons_hash.add(node)
+    after = cons_hash.get_nodes(keys)
+    moved = sum(1 for old, new in zip(before, after) if old != new)
+    return moved / (float(len(keys)) / len(cons_hash.node_tokens))
+
+def run():
+    keys = [str(uuid.uuid4()) for i in xrange(NUM_KEYS)]
+    nodes = ['10.0.0.%s:20000' % i for i in xrange(NUM_NODES)]
+    print '%d nodes, %d keys' % (NUM_NODES, NUM_KEYS)
+    print '%-20s %8s %10s %10s %10s' % ('ring', 'replicas', 'max/mean',
+                                         'min/mean', 'join moves')
+    for name, cons_hash in build_rings():
+        cons_hash.add_nodes(nodes)
+        for replicas in REPLICAS:
+            high, low = get_skew(cons_hash, keys, replicas)
+            print '%-20s %8d %10.3f %10.3f' % (name, replicas, high, low)
+
+        # Keys moved by a join, 1.0 being only the new node's share
+        print '%-20s %8s %10s %10s %10.2f' % (name, '', '', '',
+                                              get_moved(cons_hash, keys, 'new:20000'))
+
+if __name__ == '__main__':
+    run()
@@ -3,8 +3,9 @@
 # -------------------------------------------------   
 import exceptions
 import uuid
-from unittest import TestCase
-from dynamite.lib.consistent_hash.consistent_hash import ConsistentHash
+from unittest import TestCase, skipIf
+from dynamo.lib.consistent_hash import consistent_hash, hash_functions
+from dynamo.lib.consistent_hash.consistent_hash import ConsistentHash
 from collections import defaultdict
 
 # -------------------------------------------------
@@ -53,6 +54,44 @@ class TestConsistentHash(TestCase):
           
         self.assertTrue(cons_hash._is_consistent())  
         
+    def test_bulk_membership(self):
+        """
+        Ensures nodes can be added and removed in bulk without changing the
+        snapshots readers already hold
+        """
+        cons_hash = ConsistentHash(5)
+        cons_hash.add_nodes(['10.0.0.%s' % i for i in xrange(4)])
+        ring, sorted_keys, node_tokens = cons_hash.snapshot()
+        version = cons_hash.version
+        
+        added = cons_hash.add_nodes(['10.0.0.4', '10.0.0.5'])
+        self.assertEquals(len(added), 10)
+        self.assertEquals(len(cons_hash), 30)
+        self.assertTrue(cons_hash.version > version)
+        self.assertTrue(cons_hash._is_consistent())
+        self.assertEquals(len(sorted_keys), 20)
+        self.assertEquals(len(ring), 20)
+        
+        removed = cons_hash.remove_nodes(['10.0.0.0', '10.0.0.4', 'missing'])
+        self.assertEquals(len(removed), 10)
+        self.assertEquals(len(cons_hash), 20)
+        self.assertTrue(cons_hash._is_consistent())
+        self.assertFalse('10.0.0.0' in cons_hash.node_tokens)
+        
+    def test_merge_delete_tokens(self):
+        """
+        Ensures tokens are merged into and deleted from sorted token lists
+        """
+        sorted_keys = [2, 4, 6, 8]
+        self.assertEquals(consistent_hash._merge_tokens(sorted_keys, [1, 5, 9]),
+                          [1, 2, 4, 5, 6, 8, 9])
+        self.assertEquals(consistent_hash._merge_tokens([], [1, 3]), [1, 3])
+        self.assertEquals(consistent_hash._delete_tokens(sorted_keys, [2, 8]),
+                          [4, 6])
+        self.assertEquals(consistent_hash._delete_tokens(sorted_keys, []),
+                          sorted_keys)
+        self.assertEquals(sorted_keys, [2, 4, 6, 8])
+        
     def test_get_empty_ring(self):
         """
         Ensures that an exception is thrown when the ring is empty 
@@ -89,5 +128,264 @@ class TestConsistentHash(TestCase):
             self.assertTrue(node in nodes)
             node_counts[node] += 1
 
-        self.assertTrue(cons_hash._is_consistent()) 
+        self.assertTrue(cons_hash._is_consistent())
+
+    def test_add_nodes(self):
+        """
+        Ensures adding several nodes at once builds the same ring as
+        adding them one at a time
+        """
+        nodes = ['192.168.1.1:%s' % port for port in xrange(20000, 20010)]
+        bulk_hash = ConsistentHash(5)
+        bulk_hash.add_nodes(nodes)
+        
+        single_hash = ConsistentHash(5)
+        for node in nodes:
+            single_hash.add(node)
+            
+        self.assertEquals(bulk_hash.sorted_keys, single_hash.sorted_keys)
+        self.assertTrue(bulk_hash._is_consistent())
+        
+    def test_get_pos_wraps_around(self):
+        """
+        Ensures keys past the last token map to the first token and that
+        keys equal to a token map to that token
+        """
+        cons_hash = ConsistentHash(2)
+        cons_hash.add('192.168.1.1')
+        cons_hash.add('192.168.1.2')
+        
+        first, last = cons_hash.sorted_keys[0], cons_hash.sorted_keys[-1]
+        self.assertEquals(cons_hash._get_pos(last + 1), 0)
+        self.assertEquals(cons_hash._get_pos(0), 0)
+        self.assertEquals(cons_hash._get_pos(first), 0)
+        self.assertEquals(cons_hash._get_pos(first + 1), 1)
+        self.assertEquals(cons_hash._get_pos(last), len(cons_hash) - 1)
+
+    def _get_batch_hash(self):
+        cons_hash = ConsistentHash(10, ConsistentHash.STRATEGY1)
+        cons_hash.add_nodes(['192.168.1.1:%s' % port for port in xrange(20000, 20020)])
+        keys = [str(uuid.uuid4()) for i in xrange(500)]
+        keys.extend(['', 'foo', 'foo'])
+        return cons_hash, keys
+        
+    def test_get_nodes_python(self):
+        """
+        Ensures the pure python batch lookup agrees with get_node
+        """
+        cons_hash, keys = self._get_batch_hash()
+        numpy = consistent_hash.numpy
+        consistent_hash.numpy = None
+        try:
+            nodes = cons_hash.get_nodes(keys)
+        finally:
+            consistent_hash.numpy = numpy
+        self.assertEquals(nodes, [cons_hash.get_node(key) for key in keys])
+        
+    @skipIf(consistent_hash.numpy is None, 'numpy is not installed')
+    def test_get_nodes_numpy(self):
+        """
+        Ensures the numpy batch lookup agrees with get_node, including keys 
+        that land exactly on or past the ends of the ring
+        """
+        cons_hash, keys = self._get_batch_hash()
+        cons_hash.NUMPY_MIN_BATCH = 0
+        self.assertEquals(cons_hash.get_nodes(keys), 
+                          [cons_hash.get_node(key) for key in keys])
+        
+        digests = [('%032x' % token).decode('hex') 
+                   for token in (cons_hash.sorted_keys[3], 
+                                 cons_hash.sorted_keys[3] + 1,
+                                 cons_hash.sorted_keys[-1] + 1)]
+        self.assertEquals(cons_hash._get_positions_numpy(digests), [3, 4, 0])
+        self.assertEquals(cons_hash._get_positions(digests), [3, 4, 0])
+        
+    def test_hash_functions(self):
+        """
+        Ensures batch lookups agree with get_node for every hash function
+        """
+        for name in hash_functions.HASH_FUNCTIONS:
+            for strategy in (ConsistentHash.DETERMINISTIC, ConsistentHash.STRATEGY1):
+                cons_hash = ConsistentHash(10, strategy, name)
+                cons_hash.add_nodes(['192.168.1.1:%s' % port for port in xrange(20000, 20020)])
+                keys = [str(uuid.uuid4()) for i in xrange(200)] + ['', 'foo']
+                expected = [cons_hash.get_node(key) for key in keys]
+                
+                self.assertTrue(cons_hash.sorted_keys[-1] < 2 ** cons_hash.hash_function.bits)
+                self.assertEquals(cons_hash._get_positions_of(
+                    [cons_hash._gen_key(key) for key in keys[:5]]), 
+                    [cons_hash._get_pos(cons_hash._gen_key(key)) for key in keys[:5]])
+                if consistent_hash.numpy is not None:
+                    cons_hash.NUMPY_MIN_BATCH = 0
+                    self.assertEquals(cons_hash.get_nodes(keys), expected)
+                cons_hash.NUMPY_MIN_BATCH = len(keys) + 1
+                self.assertEquals(cons_hash.get_nodes(keys), expected)
+        
+    def test_group_keys(self):
+        """
+        Ensures keys are grouped by the node they map to
+        """
+        cons_hash, keys = self._get_batch_hash()
+        groups = cons_hash.group_keys(keys)
+        
+        self.assertEquals(sum(len(group) for group in groups.values()), len(keys))
+        for node, group in groups.items():
+            for key in group:
+                self.assertEquals(cons_hash.get_node(key), node)
+
+    def test_preference_list(self):
+        """
+        Ensures the preference list holds distinct nodes in ring order 
+        starting with the key's node
+        """
+        cons_hash = ConsistentHash(5)
+        nodes = ['192.168.1.1:%s' % port for port in xrange(20000, 20005)]
+        cons_hash.add_nodes(nodes)
+        
+        for i in xrange(100):
+            key = str(uuid.uuid4())
+            pref_list = cons_hash.get_preference_list(key, 3)
+            self.assertEquals(len(pref_list), 3)
+            self.assertEquals(len(set(pref_list)), 3)
+            self.assertEquals(pref_list[0], cons_hash.get_node(key))
+            self.assertEquals(cons_hash.get_preference_list(key, 1), pref_list[:1])
+        
+        # Asking for more replicas than nodes returns every node
+        self.assertEquals(sorted(cons_hash.get_preference_list('foo', 10)), nodes)
+        
+    def test_strategy3(self):
+        """
+        Ensures equal partitions are looked up by shifting the hash and are
+        dealt out evenly
+        """
+        for name in hash_functions.HASH_FUNCTIONS:
+            cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3, 
+                                       hash_function=name, partitions=64)
+            nodes = ['192.168.1.1:%s' % port for port in xrange(20000, 20010)]
+            cons_hash.add_nodes(nodes)
+            self.assertEquals(len(cons_hash), 64)
+            self.assertTrue(cons_hash._is_consistent())
+            self.assertEquals(cons_hash.sorted_keys[-1], 2 ** cons_hash.hash_function.bits - 1)
+            for tokens in cons_hash.node_tokens.values():
+                self.assertTrue(6 <= len(tokens) <= 7)
+            
+            for key in [str(uuid.uuid4()) for i in xrange(200)] + ['', 'foo']:
+                hash_key = cons_hash._gen_key(key)
+                pos = cons_hash._get_pos(hash_key)
+                self.assertTrue(cons_hash.sorted_keys[pos] >= hash_key)
+                self.assertTrue(pos == 0 or cons_hash.sorted_keys[pos - 1] < hash_key)
+
+    def test_strategy3_membership(self):
+        """
+        Ensures a node's partitions depend only on the set of nodes and that
+        membership changes move whole partitions
+        """
+        nodes = ['10.0.0.%s:8000' % i for i in xrange(8)]
+        cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3, partitions=256)
+        cons_hash.add_nodes(nodes[:7])
+        before = dict(cons_hash.ring)
+        
+        added = cons_hash.add_nodes(nodes[7:])
+        after = dict(cons_hash.ring)
+        self.assertEquals(sorted(before), sorted(after))
+        self.assertEquals(added, sorted(cons_hash.node_tokens[nodes[7]]))
+        moved = [token for token in after if before[token] != after[token]]
+        self.assertTrue(len(moved) < 2 * len(added))
+        
+        other = ConsistentHash(strategy=ConsistentHash.STRATEGY3, partitions=256)
+        other.add_nodes(list(reversed(nodes)))
+        self.assertEquals(other.ring, cons_hash.ring)
+        
+        removed = cons_hash.remove_nodes(nodes[7:])
+        self.assertEquals(removed, added)
+        self.assertEquals(cons_hash.ring, before)
+        cons_hash.remove_nodes(nodes[:7])
+        self.assertEquals(len(cons_hash), 0)
+        
+    def test_strategy3_errors(self):
+        """
+        Ensures bad partition counts and mismatched strategies are refused
+        """
+        for partitions in (0, 3, 1000, 2 ** 129):
+            self.assertRaises(exceptions.ValueError, ConsistentHash, 
+                              strategy=ConsistentHash.STRATEGY3, partitions=partitions)
+        cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3, partitions=4)
+        self.assertRaises(exceptions.ValueError, cons_hash.add, 'foo', 
+                          ConsistentHash.STRATEGY1)
+        cons_hash.add('foo', ConsistentHash.STRATEGY3)
+        self.assertEquals(cons_hash.get_node('bar'), 'foo')
+
+    def test_weights(self):
+        """
+        Ensures a node's tokens scale with its weight and that reweighting 
+        only moves the node's own tokens
+        """
+        nodes = ['10.0.0.%s:8000' % i for i in xrange(5)]
+        for strategy in (ConsistentHash.DETERMINISTIC, ConsistentHash.STRATEGY1):
+            cons_hash = ConsistentHash(4, strategy)
+            cons_hash.add_nodes(nodes, {nodes[0]: 2.5})
+            cons_hash.add('big', weight=3)
+            self.assertEquals(len(cons_hash.node_tokens[nodes[0]]), 10)
+            self.assertEquals(len(cons_hash.node_tokens[nodes[1]]), 4)
+            self.assertEquals(len(cons_hash.node_tokens['big']), 12)
+            self.assertEquals(cons_hash.weights[nodes[1]], 1)
+            before = cons_hash.ring
+            
+            changed = cons_hash.set_weights({'big': 0.5, nodes[1]: 2})
+            self.assertTrue(cons_hash._is_consistent())
+            self.assertEquals(len(changed), 14)
+            self.assertEquals(len(cons_hash.node_tokens['big']), 2)
+            self.assertEquals(len(cons_hash.node_tokens[nodes[1]]), 8)
+            for token in set(before) | set(cons_hash.ring):
+                if before.get(token) != cons_hash.ring.get(token):
+                    self.assertTrue(token in changed)
+                    self.assertTrue(before.get(token, cons_hash.ring.get(token)) 
+                                    in ('big', nodes[1]))
             
+            cons_hash.remove('big')
+            self.assertFalse('big' in cons_hash.weights)
+        
+        # Deterministic tokens only depend on the node and its weight
+        cons_hash = ConsistentHash(4)
+        cons_hash.add_nodes(nodes)
+        cons_hash.set_weights({nodes[0]: 2.5, nodes[1]: 3})
+        cons_hash.set_weights({nodes[1]: 2})
+        other = ConsistentHash(4)
+        other.add_nodes(nodes, {nodes[0]: 2.5, nodes[1]: 2})
+        self.assertEquals(other.ring, cons_hash.ring)
+        self.assertEquals(other.sorted_keys, cons_hash.sorted_keys)
+        
+    def test_strategy3_weights(self):
+        """
+        Ensures partitions are dealt out in proportion to the weights
+        """
+        nodes = ['10.0.0.%s:8000' % i for i in xrange(4)]
+        cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3, partitions=256)
+        cons_hash.add_nodes(nodes, {nodes[0]: 4})
+        self.assertEquals(len(cons_hash.node_tokens[nodes[0]]), 146)
+        for node in nodes[1:]:
+            self.assertTrue(36 <= len(cons_hash.node_tokens[node]) <= 37)
+        
+        before = cons_hash.ring
+        changed = cons_hash.set_weights({nodes[1]: 4})
+        self.assertEquals(changed, [token for token in sorted(before) 
+                                    if before[token] != cons_hash.ring[token]])
+        self.assertEquals(len(cons_hash.node_tokens[nodes[1]]), 102)
+        
+        other = ConsistentHash(strategy=ConsistentHash.STRATEGY3, partitions=256)
+        other.add_nodes(nodes, {nodes[0]: 4, nodes[1]: 4})
+        self.assertEquals(other.ring, cons_hash.ring)
+        
+    def test_bad_weights(self):
+        """
+        Ensures weights must be positive and nodes must exist to be reweighted
+        """
+        cons_hash = ConsistentHash(2)
+        for weight in (0, -1, 'heavy', None):
+            self.assertRaises(exceptions.ValueError, cons_hash.add, 'foo', 
+                              weight=weight)
+        self.assertEquals(len(cons_hash), 0)
+        cons_hash.add('foo')
+        self.assertRaises(exceptions.ValueError, cons_hash.set_weights, {'bar': 2})
+        self.assertRaises(exceptions.ValueError, cons_hash.set_weights, {'foo': 0})
+        self.assertEquals(cons_hash.weights, {'foo': 1})
@@ -0,0 +1,54 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------   
+import md5
+from unittest import TestCase
+
+from dynamo.lib.consistent_hash import HASH_FUNCTIONS, get_hash_function
+from dynamo.lib.consistent_hash.hash_functions import murmur3_32
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestHashFunctions(TestCase):
+    KEYS = ['', 'a', 'foo', 'abcd', 'abcdefg', '192.168.1.1:20000-3', u'caf\xe9']
+    
+    def test_digests(self):
+        """
+        Ensures every hash's digest is its integer in bits / 8 big endian bytes
+        """
+        for hash_function in HASH_FUNCTIONS.values():
+            for key in self.KEYS:
+                value = hash_function.hash(key)
+                digest = hash_function.digest(key)
+                self.assertTrue(0 <= value < 2 ** hash_function.bits)
+                self.assertEquals(len(digest), hash_function.bits // 8)
+                self.assertEquals(hash_function.to_int(digest), value)
+                self.assertEquals(hash_function.to_bytes(value), digest)
+                
+    def test_md5_compatible(self):
+        """
+        Ensures the md5 hash places keys where the original ring did
+        """
+        hash_function = get_hash_function('md5')
+        for key in self.KEYS[:-1]:
+            self.assertEquals(hash_function.hash(key), long(md5.new(key).hexdigest(), 16))
+        self.assertEquals(get_hash_function('md5_64').hash('foo'), 
+                          hash_function.hash('foo') >> 64)
+            
+    def test_murmur3(self):
+        """
+        Checks murmur3 against the reference implementation's outputs
+        """
+        self.assertEquals(murmur3_32(''), 0)
+        self.assertEquals(murmur3_32('', 1), 0x514e28b7)
+        self.assertEquals(murmur3_32('abc'), 0xb3dd93fa)
+        self.assertEquals(murmur3_32('hello'), 0x248bfa47)
+        self.assertEquals(murmur3_32('The quick brown fox jumps over the lazy dog'), 
+                          0x2e4ff723)
+        
+    def test_unknown(self):
+        """
+        Ensures an unknown hash function is rejected
+        """
+        self.assertRaises(ValueError, get_hash_function, 'sha1')
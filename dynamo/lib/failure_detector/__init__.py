@@ -0,0 +1 @@
+from failure_detector import PhiAccrualFailureDetector
\ No newline at end of file
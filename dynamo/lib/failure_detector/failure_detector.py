@@ -0,0 +1,160 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import math
+from collections import deque
+
+# -------------------------------------------------
+# Phi accrual failure detector
+# -------------------------------------------------
+class PhiAccrualFailureDetector(object):
+    """
+    The phi accrual failure detector of Hayashibara et al.  Rather than a
+    verdict it gives each node a suspicion level, phi, from how overdue its
+    next heartbeat is given the intervals between its last heartbeats: the
+    chance that a heartbeat this late still comes is 10 ** -phi.  A node is
+    suspected once its phi passes threshold, so the threshold trades the
+    time taken to notice a failure against the rate of false suspicions,
+    whatever the heartbeat interval or the network's jitter.
+
+    The intervals are taken to be normally distributed, with the mean and
+    standard deviation of the last max_samples.  The first heartbeat of a
+    node seeds its history with first_interval, so a node that never sends
+    another is suspected too.
+
+    Not thread safe; callers hold their own lock.
+    """
+    def __init__(self, threshold=8.0, max_samples=200, min_std_deviation=0.5,
+                 acceptable_pause=0.0, first_interval=1.0):
+        """
+        :Parameters:
+            threshold : float
+                The phi past which a node is suspected
+            max_samples : int
+                Number of intervals kept for each node
+            min_std_deviation : float
+                Smallest standard deviation used, in seconds, so heartbeats
+                that arrived like clockwork do not make a small delay
+                suspicious
+            acceptable_pause : float
+                Seconds added to the mean interval, for pauses that should
+                not raise suspicion
+            first_interval : float
+                Seconds expected between heartbeats before any were seen
+        """
+        self.threshold = threshold
+        self.max_samples = max_samples
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self.histories = {}
+
+    def __contains__(self, node):
+        return node in self.histories
+
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def heartbeat(self, node, now):
+        """
+        Records a heartbeat of a node
+
+        :Parameters:
+            node : str
+                The node name
+            now : float
+                The time the heartbeat arrived, in seconds
+        """
+        history = self.histories.get(node)
+        if history is None:
+            history = _History(self.max_samples)
+            history.add(self.first_interval - self.first_interval / 4)
+            history.add(self.first_interval + self.first_interval / 4)
+            self.histories[node] = history
+        elif now > history.last:
+            history.add(now - history.last)
+        history.last = max(now, history.last)
+
+    def phi(self, node, now):
+        """
+        :Parameters:
+            node : str
+                The node name
+            now : float
+                The current time, in seconds
+        :rtype: float
+        :returns: The suspicion level of the node, 0 if it never sent a
+                  heartbeat
+        """
+        history = self.histories.get(node)
+        if history is None:
+            return 0.0
+        mean, std_deviation = history.get_stats()
+        return get_phi(now - history.last, mean + self.acceptable_pause,
+                       max(std_deviation, self.min_std_deviation))
+
+    def is_available(self, node, now):
+        """
+        :rtype: bool
+        :returns: True if the node's phi is within the threshold
+        """
+        return self.phi(node, now) < self.threshold
+
+    def remove(self, node):
+        """
+        Forgets the heartbeats of a node
+        """
+        self.histories.pop(node, None)
+
+class _History(object):
+    """
+    The last intervals between the heartbeats of a node, with running sums
+    """
+    __slots__ = ('intervals', 'total', 'squares', 'last')
+
+    def __init__(self, max_samples):
+        self.intervals = deque(maxlen=max_samples)
+        self.total = 0.0
+        self.squares = 0.0
+        self.last = 0.0
+
+    def add(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            dropped = self.intervals[0]
+            self.total -= dropped
+            self.squares -= dropped * dropped
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+    def get_stats(self):
+        """
+        :rtype: tuple(float, float)
+        :returns: The mean and standard deviation of the intervals
+        """
+        count = len(self.intervals)
+        mean = self.total / count
+        return mean, math.sqrt(max(self.squares / count - mean * mean, 0.0))
+
+# -------------------------------------------------
+# Functions
+# -------------------------------------------------
+def get_phi(elapsed, mean, std_deviation):
+    """
+    Gets -log10 of the chance that a normally distributed interval is longer
+    than elapsed, with the logistic approximation of the normal cdf
+
+    :Parameters:
+        elapsed : float
+            Seconds since the last heartbeat
+        mean : float
+        std_deviation : float
+            Of the intervals between heartbeats
+    :rtype: float
+    """
+    # Past these bounds the exponential overflows or the chance rounds to 0
+    y = min(max((elapsed - mean) / std_deviation, -10.0), 20.0)
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if elapsed > mean:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
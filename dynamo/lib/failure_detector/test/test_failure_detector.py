@@ -0,0 +1,64 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+from unittest import TestCase
+
+from dynamo.lib.failure_detector import PhiAccrualFailureDetector
+from dynamo.lib.failure_detector.failure_detector import get_phi
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestPhiAccrualFailureDetector(TestCase):
+    def test_phi(self):
+        """
+        Ensures phi grows the longer a heartbeat is overdue, is small while
+        heartbeats keep arriving and stays finite however late they are
+        """
+        self.assertTrue(get_phi(0.5, 1.0, 0.2) < 0.01)
+        self.assertAlmostEquals(get_phi(1.0, 1.0, 0.2), 0.3, 1)
+        self.assertTrue(get_phi(1.4, 1.0, 0.2) < get_phi(1.6, 1.0, 0.2) <
+                        get_phi(2.0, 1.0, 0.2))
+        self.assertTrue(100 < get_phi(1000.0, 1.0, 0.2) < 1000)
+        self.assertEquals(get_phi(-1000.0, 1.0, 0.2), 0.0)
+
+    def test_suspect(self):
+        """
+        Ensures a node is suspected once its heartbeats stop, and that the
+        threshold is reached sooner for a node whose heartbeats were regular
+        """
+        detector = PhiAccrualFailureDetector(threshold=8.0, min_std_deviation=0.1)
+        self.assertEquals(detector.phi('a', 0.0), 0.0)
+        for i in xrange(20):
+            detector.heartbeat('a', float(i))
+            detector.heartbeat('b', i + (0.5 if i % 2 else -0.5))
+        self.assertTrue(detector.is_available('a', 19.5))
+        self.assertTrue(detector.is_available('b', 20.0))
+        self.assertFalse(detector.is_available('a', 21.0))
+        self.assertTrue(detector.is_available('b', 21.0))
+        self.assertFalse(detector.is_available('b', 30.0))
+
+        detector.heartbeat('a', 25.0)
+        self.assertTrue(detector.is_available('a', 25.5))
+        detector.remove('a')
+        self.assertFalse('a' in detector)
+
+    def test_first_heartbeat(self):
+        """
+        Ensures a node that sent one heartbeat is suspected once it is long
+        overdue by the first interval
+        """
+        detector = PhiAccrualFailureDetector(first_interval=1.0, min_std_deviation=0.1)
+        detector.heartbeat('a', 100.0)
+        self.assertTrue(detector.is_available('a', 101.0))
+        self.assertFalse(detector.is_available('a', 105.0))
+
+    def test_acceptable_pause(self):
+        """
+        Ensures an acceptable pause delays the suspicion by as much
+        """
+        detector = PhiAccrualFailureDetector(acceptable_pause=3.0, min_std_deviation=0.1)
+        for i in xrange(10):
+            detector.heartbeat('a', float(i))
+        self.assertTrue(detector.is_available('a', 12.0))
+        self.assertFalse(detector.is_available('a', 15.0))
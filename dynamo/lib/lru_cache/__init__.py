@@ -0,0 +1 @@
+from lru_cache import LRUCache
\ No newline at end of file
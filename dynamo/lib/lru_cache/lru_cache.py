@@ -0,0 +1,179 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+from collections import OrderedDict
+
+# -------------------------------------------------
+# LRU cache
+# -------------------------------------------------
+class LRUCache(object):
+    """
+    A thread safe cache bounded by its number of entries and the total 
+    length of its values.  The least recently used entries are evicted 
+    first.
+    
+    Readers that fill the cache from a slower store call reserve() before
+    reading the store and fill() with the value read.  invalidate() drops
+    any reservations of the key, so a value read before a concurrent write
+    is never cached after the write has invalidated the key.
+    """
+    MISSING = object()
+    
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, 
+                 max_value_bytes=None, sizeof=None):
+        """
+        :Parameters:
+            max_entries : int
+                Maximum number of entries
+            max_bytes : int
+                Maximum total length of the cached values
+            max_value_bytes : int
+                Maximum length of a cached value, defaults to max_bytes
+            sizeof : function
+                Gets the length of a value, len by default with None 0
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_value_bytes = max_value_bytes or max_bytes
+        if sizeof is not None:
+            self._size = sizeof
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._reservations = {}
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self.entries)
+    
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def get(self, key):
+        """
+        Gets a key and marks it as the most recently used
+        
+        :Parameters:
+            key : str
+        :rtype: object
+        :returns: The cached value, LRUCache.MISSING if the key is not cached
+        """
+        with self._lock:
+            value = self.entries.pop(key, self.MISSING)
+            if value is self.MISSING:
+                self.misses += 1
+            else:
+                self.entries[key] = value
+                self.hits += 1
+            return value
+        
+    def reserve(self, key):
+        """
+        Reserves a key before reading its value from the store
+        
+        :Parameters:
+            key : str
+        :rtype: object
+        :returns: A token to pass to fill
+        """
+        token = object()
+        with self._lock:
+            self._reservations[key] = token
+        return token
+    
+    def fill(self, key, value, token):
+        """
+        Caches a value read from the store, unless the key was invalidated 
+        or reserved again since token was taken
+        
+        :Parameters:
+            key : str
+            value : str
+                The value, None for a key that does not exist
+            token : object
+                The token returned by reserve
+        :rtype: bool
+        :returns: True if the value was cached
+        """
+        with self._lock:
+            if self._reservations.get(key) is not token:
+                return False
+            del self._reservations[key]
+            self._put(key, value)
+            return True
+        
+    def put(self, key, value):
+        """
+        Caches a value
+        
+        :Parameters:
+            key : str
+            value : str
+        """
+        with self._lock:
+            self._put(key, value)
+            
+    def invalidate(self, key):
+        """
+        Drops a key and its reservations
+        
+        :Parameters:
+            key : str
+        """
+        with self._lock:
+            self._reservations.pop(key, None)
+            value = self.entries.pop(key, self.MISSING)
+            if value is not self.MISSING:
+                self.num_bytes -= self._size(value)
+                self.invalidations += 1
+                
+    def clear(self):
+        """
+        Drops all keys
+        """
+        with self._lock:
+            self._reservations.clear()
+            self.entries.clear()
+            self.num_bytes = 0
+            
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The hit, miss, eviction and invalidation counts and the
+                  number of entries and bytes cached
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries),
+                    'bytes': self.num_bytes}
+        
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _put(self, key, value):
+        """
+        Caches a value and evicts until the cache is within its bounds.  
+        Values larger than max_value_bytes are not cached.
+        """
+        old = self.entries.pop(key, self.MISSING)
+        if old is not self.MISSING:
+            self.num_bytes -= self._size(old)
+        size = self._size(value)
+        if size > self.max_value_bytes:
+            return
+        self.entries[key] = value
+        self.num_bytes += size
+        while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= self._size(evicted)
+            self.evictions += 1
+            
+    def _size(self, value):
+        return len(value) if value is not None else 0
@@ -0,0 +1,100 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+from unittest import TestCase
+
+from dynamo.lib.lru_cache import LRUCache
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestLRUCache(TestCase):
+    def test_get_put(self):
+        """
+        Ensures cached values are returned and counted
+        """
+        cache = LRUCache()
+        self.assertTrue(cache.get('foo') is LRUCache.MISSING)
+        cache.put('foo', 'bar')
+        cache.put('missing', None)
+        self.assertEquals(cache.get('foo'), 'bar')
+        self.assertEquals(cache.get('missing'), None)
+        self.assertEquals(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 0,
+                                          'invalidations': 0, 'entries': 2, 
+                                          'bytes': 3})
+        
+    def test_evicts_least_recently_used(self):
+        """
+        Ensures the least recently used entry is evicted at max_entries
+        """
+        cache = LRUCache(max_entries=2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        cache.get('a')
+        cache.put('c', '3')
+        self.assertTrue(cache.get('b') is LRUCache.MISSING)
+        self.assertEquals(cache.get('a'), '1')
+        self.assertEquals(cache.get('c'), '3')
+        self.assertEquals(cache.stats()['evictions'], 1)
+        
+    def test_max_bytes(self):
+        """
+        Ensures entries are evicted to stay under max_bytes and values over
+        max_value_bytes are not cached
+        """
+        cache = LRUCache(max_bytes=10, max_value_bytes=6)
+        cache.put('a', 'x' * 5)
+        cache.put('b', 'x' * 5)
+        cache.put('a', 'x' * 2)
+        self.assertEquals(cache.stats()['bytes'], 7)
+        cache.put('c', 'x' * 6)
+        self.assertTrue(cache.get('b') is LRUCache.MISSING)
+        self.assertEquals(len(cache), 2)
+        cache.put('d', 'x' * 7)
+        self.assertTrue(cache.get('d') is LRUCache.MISSING)
+        self.assertEquals(cache.stats()['bytes'], 8)
+
+        cache = LRUCache(max_bytes=10, sizeof=lambda values: sum(map(len, values)))
+        cache.put('a', ['x' * 3, 'x' * 4])
+        cache.put('b', [])
+        self.assertEquals(cache.stats()['bytes'], 7)
+        cache.put('c', ['x' * 4])
+        self.assertTrue(cache.get('a') is LRUCache.MISSING)
+        self.assertEquals(cache.stats()['bytes'], 4)
+
+    def test_invalidate(self):
+        """
+        Ensures invalidated keys are dropped
+        """
+        cache = LRUCache()
+        cache.put('foo', 'bar')
+        cache.invalidate('foo')
+        cache.invalidate('other')
+        self.assertTrue(cache.get('foo') is LRUCache.MISSING)
+        self.assertEquals(cache.stats()['invalidations'], 1)
+        self.assertEquals(cache.stats()['bytes'], 0)
+        
+    def test_fill_after_invalidate(self):
+        """
+        Ensures a value read before an invalidation is not cached
+        """
+        cache = LRUCache()
+        token = cache.reserve('foo')
+        cache.invalidate('foo')
+        self.assertFalse(cache.fill('foo', 'stale', token))
+        self.assertTrue(cache.get('foo') is LRUCache.MISSING)
+        
+        token = cache.reserve('foo')
+        self.assertTrue(cache.fill('foo', 'fresh', token))
+        self.assertFalse(cache.fill('foo', 'again', token))
+        self.assertEquals(cache.get('foo'), 'fresh')
+        
+    def test_fill_after_reserve(self):
+        """
+        Ensures only the latest reservation of a key fills it
+        """
+        cache = LRUCache()
+        first = cache.reserve('foo')
+        second = cache.reserve('foo')
+        self.assertFalse(cache.fill('foo', 'first', first))
+        self.assertTrue(cache.fill('foo', 'second', second))
@@ -0,0 +1 @@
+from merkle_tree import MerkleTree
\ No newline at end of file
@@ -0,0 +1,145 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+
+# -------------------------------------------------
+# Merkle tree
+# -------------------------------------------------
+class MerkleTree(object):
+    """
+    A hash tree over the keys of a (start, end] range of a ring of 2**bits
+    tokens.  The range is split into 2**depth equal leaves and a key falls 
+    in the leaf of its token.
+    
+    Every key has a 64 bit entry hash, e.g. of its value.  The hash of a 
+    leaf is the xor of its keys' entry hashes and the hash of an inner node
+    the xor of its children's, so updating a key changes one hash per level
+    and two trees can be compared from the root down, visiting only the 
+    subtrees whose hashes differ.  Levels are numbered from the root, 0, to
+    the leaves, depth.
+    """
+    def __init__(self, start, end, bits=128, depth=10):
+        """
+        :Parameters:
+            start : long
+                The token the range starts after
+            end : long
+                The last token of the range, at or below start if the range
+                wraps past the top of the ring
+            bits : int
+                The number of bits of the ring's tokens
+            depth : int
+                The number of levels below the root
+        """
+        self.start = start
+        self.end = end
+        self.ring_size = 2 ** bits
+        self.size = (end - start) % self.ring_size or self.ring_size
+        self.depth = depth
+        self.num_leaves = 2 ** depth
+        self.levels = [[0] * (2 ** level) for level in xrange(depth + 1)]
+        self.leaves = [{} for i in xrange(self.num_leaves)]
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return sum(len(leaf) for leaf in self.leaves)
+    
+    @property
+    def root(self):
+        """
+        The hash of the whole range
+        """
+        return self.levels[0][0]
+    
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def get_leaf(self, token):
+        """
+        :Parameters:
+            token : long
+                A token in the range
+        :rtype: int
+        :returns: The index of the token's leaf
+        """
+        offset = (token - self.start - 1) % self.ring_size
+        return int(offset * self.num_leaves // self.size)
+    
+    def update(self, key, token, entry_hash):
+        """
+        Sets the entry hash of a key
+        
+        :Parameters:
+            key : str
+                The key
+            token : long
+                The key's token
+            entry_hash : long
+                The new entry hash, None to remove the key
+        """
+        index = self.get_leaf(token)
+        with self._lock:
+            leaf = self.leaves[index]
+            if entry_hash is None:
+                delta = leaf.pop(key, 0)
+            else:
+                delta = leaf.get(key, 0) ^ entry_hash
+                leaf[key] = entry_hash
+            if not delta:
+                return
+            for level in reversed(self.levels):
+                level[index] ^= delta
+                index >>= 1
+                
+    def get_hashes(self, level, indexes):
+        """
+        Gets the hashes of nodes of a level
+        
+        :Parameters:
+            level : int
+                The level, 0 for the root
+            indexes : list(int)
+                The nodes of the level
+        :rtype: list(long)
+        :returns: The hash of each node
+        """
+        hashes = self.levels[level]
+        return [hashes[index] for index in indexes]
+    
+    def get_keys(self, leaves):
+        """
+        Gets the entry hashes of the keys of leaves
+        
+        :Parameters:
+            leaves : list(int)
+                The leaf indexes
+        :rtype: dict(str, long)
+        :returns: The entry hash of each key in the leaves
+        """
+        keys = {}
+        with self._lock:
+            for index in leaves:
+                keys.update(self.leaves[index])
+        return keys
+    
+    def diff(self, level, indexes, hashes):
+        """
+        Compares nodes of a level with another tree's
+        
+        :Parameters:
+            level : int
+                The level
+            indexes : list(int)
+                The nodes compared
+            hashes : list(long)
+                The other tree's hashes of the nodes
+        :rtype: list(int)
+        :returns: The children of the nodes that differ, or the differing 
+                  leaves if level is the leaf level
+        """
+        differing = [index for index, other in 
+                     zip(indexes, hashes) if self.levels[level][index] != other]
+        if level == self.depth:
+            return differing
+        return [child for index in differing for child in (2 * index, 2 * index + 1)]
@@ -0,0 +1,80 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+from unittest import TestCase
+
+from dynamo.lib.merkle_tree import MerkleTree
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestMerkleTree(TestCase):
+    def _fill(self, tree, n=200):
+        step = tree.size // n
+        for i in xrange(n):
+            tree.update('key%s' % i, (tree.start + 1 + i * step) % tree.ring_size, 
+                        hash('value%s' % i) & 0xffffffffffffffff)
+        return step
+        
+    def test_get_leaf(self):
+        """
+        Ensures the tokens of a range, wrapping or not, map onto every leaf
+        """
+        tree = MerkleTree(100, 1124, bits=16, depth=4)
+        self.assertEquals(tree.get_leaf(101), 0)
+        self.assertEquals(tree.get_leaf(1124), 15)
+        self.assertEquals(tree.get_leaf(164), 0)
+        self.assertEquals(tree.get_leaf(165), 1)
+        
+        tree = MerkleTree(2 ** 16 - 8, 8, bits=16, depth=1)
+        self.assertEquals(tree.get_leaf(2 ** 16 - 7), 0)
+        self.assertEquals(tree.get_leaf(0), 0)
+        self.assertEquals(tree.get_leaf(1), 1)
+        self.assertEquals(tree.get_leaf(8), 1)
+        
+        tree = MerkleTree(5, 5, bits=16, depth=2)
+        self.assertEquals(tree.size, 2 ** 16)
+        self.assertEquals(tree.get_leaf(5), 3)
+        self.assertEquals(tree.get_leaf(6), 0)
+        
+    def test_update(self):
+        """
+        Ensures hashes follow updates and removals of keys
+        """
+        tree = MerkleTree(0, 0, bits=32, depth=3)
+        self.assertEquals(tree.root, 0)
+        tree.update('foo', 10, 5)
+        tree.update('bar', 2 ** 31 + 1, 3)
+        self.assertEquals(tree.root, 6)
+        self.assertEquals(tree.get_hashes(1, [0, 1]), [5, 3])
+        self.assertEquals(tree.get_hashes(3, [0, 4]), [5, 3])
+        tree.update('foo', 10, 9)
+        self.assertEquals(tree.root, 10)
+        tree.update('foo', 10, None)
+        tree.update('missing', 10, None)
+        self.assertEquals(tree.root, 3)
+        self.assertEquals(len(tree), 1)
+        self.assertEquals(tree.get_keys([4]), {'bar': 3})
+        
+    def test_diff(self):
+        """
+        Ensures walking two trees from the root visits only differing 
+        subtrees and finds the differing leaves
+        """
+        tree = MerkleTree(2 ** 63, 2 ** 62, bits=64, depth=8)
+        other = MerkleTree(2 ** 63, 2 ** 62, bits=64, depth=8)
+        step = self._fill(tree)
+        self._fill(other)
+        token = 2 ** 63 + 1 + 150 * step
+        other.update('key150', token, 12345)
+        
+        level, indexes, visited = 0, [0], 0
+        while True:
+            visited += len(indexes)
+            indexes = tree.diff(level, indexes, other.get_hashes(level, indexes))
+            if level == tree.depth or not indexes:
+                break
+            level += 1
+        self.assertEquals(indexes, [tree.get_leaf(token)])
+        self.assertEquals(visited, 1 + 2 * tree.depth)
+        self.assertEquals(tree.diff(0, [0], [tree.root]), [])
@@ -0,0 +1 @@
+from metrics import Histogram, Counter, Metrics, MetricsServer
\ No newline at end of file
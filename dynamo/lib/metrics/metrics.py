@@ -0,0 +1,441 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import BaseHTTPServer
+import functools
+import logging
+import threading
+import time
+from collections import deque
+
+# -------------------------------------------------
+# Histogram
+# -------------------------------------------------
+class Histogram(object):
+    """
+    A latency histogram with HDR style log-linear buckets over whole
+    microseconds.  Values below 2 ** precision get a bucket each; above,
+    every power of two is split into 2 ** (precision - 1) buckets, so a
+    quantile is within 2 ** (1 - precision) of the true value, 1.6% with the
+    default precision, from 1us up to HIGHEST_BITS.
+
+    Recording only appends the value to a queue, which is thread safe
+    without a lock.  The queue is folded into the buckets by the recorder
+    that fills it to FOLD_SIZE, and before the buckets are read, so the cost
+    of bucketing is amortized and the lock is taken once per fold.
+    """
+    HIGHEST_BITS = 36
+    FOLD_SIZE = 1024
+    QUANTILES = ((0.5, 'p50'), (0.9, 'p90'), (0.99, 'p99'), (0.999, 'p999'))
+
+    def __init__(self, precision=7):
+        """
+        :Parameters:
+            precision : int
+                Number of significant bits kept of each value
+        """
+        self.precision = precision
+        self.highest = (1 << self.HIGHEST_BITS) - 1
+        self.counts = [0] * ((self.HIGHEST_BITS - precision + 2) << (precision - 1))
+        self.count = 0
+        self.total = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def record(self, micros):
+        """
+        Records a value
+
+        :Parameters:
+            micros : int
+                The value in microseconds.  Values past HIGHEST_BITS are
+                counted as the highest value.
+        """
+        pending = self._pending
+        pending.append(micros)
+        if len(pending) >= self.FOLD_SIZE:
+            self._fold()
+
+    def record_since(self, start, _time=time.time):
+        """
+        Records the time elapsed since start
+
+        :Parameters:
+            start : float
+                A time.time() taken before the timed operation
+        """
+        pending = self._pending
+        pending.append(int((_time() - start) * 1000000))
+        if len(pending) >= self.FOLD_SIZE:
+            self._fold()
+
+    def get_quantiles(self, quantiles):
+        """
+        :Parameters:
+            quantiles : list(float)
+                The quantiles, in ascending order, between 0 and 1
+        :rtype: list(int)
+        :returns: The value of each quantile in microseconds, the middle of
+                  its bucket, 0 if nothing was recorded
+        """
+        self._fold()
+        with self._lock:
+            if not self.count:
+                return [0] * len(quantiles)
+            values = []
+            seen = 0
+            index = -1
+            for quantile in quantiles:
+                rank = max(int(quantile * self.count + 0.5), 1)
+                while seen < rank:
+                    index += 1
+                    seen += self.counts[index]
+                low, high = self._get_range(index)
+                values.append((low + high) // 2)
+            return values
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The count of values and their sum in seconds, and their
+                  min, max and quantiles in seconds, the min and max within
+                  the precision of their buckets
+        """
+        values = self.get_quantiles([0.0] + [quantile for quantile, name 
+                                             in self.QUANTILES] + [1.0])
+        with self._lock:
+            stats = {'count': _to_rpc(self.count),
+                     'sum': self.total / 1e6,
+                     'min': values[0] / 1e6,
+                     'max': values[-1] / 1e6}
+        for (quantile, name), value in zip(self.QUANTILES, values[1:-1]):
+            stats[name] = value / 1e6
+        return stats
+
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _fold(self):
+        """
+        Moves the recorded values into the buckets
+        """
+        with self._lock:
+            pending = self._pending
+            counts = self.counts
+            shift_bits = self.precision
+            half_bits = self.precision - 1
+            highest = self.highest
+            total = 0
+            num = len(pending)
+            for i in xrange(num):
+                value = pending.popleft()
+                if not 0 <= value <= highest:
+                    value = 0 if value < 0 else highest
+                shift = value.bit_length() - shift_bits
+                if shift <= 0:
+                    counts[value] += 1
+                else:
+                    counts[(shift << half_bits) + (value >> shift)] += 1
+                total += value
+            self.count += num
+            self.total += total
+
+    def _get_range(self, index):
+        """
+        :rtype: tuple(int, int)
+        :returns: The lowest and highest value counted in a bucket
+        """
+        if index < 1 << self.precision:
+            return index, index
+        half = 1 << (self.precision - 1)
+        shift = (index >> (self.precision - 1)) - 1
+        low = ((index & (half - 1)) | half) << shift
+        return low, low + (1 << shift) - 1
+
+# -------------------------------------------------
+# Counter
+# -------------------------------------------------
+class Counter(object):
+    """
+    A thread safe count of events or bytes
+    """
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount=1):
+        """
+        Adds to the count
+        """
+        with self._lock:
+            self.value += amount
+
+# -------------------------------------------------
+# Registry
+# -------------------------------------------------
+class Metrics(object):
+    """
+    The histograms and counters of a server, each named and labelled, and
+    sources of other counters.  Series are created once, when the code they
+    measure is set up, and kept by their callers, so recording a sample
+    does not look anything up.
+
+    Histograms hold latencies and are exported in seconds with the suffix
+    _seconds, counters with the suffix _total.  A source is a function that
+    returns a dict of counters kept elsewhere, e.g. LRUCache.stats, which is
+    called when the metrics are read.
+    """
+    def __init__(self, prefix='dynamo'):
+        """
+        :Parameters:
+            prefix : str
+                Prefix of the names exported to Prometheus
+        """
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def histogram(self, name, **labels):
+        """
+        Gets a histogram, creating it the first time
+
+        :Parameters:
+            name : str
+                The histogram name
+            labels : dict(str, str)
+                The labels of the series
+        :rtype: Histogram
+        """
+        return self._get_series(self.histograms, Histogram, name, labels)
+
+    def counter(self, name, **labels):
+        """
+        Gets a counter, creating it the first time
+
+        :Parameters:
+            name : str
+                The counter name
+            labels : dict(str, str)
+                The labels of the series
+        :rtype: Counter
+        """
+        return self._get_series(self.counters, Counter, name, labels)
+
+    def add_source(self, name, func):
+        """
+        Adds a source of counters
+
+        :Parameters:
+            name : str
+                The name the counters are reported under
+            func : function
+                Returns a dict of the counters
+        """
+        self.sources[name] = func
+
+    def remove(self, **labels):
+        """
+        Removes the histograms and counters that have the given labels, e.g.
+        those of a node that left the ring
+        """
+        labels = set(labels.iteritems())
+        with self._lock:
+            for series in (self.histograms, self.counters):
+                for key in [key for key in series if labels <= set(key[1])]:
+                    del series[key]
+
+    def timed(self, name, func, **labels):
+        """
+        Wraps a function to record its latency in a histogram and count the
+        exceptions it raises in the counter name + '_errors'
+
+        :Parameters:
+            name : str
+                The histogram name
+            func : function
+                The function to time
+            labels : dict(str, str)
+                The labels of the series
+        :rtype: function
+        :returns: The wrapped function
+        """
+        histogram = self.histogram(name, **labels)
+        errors = self.counter(name + '_errors', **labels)
+        record_since = histogram.record_since
+        _time = time.time
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            start = _time()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                record_since(start)
+                errors.add()
+                raise
+            record_since(start)
+            return result
+        return timed_func
+
+    def snapshot(self):
+        """
+        :rtype: dict
+        :returns: The stats of each histogram and the value of each counter
+                  under 'histograms' and 'counters', by name and then by
+                  labels formatted as name=value pairs joined by commas, and
+                  the counters of each source by its name
+        """
+        result = {'histograms': {}, 'counters': {}}
+        for (name, labels), histogram in self._get_items(self.histograms):
+            result['histograms'].setdefault(name, {})[_format_labels(labels)] = \
+                histogram.stats()
+        for (name, labels), counter in self._get_items(self.counters):
+            result['counters'].setdefault(name, {})[_format_labels(labels)] = \
+                _to_rpc(counter.value)
+        for name, func in self.sources.items():
+            result[name] = func()
+        return result
+
+    def to_prometheus(self):
+        """
+        :rtype: str
+        :returns: The metrics in the Prometheus text format, histograms as
+                  summaries
+        """
+        lines = []
+        last = None
+        for (name, labels), histogram in self._get_items(self.histograms):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            if name != last:
+                lines.append('# TYPE %s summary' % metric)
+                last = name
+            stats = histogram.stats()
+            for quantile, stat in Histogram.QUANTILES:
+                lines.append('%s%s %r' % (metric, _prometheus_labels(
+                    labels + (('quantile', str(quantile)),)), stats[stat]))
+            lines.append('%s_sum%s %r' % (metric, _prometheus_labels(labels), stats['sum']))
+            lines.append('%s_count%s %d' % (metric, _prometheus_labels(labels),
+                                            stats['count']))
+        last = None
+        for (name, labels), counter in self._get_items(self.counters):
+            metric = '%s_%s_total' % (self.prefix, name)
+            if name != last:
+                lines.append('# TYPE %s counter' % metric)
+                last = name
+            lines.append('%s%s %d' % (metric, _prometheus_labels(labels), counter.value))
+        for name, func in sorted(self.sources.items()):
+            for stat, value in sorted(func().iteritems()):
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    lines.append('%s_%s_%s %r' % (self.prefix, name, stat, value))
+        return '\n'.join(lines) + '\n'
+
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _get_series(self, series, series_class, name, labels):
+        key = (name, tuple(sorted((label, str(value))
+                                  for label, value in labels.iteritems())))
+        with self._lock:
+            result = series.get(key)
+            if result is None:
+                result = series[key] = series_class()
+            return result
+
+    def _get_items(self, series):
+        """
+        Gets the series sorted by name and labels
+        """
+        with self._lock:
+            return sorted(series.items())
+
+# -------------------------------------------------
+# Prometheus endpoint
+# -------------------------------------------------
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves the metrics in the Prometheus text format on /metrics from a
+    daemon thread
+    """
+    allow_reuse_address = True
+    CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+    def __init__(self, metrics, port, host=''):
+        """
+        :Parameters:
+            metrics : Metrics
+                The metrics to serve
+            port : int
+                Port number to listen on, 0 picks a free port
+            host : str
+                Address to listen on, all interfaces by default
+        """
+        self.metrics = metrics
+        self.thread = None
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _MetricsRequestHandler)
+        self.port = self.server_address[1]
+
+    def start(self):
+        """
+        Starts serving from a daemon thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops serving and closes the socket
+        """
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.metrics.to_prometheus()
+        except:
+            logging.exception('Error exporting the metrics')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', self.server.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format % args)
+
+# -------------------------------------------------
+# Functions
+# -------------------------------------------------
+def _to_rpc(value):
+    """
+    Gets a count that XML-RPC can send, whose ints are 32 bit
+    """
+    if value >= 1 << 31:
+        return float(value)
+    return value
+
+def _format_labels(labels):
+    return ','.join('%s=%s' % (label, value) for label, value in labels)
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, value.replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for label, value in labels)
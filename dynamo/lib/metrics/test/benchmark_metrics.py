@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+import timeit
+
+from dynamo.lib.metrics import Histogram
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+NUM_SAMPLES = 1000000
+NUM_THREADS = 4
+REPEAT = 3
+SETUP = """
+import time
+from dynamo.lib.metrics import Histogram, Metrics
+histogram = Histogram()
+timed = Metrics().timed('call', lambda: None)
+untimed = lambda: None
+start = time.time()
+"""
+
+# -------------------------------------------------
+# Benchmark
+# -------------------------------------------------
+def cost(stmt):
+    """
+    Microseconds per run of stmt, the best of REPEAT runs
+    """
+    return min(timeit.repeat(stmt, SETUP, repeat=REPEAT, number=NUM_SAMPLES)) * 1e6 / NUM_SAMPLES
+
+def threaded(histogram):
+    """
+    Samples per second recorded by NUM_THREADS threads at once
+    """
+    def record():
+        for i in xrange(NUM_SAMPLES / NUM_THREADS):
+            histogram.record(i)
+    threads = [threading.Thread(target=record) for i in xrange(NUM_THREADS)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return NUM_SAMPLES / (timeit.default_timer() - start)
+
+def run():
+    for name, stmt in (('record', 'histogram.record(1500)'),
+                       ('record_since', 'histogram.record_since(start)'),
+                       ('time.time', 'time.time()'),
+                       ('timed call', 'timed()'),
+                       ('untimed call', 'untimed()')):
+        print '%-28s %8.3f us' % (name, cost(stmt))
+    histogram = Histogram()
+    print '%-28s %8.0f /s' % ('record, %s threads' % NUM_THREADS, threaded(histogram))
+    
+    start = timeit.default_timer()
+    stats = histogram.stats()
+    print '%-28s %8.3f ms' % ('stats', (timeit.default_timer() - start) * 1e3)
+    print 'count=%(count)s p50=%(p50)s p99=%(p99)s max=%(max)s' % stats
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,101 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+import urllib2
+from unittest import TestCase
+
+from dynamo.lib.metrics import Histogram, Metrics, MetricsServer
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestHistogram(TestCase):
+    def test_quantiles(self):
+        """
+        Ensures quantiles are within the precision of the buckets, small
+        values exact, and out of range values clamped
+        """
+        histogram = Histogram()
+        self.assertEquals(histogram.get_quantiles([0.5, 0.99]), [0, 0])
+        for value in xrange(1, 10001):
+            histogram.record(value * 100)
+        p50, p90, p99 = histogram.get_quantiles([0.5, 0.9, 0.99])
+        for value, expected in ((p50, 500000), (p90, 900000), (p99, 990000)):
+            self.assertTrue(abs(value - expected) <= expected / 64, (value, expected))
+        self.assertEquals(histogram.count, 10000)
+        self.assertEquals(histogram.total, 100 * 10000 * 10001 / 2)
+
+        histogram = Histogram()
+        for value in (3, 5, 5, 127, -10, 1 << 40):
+            histogram.record(value)
+        self.assertEquals(histogram.get_quantiles([0.0, 0.5, 0.75]), [0, 5, 127])
+        highest = histogram.get_quantiles([1.0])[0]
+        self.assertTrue(0 <= histogram.highest - highest <= histogram.highest / 64)
+
+    def test_concurrent(self):
+        """
+        Ensures no value recorded by concurrent threads is lost
+        """
+        histogram = Histogram()
+        def record():
+            for value in xrange(5000):
+                histogram.record(value)
+        threads = [threading.Thread(target=record) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(histogram.stats()['count'], 20000)
+        self.assertEquals(sum(histogram.counts), 20000)
+        self.assertEquals(histogram.total, 4 * 5000 * 4999 / 2)
+
+class TestMetrics(TestCase):
+    def test_timed(self):
+        """
+        Ensures a timed function records its latency and counts its errors
+        """
+        metrics = Metrics()
+        def divide(a, b):
+            return a / b
+        timed = metrics.timed('rpc', divide, method='divide')
+        self.assertEquals(timed(4, 2), 2)
+        self.assertRaises(ZeroDivisionError, timed, 1, 0)
+        self.assertTrue(metrics.histogram('rpc', method='divide') is
+                        metrics.histogram('rpc', method='divide'))
+
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['histograms']['rpc']['method=divide']['count'], 2)
+        self.assertEquals(snapshot['counters']['rpc_errors'], {'method=divide': 1})
+
+        metrics.remove(method='divide')
+        self.assertEquals(metrics.snapshot(), {'histograms': {}, 'counters': {}})
+
+    def test_prometheus(self):
+        """
+        Ensures histograms are exported as summaries in seconds, counters
+        with _total and the numbers of sources, and served on /metrics
+        """
+        metrics = Metrics()
+        metrics.histogram('node_call', node='a:1', method='get').record(100)
+        metrics.counter('bytes_read').add(100)
+        metrics.add_source('cache', lambda: {'hits': 3, 'name': 'lru'})
+        text = metrics.to_prometheus()
+        self.assertTrue('# TYPE dynamo_node_call_seconds summary\n' in text)
+        self.assertTrue('dynamo_node_call_seconds{method="get",node="a:1",'
+                        'quantile="0.99"} 0.0001' in text)
+        self.assertTrue('dynamo_node_call_seconds_count{method="get",node="a:1"} 1\n'
+                        in text)
+        self.assertTrue('dynamo_bytes_read_total 100\n' in text)
+        self.assertTrue('dynamo_cache_hits 3\n' in text)
+        self.assertFalse('lru' in text)
+
+        server = MetricsServer(metrics, 0, 'localhost')
+        server.start()
+        try:
+            url = 'http://localhost:%s' % server.port
+            self.assertEquals(urllib2.urlopen(url + '/metrics').read(),
+                              metrics.to_prometheus())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/')
+        finally:
+            server.stop()
@@ -0,0 +1,4 @@
+from thread_pool_server import ThreadPoolXMLRPCServer, KeepAliveXMLRPCRequestHandler, create_server
+from connection_pool import ConnectionPool, PooledServerProxy
+from view_marshaller import ViewMarshaller, ViewXMLRPCServer, ViewXMLRPCRequestHandler, dump_response
+from binary_rpc import BinaryRPCServer, BinaryRPCConnection, BinaryServerProxy, create_binary_server
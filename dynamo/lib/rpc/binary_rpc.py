@@ -0,0 +1,629 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import itertools
+import logging
+import select
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import types
+import xmlrpclib
+
+from dynamo.lib.thread_pool import ThreadPool
+
+# -------------------------------------------------
+# Values
+# -------------------------------------------------
+# Every value starts with a one byte tag.  Integers are 64 bit, so longer
+# ones such as ring tokens are sent as decimal strings.  Strings, lists and
+# dicts are prefixed with their length.
+_TAG_NONE = 'N'
+_TAG_TRUE = 'T'
+_TAG_FALSE = 'F'
+_TAG_INT = 'i'
+_TAG_BIG_INT = 'n'
+_TAG_FLOAT = 'd'
+_TAG_STR = 's'
+_TAG_UNICODE = 'u'
+_TAG_LIST = 'l'
+_TAG_DICT = 'm'
+
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_LENGTH = struct.Struct('>I')
+
+# Buffers shorter than this are copied into the surrounding chunk rather
+# than sent with a call of their own
+COPY_THRESHOLD = 4096
+
+def _dump(value, write):
+    value_type = type(value)
+    if value is None:
+        write(_TAG_NONE)
+    elif value_type is bool:
+        write(_TAG_TRUE if value else _TAG_FALSE)
+    elif value_type is int or value_type is long:
+        if -2 ** 63 <= value < 2 ** 63:
+            write(_TAG_INT + _INT.pack(value))
+        else:
+            digits = str(value)
+            write(_TAG_BIG_INT + _LENGTH.pack(len(digits)) + digits)
+    elif value_type is str:
+        write(_TAG_STR + _LENGTH.pack(len(value)) + value)
+    elif value_type is types.BufferType:
+        write(_TAG_STR + _LENGTH.pack(len(value)))
+        write(value)
+    elif value_type is unicode:
+        value = value.encode('utf-8')
+        write(_TAG_UNICODE + _LENGTH.pack(len(value)) + value)
+    elif value_type is float:
+        write(_TAG_FLOAT + _FLOAT.pack(value))
+    elif value_type is list or value_type is tuple:
+        write(_TAG_LIST + _LENGTH.pack(len(value)))
+        for item in value:
+            _dump(item, write)
+    elif value_type is dict:
+        write(_TAG_DICT + _LENGTH.pack(len(value)))
+        for key, item in value.iteritems():
+            _dump(key, write)
+            _dump(item, write)
+    else:
+        raise TypeError('cannot marshal %s objects' % value_type)
+
+def _load(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == _TAG_STR or tag == _TAG_UNICODE or tag == _TAG_BIG_INT:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        pos += _LENGTH.size
+        value = data[pos:pos + length]
+        if len(value) != length:
+            raise ValueError('Truncated value')
+        if tag == _TAG_UNICODE:
+            value = value.decode('utf-8')
+        elif tag == _TAG_BIG_INT:
+            value = long(value)
+        return value, pos + length
+    if tag == _TAG_INT:
+        return _INT.unpack_from(data, pos)[0], pos + _INT.size
+    if tag == _TAG_LIST:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        pos += _LENGTH.size
+        value = []
+        for i in xrange(length):
+            item, pos = _load(data, pos)
+            value.append(item)
+        return value, pos
+    if tag == _TAG_DICT:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        pos += _LENGTH.size
+        value = {}
+        for i in xrange(length):
+            key, pos = _load(data, pos)
+            value[key], pos = _load(data, pos)
+        return value, pos
+    if tag == _TAG_NONE:
+        return None, pos
+    if tag == _TAG_TRUE:
+        return True, pos
+    if tag == _TAG_FALSE:
+        return False, pos
+    if tag == _TAG_FLOAT:
+        return _FLOAT.unpack_from(data, pos)[0], pos + _FLOAT.size
+    raise ValueError('Unknown tag %r' % tag)
+
+def dumps(value):
+    """
+    Marshals a value
+
+    :Parameters:
+        value : object
+            None, a bool, int, long, float, str, buffer, unicode, list,
+            tuple or dict of them.  Tuples are loaded as lists.
+    :rtype: str
+    :returns: The marshalled value
+    """
+    chunks = []
+    _dump(value, chunks.append)
+    return ''.join(str(chunk) for chunk in chunks)
+
+def loads(data):
+    """
+    Unmarshals a value
+
+    :Parameters:
+        data : str
+            The marshalled value
+    :rtype: object
+    :returns: The value
+    """
+    try:
+        value, pos = _load(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError('Truncated value')
+    if pos != len(data):
+        raise ValueError('%s bytes after the value' % (len(data) - pos))
+    return value
+
+# -------------------------------------------------
+# Frames
+# -------------------------------------------------
+# A frame is its payload length, the request id its response is matched by
+# and its kind, followed by the marshalled payload.  A request's payload is
+# [method, params], a response's the result and a fault's [code, string].
+HEADER = struct.Struct('>IIB')
+REQUEST = 1
+RESPONSE = 2
+FAULT = 3
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+def dump_frame(request_id, kind, value):
+    """
+    Marshals a frame
+
+    :Parameters:
+        request_id : int
+            The id of the request, a 32 bit unsigned integer
+        kind : int
+            REQUEST, RESPONSE or FAULT
+        value : object
+            The payload
+    :rtype: list
+    :returns: The strings and buffers of the frame
+    """
+    chunks = []
+    _dump(value, chunks.append)
+    size = sum(len(chunk) for chunk in chunks)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError('Frame of %s bytes is too large' % size)
+    chunks.insert(0, HEADER.pack(size, request_id, kind))
+    return chunks
+
+def dump_reply(request_id, result):
+    """
+    Marshals the response to a request
+
+    :Parameters:
+        request_id : int
+            The id of the request
+        result : object
+            The method's return value or an xmlrpclib.Fault
+    :rtype: list
+    :returns: The strings and buffers of the frame
+    """
+    if isinstance(result, xmlrpclib.Fault):
+        return dump_frame(request_id, FAULT, (result.faultCode, result.faultString))
+    try:
+        return dump_frame(request_id, RESPONSE, result)
+    except (TypeError, ValueError):
+        exc_type, exc_value = sys.exc_info()[:2]
+        return dump_frame(request_id, FAULT, (1, '%s:%s' % (exc_type, exc_value)))
+
+def join_chunks(chunks):
+    """
+    Joins chunks into runs to send.  Large buffers are left on their own so
+    they are sent without being copied.
+
+    :rtype: list
+    :returns: Strings and large buffers
+    """
+    runs = []
+    run = []
+    for chunk in chunks:
+        if type(chunk) is types.BufferType:
+            if len(chunk) >= COPY_THRESHOLD:
+                if run:
+                    runs.append(''.join(run))
+                    run = []
+                runs.append(chunk)
+                continue
+            chunk = str(chunk)
+        run.append(chunk)
+    if run:
+        runs.append(''.join(run))
+    return runs
+
+def parse_header(data):
+    """
+    Unmarshals a frame header
+
+    :rtype: tuple(int, int, int)
+    :returns: The payload length, request id and kind
+    """
+    size, request_id, kind = HEADER.unpack(data)
+    if not 0 < size <= MAX_FRAME_SIZE:
+        raise ValueError('Bad frame size %s' % size)
+    return size, request_id, kind
+
+class FrameParser(object):
+    """
+    Splits the bytes read from a connection into frames
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.needed = HEADER.size
+        self.header = None
+
+    def feed(self, data):
+        """
+        Adds bytes read from the connection
+
+        :rtype: list(tuple(int, int, object, int))
+        :returns: The request id, kind, payload and size of each frame
+                  completed by the bytes
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+        frames = []
+        while self.size >= self.needed:
+            data = ''.join(self.chunks)
+            if self.header is None:
+                self.needed, request_id, kind = parse_header(data[:HEADER.size])
+                self.header = (request_id, kind)
+                data = data[HEADER.size:]
+            else:
+                request_id, kind = self.header
+                frames.append((request_id, kind, loads(data[:self.needed]),
+                               HEADER.size + self.needed))
+                data = data[self.needed:]
+                self.header = None
+                self.needed = HEADER.size
+            self.chunks = [data] if data else []
+            self.size = len(data)
+        return frames
+
+def read_frame(rfile):
+    """
+    Reads a frame from a file
+
+    :rtype: tuple(int, int, object)
+    :returns: The request id, kind and payload of the frame, None if the
+              file was closed between frames
+    """
+    header = rfile.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise EOFError('Connection closed in a frame header')
+    size, request_id, kind = parse_header(header)
+    payload = rfile.read(size)
+    if len(payload) < size:
+        raise EOFError('Connection closed in a frame')
+    return request_id, kind, loads(payload)
+
+# -------------------------------------------------
+# Server
+# -------------------------------------------------
+class BinaryRPCRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads the requests of a connection and runs them on the server's
+    worker threads.  Responses are written as the requests finish, so a
+    slow request does not hold up the ones behind it.
+    """
+    def handle(self):
+        write_lock = threading.Lock()
+        futures = []
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    break
+                request_id, kind, payload = frame
+                if kind != REQUEST:
+                    raise ValueError('Expected a request, not a frame of kind %s' % kind)
+                futures = [future for future in futures if not future.done()]
+                futures.append(self.server.pool.submit(self._respond, request_id,
+                                                       payload, write_lock))
+        except (EOFError, ValueError, socket.error), e:
+            logging.debug('Closing the connection from %s: %s' %
+                          (self.client_address, e))
+
+        # The connection is closed once this returns
+        for future in futures:
+            future.result()
+
+    def _respond(self, request_id, payload, write_lock):
+        """
+        Runs a request and writes its response
+        """
+        chunks = dump_reply(request_id, self.server.call(payload))
+        try:
+            with write_lock:
+                for run in join_chunks(chunks):
+                    self.connection.sendall(run)
+        except socket.error, e:
+            logging.debug('Error responding to %s: %s' % (self.client_address, e))
+
+class BinaryRPCServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A server of the binary protocol.  Each connection is read by a thread
+    of its own and its requests are run by a fixed pool of worker threads,
+    so one connection can have many requests in flight.  Functions are
+    registered as with SimpleXMLRPCServer.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, addr, num_workers=1, queue_size=64):
+        """
+        :Parameters:
+            addr : tuple(str, int)
+                The address to listen on
+            num_workers : int
+                Number of worker threads
+            queue_size : int
+                Maximum number of requests waiting for a worker
+        """
+        self.funcs = {}
+        self.pool = ThreadPool(num_workers, queue_size, name='binary-rpc')
+        self.thread = None
+        SocketServer.TCPServer.__init__(self, addr, BinaryRPCRequestHandler)
+
+    def register_function(self, function, name=None):
+        """
+        Registers a function to be called by name
+        """
+        self.funcs[name or function.__name__] = function
+
+    def call(self, payload):
+        """
+        Calls the function a request names
+
+        :Parameters:
+            payload : list
+                The method name and parameters
+        :rtype: object
+        :returns: The return value, or an xmlrpclib.Fault if it failed
+        """
+        try:
+            method, params = payload
+            func = self.funcs.get(method)
+            if func is None:
+                raise xmlrpclib.Fault(1, 'method "%s" is not supported' % method)
+            return func(*params)
+        except xmlrpclib.Fault, fault:
+            return fault
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            return xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value))
+
+    def start(self):
+        """
+        Serves requests on a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='binary-rpc')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def server_close(self):
+        """
+        Closes the listening socket and stops the workers
+        """
+        SocketServer.TCPServer.server_close(self)
+        self.pool.shutdown(False)
+
+def create_binary_server(port, threads=0, queue_size=64):
+    """
+    Creates the binary protocol server used by the storage nodes and load
+    balancers alongside their XML-RPC servers
+
+    :Parameters:
+        port : int
+            The port to listen on, 0 picks a free port
+        threads : int
+            Number of worker threads, 0 runs one request at a time
+        queue_size : int
+            Maximum number of requests waiting for a worker
+    :rtype: BinaryRPCServer
+    :returns: The server
+    """
+    logging.info('Starting a binary protocol server on port %s' % port)
+    return BinaryRPCServer(('', port), max(threads, 1), queue_size)
+
+# -------------------------------------------------
+# Client
+# -------------------------------------------------
+class _PendingRequest(object):
+    """
+    A request waiting for its response
+    """
+    __slots__ = ('method', 'deadline', 'event', 'result', 'error')
+
+    def __init__(self, method, deadline):
+        self.method = method
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, error, result=None):
+        self.error = error
+        self.result = result
+        self.event.set()
+
+class BinaryRPCConnection(object):
+    """
+    A connection to a binary protocol server shared by any number of
+    threads.  Each request is tagged with an id and its caller waits for
+    the response with that id, so requests are multiplexed on one socket
+    and answered in any order.  A reader thread receives the responses and
+    fails the requests that have waited for longer than the timeout, so 
+    callers can block without a timeout of their own; a timed wait polls in
+    Python 2.
+
+    The connection is opened by the first call and again by the first call
+    after it breaks, which fails the requests in flight.
+    """
+    TICK = 0.05
+    
+    def __init__(self, host, port, timeout=10.0):
+        """
+        :Parameters:
+            host : str
+                The server host
+            port : int
+                The server port
+            timeout : float
+                Seconds to wait for a response
+        """
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pending = {}
+        self._ids = itertools.count()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def call(self, method, params):
+        """
+        Calls a method on the server
+
+        :Parameters:
+            method : str
+                The method name
+            params : tuple
+                The method parameters
+        :rtype: object
+        :returns: The method's return value
+        """
+        request_id = next(self._ids) & 0xffffffff
+        runs = join_chunks(dump_frame(request_id, REQUEST, (method, params)))
+        request = _PendingRequest(method, time.time() + self.timeout)
+        error = None
+        with self.lock:
+            sock = self._connect()
+            self.pending[request_id] = request
+            try:
+                for run in runs:
+                    sock.sendall(run)
+            except socket.error, e:
+                self.pending.pop(request_id, None)
+                error = e
+            else:
+                self.bytes_sent += sum(len(run) for run in runs)
+        if error is not None:
+            self._reset(sock, error)
+            raise error
+        
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        """
+        Closes the connection, failing the requests in flight
+        """
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            self._reset(sock, IOError('Connection to %s:%s closed' %
+                                      (self.host, self.port)))
+
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _connect(self):
+        """
+        Opens the socket if it is not open.  Called with the lock held.
+        """
+        if self.sock is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            reader = threading.Thread(target=self._read, args=(sock,),
+                                      name='binary-rpc-reader')
+            reader.daemon = True
+            reader.start()
+        return self.sock
+
+    def _read(self, sock):
+        """
+        Reader thread loop, handing each response to its caller
+        """
+        parser = FrameParser()
+        error = None
+        next_expiry = time.time() + self.TICK
+        while self.sock is sock:
+            try:
+                readable = select.select([sock], [], [], self.TICK)[0]
+                now = time.time()
+                if now >= next_expiry:
+                    self._expire(now)
+                    next_expiry = now + self.TICK
+                if not readable:
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    error = IOError('Connection to %s:%s closed' % (self.host, self.port))
+                    break
+                frames = parser.feed(data)
+            except (socket.error, select.error, ValueError), e:
+                error = e
+                break
+            for request_id, kind, payload, size in frames:
+                with self.lock:
+                    self.bytes_received += size
+                    request = self.pending.pop(request_id, None)
+                if request is None:
+                    continue
+                if kind == FAULT:
+                    request.finish(xmlrpclib.Fault(*payload))
+                else:
+                    request.finish(None, payload)
+        if error is not None:
+            self._reset(sock, error)
+
+    def _expire(self, now):
+        """
+        Fails the requests past their deadline
+        """
+        with self.lock:
+            expired = [request_id for request_id, request in self.pending.iteritems()
+                       if request.deadline <= now]
+            expired = [self.pending.pop(request_id) for request_id in expired]
+        for request in expired:
+            request.finish(IOError('Timed out calling %s on %s:%s' % 
+                                   (request.method, self.host, self.port)))
+            
+    def _reset(self, sock, error):
+        """
+        Closes a socket and fails the requests sent on it
+        """
+        with self.lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            pending, self.pending = self.pending, {}
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        for request in pending.itervalues():
+            request.finish(error)
+
+class BinaryServerProxy(object):
+    """
+    A thread safe stand in for xmlrpclib.ServerProxy that makes its calls
+    with the binary protocol
+    """
+    def __init__(self, connection):
+        """
+        :Parameters:
+            connection : BinaryRPCConnection
+                The connection to the server
+        """
+        self.connection = connection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *params: self.connection.call(name, params)
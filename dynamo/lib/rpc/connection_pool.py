@@ -0,0 +1,223 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import errno
+import httplib
+import logging
+import select
+import socket
+import threading
+import time
+import xmlrpclib
+
+# -------------------------------------------------
+# Connection pool
+# -------------------------------------------------
+class ConnectionPool(object):
+    """
+    A pool of HTTP/1.1 keep-alive connections to one XML-RPC server.
+    
+    Connections are checked out for the length of one call, so a pool can
+    be shared by any number of threads.  Idle connections beyond min_size 
+    are closed after idle_timeout seconds, and a connection that has been 
+    idle for longer than check_interval is checked for a close by the 
+    server before it is reused.  At most max_size connections are open at
+    once; further callers wait up to acquire_timeout seconds for one to be 
+    released.
+    """
+    PATH = '/RPC2'
+    
+    def __init__(self, host, port, min_size=1, max_size=8, idle_timeout=30.0,
+                 check_interval=1.0, timeout=10.0, acquire_timeout=None):
+        """
+        :Parameters:
+            host : str
+                The server host
+            port : int
+                The server port
+            min_size : int
+                Number of idle connections kept open regardless of idle_timeout
+            max_size : int
+                Maximum number of open connections
+            idle_timeout : float
+                Seconds after which an idle connection is closed
+            check_interval : float
+                Idle seconds after which a connection is checked before reuse
+            timeout : float
+                Socket timeout in seconds
+            acquire_timeout : float
+                Seconds to wait for a free connection, defaults to timeout
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Invalid pool sizes min=%s max=%s' % (min_size, max_size))
+        self.host = host
+        self.port = int(port)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.acquire_timeout = timeout if acquire_timeout is None else acquire_timeout
+        self.idle = []
+        self.num_open = 0
+        self.condition = threading.Condition()
+        
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def call(self, method, params):
+        """
+        Calls an XML-RPC method on the server
+        
+        :Parameters:
+            method : str
+                The method name
+            params : tuple
+                The method parameters
+        :rtype: object
+        :returns: The method's return value
+        """
+        body = xmlrpclib.dumps(params, method, allow_none=True)
+        
+        # A reused connection may have been closed by the server since it
+        # was checked, so a call that finds it closed is retried on a new 
+        # connection.  Any other failure, a timeout above all, may come 
+        # after the server ran the call, so it is not retried.
+        while True:
+            conn, reused = self.acquire()
+            try:
+                conn.request('POST', self.PATH, body, {'Content-Type': 'text/xml'})
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                self.release(conn, False)
+                if reused and _is_closed(e):
+                    logging.debug('Retrying %s on a new connection to %s:%s' % 
+                                  (method, self.host, self.port))
+                    continue
+                raise
+            break
+        
+        self.release(conn, not response.will_close)
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError('%s:%s' % (self.host, self.port), 
+                                          response.status, response.reason, 
+                                          dict(response.getheaders()))
+        return xmlrpclib.loads(data)[0][0]
+    
+    def acquire(self):
+        """
+        Checks out a connection, waiting if max_size are already in use
+        
+        :rtype: tuple(httplib.HTTPConnection, bool)
+        :returns: The connection and whether it has been used before 
+        """
+        deadline = time.time() + self.acquire_timeout
+        with self.condition:
+            while True:
+                self._evict(time.time())
+                while self.idle:
+                    conn, last_used = self.idle.pop()
+                    if time.time() - last_used < self.check_interval or \
+                            self._is_alive(conn):
+                        return conn, True
+                    self._discard(conn)
+                if self.num_open < self.max_size:
+                    self.num_open += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError('No free connection to %s:%s' % (self.host, self.port))
+                self.condition.wait(remaining)
+        
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+    
+    def release(self, conn, reusable=True):
+        """
+        Returns a checked out connection to the pool
+        
+        :Parameters:
+            conn : httplib.HTTPConnection
+                The connection
+            reusable : bool
+                False if the connection is broken or was closed by the server
+        """
+        with self.condition:
+            if reusable and conn.sock is not None:
+                self.idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self.condition.notify()
+            
+    def close(self):
+        """
+        Closes the idle connections
+        """
+        with self.condition:
+            while self.idle:
+                self._discard(self.idle.pop()[0])
+                
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _evict(self, now):
+        """
+        Closes the connections beyond min_size that have been idle for
+        longer than idle_timeout.  Idle connections are kept most recently
+        used last, so the stalest are at the front.
+        """
+        while len(self.idle) > self.min_size and \
+                now - self.idle[0][1] > self.idle_timeout:
+            self._discard(self.idle.pop(0)[0])
+            
+    def _discard(self, conn):
+        conn.close()
+        self.num_open -= 1
+        
+    def _is_alive(self, conn):
+        """
+        An idle keep-alive connection should have nothing to read.  If it is
+        readable the server has closed it.
+        """
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (socket.error, select.error, ValueError):
+            return False
+        return not readable
+    
+# Errors of a connection closed before the server read the request
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED, errno.EBADF)
+
+def _is_closed(error):
+    """
+    Gets whether a call failed because its connection had been closed, 
+    rather than timing out or failing on the server
+    
+    :Parameters:
+        error : Exception
+            The socket.error or httplib.HTTPException the call raised
+    :rtype: bool
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and error.errno in CLOSED_ERRNOS
+    
+class PooledServerProxy(object):
+    """
+    A thread safe stand in for xmlrpclib.ServerProxy that makes its calls on
+    connections from a ConnectionPool
+    """
+    def __init__(self, pool):
+        """
+        :Parameters:
+            pool : ConnectionPool
+                The pool of connections to the server
+        """
+        self.pool = pool
+        
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *params: self.pool.call(name, params)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import os
+import random
+import socket
+import string
+import threading
+import timeit
+
+from dynamo.lib.rpc import ConnectionPool, PooledServerProxy, create_server, \
+    BinaryRPCConnection, BinaryServerProxy, create_binary_server
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+VALUE_SIZES = [16, 1024, 16 * 1024, 256 * 1024]
+NUM_REQUESTS = 2000
+MAX_BYTES = 64 * 1024 * 1024
+THREADS = 4
+
+# -------------------------------------------------
+# Benchmark
+# -------------------------------------------------
+class CountingRelay(object):
+    """
+    Forwards connections to a server, counting the bytes sent each way
+    """
+    def __init__(self, port):
+        self.port = port
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            client = self.listener.accept()[0]
+            server = socket.create_connection(('127.0.0.1', self.port))
+            for source, sink in ((client, server), (server, client)):
+                thread = threading.Thread(target=self._pump, args=(source, sink))
+                thread.daemon = True
+                thread.start()
+
+    def _pump(self, source, sink):
+        while True:
+            data = source.recv(65536)
+            if not data:
+                sink.close()
+                return
+            with self.lock:
+                self.bytes += len(data)
+            sink.sendall(data)
+
+def start_servers(store):
+    """
+    Serves get and put over both protocols
+
+    :rtype: tuple(int, int)
+    :returns: The XML-RPC and binary ports
+    """
+    xmlrpc_server = create_server(0, THREADS)
+    binary_server = create_binary_server(0, THREADS)
+    for server in (xmlrpc_server, binary_server):
+        server.register_function(store.get, 'get')
+        server.register_function(lambda key, value: store.__setitem__(key, value) or '200',
+                                 'put')
+    thread = threading.Thread(target=xmlrpc_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    binary_server.start()
+    return xmlrpc_server.server_address[1], binary_server.server_address[1]
+
+def get_proxies(xmlrpc_port, binary_port):
+    """
+    :rtype: list(tuple(str, object))
+    :returns: The name and a proxy of each protocol
+    """
+    return [('xmlrpc', PooledServerProxy(ConnectionPool('127.0.0.1', xmlrpc_port))),
+            ('binary', BinaryServerProxy(BinaryRPCConnection('127.0.0.1', binary_port)))]
+
+def measure(proxy, value, num_requests):
+    """
+    Puts and gets a value
+
+    :rtype: tuple(float, float)
+    :returns: CPU and wall seconds per put and get
+    """
+    start_cpu = sum(os.times()[:2])
+    start = timeit.default_timer()
+    for i in xrange(num_requests):
+        proxy.put('key', value)
+        proxy.get('key')
+    wall = timeit.default_timer() - start
+    cpu = sum(os.times()[:2]) - start_cpu
+    return cpu / (2 * num_requests), wall / (2 * num_requests)
+
+def run():
+    store = {}
+    xmlrpc_port, binary_port = start_servers(store)
+    relays = {'xmlrpc': CountingRelay(xmlrpc_port), 
+              'binary': CountingRelay(binary_port)}
+    print 'Client and server share one process; CPU is both sides of a request'
+    print '%10s %8s %14s %14s %16s' % ('value', 'protocol', 'CPU us/req',
+                                        'wall us/req', 'wire bytes/req')
+    for size in VALUE_SIZES:
+        value = ''.join(random.choice(string.letters) for i in xrange(size))
+        num_requests = max(10, min(NUM_REQUESTS, MAX_BYTES // size))
+        for name, proxy in get_proxies(xmlrpc_port, binary_port):
+            measure(proxy, value, 10)
+            cpu, wall = measure(proxy, value, num_requests)
+            print '%10d %8s %14.1f %14.1f' % (size, name, cpu * 1e6, wall * 1e6),
+
+            # Bytes are counted on a separate run through a relay, after a
+            # first call has opened the connection
+            relay = relays[name]
+            relayed = dict(get_proxies(relays['xmlrpc'].listener.getsockname()[1],
+                                       relays['binary'].listener.getsockname()[1]))[name]
+            relayed.put('key', value)
+            start_bytes = relay.bytes
+            measure(relayed, value, 10)
+            print '%16.0f' % ((relay.bytes - start_bytes) / 20.0)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,137 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+import time
+import xmlrpclib
+from unittest import TestCase
+
+from dynamo.lib.rpc import binary_rpc
+from dynamo.lib.rpc import BinaryRPCServer, BinaryRPCConnection, BinaryServerProxy
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestBinaryValues(TestCase):
+    def test_round_trip(self):
+        """
+        Ensures every supported type survives marshalling
+        """
+        values = [None, True, False, 0, -1, int(2 ** 63 - 1), int(-2 ** 63), 2 ** 127 + 1,
+                  -2 ** 100, 1.5, '', 'foo\0bar', u'caf\xe9', [],
+                  [1, ['a', None], {'b': 2.0}], {'key': ['value', 3], 4: u'x'}]
+        for value in values:
+            self.assertEquals(binary_rpc.loads(binary_rpc.dumps(value)), value)
+            self.assertEquals(type(binary_rpc.loads(binary_rpc.dumps(value))),
+                              type(value))
+        self.assertEquals(binary_rpc.loads(binary_rpc.dumps(('a', 1))), ['a', 1])
+        self.assertEquals(binary_rpc.loads(binary_rpc.dumps(buffer('abc', 1))), 'bc')
+
+    def test_bad_values(self):
+        """
+        Ensures unsupported and malformed values are refused
+        """
+        self.assertRaises(TypeError, binary_rpc.dumps, object())
+        data = binary_rpc.dumps(['foo', 1])
+        self.assertRaises(ValueError, binary_rpc.loads, data[:-1])
+        self.assertRaises(ValueError, binary_rpc.loads, data + 'N')
+        self.assertRaises(ValueError, binary_rpc.loads, 'x')
+
+    def test_frames(self):
+        """
+        Ensures frames split across reads are parsed and large buffers are
+        left to be sent on their own
+        """
+        big = buffer('x' * binary_rpc.COPY_THRESHOLD)
+        chunks = binary_rpc.dump_reply(7, ['small', big])
+        runs = binary_rpc.join_chunks(chunks)
+        self.assertEquals(len(runs), 2)
+        self.assertTrue(runs[1] is big)
+        data = ''.join(str(run) for run in runs) + \
+            ''.join(binary_rpc.join_chunks(binary_rpc.dump_reply(8, xmlrpclib.Fault(2, 'no'))))
+
+        parser = binary_rpc.FrameParser()
+        frames = []
+        for i in xrange(0, len(data), 5):
+            frames.extend(parser.feed(data[i:i + 5]))
+        self.assertEquals([frame[:3] for frame in frames],
+                          [(7, binary_rpc.RESPONSE, ['small', str(big)]),
+                           (8, binary_rpc.FAULT, [2, 'no'])])
+        self.assertEquals(sum(frame[3] for frame in frames), len(data))
+        self.assertRaises(ValueError, parser.feed, '\0' * binary_rpc.HEADER.size)
+
+class TestBinaryRPC(TestCase):
+    def setUp(self):
+        self.server = BinaryRPCServer(('127.0.0.1', 0), 4, 8)
+        self.release = threading.Event()
+        self.server.register_function(lambda: self.release.wait(5) and 'slow', 'slow')
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.server.register_function(lambda: buffer('value'), 'get_buffer')
+        self.server.register_function(lambda: 1 / 0, 'fail')
+        self.server.start()
+        self.connection = BinaryRPCConnection('127.0.0.1', self.server.server_address[1],
+                                              timeout=2.0)
+        self.proxy = BinaryServerProxy(self.connection)
+
+    def tearDown(self):
+        self.release.set()
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_call(self):
+        """
+        Ensures calls return their results and failures raise faults
+        """
+        self.assertEquals(self.proxy.double(21), 42)
+        self.assertEquals(self.proxy.double('ab'), 'abab')
+        self.assertEquals(self.proxy.get_buffer(), 'value')
+        self.assertRaises(xmlrpclib.Fault, self.proxy.fail)
+        self.assertRaises(xmlrpclib.Fault, self.proxy.missing)
+        self.assertEquals(self.proxy.double(2 ** 100), 2 ** 101)
+        self.assertTrue(self.connection.bytes_sent > 0)
+        self.assertTrue(self.connection.bytes_received > 0)
+
+    def test_multiplexing(self):
+        """
+        Ensures a request on the same connection is answered while an
+        earlier one is still running
+        """
+        results = []
+        slow = threading.Thread(target=lambda: results.append(self.proxy.slow()))
+        slow.start()
+        time.sleep(0.1)
+
+        self.assertEquals(self.proxy.double(1), 2)
+        self.assertEquals(results, [])
+        self.release.set()
+        slow.join(5)
+        self.assertEquals(results, ['slow'])
+
+    def test_reconnect(self):
+        """
+        Ensures calls in flight fail when the connection closes and the next
+        call opens a new one
+        """
+        errors = []
+        def call():
+            try:
+                self.proxy.slow()
+            except IOError, e:
+                errors.append(e)
+        slow = threading.Thread(target=call)
+        slow.start()
+        time.sleep(0.1)
+        self.connection.close()
+        slow.join(5)
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(self.proxy.double(4), 8)
+
+    def test_timeout(self):
+        """
+        Ensures a call fails once its timeout passes
+        """
+        self.connection.timeout = 0.2
+        self.assertRaises(IOError, self.proxy.slow)
+        self.release.set()
+        self.assertEquals(self.proxy.double(3), 6)
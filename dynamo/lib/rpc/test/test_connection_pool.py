@@ -0,0 +1,145 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import socket
+import threading
+import time
+import xmlrpclib
+from unittest import TestCase
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+from dynamo.lib.rpc import (ConnectionPool, KeepAliveXMLRPCRequestHandler, 
+                            PooledServerProxy, ThreadPoolXMLRPCServer)
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestConnectionPool(TestCase):
+    def start_server(self, handler):
+        """
+        Starts a server that counts the connections it accepts
+        """
+        self.accepted = []
+        class CountingServer(ThreadPoolXMLRPCServer):
+            def process_request(server_self, request, client_address):
+                self.accepted.append(client_address)
+                ThreadPoolXMLRPCServer.process_request(server_self, request, 
+                                                       client_address)
+        
+        self.server = CountingServer(('127.0.0.1', 0), 8, 8, allow_none=True,
+                                     logRequests=False, requestHandler=handler)
+        self.release = threading.Event()
+        self.slow_calls = []
+        def slow():
+            self.slow_calls.append(time.time())
+            time.sleep(0.3)
+            return True
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.server.register_function(slow, 'slow')
+        self.server.register_function(lambda: self.release.wait(5), 'block')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server.server_address
+        
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def test_keep_alive(self):
+        """
+        Ensures sequential calls reuse one connection
+        """
+        pool = ConnectionPool(*self.start_server(KeepAliveXMLRPCRequestHandler))
+        proxy = PooledServerProxy(pool)
+        for i in xrange(10):
+            self.assertEquals(proxy.double(i), i * 2)
+        self.assertEquals(len(self.accepted), 1)
+        self.assertEquals(pool.num_open, 1)
+        
+    def test_http_10_server(self):
+        """
+        Ensures connections closed by an HTTP/1.0 server are not reused
+        """
+        pool = ConnectionPool(*self.start_server(SimpleXMLRPCRequestHandler))
+        proxy = PooledServerProxy(pool)
+        for i in xrange(3):
+            self.assertEquals(proxy.double(i), i * 2)
+        self.assertEquals(len(self.accepted), 3)
+        self.assertEquals(pool.num_open, 0)
+        
+    def test_fault(self):
+        """
+        Ensures faults are raised and the connection is still reused
+        """
+        pool = ConnectionPool(*self.start_server(KeepAliveXMLRPCRequestHandler))
+        proxy = PooledServerProxy(pool)
+        self.assertRaises(xmlrpclib.Fault, proxy.missing)
+        self.assertEquals(proxy.double(1), 2)
+        self.assertEquals(len(self.accepted), 1)
+        
+    def test_max_size(self):
+        """
+        Ensures callers wait for a connection once max_size are in use
+        """
+        host, port = self.start_server(KeepAliveXMLRPCRequestHandler)
+        pool = ConnectionPool(host, port, max_size=1, acquire_timeout=0.2)
+        proxy = PooledServerProxy(pool)
+        blocked = threading.Thread(target=proxy.block)
+        blocked.start()
+        time.sleep(0.1)
+        self.assertRaises(IOError, proxy.double, 1)
+        self.release.set()
+        blocked.join()
+        self.assertEquals(proxy.double(1), 2)
+        
+    def test_idle_eviction(self):
+        """
+        Ensures idle connections beyond min_size are closed
+        """
+        host, port = self.start_server(KeepAliveXMLRPCRequestHandler)
+        pool = ConnectionPool(host, port, min_size=0, idle_timeout=0.05)
+        proxy = PooledServerProxy(pool)
+        self.assertEquals(proxy.double(1), 2)
+        time.sleep(0.1)
+        self.assertEquals(proxy.double(1), 2)
+        self.assertEquals(len(self.accepted), 2)
+        self.assertEquals(pool.num_open, 1)
+        
+    def test_server_closed_connection(self):
+        """
+        Ensures a connection the server closed is detected and replaced
+        """
+        host, port = self.start_server(KeepAliveXMLRPCRequestHandler)
+        pool = ConnectionPool(host, port, check_interval=0)
+        proxy = PooledServerProxy(pool)
+        self.assertEquals(proxy.double(1), 2)
+        pool.idle[0][0].sock.shutdown(0)
+        self.assertEquals(proxy.double(2), 4)
+        self.assertEquals(len(self.accepted), 2)
+        
+    def test_stale_connection_retry(self):
+        """
+        Ensures a call that fails on a reused connection is retried
+        """
+        host, port = self.start_server(KeepAliveXMLRPCRequestHandler)
+        pool = ConnectionPool(host, port, check_interval=60)
+        proxy = PooledServerProxy(pool)
+        self.assertEquals(proxy.double(1), 2)
+        pool.idle[0][0].sock.close()
+        self.assertEquals(proxy.double(2), 4)
+        
+    def test_timeout_not_retried(self):
+        """
+        Ensures a call that times out on a reused connection is not sent 
+        again, since the server may have run it
+        """
+        host, port = self.start_server(KeepAliveXMLRPCRequestHandler)
+        pool = ConnectionPool(host, port, timeout=0.1)
+        proxy = PooledServerProxy(pool)
+        self.assertEquals(proxy.double(1), 2)
+        self.assertRaises(socket.timeout, proxy.slow)
+        time.sleep(0.4)
+        self.assertEquals(len(self.slow_calls), 1)
+        self.assertEquals(pool.num_open, 0)
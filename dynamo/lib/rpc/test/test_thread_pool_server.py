@@ -0,0 +1,105 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import socket
+import threading
+import time
+import xmlrpclib
+from unittest import TestCase
+
+from dynamo.lib.rpc import ThreadPoolXMLRPCServer, KeepAliveXMLRPCRequestHandler
+from dynamo.lib.rpc.connection_pool import ConnectionPool
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestThreadPoolXMLRPCServer(TestCase):
+    def setUp(self):
+        self.server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 4, 8, 
+                                             logRequests=False)
+        self.release = threading.Event()
+        self.server.register_function(lambda: self.release.wait(5) or True, 'block')
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def test_slow_request_does_not_block(self):
+        """
+        Ensures a request is served while another one is still running
+        """
+        blocked = threading.Thread(target=xmlrpclib.ServerProxy(self.url).block)
+        blocked.start()
+        
+        self.assertEquals(xmlrpclib.ServerProxy(self.url).double(21), 42)
+        self.assertTrue(blocked.is_alive())
+        self.release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        
+class TestKeepAlive(TestCase):
+    def setUp(self):
+        self.server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 2, 8, logRequests=False,
+                                             requestHandler=KeepAliveXMLRPCRequestHandler)
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def test_idle_connections_do_not_hold_workers(self):
+        """
+        Ensures more idle kept alive connections than workers do not hold 
+        up requests
+        """
+        pools = [ConnectionPool('127.0.0.1', self.port, timeout=2) for i in xrange(6)]
+        start = time.time()
+        for i in xrange(3):
+            for pool in pools:
+                self.assertEquals(pool.call('double', (i,)), i * 2)
+        self.assertTrue(time.time() - start < 1)
+        for pool in pools:
+            self.assertEquals(pool.num_open, 1)
+            pool.close()
+            
+    def test_pipelined_requests(self):
+        """
+        Ensures requests sent before the previous response are all answered
+        """
+        sock = socket.create_connection(('127.0.0.1', self.port), 2)
+        requests = []
+        for i in xrange(3):
+            body = xmlrpclib.dumps((i,), 'double')
+            requests.append('POST /RPC2 HTTP/1.1\r\nContent-Length: %s\r\n\r\n%s' % 
+                            (len(body), body))
+        sock.sendall(''.join(requests))
+        data = ''
+        while data.count('</methodResponse>') < 3:
+            chunk = sock.recv(4096)
+            self.assertTrue(chunk)
+            data += chunk
+        sock.close()
+        self.assertEquals(data.count('<int>'), 3)
+        self.assertTrue('<int>4</int>' in data)
+        
+    def test_idle_timeout(self):
+        """
+        Ensures idle connections are closed after idle_timeout
+        """
+        self.server.idle_timeout = 0.1
+        pool = ConnectionPool('127.0.0.1', self.port, timeout=2)
+        self.assertEquals(pool.call('double', (1,)), 2)
+        time.sleep(0.5)
+        self.assertEquals(self.server.idle, {})
+        self.assertEquals(pool.call('double', (2,)), 4)
+        pool.close()
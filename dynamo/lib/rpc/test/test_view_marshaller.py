@@ -0,0 +1,78 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+import xmlrpclib
+from unittest import TestCase
+
+from dynamo.lib.rpc import ThreadPoolXMLRPCServer, ViewXMLRPCServer, dump_response
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestDumpResponse(TestCase):
+    def test_matches_xmlrpclib(self):
+        """
+        Ensures buffers marshal like the strings they view
+        """
+        value = 'x' * 100 + 'a & b < c'
+        for response in [buffer(value), {'foo': buffer(value, 3, 20), 'bar': None},
+                         [buffer(value, 100)]]:
+            expected = xmlrpclib.dumps((_copy(response),), methodresponse=1, 
+                                       allow_none=True)
+            self.assertEquals(str(dump_response(response, allow_none=True)), expected)
+            
+    def test_string_response(self):
+        """
+        Ensures responses without buffers are marshalled to a string
+        """
+        response = dump_response({'foo': 'bar'})
+        self.assertTrue(isinstance(response, str))
+        self.assertEquals(xmlrpclib.loads(response)[0][0], {'foo': 'bar'})
+        
+    def test_chunks_length(self):
+        """
+        Ensures the length of a chunked response is its size in bytes
+        """
+        response = dump_response(buffer('abc' * 1000))
+        self.assertEquals(len(response), len(str(response)))
+        
+class TestViewXMLRPCServer(TestCase):
+    def _serve(self, server):
+        value = 'abc<>' * 200000
+        server.register_function(lambda start: buffer(value, start), 'view')
+        server.register_function(lambda: {'a': buffer(value, 0, 5), 'b': 'c'}, 'struct')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            proxy = xmlrpclib.ServerProxy('http://127.0.0.1:%s' % server.server_address[1])
+            self.assertEquals(proxy.view(5), value[5:])
+            self.assertEquals(proxy.struct(), {'a': 'abc<>', 'b': 'c'})
+        finally:
+            server.shutdown()
+            server.server_close()
+    
+    def test_single_threaded(self):
+        """
+        Ensures buffers are served by the single threaded server
+        """
+        self._serve(ViewXMLRPCServer(('127.0.0.1', 0), logRequests=False))
+        
+    def test_thread_pool(self):
+        """
+        Ensures buffers are served by the thread pool server
+        """
+        self._serve(ThreadPoolXMLRPCServer(('127.0.0.1', 0), 2, 4, logRequests=False))
+
+def _copy(response):
+    """
+    Replaces the buffers of a response with strings
+    """
+    if isinstance(response, buffer):
+        return str(response)
+    if isinstance(response, dict):
+        return dict((key, _copy(value)) for key, value in response.items())
+    if isinstance(response, list):
+        return [_copy(value) for value in response]
+    return response
@@ -0,0 +1,175 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import logging
+import select
+import socket
+import threading
+import time
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+from dynamo.lib.rpc.view_marshaller import ViewXMLRPCDispatcherMixin, \
+    ViewXMLRPCRequestHandler, ViewXMLRPCServer
+from dynamo.lib.thread_pool import ThreadPool
+
+# -------------------------------------------------
+# Thread pool server
+# -------------------------------------------------
+class KeepAliveXMLRPCRequestHandler(ViewXMLRPCRequestHandler):
+    """
+    A request handler that keeps HTTP/1.1 connections open between calls.
+    Once the requests the client has sent are answered, a 
+    ThreadPoolXMLRPCServer watches the connection for the next one without
+    holding a worker thread.  timeout bounds the wait for the rest of a 
+    request that has started to arrive.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 10
+    
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        # Requests the client pipelined may already be in the read buffer, 
+        # where watching the socket would not see them
+        while not self.close_connection and self.rfile._rbuf.tell():
+            self.handle_one_request()
+        self.keep_alive = not self.close_connection
+    
+class ThreadPoolXMLRPCServer(ViewXMLRPCDispatcherMixin, SimpleXMLRPCServer):
+    """
+    An XML-RPC server that hands each accepted connection to a fixed pool of
+    worker threads.  Connections waiting for a worker are held in a bounded
+    queue; once it is full the accept loop blocks and further clients wait 
+    in the listen backlog.  Kept alive connections that are idle between 
+    requests are watched by a separate thread and queued again once readable, 
+    so they do not hold workers.  Buffer responses are sent without being 
+    copied when the request handler is a ViewXMLRPCRequestHandler.
+    """
+    def __init__(self, addr, num_workers=8, queue_size=64, idle_timeout=30.0,
+                 **kwargs):
+        """
+        :Parameters:
+            addr : tuple(str, int)
+                The address to listen on
+            num_workers : int
+                Number of worker threads
+            queue_size : int
+                Maximum number of accepted connections waiting for a worker
+            idle_timeout : float
+                Seconds after which an idle kept alive connection is closed
+        """
+        self.request_queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        kwargs.setdefault('requestHandler', ViewXMLRPCRequestHandler)
+        self.pool = ThreadPool(num_workers, queue_size, name='rpc')
+        self.idle = {}
+        self.idle_lock = threading.Lock()
+        self.closing = False
+        self._wakeup, self._waker = socket.socketpair()
+        self.watcher = threading.Thread(target=self._watch_idle, name='rpc-idle')
+        self.watcher.daemon = True
+        SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+        self.watcher.start()
+        
+    def process_request(self, request, client_address):
+        """
+        Queues a connection for the worker threads
+        """
+        self.pool.submit(self._process_request_worker, request, client_address)
+        
+    def server_close(self):
+        """
+        Closes the listening socket and the idle connections and stops the 
+        workers
+        """
+        SimpleXMLRPCServer.server_close(self)
+        with self.idle_lock:
+            if self.closing:
+                return
+            self.closing = True
+        if self.watcher.is_alive():
+            self._waker.send('x')
+            self.watcher.join()
+        for request in self.idle:
+            self.shutdown_request(request)
+        self.idle.clear()
+        self._wakeup.close()
+        self._waker.close()
+        self.pool.shutdown()
+        
+    def _process_request_worker(self, request, client_address):
+        """
+        Handles a connection on a worker thread, handing it to the idle
+        watcher if the request handler keeps it alive
+        """
+        keep_alive = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = getattr(handler, 'keep_alive', False)
+        except:
+            self.handle_error(request, client_address)
+        with self.idle_lock:
+            if keep_alive and not self.closing:
+                self.idle[request] = (client_address, time.time() + self.idle_timeout)
+                self._waker.send('x')
+                return
+        self.shutdown_request(request)
+        
+    def _watch_idle(self):
+        """
+        Queues the idle connections that become readable for the workers 
+        and closes those idle for longer than idle_timeout
+        """
+        while True:
+            with self.idle_lock:
+                if self.closing:
+                    return
+                requests = list(self.idle)
+                deadline = min([entry[1] for entry in self.idle.values()] or [None])
+            wait = None if deadline is None else max(deadline - time.time(), 0)
+            readable = select.select(requests + [self._wakeup], [], [], wait)[0]
+            if self._wakeup in readable:
+                self._wakeup.recv(4096)
+            
+            now = time.time()
+            ready, expired = [], []
+            with self.idle_lock:
+                for request, (client_address, deadline) in self.idle.items():
+                    if request in readable:
+                        ready.append((request, client_address))
+                    elif deadline <= now:
+                        expired.append(request)
+                    else:
+                        continue
+                    del self.idle[request]
+            for request in expired:
+                self.shutdown_request(request)
+            for request, client_address in ready:
+                self.pool.submit(self._process_request_worker, request, client_address)
+            
+# -------------------------------------------------
+# Factory
+# -------------------------------------------------
+def create_server(port, threads=0, queue_size=64):
+    """
+    Creates the XML-RPC server used by the storage nodes and load balancers.
+    The threaded server keeps connections alive between calls; the single 
+    threaded one closes them so one client cannot hold it.  Both send 
+    buffer values without copying them.
+    
+    :Parameters:
+        port : int
+            The port to listen on
+        threads : int
+            Number of worker threads, 0 serves one request at a time
+        queue_size : int
+            Maximum number of connections waiting for a worker
+    :rtype: SimpleXMLRPCServer
+    :returns: The server
+    """
+    if threads:
+        logging.info('Starting a %s thread server on port %s' % (threads, port))
+        return ThreadPoolXMLRPCServer(('', port), threads, queue_size, 
+                                      allow_none=True, logRequests=False,
+                                      requestHandler=KeepAliveXMLRPCRequestHandler)
+    return ViewXMLRPCServer(('', port), allow_none=True)
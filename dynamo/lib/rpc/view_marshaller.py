@@ -0,0 +1,160 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import re
+import sys
+import types
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+# -------------------------------------------------
+# Marshalling
+# -------------------------------------------------
+class ViewMarshaller(xmlrpclib.Marshaller):
+    """
+    A marshaller that writes buffer values as XML-RPC strings without 
+    copying them, and can return a response as the list of its pieces 
+    rather than joining them into one string.
+    """
+    ESCAPE_CHARS = re.compile('[&<>]')
+    
+    dispatch = dict(xmlrpclib.Marshaller.dispatch)
+    
+    def dump_buffer(self, value, write):
+        write('<value><string>')
+        if self.ESCAPE_CHARS.search(value):
+            write(xmlrpclib.escape(str(value)))
+        else:
+            write(value)
+        write('</string></value>\n')
+    dispatch[types.BufferType] = dump_buffer
+    
+    def dump_chunks(self, values):
+        """
+        Marshals a parameter tuple
+        
+        :rtype: list
+        :returns: The strings and buffers of the marshalled parameters
+        """
+        out = []
+        write = out.append
+        write('<params>\n')
+        for value in values:
+            write('<param>\n')
+            self._Marshaller__dump(value, write)
+            write('</param>\n')
+        write('</params>\n')
+        return out
+    
+class ResponseChunks(object):
+    """
+    A marshalled response held as strings and buffers.  len() is the number
+    of bytes the response takes on the wire.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = sum(len(chunk) for chunk in chunks)
+        
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        return iter(self.chunks)
+    
+    def __str__(self):
+        return ''.join(str(chunk) for chunk in self.chunks)
+
+def dump_response(response, allow_none=False, encoding=None):
+    """
+    Marshals a method response.  Responses holding buffers are returned as
+    ResponseChunks so the buffers can be sent without being copied, others
+    as a string.
+    
+    :Parameters:
+        response : object
+            The value returned by the method
+        allow_none : bool
+            Whether None can be marshalled
+        encoding : str
+            The encoding of the response
+    :rtype: ResponseChunks or str
+    :returns: The marshalled response
+    """
+    encoding = encoding or 'utf-8'
+    marshaller = ViewMarshaller(encoding, allow_none)
+    chunks = marshaller.dump_chunks((response,))
+    if encoding == 'utf-8':
+        header = "<?xml version='1.0'?>\n<methodResponse>\n"
+    else:
+        header = "<?xml version='1.0' encoding='%s'?>\n<methodResponse>\n" % encoding
+    chunks = [header] + chunks + ['</methodResponse>\n']
+    
+    if any(type(chunk) is types.BufferType for chunk in chunks):
+        return ResponseChunks(chunks)
+    return ''.join(chunks)
+
+# -------------------------------------------------
+# Server
+# -------------------------------------------------
+class ViewXMLRPCDispatcherMixin:
+    """
+    Marshals responses with dump_response.  Mixed into an XML-RPC server 
+    whose request handler is a ViewXMLRPCRequestHandler.
+    """
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        try:
+            params, method = xmlrpclib.loads(data)
+            if dispatch_method is not None:
+                response = dispatch_method(method, params)
+            else:
+                response = self._dispatch(method, params)
+            return dump_response(response, self.allow_none, self.encoding)
+        except xmlrpclib.Fault, fault:
+            return xmlrpclib.dumps(fault, allow_none=self.allow_none,
+                                   encoding=self.encoding)
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            return xmlrpclib.dumps(xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value)),
+                                   allow_none=self.allow_none, encoding=self.encoding)
+
+class ViewXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    A request handler that sends the buffers of a ResponseChunks straight 
+    to the socket.  Responses are never gzipped, which would copy them.
+    """
+    encode_threshold = None
+    
+    def setup(self):
+        SimpleXMLRPCRequestHandler.setup(self)
+        self.wfile = _ChunkWriter(self.wfile, self.connection)
+        
+class ViewXMLRPCServer(ViewXMLRPCDispatcherMixin, SimpleXMLRPCServer):
+    """
+    A single threaded XML-RPC server that sends buffers without copying them
+    """
+    def __init__(self, addr, requestHandler=ViewXMLRPCRequestHandler, **kwargs):
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler=requestHandler, 
+                                    **kwargs)
+        
+class _ChunkWriter(object):
+    """
+    Wraps a request handler's output file.  Strings are buffered as usual, 
+    buffers are sent with sendall once the strings before them are flushed.
+    """
+    def __init__(self, wfile, sock):
+        self.wfile = wfile
+        self.sock = sock
+        
+    def write(self, data):
+        if not isinstance(data, ResponseChunks):
+            return self.wfile.write(data)
+        for chunk in data:
+            if type(chunk) is types.BufferType:
+                self.wfile.flush()
+                self.sock.sendall(chunk)
+            else:
+                self.wfile.write(chunk)
+        self.wfile.flush()
+        
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
@@ -0,0 +1 @@
+from thread_pool import ThreadPool, Future
\ No newline at end of file
@@ -0,0 +1,46 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import threading
+from unittest import TestCase
+
+from dynamo.lib.thread_pool import ThreadPool
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestThreadPool(TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(4)
+        
+    def tearDown(self):
+        self.pool.shutdown()
+        
+    def test_submit(self):
+        """
+        Ensures submitted calls run and return their results
+        """
+        futures = [self.pool.submit(pow, i, 2) for i in xrange(20)]
+        self.assertEquals([future.result(1) for future in futures], 
+                          [i ** 2 for i in xrange(20)])
+        
+    def test_exception(self):
+        """
+        Ensures exceptions are re-raised by result()
+        """
+        future = self.pool.submit(int, 'not a number')
+        self.assertRaises(ValueError, future.result, 1)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        
+    def test_done_callback(self):
+        """
+        Ensures callbacks run whether added before or after completion
+        """
+        called = []
+        event = threading.Event()
+        future = self.pool.submit(event.wait, 1)
+        future.add_done_callback(called.append)
+        event.set()
+        future.result(1)
+        future.add_done_callback(called.append)
+        self.assertEquals(called, [future, future])
@@ -0,0 +1,162 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import sys
+import logging
+import threading
+import Queue
+
+# -------------------------------------------------
+# Future
+# -------------------------------------------------
+class Future(object):
+    """
+    The pending result of a call submitted to a ThreadPool
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        
+    def done(self):
+        """
+        :rtype: bool
+        :returns: True if the call has finished
+        """
+        return self._done.is_set()
+    
+    def result(self, timeout=None):
+        """
+        Waits for the call to finish and returns its result, re-raising
+        the exception if the call failed
+        
+        :Parameters:
+            timeout : float
+                Number of seconds to wait, None waits forever
+        :rtype: object
+        :returns: The return value of the call
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the result')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+    
+    def exception(self):
+        """
+        :rtype: Exception
+        :returns: The exception raised by the call, if any 
+        """
+        return self._exc_info[1] if self._exc_info else None
+        
+    def add_done_callback(self, callback):
+        """
+        Calls callback(future) once the call finishes.  If it already has the
+        callback is invoked right away.
+        
+        :Parameters:
+            callback : function
+                A function taking the future
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+        
+    def set_result(self, result):
+        self._finish(result, None)
+        
+    def set_exc_info(self, exc_info):
+        self._finish(None, exc_info)
+        
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logging.exception('Error in future callback')
+                
+# -------------------------------------------------
+# Thread pool
+# -------------------------------------------------
+class ThreadPool(object):
+    """
+    A fixed size pool of daemon worker threads fed from a work queue
+    """
+    def __init__(self, num_workers, queue_size=0, name='pool'):
+        """
+        :Parameters:
+            num_workers : int
+                Number of worker threads
+            queue_size : int
+                Maximum number of pending calls, 0 is unbounded.  submit 
+                blocks while the queue is full.
+            name : str
+                Prefix for the worker thread names
+        """
+        if num_workers < 1:
+            raise ValueError('A thread pool needs at least one worker')
+        self.num_workers = num_workers
+        self.queue = Queue.Queue(queue_size)
+        self.workers = []
+        for i in xrange(num_workers):
+            worker = threading.Thread(target=self._work, name='%s-%s' % (name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules func(*args, **kwargs) on the pool
+        
+        :Parameters:
+            func : function
+                The function to call
+        :rtype: Future
+        :returns: The pending result of the call
+        """
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+    
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the queued calls have run
+        
+        :Parameters:
+            wait : bool
+                Whether to wait for the workers to exit
+        """
+        for worker in self.workers:
+            self.queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+    
+    # -------------------------------------------------
+    # Private methods
+    # -------------------------------------------------
+    def _work(self):
+        """
+        Worker thread loop
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exc_info(sys.exc_info())
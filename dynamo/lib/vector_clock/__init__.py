@@ -0,0 +1 @@
+from vector_clock import VectorClock, VersionClock, reconcile, get_context
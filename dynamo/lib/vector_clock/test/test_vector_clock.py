@@ -0,0 +1,101 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+from unittest import TestCase
+
+from dynamo.lib.vector_clock import VectorClock, VersionClock, reconcile, get_context
+
+# -------------------------------------------------
+# Tests
+# -------------------------------------------------
+class TestVectorClock(TestCase):
+    def test_compare(self):
+        """
+        Ensures a clock descends the clocks whose writes it has seen and
+        that merging two clocks descends both
+        """
+        a = VectorClock({'a': 2, 'b': 1})
+        b = VectorClock({'a': 1, 'b': 3})
+        self.assertTrue(a.descends(VectorClock({'a': 1})))
+        self.assertTrue(a.descends(VectorClock()))
+        self.assertFalse(a.descends(b))
+        self.assertFalse(b.descends(a))
+        merged = a.merge(b)
+        self.assertEquals(merged, VectorClock({'a': 2, 'b': 3}))
+        self.assertTrue(merged.descends(a) and merged.descends(b))
+
+    def test_truncate(self):
+        """
+        Ensures truncating keeps the entries of the latest writes
+        """
+        clock = VectorClock({'a': 5, 'b': 1, 'c': 3})
+        self.assertEquals(clock.truncate(2), VectorClock({'a': 5, 'c': 3}))
+        self.assertEquals(clock.truncate(3), clock)
+
+    def test_encode(self):
+        """
+        Ensures clocks survive encoding, including node names with colons
+        """
+        clock = VectorClock({'10.0.0.1:20000': 2 ** 52, '10.0.0.2:20000': 1})
+        self.assertEquals(clock.encode(), '10.0.0.1:20000=10000000000000,10.0.0.2:20000=1')
+        self.assertEquals(VectorClock.decode(clock.encode()), clock)
+        self.assertEquals(VectorClock.decode(''), VectorClock())
+        self.assertEquals(VectorClock.decode(None), VectorClock())
+        self.assertRaises(ValueError, VectorClock.decode, 'a=1,b')
+
+        version = VersionClock('a:1', 7, clock)
+        self.assertEquals(VersionClock.decode(version.encode()), version)
+        self.assertEquals(VersionClock('a:1', 7).encode(), 'a:1=7')
+        self.assertEquals(VersionClock.decode(''), None)
+        self.assertRaises(ValueError, VersionClock.decode, 'a=1,b=2')
+
+class TestReconcile(TestCase):
+    def test_supersede(self):
+        """
+        Ensures a version written with another in its past supersedes it,
+        and that versions without a clock are superseded by any that have one
+        """
+        first = ('one', 1, VersionClock('a', 1))
+        second = ('two', 2, VersionClock('b', 2, VectorClock({'a': 1})))
+        self.assertEquals(reconcile([second, first]), [second])
+        self.assertEquals(reconcile([('old', 5, None), first]), [first])
+        self.assertEquals(reconcile([('old', 5, None), ('older', 3, None)]),
+                          [('old', 5, None)])
+        self.assertEquals(reconcile([]), [])
+
+    def test_siblings(self):
+        """
+        Ensures two writes a node takes from the same context are both kept,
+        and that a write with the merged context supersedes them
+        """
+        context = VectorClock({'a': 1})
+        first = ('one', 2, VersionClock('a', 2, context))
+        second = ('two', 3, VersionClock('a', 3, context))
+        siblings = reconcile([second, first])
+        self.assertEquals(siblings, [first, second])
+
+        merged = get_context(siblings)
+        self.assertEquals(merged, VectorClock({'a': 3}))
+        self.assertTrue(first[2].seen_by(merged) and second[2].seen_by(merged))
+        third = ('three', 4, VersionClock('b', 4, merged))
+        self.assertEquals(reconcile([first, second, third]), [third])
+
+    def test_copies(self):
+        """
+        Ensures the copies of one write that replicas return are kept once
+        whatever order they arrive in, and that distinct writes of the same
+        value are both kept
+        """
+        clock = VersionClock('a', 10, VectorClock({'x': 1}))
+        copies = [('value', 1, clock), ('value', 1, clock), ('value', 1, clock)]
+        self.assertEquals(reconcile(copies), [('value', 1, clock)])
+        
+        truncated = ('value', 1, VersionClock('a', 10, VectorClock({'y': 2})))
+        merged = reconcile([copies[0], truncated])
+        self.assertEquals(merged, [('value', 1, VersionClock('a', 10, VectorClock({'x': 1,
+                                                                                  'y': 2})))])
+        self.assertEquals(reconcile([truncated, copies[0]]), merged)
+        self.assertEquals(len(reconcile([copies[0], truncated], max_entries=1)[0][2].past), 1)
+
+        other = ('value', 2, VersionClock('b', 11, VectorClock({'x': 1})))
+        self.assertEquals(reconcile([other] + copies), [copies[0], other])
@@ -0,0 +1,281 @@
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import exceptions
+
+# -------------------------------------------------
+# Vector clocks
+# -------------------------------------------------
+class VectorClock(object):
+    """
+    A map from node names to the counter of the last write each node made
+    that a version or a client has seen.  Counters only grow, so a clock
+    descends another if it has seen everything the other has.
+
+    Clocks are encoded as text, e.g. "10.0.0.1:20000=5a3f0c2e8b1d0", with
+    the counters in hex and the entries in node order, so they can be kept
+    next to a value and passed through XML-RPC as an opaque context.
+    """
+    def __init__(self, counters=None):
+        """
+        :Parameters:
+            counters : dict(str, long)
+                The counter of each node
+        """
+        self.counters = dict(counters or {})
+
+    def __len__(self):
+        return len(self.counters)
+
+    def __eq__(self, other):
+        return isinstance(other, VectorClock) and self.counters == other.counters
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'VectorClock(%r)' % self.counters
+
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def get(self, node):
+        """
+        :rtype: long
+        :returns: The counter of a node, 0 if it has none
+        """
+        return self.counters.get(node, 0)
+
+    def descends(self, other):
+        """
+        :rtype: bool
+        :returns: True if this clock has seen every write other has
+        """
+        for node, counter in other.counters.iteritems():
+            if self.counters.get(node, 0) < counter:
+                return False
+        return True
+
+    def merge(self, other):
+        """
+        :rtype: VectorClock
+        :returns: The clock that has seen the writes of both clocks
+        """
+        counters = dict(self.counters)
+        for node, counter in other.counters.iteritems():
+            if counter > counters.get(node, 0):
+                counters[node] = counter
+        return VectorClock(counters)
+
+    def truncate(self, max_entries):
+        """
+        Drops the entries with the lowest counters, which are those of the
+        oldest writes since counters are taken from the time, to keep at
+        most max_entries.  A truncated clock has seen fewer writes, so it can
+        only make versions look concurrent, never hide one.
+
+        :rtype: VectorClock
+        :returns: The truncated clock
+        """
+        if len(self.counters) <= max_entries:
+            return self
+        entries = sorted(self.counters.iteritems(), key=lambda entry: (entry[1], entry[0]))
+        return VectorClock(entries[len(entries) - max_entries:])
+
+    def encode(self):
+        """
+        :rtype: str
+        :returns: The clock as text, empty for an empty clock
+        """
+        return ','.join('%s=%x' % (node, counter)
+                        for node, counter in sorted(self.counters.iteritems()))
+
+    @classmethod
+    def decode(cls, text):
+        """
+        :Parameters:
+            text : str
+                A clock encoded with encode, empty or None for an empty clock
+        :rtype: VectorClock
+        :returns: The clock
+        """
+        counters = {}
+        if text:
+            try:
+                for entry in str(text).split(','):
+                    node, counter = entry.rsplit('=', 1)
+                    counters[node] = long(counter, 16)
+            except exceptions.ValueError:
+                raise exceptions.ValueError('Bad vector clock %r' % text)
+        return cls(counters)
+
+class VersionClock(object):
+    """
+    The clock of one version of a key: the dot, i.e. the node and counter of
+    the write that made the version, and the vector clock of the versions
+    the writer had seen.  Keeping the dot apart from the versions it
+    supersedes means two writes a node takes from the same context do not
+    supersede each other, as they would if the node's counter were simply
+    incremented.
+
+    Encoded as the dot followed by the past clock, e.g.
+    "10.0.0.1:20000=5a3f0c2e8b1d0|10.0.0.2:20000=5a3f0c2e80000".
+    """
+    def __init__(self, node, counter, past=None):
+        """
+        :Parameters:
+            node : str
+                The node that took the write
+            counter : long
+                The node's counter for the write
+            past : VectorClock
+                The clock of the versions the write supersedes
+        """
+        self.node = node
+        self.counter = counter
+        self.past = past or VectorClock()
+
+    def __eq__(self, other):
+        return isinstance(other, VersionClock) and \
+            (self.node, self.counter, self.past) == (other.node, other.counter, other.past)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'VersionClock(%r, %r, %r)' % (self.node, self.counter, self.past)
+
+    # -------------------------------------------------
+    # Public methods
+    # -------------------------------------------------
+    def covers(self, other):
+        """
+        Whether this version supersedes another, which it does if it was
+        written with the other's write in its past or is the same write
+
+        :Parameters:
+            other : VersionClock
+                The other version's clock, None for a version written
+                without one, which every clock covers
+        :rtype: bool
+        """
+        if other is None:
+            return True
+        if other.node == self.node and other.counter == self.counter:
+            return True
+        return self.past.get(other.node) >= other.counter
+
+    def seen_by(self, clock):
+        """
+        :Parameters:
+            clock : VectorClock
+                A context
+        :rtype: bool
+        :returns: True if the context has seen this version's write
+        """
+        return clock.get(self.node) >= self.counter
+
+    def to_vector(self):
+        """
+        :rtype: VectorClock
+        :returns: The clock of everything this version has seen, itself
+                  included
+        """
+        return self.past.merge(VectorClock({self.node: self.counter}))
+
+    def encode(self):
+        """
+        :rtype: str
+        :returns: The clock as text
+        """
+        dot = '%s=%x' % (self.node, self.counter)
+        if not self.past:
+            return dot
+        return '%s|%s' % (dot, self.past.encode())
+
+    @classmethod
+    def decode(cls, text):
+        """
+        :Parameters:
+            text : str
+                A clock encoded with encode
+        :rtype: VersionClock
+        :returns: The clock, None if text is empty or None
+        """
+        if not text:
+            return None
+        dot, _, past = str(text).partition('|')
+        dot = VectorClock.decode(dot)
+        if len(dot) != 1:
+            raise exceptions.ValueError('Bad version clock %r' % text)
+        node, counter = dot.counters.items()[0]
+        return cls(node, counter, VectorClock.decode(past))
+
+# -------------------------------------------------
+# Functions
+# -------------------------------------------------
+def reconcile(versions, max_entries=None):
+    """
+    Reduces the versions of a key to its siblings, the versions no other
+    supersedes.
+
+    A write is stamped once, by the coordinator of its key, so the copies 
+    of one version that replicas return share its dot and are kept once,
+    with the pasts of the copies merged.  Versions with different dots are
+    distinct writes even if their values are equal.  Versions written 
+    without a clock are superseded by any that have one, and among 
+    themselves the one with the latest date wins.
+
+    :Parameters:
+        versions : list(tuple(str, int, VersionClock))
+            (value, date, clock) versions, the clock None if the version was
+            written without one
+        max_entries : int
+            Maximum entries in the merged past of a version's copies, None 
+            for no limit
+    :rtype: list(tuple(str, int, VersionClock))
+    :returns: The siblings, oldest first
+    """
+    unclocked = None
+    dots = {}
+    for value, date, clock in versions:
+        if clock is None:
+            if unclocked is None or date >= unclocked[1]:
+                unclocked = (value, date, clock)
+            continue
+        dot = (clock.node, clock.counter)
+        other = dots.get(dot)
+        if other is not None:
+            past = clock.past.merge(other[2].past)
+            if max_entries is not None:
+                past = past.truncate(max_entries)
+            value, date, clock = (value, max(date, other[1]), 
+                                  VersionClock(clock.node, clock.counter, past))
+        dots[dot] = (value, date, clock)
+
+    if not dots:
+        return [unclocked] if unclocked is not None else []
+    clocked = dots.values()
+    siblings = []
+    for version in clocked:
+        clock = version[2]
+        if not any(other[2].covers(clock) and not clock.covers(other[2])
+                   for other in clocked if other is not version):
+            siblings.append(version)
+    siblings.sort(key=lambda version: (version[1], version[2].node, version[2].counter))
+    return siblings
+
+def get_context(versions):
+    """
+    :Parameters:
+        versions : list(tuple(str, int, VersionClock))
+            The siblings of a key
+    :rtype: VectorClock
+    :returns: The clock of everything the siblings have seen, which a write
+              made with it supersedes
+    """
+    context = VectorClock()
+    for value, date, clock in versions:
+        if clock is not None:
+            context = context.merge(clock.to_vector())
+    return context
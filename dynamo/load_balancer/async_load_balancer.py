@@ -0,0 +1,949 @@
+#!/usr/bin/env python
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import asynchat
+import asyncore
+import logging
+import socket
+import sys
+import time
+import xmlrpclib
+from collections import deque
+
+from dynamo.lib.rpc import binary_rpc
+from dynamo.load_balancer.load_balancer import LoadBalancer, _MultiPut
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class AsyncLoadBalancer(LoadBalancer):
+    """
+    A load balancer that serves the same get/put and multi_get/multi_put 
+    XML-RPC interface as LoadBalancer from a single event loop thread.  Requests to the storage 
+    nodes are made with non-blocking sockets, so the number of requests in 
+    flight is bounded by sockets rather than threads.
+    
+    Each storage node gets up to max_connections connections.  Once a node 
+    has shown that it keeps connections alive, up to max_pipeline requests 
+    are written to a connection before their responses arrive.  Every 
+    storage node request fails after timeout seconds.
+    
+    The binary protocol can be served on a second port from the same event
+    loop.  Its responses are written as they complete rather than in the 
+    order the requests arrived.
+    
+    Gossip rounds with the storage nodes are sent from the event loop too,
+    like any other storage node request, so membership changes they bring
+    are applied on the event loop thread.
+    
+    An RPC is timed until its response is ready, and a storage node request
+    until its callback, so they include the time spent waiting for the event
+    loop.  The Prometheus endpoint is served from its own thread.
+    """
+    FAN_OUT_WORKERS = 0
+    TICK = 0.05
+    LISTEN_BACKLOG = 1024
+    
+    def __init__(self, servers, port, replicas=3, read_quorum=2, write_quorum=2,
+                 timeout=5.0, max_connections=4, max_pipeline=16, 
+                 hash_function='md5', partitions=0, binary_port=None,
+                 hinted_handoff=True, down_interval=5.0, gossip_interval=1.0,
+                 phi_threshold=8.0, metrics_port=None):
+        """
+        Parameters:
+            servers : list(str)
+                A list of servers. Each server name is in the 
+                format {host/ip}:port, optionally followed by :weight
+            port : int
+                Port number to start on, 0 picks a free port
+            replicas : int
+                Number of storage nodes (N) each key is written to
+            read_quorum : int
+                Number of replicas (R) that must answer a get
+            write_quorum : int
+                Number of replicas (W) that must acknowledge a put
+            timeout : float
+                Seconds to wait for a storage node to answer a request
+            max_connections : int
+                Maximum number of connections to each storage node
+            max_pipeline : int
+                Maximum number of unanswered requests on one connection
+            hash_function : str
+                The hash function of the ring, which must match the storage nodes'
+            partitions : int
+                Number of equal partitions of the ring, which must match the 
+                storage nodes', 0 for random tokens
+            binary_port : int
+                Port to also serve the binary protocol on, 0 picks a free 
+                port and None disables it
+            hinted_handoff : bool
+                Whether writes for replicas that are down go to the next 
+                nodes on the ring as hints
+            down_interval : float
+                Seconds a storage node that failed is passed over by writes
+                before it is tried again
+            gossip_interval : float
+                Seconds between gossip rounds with a storage node, 0 
+                disables them
+            phi_threshold : float
+                The suspicion level past which a storage node whose 
+                heartbeats stopped is treated as down
+            metrics_port : int
+                Port to serve the metrics to Prometheus on, None disables it
+        """
+        self.clients = {}
+        LoadBalancer.__init__(self, servers, port, replicas, read_quorum, 
+                              write_quorum, timeout, hash_function=hash_function,
+                              partitions=partitions, binary_port=binary_port,
+                              hinted_handoff=hinted_handoff, 
+                              down_interval=down_interval, 
+                              gossip_interval=gossip_interval,
+                              phi_threshold=phi_threshold,
+                              metrics_port=metrics_port)
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self.socket_map = {}
+        self.listener = None
+        self.binary_listener = None
+        self.running = False
+        self.next_gossip = 0
+        self.async_methods = {'get': self.get_async, 
+                              'put': self.put_async,
+                              'multi_get': self.multi_get_async,
+                              'multi_put': self.multi_put_async,
+                              'add_nodes': self._run_sync(self.add_nodes),
+                              'remove_nodes': self._run_sync(self.remove_nodes),
+                              'set_weights': self._run_sync(self.set_weights),
+                              'membership_stats': self._run_sync(self.membership_stats),
+                              'stats': self._run_sync(self.stats)}
+        self.rpc_metrics = dict((method, (self.metrics.histogram('rpc', method=method),
+                                          self.metrics.counter('rpc_errors', method=method)))
+                                for method in self.async_methods)
+        
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def listen(self):
+        """
+        Opens the listening socket.  Called by run if it has not been already.
+        """
+        self.listener = _FrontendListener(self, self.port, _FrontendConnection)
+        self.port = self.listener.socket.getsockname()[1]
+        if self.binary_port is not None:
+            self.binary_listener = _FrontendListener(self, self.binary_port, 
+                                                     _BinaryFrontendConnection)
+            self.binary_port = self.binary_listener.socket.getsockname()[1]
+        
+    def run(self):
+        """
+        Main event loop
+        """
+        if self.listener is None:
+            self.listen()
+        self._start_metrics_server()
+        self.running = True
+        while self.running:
+            asyncore.loop(self.TICK, True, self.socket_map, 1)
+            now = time.time()
+            self._expire(now)
+            self._gossip(now)
+        
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+        self.listener = None
+        self.binary_listener = None
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+    
+    def stop(self):
+        """
+        Stops the event loop after its current iteration
+        """
+        self.running = False
+        
+    # ------------------------------------------------------
+    # Asynchronous RPC methods
+    # ------------------------------------------------------
+    def get_async(self, key, with_context=False, callback=None):
+        """
+        Gets a key from the storage nodes holding its replicas
+        
+        :Parameters:
+            key : str
+                The key value
+            with_context : bool
+                Whether to get the siblings and their context, as 
+                LoadBalancer.get does
+            callback : function
+                Called with the value, or None if the read quorum failed
+        """
+        def done(responses):
+            value = None
+            if responses is None:
+                logging.error('Error getting the key=%s' % key)
+            elif with_context:
+                value = self._merge_versions(responses.values())
+            else:
+                value = self._choose_value(responses.values())
+            callback(value)
+        self._fan_out_async(key, 'get_versions', ([key],), self.read_quorum, None, done)
+        
+    def put_async(self, key, value, context=None, callback=None):
+        """
+        Puts a key on the storage nodes holding its replicas
+        
+        :Parameters:
+            key : str
+                The key name
+            value : str
+                The value
+            context : str
+                The context returned by a get with context, None to replace
+                every version
+            callback : function
+                Called with 200 if the write quorum succeeded, 400 otherwise.
+                The write is stamped by its coordinator and the version sent
+                to the other replicas, as LoadBalancer.put does.  Versions 
+                for replicas that are down or fail go to the next nodes on 
+                the ring as hints.
+        """
+        try:
+            nodes = self.datastore_view.get_preference_list(key, self.replicas)
+        except:
+            logging.exception('Error routing key=%s' % key)
+            callback('400')
+            return
+        
+        def replicated(responses):
+            if responses is None:
+                logging.error("Error putting key=%s, value=%s" % (key, value))
+            callback('200' if responses is not None else '400')
+        def coordinated(coordinator, version):
+            if coordinator is None:
+                logging.error("Error putting key=%s, value=%s" % (key, value))
+                callback('400')
+                return
+            quorum_call = _QuorumCall(self, 'replica_put', (key, value) + tuple(version), 
+                                      min(self.write_quorum, len(nodes)) - 1, 
+                                      lambda code: code == '200', replicated, 
+                                      time.time() + self.timeout, 
+                                      self._get_fallbacks(key))
+            quorum_call.start([node for node in nodes if node != coordinator])
+        self._coordinate_async(nodes, 'coordinate_put', (key, value, context), coordinated)
+        
+    def multi_get_async(self, keys, callback=None):
+        """
+        Gets a number of keys with one get_versions to each storage node 
+        holding their replicas, as LoadBalancer.multi_get does
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+            callback : function
+                Called with a {'status': status, 'value': value} dict for 
+                each key
+        """
+        pref_lists = self._get_preference_lists(keys)
+        self._fan_out_batches_async('get_versions', self._get_read_batches(pref_lists),
+                                    lambda responses: callback(
+                                        self._get_multi_get_results(pref_lists, responses)))
+        
+    def multi_put_async(self, items, callback=None):
+        """
+        Puts a number of keys with batched calls to their coordinators, 
+        their other replicas and the fallbacks of those that are down or 
+        fail, as LoadBalancer.multi_put does
+        
+        :Parameters:
+            items : list(tuple(str, str))
+                (key, value) pairs
+            callback : function
+                Called with 200 for each key the write quorum acknowledged,
+                400 otherwise
+        """
+        write = _MultiPut(self, items)
+        def hinted(responses):
+            write.add_hinted(responses)
+            callback(write.get_results())
+        def replicated(batches, responses):
+            write.add_replicated(batches, responses)
+            self._fan_out_batches_async('hinted_multi_put', write.get_hint_batches(), 
+                                        hinted)
+        def coordinate(pending):
+            if not pending:
+                batches = write.get_replica_batches()
+                self._fan_out_batches_async('replica_multi_put', batches, 
+                                            lambda responses: replicated(batches, responses))
+                return
+            batches = write.get_coordinate_batches(pending)
+            self._fan_out_batches_async('coordinate_multi_put', batches,
+                                        lambda responses: coordinate(
+                                            write.add_stamped(batches, responses)))
+        coordinate(write.get_pending())
+        
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _has_node(self, node):
+        """
+        :rtype: bool
+        :returns: Whether a storage node has a client
+        """
+        return node in self.clients
+    
+    def _open_node(self, node):
+        """
+        Creates the client of a storage node
+        """
+        self.clients[node] = _StorageNodeClient(self, node)
+        
+    def _close_node(self, node):
+        """
+        Closes the client of a storage node, failing its outstanding calls
+        """
+        self.clients.pop(node).close()
+        self._remove_node_metrics(node)
+        
+    def _run_sync(self, func):
+        """
+        Wraps a method that returns its result for _dispatch, which runs it
+        on the event loop thread
+        """
+        def handler(*params, **kwargs):
+            kwargs['callback'](func(*params))
+        return handler
+    
+    def _fan_out_async(self, key, method, args, quorum, is_success, callback):
+        """
+        Sends an RPC to every replica of a key and calls callback with the
+        successful responses by node once quorum of them succeed, or with 
+        None once the quorum can no longer be reached
+        """
+        try:
+            nodes = self.datastore_view.get_preference_list(key, self.replicas)
+        except:
+            logging.exception('Error routing key=%s' % key)
+            callback(None)
+            return
+        
+        quorum_call = _QuorumCall(self, method, args, min(quorum, len(nodes)), 
+                                  is_success, callback, time.time() + self.timeout)
+        quorum_call.start(nodes)
+    
+    def _fan_out_batches_async(self, method, batches, callback):
+        """
+        Sends a batched RPC to a number of nodes and calls callback with the
+        responses of the nodes that answered in time, by node
+        """
+        responses = {}
+        pending = [len(batches)]
+        if not batches:
+            callback(responses)
+            return
+        deadline = time.time() + self.timeout
+        def add(node, error, result):
+            if error is None:
+                self._call_succeeded(node)
+                responses[node] = result
+            else:
+                self._call_failed(node, error)
+                logging.error('Error calling %s on node=%s: %s' % (method, node, error))
+            pending[0] -= 1
+            if not pending[0]:
+                callback(responses)
+        for node, batch in batches.items():
+            self.clients[node].call(method, (batch,), deadline, 
+                                    lambda error, result, node=node: add(node, error, result))
+    
+    def _coordinate_async(self, nodes, method, args, callback):
+        """
+        Sends a write to the coordinator of a key, moving on to the next 
+        replica if the call fails, and calls callback with the node that 
+        took the write and its response, or with None and None if no 
+        replica did
+        """
+        coordinators = iter(self._get_coordinators(nodes))
+        deadline = time.time() + self.timeout
+        def send():
+            node = next(coordinators, None)
+            if node is None:
+                callback(None, None)
+                return
+            def done(error, result):
+                if error is None:
+                    self._call_succeeded(node)
+                else:
+                    self._call_failed(node, error)
+                if error is None and result is not None:
+                    callback(node, result)
+                else:
+                    logging.error('Error calling %s on node=%s: %s' % (method, node, error))
+                    send()
+            self.clients[node].call(method, args, deadline, done)
+        send()
+    
+    def _dispatch(self, method, params, respond):
+        """
+        Runs an RPC from a client and calls respond with its result, or with
+        an xmlrpclib.Fault if it failed
+        """
+        handler = self.async_methods.get(method)
+        if handler is None:
+            respond(xmlrpclib.Fault(1, 'method "%s" is not supported' % method))
+            return
+        histogram, errors = self.rpc_metrics[method]
+        start = time.time()
+        def timed_respond(result):
+            histogram.record_since(start)
+            if isinstance(result, xmlrpclib.Fault):
+                errors.add()
+            respond(result)
+        try:
+            handler(*params, callback=timed_respond)
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            timed_respond(xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value)))
+            
+    def _expire(self, now):
+        """
+        Fails storage node requests that are past their deadline
+        """
+        for client in self.clients.values():
+            client.expire(now)
+            
+    def _gossip(self, now):
+        """
+        Starts a gossip round with a storage node once the last round's 
+        interval has passed
+        """
+        if not self.membership.interval or now < self.next_gossip:
+            return
+        self.next_gossip = now + self.membership.interval
+        node = self.membership.start_round(now)
+        if node is None or node not in self.clients:
+            return
+        deadline = now + self.timeout
+        def pushed(error, result):
+            if error is not None:
+                self.membership.fail_round(node, error)
+            else:
+                self.membership.merge(result)
+        def done(error, result):
+            if error is not None:
+                self.membership.fail_round(node, error)
+                return
+            push = self.membership.finish_round(result)
+            if push is not None and node in self.clients:
+                self.clients[node].call('gossip', (push,), deadline, pushed)
+        self.clients[node].call('gossip', (self.membership.get_state(),), deadline, done)
+            
+class _QuorumCall(object):
+    """
+    Collects the responses of the replicas of one client request, sending
+    the call to a fallback node as a hint for each replica that is down or
+    fails
+    """
+    def __init__(self, engine, method, args, quorum, is_success, callback, 
+                 deadline, fallbacks=None):
+        self.engine = engine
+        self.method = method
+        self.args = args
+        self.quorum = quorum
+        self.is_success = is_success
+        self.callback = callback
+        self.deadline = deadline
+        self.fallbacks = fallbacks if fallbacks is not None else iter(())
+        self.responses = {}
+        self.pending = 0
+        self.done = False
+        
+    def start(self, nodes):
+        """
+        Sends the call to the nodes, or to fallbacks for those that are down.
+        Nodes that are down without a fallback are skipped while the others
+        can make the quorum.
+        """
+        # Every node is pending before the first is sent, since a call can
+        # fail before send returns
+        calls = self.engine._route(nodes, self.quorum, self.fallbacks)
+        self.pending = len(calls)
+        for node, owner in calls:
+            self.send(node, owner)
+        if not self.done and self.quorum <= 0:
+            self.done = True
+            self.callback(self.responses)
+    
+    def send(self, node, owner=None):
+        """
+        Sends the call to a node, as a hint for owner if it is given
+        """
+        method, args = self.method, self.args
+        if owner is not None:
+            method, args = 'hinted_' + method, args + (owner,)
+        self.engine.clients[node].call(method, args, self.deadline, 
+                                       lambda error, result: 
+                                           self.add(node, owner, error, result))
+        
+    def add(self, node, owner, error, result):
+        if error is None:
+            self.engine._call_succeeded(node)
+        else:
+            self.engine._call_failed(node, error)
+        if self.done:
+            return
+        if error is None and (self.is_success is None or self.is_success(result)):
+            self.responses[node] = result
+            self.pending -= 1
+        else:
+            logging.error('Error calling %s on node=%s: %s' % (self.method, node, error))
+            fallback = next(self.fallbacks, None)
+            if fallback is not None:
+                self.send(fallback, owner or node)
+            else:
+                self.pending -= 1
+        
+        if self.done:
+            return
+        if len(self.responses) >= self.quorum:
+            self.done = True
+            self.callback(self.responses)
+        elif len(self.responses) + self.pending < self.quorum:
+            self.done = True
+            self.callback(None)
+            
+# ------------------------------------------------------
+# Storage node connections
+# ------------------------------------------------------
+class _PendingCall(object):
+    """
+    An RPC to a storage node waiting for its response
+    """
+    __slots__ = ('method', 'args', 'deadline', 'callback', 'retries', 'done', 
+                 'offset')
+    
+    def __init__(self, method, args, deadline, callback):
+        self.method = method
+        self.args = args
+        self.deadline = deadline
+        self.callback = callback
+        self.retries = 0
+        self.done = False
+        self.offset = None
+        
+    def finish(self, error, result=None):
+        if self.done:
+            return
+        self.done = True
+        try:
+            self.callback(error, result)
+        except:
+            logging.exception('Error in the %s callback' % self.method)
+        
+class _StorageNodeClient(object):
+    """
+    Queues RPCs to one storage node and spreads them over its connections
+    """
+    def __init__(self, engine, node):
+        host, port = node.rsplit(':', 1)
+        self.engine = engine
+        self.node = node
+        self.address = (host, int(port))
+        self.queue = deque()
+        self.connections = []
+        
+    def call(self, method, args, deadline, callback):
+        """
+        Calls an RPC method on the node
+        
+        :Parameters:
+            method : str
+                The RPC method name
+            args : tuple
+                The RPC arguments
+            deadline : float
+                Time after which the call fails 
+            callback : function
+                Called with (error, result) once the call finishes
+        """
+        start = time.time()
+        def timed_callback(error, result):
+            self.engine._record_call(self.node, method, start, error is not None)
+            callback(error, result)
+        self.queue.append(_PendingCall(method, args, deadline, timed_callback))
+        self.dispatch()
+        
+    def close(self):
+        """
+        Fails the queued calls and closes the connections to the node
+        """
+        error = IOError('%s was removed from the ring' % self.node)
+        queue, self.queue = self.queue, deque()
+        for call in queue:
+            call.finish(error)
+        for conn in list(self.connections):
+            conn._close(error)
+        
+    def dispatch(self):
+        """
+        Sends queued calls on connections that can take them
+        """
+        while self.queue:
+            if self.queue[0].done:
+                self.queue.popleft()
+                continue
+            conn = self._get_connection()
+            if conn is None:
+                break
+            conn.send_call(self.queue.popleft())
+            
+    def connection_closed(self, conn, calls, error):
+        """
+        Called by a connection once it has closed with the calls it had not
+        received responses for.  Calls cut off by the node closing an idle 
+        connection are retried once if none of their request was written, 
+        others fail with the error since the node may have run them.
+        """
+        if conn in self.connections:
+            self.connections.remove(conn)
+        for call in reversed(calls):
+            if isinstance(error, _ConnectionClosed) and call.retries == 0 and \
+                    not conn.was_written(call):
+                call.retries += 1
+                self.queue.appendleft(call)
+            else:
+                call.finish(error)
+        self.dispatch()
+        
+    def expire(self, now):
+        """
+        Fails calls that are past their deadline
+        """
+        if self.queue and any(call.deadline <= now for call in self.queue):
+            for call in self.queue:
+                if call.deadline <= now:
+                    call.finish(_Timeout('Timed out calling %s on %s' % 
+                                         (call.method, self.node)))
+            self.queue = deque(call for call in self.queue if not call.done)
+        for conn in list(self.connections):
+            conn.expire(now)
+            
+    def _get_connection(self):
+        """
+        Gets the least loaded connection that can take another call, opening
+        a new one if none can and the node is below max_connections
+        """
+        best = None
+        for conn in self.connections:
+            if conn.can_send() and (best is None or 
+                                    len(conn.in_flight) < len(best.in_flight)):
+                best = conn
+        if (best is None or best.in_flight) and \
+                len(self.connections) < self.engine.max_connections:
+            best = _StorageNodeConnection(self)
+            self.connections.append(best)
+        return best
+    
+class _ConnectionClosed(IOError):
+    pass
+
+class _Timeout(IOError):
+    pass
+
+class _StorageNodeConnection(asynchat.async_chat):
+    """
+    A non-blocking HTTP connection to a storage node.  Until the node's first
+    response shows whether it keeps connections alive only one request is
+    written; afterwards requests are pipelined up to max_pipeline deep.
+    """
+    REQUEST = ('POST /RPC2 HTTP/1.1\r\nHost: %s\r\nContent-Type: text/xml\r\n'
+               'Content-Length: %s\r\n\r\n')
+    
+    def __init__(self, client):
+        asynchat.async_chat.__init__(self, map=client.engine.socket_map)
+        self.client = client
+        self.in_flight = deque()
+        self.keep_alive = None
+        self.closing = False
+        self.pushed = 0
+        self.written = 0
+        self._reset()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(client.address)
+        
+    def can_send(self):
+        if self.closing or self.keep_alive is False:
+            return False
+        if self.keep_alive is None:
+            return not self.in_flight
+        return len(self.in_flight) < self.client.engine.max_pipeline
+    
+    def send_call(self, call):
+        body = xmlrpclib.dumps(call.args, call.method, allow_none=True)
+        request = self.REQUEST % (self.client.node, len(body)) + body
+        call.offset = self.pushed
+        self.pushed += len(request)
+        self.in_flight.append(call)
+        self.push(request)
+        
+    def was_written(self, call):
+        """
+        :rtype: bool
+        :returns: Whether any of the request of a call sent on the connection 
+                  was written to the socket
+        """
+        return self.written > call.offset
+        
+    def expire(self, now):
+        """
+        Fails the calls past their deadline.  Responses arrive in order, so
+        the connection is closed and the remaining calls that were not yet 
+        written are retried.
+        """
+        if any(call.deadline <= now for call in self.in_flight):
+            for call in self.in_flight:
+                if call.deadline <= now:
+                    call.finish(_Timeout('Timed out calling %s on %s' % 
+                                         (call.method, self.client.node)))
+            self._close(_ConnectionClosed('Connection reset after a timeout'))
+            
+    # ------------------------------------------------------
+    # asynchat callbacks
+    # ------------------------------------------------------
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        self.written += sent
+        return sent
+        
+    def found_terminator(self):
+        if self.status is None:
+            self._parse_head(''.join(self.buffer))
+            self.buffer = []
+            if self.length:
+                self.set_terminator(self.length)
+                return
+        body = ''.join(self.buffer)
+        status = self.status
+        self._reset()
+        self._handle_response(status, body)
+        
+    def handle_connect(self):
+        pass
+        
+    def handle_close(self):
+        self._close(_ConnectionClosed('Connection to %s closed' % self.client.node))
+        
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        logging.error('Error on the connection to %s: %s' % (self.client.node, error))
+        self._close(error)
+        
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _reset(self):
+        self.buffer = []
+        self.status = None
+        self.length = 0
+        self.set_terminator('\r\n\r\n')
+        
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        version, status = lines[0].split(' ', 2)[:2]
+        headers = _parse_headers(lines[1:])
+        self.status = int(status)
+        self.length = int(headers.get('content-length', 0))
+        self.keep_alive = version == 'HTTP/1.1' and \
+                          headers.get('connection', '').lower() != 'close'
+        
+    def _handle_response(self, status, body):
+        call = self.in_flight.popleft()
+        if status != 200:
+            call.finish(xmlrpclib.ProtocolError(self.client.node, status, 
+                                                'HTTP error', {}))
+        else:
+            try:
+                result = xmlrpclib.loads(body)[0][0]
+            except:
+                call.finish(sys.exc_info()[1])
+            else:
+                call.finish(None, result)
+        
+        if self.keep_alive:
+            self.client.dispatch()
+        else:
+            self._close(_ConnectionClosed('Connection to %s closed' % self.client.node))
+        
+    def _close(self, error):
+        if self.closing:
+            return
+        self.closing = True
+        self.close()
+        calls = [call for call in self.in_flight if not call.done]
+        self.in_flight.clear()
+        self.client.connection_closed(self, calls, error)
+        
+# ------------------------------------------------------
+# Client connections
+# ------------------------------------------------------
+class _FrontendListener(asyncore.dispatcher):
+    """
+    Accepts client connections
+    """
+    def __init__(self, engine, port, connection_class):
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.engine = engine
+        self.connection_class = connection_class
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', port))
+        self.listen(engine.LISTEN_BACKLOG)
+        
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connection_class(self.engine, pair[0])
+            
+    def handle_error(self):
+        logging.exception('Error accepting a connection')
+
+class _FrontendConnection(asynchat.async_chat):
+    """
+    An HTTP connection from a client.  Pipelined requests are dispatched as
+    soon as they are read and their responses are written back in order.
+    """
+    RESPONSE = ('HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n'
+                'Content-Length: %s\r\n\r\n')
+    
+    def __init__(self, engine, sock):
+        asynchat.async_chat.__init__(self, sock, map=engine.socket_map)
+        self.engine = engine
+        self.responses = deque()
+        self.close_after = False
+        self.closing = False
+        self._reset()
+        
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        
+    def found_terminator(self):
+        if self.head is None:
+            self.head = ''.join(self.buffer)
+            self.buffer = []
+            lines = self.head.split('\r\n')
+            version = lines[0].split(' ')[-1]
+            headers = _parse_headers(lines[1:])
+            if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                self.close_after = True
+            length = int(headers.get('content-length', 0))
+            if length:
+                self.set_terminator(length)
+                return
+        body = ''.join(self.buffer)
+        self._reset()
+        self._handle_request(body)
+        
+    def handle_close(self):
+        self.closing = True
+        self.close()
+        
+    def handle_error(self):
+        logging.exception('Error on a client connection')
+        self.handle_close()
+        
+    def _reset(self):
+        self.buffer = []
+        self.head = None
+        self.set_terminator('\r\n\r\n')
+        
+    def _handle_request(self, body):
+        slot = [None]
+        self.responses.append(slot)
+        try:
+            params, method = xmlrpclib.loads(body)
+        except:
+            self._respond(slot, xmlrpclib.Fault(1, 'Invalid request'))
+            return
+        self.engine._dispatch(method, params, 
+                              lambda result: self._respond(slot, result))
+        
+    def _respond(self, slot, result):
+        if self.closing:
+            return
+        if isinstance(result, xmlrpclib.Fault):
+            slot[0] = xmlrpclib.dumps(result)
+        else:
+            slot[0] = xmlrpclib.dumps((result,), methodresponse=True, allow_none=True)
+        while self.responses and self.responses[0][0] is not None:
+            response = self.responses.popleft()[0]
+            self.push(self.RESPONSE % len(response) + response)
+        if self.close_after and not self.responses:
+            self.closing = True
+            self.close_when_done()
+        
+class _BinaryFrontendConnection(asynchat.async_chat):
+    """
+    A binary protocol connection from a client.  Requests are dispatched as 
+    soon as they are read and each response is written once it completes.
+    """
+    def __init__(self, engine, sock):
+        asynchat.async_chat.__init__(self, sock, map=engine.socket_map)
+        self.engine = engine
+        self.closing = False
+        self._reset()
+        
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        
+    def found_terminator(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.request_id is None:
+            size, self.request_id, kind = binary_rpc.parse_header(data)
+            if kind != binary_rpc.REQUEST:
+                raise ValueError('Expected a request, not a frame of kind %s' % kind)
+            self.set_terminator(size)
+            return
+        request_id = self.request_id
+        self._reset()
+        try:
+            method, params = binary_rpc.loads(data)
+        except:
+            self._respond(request_id, xmlrpclib.Fault(1, 'Invalid request'))
+            return
+        self.engine._dispatch(method, params, 
+                              lambda result: self._respond(request_id, result))
+        
+    def handle_close(self):
+        self.closing = True
+        self.close()
+        
+    def handle_error(self):
+        logging.exception('Error on a binary client connection')
+        self.handle_close()
+        
+    def _reset(self):
+        self.buffer = []
+        self.request_id = None
+        self.set_terminator(binary_rpc.HEADER.size)
+        
+    def _respond(self, request_id, result):
+        if self.closing:
+            return
+        for run in binary_rpc.join_chunks(binary_rpc.dump_reply(request_id, result)):
+            self.push(run)
+        
+def _parse_headers(lines):
+    """
+    Parses HTTP header lines into a dict keyed by lower case header names
+    """
+    headers = {}
+    for line in lines:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
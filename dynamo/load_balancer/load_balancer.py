@@ -3,12 +3,21 @@
 # Imports
 # ------------------------------------------------------
 import logging
-import xmlrpclib
+import time
 import exceptions
+import Queue
+import xmlrpclib
+from collections import defaultdict
 from optparse import OptionParser
-from SimpleXMLRPCServer import SimpleXMLRPCServer
 
-from dynamo.storage.datastore_view import DataStoreView
+from dynamo.lib.consistent_hash import HASH_FUNCTIONS
+from dynamo.lib.metrics import Metrics, MetricsServer
+from dynamo.lib.vector_clock import VersionClock, reconcile, get_context
+from dynamo.lib.thread_pool import ThreadPool
+from dynamo.lib.rpc import ConnectionPool, PooledServerProxy, create_server, \
+    create_binary_server
+from dynamo.storage.datastore_view import DataStoreView, encode_ranges, parse_servers
+from dynamo.storage.membership import Membership
 
 # ------------------------------------------------------
 # Config
@@ -20,29 +29,116 @@ logging.basicConfig(level=logging.INFO)
 # ------------------------------------------------------
 class LoadBalancer(object):
     """
-    A load balancer that routes requests to the appropriate storage node
+    A load balancer that routes requests to the appropriate storage node.
+    
+    Writes use a sloppy quorum.  A storage node that fails a call is 
+    marked down for down_interval seconds.  While a replica is down, or as
+    soon as a write to it fails, its write goes to the next healthy node 
+    after the key's preference list instead.  That node stores it as a 
+    hint and replays it to the replica once the replica is back.  Hints 
+    count towards the write quorum.
+    
+    The load balancer also gossips with the storage nodes, see 
+    membership.Membership, to learn membership changes made elsewhere and 
+    the nodes' heartbeats.  A node whose heartbeats stop is suspected and 
+    treated as down before any request to it fails.  Reads skip replicas
+    that are down while the others can still make the read quorum.
+    
+    The latency and errors of every RPC method, and of the calls to each 
+    storage node by method, are kept in metrics, returned by the stats RPC
+    and optionally served to Prometheus on metrics_port.
     """
-    CONN_STR = 'http://%s'
+    FAN_OUT_WORKERS = 32
+    RPC_METHODS = ('get', 'put', 'multi_get', 'multi_put', 'add_nodes', 
+                   'remove_nodes', 'set_weights', 'membership_stats', 'stats')
     
-    def __init__(self, servers, port):
+    def __init__(self, servers, port, replicas=3, read_quorum=2, write_quorum=2,
+                 timeout=5.0, threads=0, queue_size=64, pool_size=8,
+                 hash_function='md5', partitions=0, binary_port=None,
+                 hinted_handoff=True, down_interval=5.0, gossip_interval=1.0,
+                 phi_threshold=8.0, metrics_port=None):
         """
         Parameters:
             servers : list(str)
                 A list of servers. Each server name is in the 
-                format {host/ip}:port
+                format {host/ip}:port, optionally followed by :weight
+            port : int
+                Port number to start on
+            replicas : int
+                Number of storage nodes (N) each key is written to
+            read_quorum : int
+                Number of replicas (R) that must answer a get
+            write_quorum : int
+                Number of replicas (W) that must acknowledge a put
+            timeout : float
+                Seconds to wait for a quorum before failing a request
+            threads : int
+                Number of RPC worker threads, 0 serves one request at a time
+            queue_size : int
+                Number of connections that can wait for a worker thread
+            pool_size : int
+                Maximum number of keep-alive connections to each storage node
+            hash_function : str
+                The hash function of the ring, which must match the storage nodes'
+            partitions : int
+                Number of equal partitions of the ring, which must match the 
+                storage nodes', 0 for random tokens
+            binary_port : int
+                Port to also serve the binary protocol on, None disables it
+            hinted_handoff : bool
+                Whether writes for replicas that are down go to the next 
+                nodes on the ring as hints
+            down_interval : float
+                Seconds a storage node that failed is passed over by writes
+                before it is tried again
+            gossip_interval : float
+                Seconds between gossip rounds with a storage node, 0 
+                disables them
+            phi_threshold : float
+                The suspicion level past which a storage node whose 
+                heartbeats stopped is treated as down
+            metrics_port : int
+                Port to serve the metrics to Prometheus on, None disables it
         """
         self.port = int(port)
         self.server = None
+        self.binary_port = binary_port
+        self.binary_server = None
+        self.threads = threads
+        self.queue_size = queue_size
         if not servers:
             raise exceptions.ValueError("Cannot have empty server list")
+        if not 0 < read_quorum <= replicas or not 0 < write_quorum <= replicas:
+            raise exceptions.ValueError("Quorums must be between 1 and %s" % replicas)
+        self.replicas = replicas
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.hinted_handoff = hinted_handoff
+        self.down_interval = down_interval
+        self.down = {}
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.call_metrics = {}
         
         # Create the load balancer's view of the storage node ring
-        self.datastore_view = DataStoreView(servers)
+        self.datastore_view = DataStoreView(servers, replicas, 
+                                            hash_function=hash_function,
+                                            partitions=partitions)
+        self.membership = Membership(None, servers, self._get_conn, self._set_members,
+                                     interval=gossip_interval, threshold=phi_threshold)
         
-        # Open connections to each server
+        # Open connection pools to each server.  Calls check a connection 
+        # out so the proxies can be shared by the fan out workers
+        self.servers = parse_servers(servers)[0]
         self.server_conns = {}
-        for server in servers:
-            self.server_conns[server] = xmlrpclib.ServerProxy(self.CONN_STR % server)
+        for server in self.servers:
+            self._open_node(server)
+        self.fan_out_pool = None
+        if self.FAN_OUT_WORKERS:
+            self.fan_out_pool = ThreadPool(self.FAN_OUT_WORKERS, name='fan-out')
 
     # ------------------------------------------------------
     # Public methods
@@ -51,30 +147,54 @@ class LoadBalancer(object):
         """
         Main storage node loop
         """
-        self.server = SimpleXMLRPCServer(('', self.port), allow_none=True)
-        self.server.register_function(self.get, "get")
-        self.server.register_function(self.put, "put")  
+        self.server = create_server(self.port, self.threads, self.queue_size)
+        self._register_functions(self.server)
+        if self.binary_port is not None:
+            self.binary_server = create_binary_server(self.binary_port, self.threads, 
+                                                      self.queue_size)
+            self._register_functions(self.binary_server)
+            self.binary_server.start()
+        if self.membership.interval:
+            self.membership.start()
+        self._start_metrics_server()
         self.server.serve_forever()
 
     # ------------------------------------------------------
     # RPC methods
     # ------------------------------------------------------         
-    def get(self, key):
+    def get(self, key, with_context=False):
         """
-        Gets a key from the appropriate storage node
+        Gets a key from the storage nodes holding its replicas.  The read is
+        sent to all N replicas in parallel and the versions the first R to 
+        answer hold are merged by their clocks, so a stale replica's 
+        versions are dropped however many replicas return them.  The latest
+        written of the siblings is returned, or with context all of them 
+        with the context that a put resolving them passes back.
         
         :Parameters:
             key : str
                 The key value        
+            with_context : bool
+                Whether to return the siblings and their context
+        :rtype: str or dict
+        :returns: The value, or with context a {'values': values, 'context':
+                  context} dict.  None if the read quorum failed.
         """
         value = None
         try:
-            # Find the responsbile node
-            respon_node = self.datastore_view.get_node(key)
-            logging.debug('Getting key=%s from node=%s' % (key, respon_node))        
+            # Find the responsbile nodes
+            respon_nodes = self.datastore_view.get_preference_list(key, self.replicas)
+            logging.debug('Getting key=%s from nodes=%s' % (key, respon_nodes))        
     
-            # Get the value from that node
-            value = self.server_conns[respon_node].get(key)
+            # Get the versions from those nodes
+            responses = self._fan_out(respon_nodes, 'get_versions', ([key],),
+                                      self.read_quorum)
+            if responses is None:
+                raise RuntimeError('Read quorum not reached')
+            if with_context:
+                value = self._merge_versions(responses.values())
+            else:
+                value = self._choose_value(responses.values())
             
             logging.debug('Value=%s' % value)
         except:
@@ -84,7 +204,12 @@ class LoadBalancer(object):
     
     def put(self, key, value, context=None):
         """
-        Puts a key in the appropriate datastore
+        Puts a key in the appropriate datastores.  The write is stamped by 
+        its coordinator, the first replica that is up, and the stamped 
+        version sent to the other replicas in parallel.  The write succeeds
+        once W replicas, the coordinator included, acknowledge it.  Versions
+        for replicas that are down or fail go to the next nodes on the ring
+        as hints.
         
         :Parameters:
             key : str
@@ -92,35 +217,781 @@ class LoadBalancer(object):
             value : str
                 The value
             context : str
-                Should be only be None for now.  In the future an application will be
-                able to add a custom context string
+                The context returned by a get with context, whose siblings
+                the value replaces.  None replaces every version the 
+                replicas hold.
                 
         :rtype: str
         :returns 200 if the operation succeeded, 400 otherwise
         """
         respon_code = None
         try:
-            # Find the responsbile node
-            respon_node = self.datastore_view.get_node(key)
-            logging.debug('Putting key=%s on node=%s' % (key, respon_node))        
+            # Find the responsbile nodes
+            respon_nodes = self.datastore_view.get_preference_list(key, self.replicas)
+            logging.debug('Putting key=%s on nodes=%s' % (key, respon_nodes))        
 
-            # Get the value from that node
-            respon_code = self.server_conns[respon_node].put(key, value)                
+            # Stamp the write on its coordinator and send the version to the
+            # other replicas
+            coordinator, version = self._coordinate(respon_nodes, 'coordinate_put', 
+                                                    (key, value, context))
+            if coordinator is None:
+                raise RuntimeError('No replica coordinated the write')
+            others = [node for node in respon_nodes if node != coordinator]
+            responses = self._fan_out(others, 'replica_put', (key, value) + tuple(version), 
+                                      min(self.write_quorum, len(respon_nodes)) - 1, 
+                                      lambda code: code == '200',
+                                      self._get_fallbacks(key))
+            respon_code = '200' if responses is not None else '400'
         except:
             logging.error("Error putting key=%s, value=%s" % (key,value))
             respon_code = "400"
         return respon_code
 
+    def multi_get(self, keys):
+        """
+        Gets a number of keys.  Keys are grouped by the storage nodes holding
+        their replicas and each node is sent one get_versions in parallel.
+        The versions of each key are merged by their clocks and the latest 
+        written of its siblings returned, as get does.
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: dict(str, dict)
+        :returns: A {'status': status, 'value': value} dict for each key.  The
+                  status is 200 if the read quorum answered, 400 otherwise.
+        """
+        pref_lists = self._get_preference_lists(keys)
+        responses = self._fan_out_batches('get_versions', self._get_read_batches(pref_lists))
+        return self._get_multi_get_results(pref_lists, responses)
+    
+    def multi_put(self, items):
+        """
+        Puts a number of keys.  Keys are grouped by their coordinators, the 
+        first of their replicas that is up, and each coordinator is sent one
+        coordinate_multi_put in parallel; keys whose coordinator fails move 
+        on to their next replica.  The stamped versions are then grouped by
+        the other replicas, which are sent one replica_multi_put each, and 
+        the versions for replicas that are down or fail by the next nodes on
+        the ring, which are sent one hinted_multi_put each.
+        
+        :Parameters:
+            items : list(tuple(str, str))
+                (key, value) pairs
+        :rtype: dict(str, str)
+        :returns: 200 for each key the write quorum acknowledged, 400 otherwise
+        """
+        write = _MultiPut(self, items)
+        pending = write.get_pending()
+        while pending:
+            batches = write.get_coordinate_batches(pending)
+            pending = write.add_stamped(batches, self._fan_out_batches('coordinate_multi_put', 
+                                                                       batches))
+        batches = write.get_replica_batches()
+        write.add_replicated(batches, self._fan_out_batches('replica_multi_put', batches))
+        hints = write.get_hint_batches()
+        write.add_hinted(self._fan_out_batches('hinted_multi_put', hints))
+        return write.get_results()
+
+    def add_nodes(self, nodes):
+        """
+        Adds storage nodes to the ring.  Connections to them are set up 
+        before the new ring is swapped in, so requests routed by it can 
+        reach them.
+        
+        :Parameters:
+            nodes : list(str)
+                The node names, each in the format {host/ip}:port optionally
+                followed by :weight
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        names = parse_servers(nodes)[0]
+        opened = [node for node in names if not self._has_node(node)]
+        for node in opened:
+            self._open_node(node)
+        try:
+            moved = self.datastore_view.add_nodes(nodes)
+        except:
+            for node in opened:
+                self._close_node(node)
+            raise
+        self.servers.extend(names)
+        self.membership.record(weights=parse_servers(nodes)[1])
+        return encode_ranges(moved)
+    
+    def remove_nodes(self, nodes):
+        """
+        Removes storage nodes from the ring and then closes their connections
+        
+        :Parameters:
+            nodes : list(str)
+                The node names
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        moved = self.datastore_view.remove_nodes(nodes)
+        for node in nodes:
+            if self._has_node(node):
+                self._close_node(node)
+            if node in self.servers:
+                self.servers.remove(node)
+            self.down.pop(node, None)
+        self.membership.record(left=nodes)
+        return encode_ranges(moved)
+    
+    def set_weights(self, weights):
+        """
+        Changes the weights of storage nodes in the ring
+        
+        :Parameters:
+            weights : dict(str, float)
+                The new weight of each node
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        moved = self.datastore_view.set_weights(weights)
+        self.membership.record(weights=weights)
+        return encode_ranges(moved)
+    
+    def membership_stats(self):
+        """
+        Gets the gossip counters
+        
+        :rtype: dict
+        :returns: The ring version, the members, the phi of each storage 
+                  node and the suspected ones, see Membership.stats
+        """
+        return self.membership.stats()
+    
+    def stats(self):
+        """
+        Gets the latency histograms and error counters of the load balancer
+        
+        :rtype: dict
+        :returns: The count, sum, min, max and quantiles in seconds of the 
+                  latencies of each RPC method and of the calls to each 
+                  storage node by method, and the errors of each, see 
+                  Metrics.snapshot
+        """
+        return self.metrics.snapshot()
+        
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _register_functions(self, server):
+        """
+        Registers the RPC methods with a server
+        """
+        for method in self.RPC_METHODS:
+            server.register_function(self.metrics.timed('rpc', getattr(self, method), 
+                                                        method=method), method)
+    
+    def _start_metrics_server(self):
+        """
+        Serves the metrics to Prometheus if a metrics port is set
+        """
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
+        
+    def _is_down(self, node):
+        """
+        Whether a storage node is suspected by the failure detector or 
+        failed within the last down_interval seconds
+        """
+        if self.membership.is_suspected(node):
+            return True
+        failed_at = self.down.get(node)
+        return failed_at is not None and time.time() - failed_at < self.down_interval
+    
+    def _call_failed(self, node, error):
+        """
+        Marks a storage node down if a call to it failed for any reason other
+        than a fault raised by the node itself
+        """
+        if error is not None and not isinstance(error, xmlrpclib.Fault):
+            if not self._is_down(node):
+                logging.info('Marking node=%s down' % node)
+            self.down[node] = time.time()
+    
+    def _call_succeeded(self, node):
+        """
+        Marks a storage node that answered as up
+        """
+        if self.down.pop(node, None) is not None:
+            logging.info('Marking node=%s up' % node)
+    
+    def _set_members(self, weights):
+        """
+        Swaps in a ring of the members gossip agreed on.  Connections to new
+        members are opened before the ring is swapped in and those to 
+        members that left are closed after.
+        
+        :Parameters:
+            weights : dict(str, float)
+                The weight of each member
+        """
+        for node in weights:
+            if node not in self.servers:
+                self._open_node(node)
+        self.datastore_view.set_members(weights)
+        for node in self.servers:
+            if node not in weights:
+                self._close_node(node)
+                self.down.pop(node, None)
+        self.servers = sorted(weights)
+        
+    def _route(self, nodes, quorum, fallbacks):
+        """
+        Picks the nodes to send a call for each of a key's replicas to.  A
+        replica that is down is stood in for by the next fallback, or 
+        skipped if there is none and the replicas that are up can make the
+        quorum without it.
+        
+        :Parameters:
+            nodes : list(str)
+                The replicas
+            quorum : int
+                Number of successful responses needed
+            fallbacks : iterator(str)
+                Nodes that stand in for replicas that are down
+        :rtype: list(tuple(str, str))
+        :returns: (node, owner) pairs, owner being the replica a fallback 
+                  stands in for and None for the replicas themselves
+        """
+        down = [node for node in nodes if self._is_down(node)]
+        calls = []
+        for node in nodes:
+            if node in down:
+                fallback = next(fallbacks, None)
+                if fallback is not None:
+                    calls.append((fallback, node))
+                    continue
+                if len(nodes) - len(down) >= quorum:
+                    continue
+            calls.append((node, None))
+        return calls
+    
+    def _get_coordinators(self, nodes):
+        """
+        Orders the replicas of a key in which they are tried as the 
+        coordinator of a write, the first of them that are up first
+        
+        :Parameters:
+            nodes : list(str)
+                The key's preference list
+        :rtype: list(str)
+        """
+        return [node for node in nodes if not self._is_down(node)] + \
+            [node for node in nodes if self._is_down(node)]
+    
+    def _coordinate(self, nodes, method, args):
+        """
+        Calls a write on the coordinator of a key, moving on to the next 
+        replica if the call fails or times out
+        
+        :Parameters:
+            nodes : list(str)
+                The key's preference list
+            method : str
+                The RPC method name
+            args : tuple
+                The RPC arguments
+        :rtype: tuple(str, object)
+        :returns: The node that took the write and its response, or None 
+                  and None if no replica did
+        """
+        for node in self._get_coordinators(nodes):
+            future = self.fan_out_pool.submit(self._call, node, method, args)
+            try:
+                response = future.result(self.timeout)
+            except Exception, e:
+                logging.error('Error calling %s on node=%s: %s' % (method, node, e))
+                if future.done():
+                    self._call_failed(node, e)
+                continue
+            self._call_succeeded(node)
+            if response is not None:
+                return node, response
+            logging.error('Node=%s did not coordinate %s' % (node, method))
+        return None, None
+    
+    def _get_fallbacks(self, key):
+        """
+        Gets the nodes that take the hints for a key's replicas, which are 
+        the nodes after its preference list that are not down.  The nodes 
+        are only looked up once the first is needed.
+        
+        :Parameters:
+            key : str
+                The key name
+        :rtype: iterator(str)
+        :returns: The nodes in ring order
+        """
+        if not self.hinted_handoff:
+            return
+        nodes = self.datastore_view.get_preference_list(key, len(self.servers))
+        for node in nodes[self.replicas:]:
+            if not self._is_down(node):
+                yield node
+        
+    def _has_node(self, node):
+        """
+        :rtype: bool
+        :returns: Whether a connection to a storage node is open
+        """
+        return node in self.server_conns
+    
+    def _open_node(self, node):
+        """
+        Opens a connection pool to a storage node.  Calls check a connection
+        out so the proxies can be shared by the fan out workers.
+        """
+        host, server_port = node.rsplit(':', 1)
+        pool = ConnectionPool(host, server_port, max_size=self.pool_size, 
+                              timeout=self.timeout)
+        self.server_conns[node] = PooledServerProxy(pool)
+        
+    def _close_node(self, node):
+        """
+        Closes the connection pool to a storage node
+        """
+        self.server_conns.pop(node).pool.close()
+        self._remove_node_metrics(node)
+    
+    def _record_call(self, node, method, start, failed):
+        """
+        Records the latency of a call to a storage node, and its failure
+        
+        :Parameters:
+            node : str
+                The node name
+            method : str
+                The RPC method name
+            start : float
+                The time the call was made
+            failed : bool
+                Whether the call raised an error
+        """
+        metrics = self.call_metrics.get((node, method))
+        if metrics is None:
+            metrics = (self.metrics.histogram('node_call', node=node, method=method),
+                       self.metrics.counter('node_call_errors', node=node, method=method))
+            self.call_metrics[(node, method)] = metrics
+        metrics[0].record_since(start)
+        if failed:
+            metrics[1].add()
+    
+    def _remove_node_metrics(self, node):
+        """
+        Removes the call metrics of a storage node that left the ring
+        """
+        for key in [key for key in self.call_metrics.keys() if key[0] == node]:
+            self.call_metrics.pop(key, None)
+        self.metrics.remove(node=node)
+        
+    def _get_preference_lists(self, keys):
+        """
+        Gets the preference list of each of a number of keys
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: dict(str, list(str))
+        :returns: The nodes responsible for each key
+        """
+        return dict((key, self.datastore_view.get_preference_list(key, self.replicas))
+                    for key in set(keys))
+    
+    def _get_read_batches(self, pref_lists):
+        """
+        Groups keys by the storage nodes holding their replicas
+        
+        :Parameters:
+            pref_lists : dict(str, list(str))
+                The nodes responsible for each key
+        :rtype: dict(str, list(str))
+        :returns: The keys to read from each node
+        """
+        batches = defaultdict(list)
+        for key, nodes in pref_lists.iteritems():
+            for node in nodes:
+                batches[node].append(key)
+        return batches
+    
+    def _get_multi_get_results(self, pref_lists, responses):
+        """
+        Merges the versions of each key the storage nodes sent
+        
+        :Parameters:
+            pref_lists : dict(str, list(str))
+                The nodes responsible for each key
+            responses : dict(str, list(tuple))
+                The get_versions rows of each node that answered
+        :rtype: dict(str, dict)
+        :returns: The status and value of each key, see multi_get
+        """
+        versions = defaultdict(list)
+        for rows in responses.itervalues():
+            for row in rows:
+                versions[row[0]].append(row)
+        
+        results = {}
+        for key, nodes in pref_lists.iteritems():
+            answered = sum(1 for node in nodes if node in responses)
+            if answered >= min(self.read_quorum, len(nodes)):
+                results[key] = {'status': '200', 
+                                'value': self._choose_value([versions[key]])}
+            else:
+                logging.error('Error getting the key=%s' % key)
+                results[key] = {'status': '400', 'value': None}
+        return results
+    
+    def _fan_out_batches(self, method, batches):
+        """
+        Calls a batched RPC method on a number of nodes in parallel and waits
+        for all of them or the timeout
+        
+        :Parameters:
+            method : str
+                The RPC method name
+            batches : dict(str, list)
+                The argument to send each node
+        :rtype: dict(str, object)
+        :returns: The responses of the nodes that answered in time
+        """
+        futures = dict((node, self.fan_out_pool.submit(self._call, node, method, (batch,)))
+                       for node, batch in batches.iteritems())
+        deadline = time.time() + self.timeout
+        responses = {}
+        for node, future in futures.iteritems():
+            try:
+                responses[node] = future.result(max(0, deadline - time.time()))
+                self._call_succeeded(node)
+            except Exception, e:
+                logging.error('Error calling %s on node=%s' % (method, node))
+                if future.done():
+                    self._call_failed(node, e)
+        return responses
+    
+    def _get_conn(self, node):
+        """
+        Gets the connection to a storage node
+        
+        :Parameters:
+            node : str
+                The node name
+        :rtype: PooledServerProxy
+        :returns: A connection to the node
+        """
+        return self.server_conns[node]
+    
+    def _call(self, node, method, args):
+        """
+        Calls an RPC method on a storage node
+        """
+        start = time.time()
+        try:
+            result = getattr(self._get_conn(node), method)(*args)
+        except:
+            self._record_call(node, method, start, True)
+            raise
+        self._record_call(node, method, start, False)
+        return result
+    
+    def _fan_out(self, nodes, method, args, quorum, is_success=None, fallbacks=None):
+        """
+        Calls an RPC method on a number of nodes in parallel and waits until
+        quorum of them succeed.  Calls still running once the quorum is 
+        reached are left to finish in the background.
+        
+        :Parameters:
+            nodes : list(str)
+                The nodes to call
+            method : str
+                The RPC method name
+            args : tuple
+                The RPC arguments
+            quorum : int
+                Number of successful responses needed.  Capped at the number
+                of nodes when the ring holds fewer than N nodes.
+            is_success : function
+                Returns whether a response counts towards the quorum.  By 
+                default any response without an exception does.
+            fallbacks : iterator(str)
+                Nodes that stand in for each node that is down or fails, by
+                calling 'hinted_' + method with the args and the node they 
+                stand in for.  None calls only the nodes given.
+        :rtype: dict(str, object)
+        :returns: The successful responses by node, or None if the quorum 
+                  could not be reached
+        """
+        quorum = min(quorum, len(nodes))
+        if fallbacks is None:
+            fallbacks = iter(())
+        results = Queue.Queue()
+        def submit(node, owner=None):
+            if owner is None:
+                future = self.fan_out_pool.submit(self._call, node, method, args)
+            else:
+                future = self.fan_out_pool.submit(self._call, node, 'hinted_' + method, 
+                                                  args + (owner,))
+            future.add_done_callback(lambda future: results.put((node, owner, future)))
+        
+        calls = self._route(nodes, quorum, fallbacks)
+        for node, owner in calls:
+            submit(node, owner)
+        
+        responses = {}
+        pending = len(calls)
+        deadline = time.time() + self.timeout
+        try:
+            while len(responses) < quorum and len(responses) + pending >= quorum:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty()
+                node, owner, future = results.get(timeout=remaining)
+                if future.exception() is None and \
+                        (is_success is None or is_success(future.result())):
+                    responses[node] = future.result()
+                    self._call_succeeded(node)
+                    pending -= 1
+                    continue
+                
+                logging.error('Error calling %s on node=%s: %s' % 
+                              (method, node, future.exception()))
+                self._call_failed(node, future.exception())
+                fallback = next(fallbacks, None)
+                if fallback is not None:
+                    submit(fallback, owner or node)
+                else:
+                    pending -= 1
+        except Queue.Empty:
+            logging.error('Timed out calling %s on %s' % (method, nodes))
+            
+        if len(responses) < quorum:
+            return None
+        return responses
+    
+    def _merge_versions(self, responses):
+        """
+        Merges the siblings returned by a number of replicas
+        
+        :Parameters:
+            responses : list(list(tuple(str, str, str, str)))
+                The (key, value, date, clock) rows each replica returned
+        :rtype: dict
+        :returns: A {'values': values, 'context': context} dict, with no 
+                  values if no replica had the key
+        """
+        versions = [(value, int(date), VersionClock.decode(clock))
+                    for rows in responses for key, value, date, clock in rows]
+        siblings = reconcile(versions)
+        return {'values': [value for value, date, clock in siblings],
+                'context': get_context(siblings).encode()}
+    
+    def _choose_value(self, responses):
+        """
+        Chooses the value a get without context returns, the latest written
+        of the siblings the replicas hold
+        
+        :Parameters:
+            responses : list(list(tuple(str, str, str, str)))
+                The (key, value, date, clock) rows each replica returned
+        :rtype: str
+        :returns: The value or None if no replica had the key
+        """
+        values = self._merge_versions(responses)['values']
+        if not values:
+            return None
+        return values[-1]
+
+class _MultiPut(object):
+    """
+    The state of a multi_put between its rounds of batched calls, so both 
+    engines send the same batches and count the same acknowledgements.  
+    Each round's batches are got from it, sent, and their responses added
+    back.
+    """
+    def __init__(self, engine, items):
+        if isinstance(items, dict):
+            items = items.items()
+        self.engine = engine
+        self.values = dict(items)
+        self.pref_lists = engine._get_preference_lists(self.values.keys())
+        self.coordinators = dict((key, engine._get_coordinators(nodes)) 
+                                 for key, nodes in self.pref_lists.iteritems())
+        self.stamped = {}
+        self.missed = []
+        self.responses = {}
+        self.hinted = defaultdict(list)
+        self.hint_responses = {}
+        
+    def get_pending(self):
+        """
+        :rtype: list(str)
+        :returns: The keys to stamp in the first round
+        """
+        return list(self.values)
+    
+    def get_coordinate_batches(self, pending):
+        """
+        Groups the keys not stamped yet by their next coordinator
+        
+        :rtype: dict(str, list(tuple(str, str)))
+        :returns: The (key, value) pairs to send each node
+        """
+        batches = defaultdict(list)
+        for key in pending:
+            if self.coordinators[key]:
+                batches[self.coordinators[key].pop(0)].append((key, self.values[key]))
+        return batches
+    
+    def add_stamped(self, batches, responses):
+        """
+        Adds the versions the coordinators stamped
+        
+        :rtype: list(str)
+        :returns: The keys whose coordinator failed, to send to their next 
+                  replica
+        """
+        pending = []
+        for node, batch in batches.iteritems():
+            for key, value in batch:
+                version = responses.get(node, {}).get(key)
+                if version is not None:
+                    self.stamped[key] = (node, version)
+                else:
+                    pending.append(key)
+        return pending
+    
+    def get_replica_batches(self):
+        """
+        Groups the stamped versions by the other replicas of their keys, 
+        setting aside those of replicas that are down
+        
+        :rtype: dict(str, list(tuple(str, str, str, str)))
+        :returns: The (key, value, date, clock) rows to send each node
+        """
+        batches = defaultdict(list)
+        for key, (coordinator, (date, clock)) in self.stamped.iteritems():
+            row = (key, self.values[key], date, clock)
+            for node in self.pref_lists[key]:
+                if node == coordinator:
+                    continue
+                if self.engine.hinted_handoff and self.engine._is_down(node):
+                    self.missed.append((row, node))
+                else:
+                    batches[node].append(row)
+        return batches
+    
+    def add_replicated(self, batches, responses):
+        """
+        Adds the responses of the replicas, setting aside the rows of those
+        that failed
+        """
+        self.responses = responses
+        for node, batch in batches.iteritems():
+            if node not in responses:
+                self.missed.extend((row, node) for row in batch)
+    
+    def get_hint_batches(self):
+        """
+        Groups the rows of the replicas that are down or failed by their 
+        fallbacks.  Each key's hints go to distinct fallbacks, in ring order.
+        
+        :rtype: dict(str, list(tuple(str, str, str, str, str)))
+        :returns: The (key, value, owner, date, clock) hints to send each node
+        """
+        hints = defaultdict(list)
+        if not self.engine.hinted_handoff:
+            return hints
+        fallbacks = {}
+        for (key, value, date, clock), node in self.missed:
+            if key not in fallbacks:
+                fallbacks[key] = self.engine._get_fallbacks(key)
+            fallback = next(fallbacks[key], None)
+            if fallback is not None:
+                hints[fallback].append((key, value, node, date, clock))
+                self.hinted[key].append(fallback)
+        return hints
+    
+    def add_hinted(self, responses):
+        """
+        Adds the responses of the fallbacks
+        """
+        self.hint_responses = responses
+    
+    def get_results(self):
+        """
+        :rtype: dict(str, str)
+        :returns: The status of each key, see LoadBalancer.multi_put
+        """
+        results = {}
+        for key, nodes in self.pref_lists.iteritems():
+            acks = 0
+            if key in self.stamped:
+                acks += 1
+                acks += sum(1 for node in nodes 
+                            if self.responses.get(node, {}).get(key) == '200')
+                acks += sum(1 for node in self.hinted[key]
+                            if self.hint_responses.get(node, {}).get(key) == '200')
+            if acks >= min(self.engine.write_quorum, len(nodes)):
+                results[key] = '200'
+            else:
+                logging.error('Error putting key=%s' % key)
+                results[key] = '400'
+        return results
+
 # ------------------------------------------------------
 # Main
 # ------------------------------------------------------
 def parse_args():
     parser = OptionParser()
     parser.add_option('-s', '--server', dest='servers',
-                      help='List of storage nodes(one per server) (Required)',
+                      help='List of storage nodes(one per server), each host:port or host:port:weight (Required)',
                       action='append', default=[])
     parser.add_option('-p', '--port', dest='port', default=30000,
                       help='Port to start the storage node on')    
+    parser.add_option('-n', '--replicas', dest='replicas', default=3, type='int',
+                      help='Number of storage nodes each key is replicated to')
+    parser.add_option('-r', '--read-quorum', dest='read_quorum', default=2, 
+                      type='int', help='Number of replicas that must answer a get')
+    parser.add_option('-w', '--write-quorum', dest='write_quorum', default=2, 
+                      type='int', help='Number of replicas that must acknowledge a put')
+    parser.add_option('--pool-size', dest='pool_size', default=8, type='int',
+                      help='Maximum number of connections to each storage node')
+    parser.add_option('-e', '--engine', dest='engine', default='xmlrpc',
+                      choices=['xmlrpc', 'async'],
+                      help='xmlrpc serves requests on threads, async from one event loop')
+    parser.add_option('-t', '--threads', dest='threads', default=0, type='int',
+                      help='Number of RPC worker threads, 0 serves one request at a time')
+    parser.add_option('-q', '--accept-queue', dest='queue_size', default=64, 
+                      type='int', help='Connections that can wait for a worker thread')
+    parser.add_option('--hash', dest='hash_function', default='md5',
+                      choices=sorted(HASH_FUNCTIONS),
+                      help='Hash function of the ring, the same on every node')
+    parser.add_option('--binary-port', dest='binary_port', default=None, type='int',
+                      help='Port to also serve the binary protocol on')
+    parser.add_option('--partitions', dest='partitions', default=0, type='int',
+                      help='Equal partitions of the ring, the same on every node, 0 for random tokens')
+    parser.add_option('--down-interval', dest='down_interval', default=5.0, 
+                      type='float', help='Seconds a storage node that failed is passed over by writes')
+    parser.add_option('--gossip-interval', dest='gossip_interval', default=1.0, 
+                      type='float', 
+                      help='Seconds between gossip rounds with a storage node, 0 disables them')
+    parser.add_option('--phi-threshold', dest='phi_threshold', default=8.0, 
+                      type='float', 
+                      help='Suspicion level past which a storage node is taken to be down')
+    parser.add_option('--metrics-port', dest='metrics_port', default=None, type='int',
+                      help='Port to serve the metrics to Prometheus on')
+    parser.add_option('--no-hinted-handoff', dest='hinted_handoff', default=True,
+                      action='store_false', 
+                      help='Fail the writes of replicas that are down instead of sending them to the next node')
 
     options, args = parser.parse_args()
     if not options.servers:
@@ -131,5 +1002,31 @@ def parse_args():
 
 if __name__ == '__main__':
     options = parse_args()
-    load_balancer = LoadBalancer(options.servers, options.port)
+    if options.engine == 'async':
+        from dynamo.load_balancer.async_load_balancer import AsyncLoadBalancer
+        load_balancer = AsyncLoadBalancer(options.servers, options.port, 
+                                          options.replicas, options.read_quorum, 
+                                          options.write_quorum,
+                                          hash_function=options.hash_function,
+                                          partitions=options.partitions,
+                                          binary_port=options.binary_port,
+                                          hinted_handoff=options.hinted_handoff,
+                                          down_interval=options.down_interval,
+                                          gossip_interval=options.gossip_interval,
+                                          phi_threshold=options.phi_threshold,
+                                          metrics_port=options.metrics_port)
+    else:
+        load_balancer = LoadBalancer(options.servers, options.port, options.replicas,
+                                     options.read_quorum, options.write_quorum, 
+                                     threads=options.threads, 
+                                     queue_size=options.queue_size,
+                                     pool_size=options.pool_size,
+                                     hash_function=options.hash_function,
+                                     partitions=options.partitions,
+                                     binary_port=options.binary_port,
+                                     hinted_handoff=options.hinted_handoff,
+                                     down_interval=options.down_interval,
+                                     gossip_interval=options.gossip_interval,
+                                     phi_threshold=options.phi_threshold,
+                                     metrics_port=options.metrics_port)
     load_balancer.run()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -------------------------------------------------
+# Imports
+# -------------------------------------------------
+import logging
+import socket
+import threading
+import time
+import uuid
+
+from dynamo.lib.rpc import create_server
+from dynamo.load_balancer.load_balancer import LoadBalancer
+from dynamo.storage.hints import HintStore
+from dynamo.storage.storage_node import StorageNode
+
+# -------------------------------------------------
+# Config
+# -------------------------------------------------
+logging.getLogger().setLevel(logging.CRITICAL)
+
+NUM_NODES = 5
+WRITERS = 4
+DOWN_TIME = 1.0
+SETTLE_TIME = 0.5
+WRITE_QUORUMS = [2, 3]
+
+# -------------------------------------------------
+# Rolling restart
+# -------------------------------------------------
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class RestartableNode(object):
+    """
+    A storage node with in-memory keys and hints whose server can be
+    stopped and started again on the same port
+    """
+    def __init__(self, port, servers):
+        self.node = StorageNode(list(servers), port, threads=8,
+                                persistence_options={'conn_str': ':memory:'},
+                                compaction_interval=0)
+        self.node.hints = HintStore(':memory:', self.node._send_hints,
+                                    retry_interval=0.2, max_retry_interval=0.5)
+        self.node.hints.start()
+        self.server = None
+
+    def start(self):
+        self.server = create_server(self.node.port, 8)
+        self.node._register_functions(self.server)
+        self.connections = []
+        process_request = self.server.process_request
+        def track(request, client_address):
+            self.connections.append(request)
+            process_request(request, client_address)
+        self.server.process_request = track
+        self.server.handle_error = lambda request, client_address: None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        # Like a killed process, the open connections are dropped too
+        self.server.shutdown()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server.server_close()
+
+def writer(load_balancer, stopped, results):
+    """
+    Puts keys until stopped, recording the time, latency and status of each
+    """
+    while not stopped.is_set():
+        start = time.time()
+        code = load_balancer.put(str(uuid.uuid4()), 'value')
+        results.append((start, time.time() - start, code == '200'))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_restart(write_quorum, hinted_handoff):
+    """
+    Restarts each node in turn under a steady write load
+
+    :rtype: tuple(list, list, int)
+    :returns: The (start, latency, success) of every put, the (start, end)
+              of each node's downtime and the hints left once replayed
+    """
+    ports = [get_free_port() for i in xrange(NUM_NODES)]
+    names = ['%s:%s' % (socket.gethostbyname(socket.gethostname()), port)
+             for port in ports]
+    nodes = [RestartableNode(port, names) for port in ports]
+    for node in nodes:
+        node.start()
+    load_balancer = LoadBalancer(names, 0, write_quorum=write_quorum, timeout=1.0,
+                                 hinted_handoff=hinted_handoff, down_interval=0.5)
+
+    stopped = threading.Event()
+    results = []
+    writers = [threading.Thread(target=writer, args=(load_balancer, stopped, results))
+               for i in xrange(WRITERS)]
+    for thread in writers:
+        thread.start()
+    time.sleep(SETTLE_TIME)
+    downtimes = []
+    for node in nodes:
+        start = time.time()
+        node.stop()
+        time.sleep(DOWN_TIME)
+        node.start()
+        downtimes.append((start, time.time()))
+        time.sleep(SETTLE_TIME)
+    stopped.set()
+    for thread in writers:
+        thread.join()
+
+    # Give the replayers time to deliver their hints
+    for i in xrange(100):
+        if not sum(node.node.hints.stats()['hints'] for node in nodes):
+            break
+        time.sleep(0.1)
+    left = sum(node.node.hints.stats()['hints'] for node in nodes)
+    for node in nodes:
+        node.stop()
+        node.node.hints.close()
+    return results, downtimes, left
+
+def run():
+    print '%d nodes, N=3, %d writers, each node down for %.1fs in turn' % (
+        NUM_NODES, WRITERS, DOWN_TIME)
+    print '%3s %6s %8s %12s %12s %12s %12s' % ('W', 'hints', 'puts', 'failed %',
+                                               'p50 ms', 'p99 ms', 'hints left')
+    for write_quorum in WRITE_QUORUMS:
+        for hinted_handoff in (False, True):
+            results, downtimes, left = run_restart(write_quorum, hinted_handoff)
+            failed = sum(1 for start, latency, success in results if not success)
+            latencies = [latency for start, latency, success in results]
+            print '%3d %6s %8d %12.2f %12.2f %12.2f %12d' % (
+                write_quorum, 'on' if hinted_handoff else 'off', len(results),
+                100.0 * failed / max(1, len(results)),
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                left)
+
+if __name__ == '__main__':
+    run()
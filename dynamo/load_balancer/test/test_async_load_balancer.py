@@ -0,0 +1,323 @@
+# --------------------------------------------------------
+# Imports
+# --------------------------------------------------------
+import logging
+import threading
+import time
+import xmlrpclib
+from unittest import TestCase
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+from dynamo.lib.rpc import ThreadPoolXMLRPCServer, BinaryRPCConnection, BinaryServerProxy
+from dynamo.load_balancer.async_load_balancer import AsyncLoadBalancer, _ConnectionClosed
+
+# --------------------------------------------------------
+# Config
+# --------------------------------------------------------
+logging.basicConfig(level=logging.CRITICAL)
+
+# --------------------------------------------------------
+# Mocks
+# --------------------------------------------------------
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+class MockStorageNode(object):
+    """
+    An in-memory storage node served on a free port
+    """
+    def __init__(self, keep_alive):
+        handler = KeepAliveRequestHandler if keep_alive else SimpleXMLRPCRequestHandler
+        self.server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 8, 64, allow_none=True,
+                                             logRequests=False, requestHandler=handler)
+        self.name = '127.0.0.1:%s' % self.server.server_address[1]
+        self.data = {}
+        self.hints = {}
+        self.members = None
+        self.slow = threading.Event()
+        self.slow.set()
+        self.server.register_function(self.get_versions, 'get_versions')
+        self.server.register_function(self.coordinate_put, 'coordinate_put')
+        self.server.register_function(self.replica_put, 'replica_put')
+        self.server.register_function(self.hinted_replica_put, 'hinted_replica_put')
+        self.server.register_function(self.coordinate_multi_put, 'coordinate_multi_put')
+        self.server.register_function(self.replica_multi_put, 'replica_multi_put')
+        self.server.register_function(self.hinted_multi_put, 'hinted_multi_put')
+        self.server.register_function(self.gossip, 'gossip')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        
+    def get_versions(self, keys):
+        self.slow.wait(5)
+        return [(key, self.data[key], '1', None) for key in keys if key in self.data]
+    
+    def coordinate_put(self, key, value, context=None):
+        self.data[key] = value
+        return ['1', '%s=1' % self.name]
+    
+    def replica_put(self, key, value, date, clock):
+        self.data[key] = value
+        return '200'
+    
+    def hinted_replica_put(self, key, value, date, clock, owner):
+        self.hints[key] = (value, owner)
+        return '200'
+    
+    def coordinate_multi_put(self, items):
+        for key, value in items:
+            self.data[key] = value
+        return dict((key, ['1', '%s=1' % self.name]) for key, value in items)
+    
+    def replica_multi_put(self, rows):
+        for key, value, date, clock in rows:
+            self.data[key] = value
+        return dict((row[0], '200') for row in rows)
+    
+    def hinted_multi_put(self, items):
+        for key, value, owner, date, clock in items:
+            self.hints[key] = (value, owner)
+        return dict((item[0], '200') for item in items)
+    
+    def gossip(self, state):
+        if self.members is None:
+            return {'digest': state['digest'], 'heartbeats': []}
+        return {'digest': 'members', 'heartbeats': [], 'members': self.members}
+    
+    def close(self):
+        self.slow.set()
+        self.server.shutdown()
+        self.server.server_close()
+    
+# --------------------------------------------------------
+# Test
+# --------------------------------------------------------
+class TestAsyncLoadBalancer(TestCase):
+    def setUp(self):
+        self.storage_nodes = [MockStorageNode(keep_alive) 
+                              for keep_alive in (True, True, False)]
+        self.load_balancer = AsyncLoadBalancer([sn.name for sn in self.storage_nodes], 
+                                               0, timeout=0.5, binary_port=0)
+        self.load_balancer.listen()
+        self.thread = threading.Thread(target=self.load_balancer.run)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.load_balancer.port
+        
+    def tearDown(self):
+        self.load_balancer.stop()
+        self.thread.join()
+        for storage_node in self.storage_nodes:
+            storage_node.close()
+            
+    def test_put_get(self):
+        """
+        Ensures values written through the load balancer can be read back
+        and reach every replica
+        """
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertEquals(proxy.put('foo', 'bar'), '200')
+        self.assertEquals(proxy.get('foo'), 'bar')
+        self.assertEquals(proxy.get('missing'), None)
+        for storage_node in self.storage_nodes:
+            self.assertEquals(storage_node.data.get('foo'), 'bar')
+            
+    def test_multi_put_get(self):
+        """
+        Ensures batches of keys are written to every replica and read back
+        """
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertEquals(proxy.multi_put([('foo', 'bar'), ('baz', 'qux')]), 
+                          {'foo': '200', 'baz': '200'})
+        self.assertEquals(proxy.multi_get(['foo', 'baz', 'missing']),
+                          {'foo': {'status': '200', 'value': 'bar'},
+                           'baz': {'status': '200', 'value': 'qux'},
+                           'missing': {'status': '200', 'value': None}})
+        for storage_node in self.storage_nodes:
+            self.assertEquals(storage_node.data, {'foo': 'bar', 'baz': 'qux'})
+        self.assertEquals(proxy.multi_put([]), {})
+            
+    def test_binary_protocol(self):
+        """
+        Ensures the binary protocol is served from the same event loop and 
+        answers each request once it completes
+        """
+        connection = BinaryRPCConnection('127.0.0.1', self.load_balancer.binary_port)
+        proxy = BinaryServerProxy(connection)
+        try:
+            self.assertEquals(proxy.put('foo', 'bar'), '200')
+            self.assertEquals(proxy.get('foo'), 'bar')
+            self.assertRaises(xmlrpclib.Fault, proxy.delete, 'foo')
+            
+            for storage_node in self.storage_nodes:
+                storage_node.slow.clear()
+            results = []
+            slow = threading.Thread(target=lambda: results.append(proxy.get('foo')))
+            slow.start()
+            self.assertEquals(proxy.put('baz', 'qux'), '200')
+            self.assertEquals(results, [])
+            for storage_node in self.storage_nodes:
+                storage_node.slow.set()
+            slow.join(5)
+        finally:
+            connection.close()
+        
+    def test_unknown_method(self):
+        """
+        Ensures unsupported methods return a fault
+        """
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertRaises(xmlrpclib.Fault, proxy.delete, 'foo')
+        
+    def test_stats(self):
+        """
+        Ensures RPCs are timed until they are answered, faults counted, and
+        the calls to each storage node timed from the event loop
+        """
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertEquals(proxy.put('foo', 'bar'), '200')
+        self.assertEquals(proxy.get('foo'), 'bar')
+        self.assertRaises(xmlrpclib.Fault, proxy.get)
+        stats = proxy.stats()
+        self.assertEquals(stats['histograms']['rpc']['method=put']['count'], 1)
+        self.assertEquals(stats['histograms']['rpc']['method=get']['count'], 2)
+        self.assertEquals(stats['counters']['rpc_errors']['method=get'], 1)
+        puts = [series['count'] for labels, series in 
+                stats['histograms']['node_call'].iteritems() 
+                if labels.split(',')[0] in ('method=coordinate_put', 
+                                            'method=replica_put')]
+        self.assertTrue(2 <= sum(puts) <= 3)
+        
+    def test_concurrent_clients(self):
+        """
+        Ensures many concurrent clients are served by the single event loop 
+        thread without exceeding the per node connection limit
+        """
+        errors = []
+        def client(num):
+            proxy = xmlrpclib.ServerProxy(self.url)
+            for i in xrange(10):
+                key = 'key-%s-%s' % (num, i)
+                if proxy.put(key, key) != '200' or proxy.get(key) != key:
+                    errors.append(key)
+        clients = [threading.Thread(target=client, args=(i,)) for i in xrange(32)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+            
+        self.assertEquals(errors, [])
+        for client in self.load_balancer.clients.values():
+            self.assertTrue(len(client.connections) <= self.load_balancer.max_connections)
+            
+    def test_timeout(self):
+        """
+        Ensures a slow replica does not hold up a read that can reach its
+        quorum without it, and fails a read that cannot
+        """
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertEquals(proxy.put('foo', 'bar'), '200')
+        self.storage_nodes[0].slow.clear()
+        self.assertEquals(proxy.get('foo'), 'bar')
+        
+        self.storage_nodes[1].slow.clear()
+        self.assertEquals(proxy.get('foo'), None)
+        
+    def test_sloppy_quorum(self):
+        """
+        Ensures the write of a replica that is down goes to the next node on
+        the ring as a hint
+        """
+        storage_node = MockStorageNode(True)
+        self.storage_nodes.append(storage_node)
+        self.load_balancer.stop()
+        self.thread.join()
+        self.load_balancer = AsyncLoadBalancer([sn.name for sn in self.storage_nodes], 
+                                               0, write_quorum=3, timeout=0.5)
+        self.load_balancer.listen()
+        self.thread = threading.Thread(target=self.load_balancer.run)
+        self.thread.start()
+        
+        nodes = dict((sn.name, sn) for sn in self.storage_nodes)
+        pref_list = self.load_balancer.datastore_view.get_preference_list('foo', 4)
+        nodes[pref_list[0]].close()
+        proxy = xmlrpclib.ServerProxy('http://127.0.0.1:%s' % self.load_balancer.port)
+        for value in ('bar', 'baz'):
+            self.assertEquals(proxy.put('foo', value), '200')
+            self.assertEquals(nodes[pref_list[3]].hints, {'foo': (value, pref_list[0])})
+            self.assertEquals(nodes[pref_list[1]].data, {'foo': value})
+        self.assertTrue(self.load_balancer._is_down(pref_list[0]))
+        
+    def test_membership(self):
+        """
+        Ensures added nodes get a client, a rejected batch leaves the 
+        clients of existing members open, and removed nodes' clients are 
+        closed
+        """
+        storage_node = MockStorageNode(True)
+        self.storage_nodes.append(storage_node)
+        member = self.storage_nodes[0].name
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertTrue(proxy.add_nodes([storage_node.name]))
+        self.assertTrue(storage_node.name in self.load_balancer.clients)
+        self.assertRaises(xmlrpclib.Fault, proxy.add_nodes, [member])
+        self.assertTrue(member in self.load_balancer.clients)
+        self.assertEquals(proxy.put('foo', 'bar'), '200')
+        self.assertEquals(proxy.get('foo'), 'bar')
+        
+        self.assertTrue(proxy.remove_nodes([storage_node.name]))
+        self.assertFalse(storage_node.name in self.load_balancer.clients)
+        self.assertFalse(storage_node.name in self.load_balancer.servers)
+        self.assertFalse(storage_node.name in 
+                         str(self.load_balancer.metrics.snapshot()['histograms']))
+        self.assertEquals(proxy.put('foo', 'baz'), '200')
+        
+    def test_gossip(self):
+        """
+        Ensures gossip rounds are sent from the event loop and the ring 
+        changes they bring are applied
+        """
+        removed = self.storage_nodes[2].name
+        for storage_node in self.storage_nodes:
+            storage_node.members = [[storage_node.name, 0, 'joined', 1.0],
+                                    [removed, 1, 'left', 0.0]]
+        for i in xrange(100):
+            if removed not in self.load_balancer.servers:
+                break
+            threading.Event().wait(0.05)
+        self.assertEquals(self.load_balancer.datastore_view.table.nodes, 
+                          tuple(sorted(sn.name for sn in self.storage_nodes[:2])))
+        self.assertFalse(removed in self.load_balancer.clients)
+        proxy = xmlrpclib.ServerProxy(self.url)
+        self.assertEquals(proxy.put('foo', 'bar'), '200')
+        self.assertEquals(self.storage_nodes[2].data, {})
+        self.assertEquals(proxy.membership_stats()['ring_version'], 1)
+        
+class TestStorageNodeClient(TestCase):
+    def setUp(self):
+        self.node = '127.0.0.1:1'
+        self.load_balancer = AsyncLoadBalancer([self.node], 0, replicas=1, 
+                                               read_quorum=1, write_quorum=1,
+                                               max_connections=1)
+        self.client = self.load_balancer.clients[self.node]
+        
+    def tearDown(self):
+        self.client.close()
+        
+    def test_written_calls_not_retried(self):
+        """
+        Ensures calls on a closed connection are only retried if none of 
+        their request was written, since a node may have run the others
+        """
+        results = []
+        for key in ('foo', 'bar', 'baz'):
+            self.client.call('coordinate_put', (key, 'value'), time.time() + 5, 
+                             lambda error, result, key=key: results.append((key, error)))
+            self.client.connections[0].keep_alive = True
+        conn = self.client.connections[0]
+        self.assertEquals(len(conn.in_flight), 3)
+        conn.written = conn.in_flight[1].offset + 1
+        conn._close(_ConnectionClosed('Connection closed'))
+        
+        self.assertEquals(sorted(key for key, error in results), ['bar', 'foo'])
+        self.assertEquals([call.args[0] for call in self.client.connections[0].in_flight],
+                          ['baz'])
@@ -1,9 +1,11 @@
 # --------------------------------------------------------
 # Imports
 # --------------------------------------------------------
+import threading
 from unittest import TestCase
 
 from dynamo.load_balancer.load_balancer import LoadBalancer
+from dynamo.storage.test.mocks import MockCluster
 
 # --------------------------------------------------------
 # Test
@@ -19,4 +21,390 @@ class TestLoadBalancer(TestCase):
             load_balancer = LoadBalancer([], 20000)
         except:
             threw_exc = True
-        self.assertTrue(threw_exc)
\ No newline at end of file
+        self.assertTrue(threw_exc)
+
+    def _get_load_balancer(self, responses, **kwargs):
+        """
+        Gets a load balancer whose storage node calls return the responses
+        for each node in the preference list of foo, raising them if they 
+        are exceptions.  A node that returns 200 coordinates writes.
+        """
+        servers = ['127.0.0.1:%s' % port for port in xrange(20000, 20003)]
+        load_balancer = LoadBalancer(servers, 30000, **kwargs)
+        pref_list = load_balancer.datastore_view.get_preference_list('foo', 3)
+        def call(node, method, args):
+            response = responses[pref_list.index(node)]
+            if isinstance(response, Exception):
+                raise response
+            if hasattr(response, 'wait'):
+                response.wait()
+                response = '200'
+            if method == 'coordinate_put':
+                return ['1', '%s=1' % node] if response == '200' else None
+            return response
+        load_balancer._call = call
+        return load_balancer
+    
+    def test_invalid_quorum(self):
+        """
+        Ensures quorums larger than the replica count are rejected
+        """
+        self.assertRaises(ValueError, LoadBalancer, ['127.0.0.1:20000'], 30000,
+                          replicas=2, write_quorum=3)
+        
+    def test_put_quorum(self):
+        """
+        Ensures a put succeeds once W replicas acknowledge it
+        """
+        load_balancer = self._get_load_balancer(['200', '200', IOError()])
+        self.assertEquals(load_balancer.put('foo', 'bar'), '200')
+        
+        load_balancer = self._get_load_balancer(['200', '400', IOError()])
+        self.assertEquals(load_balancer.put('foo', 'bar'), '400')
+        
+        # A coordinator that fails is passed over for the next replica
+        load_balancer = self._get_load_balancer([IOError(), '200', '200'])
+        self.assertEquals(load_balancer.put('foo', 'bar'), '200')
+        
+        load_balancer = self._get_load_balancer([IOError(), IOError(), IOError()])
+        self.assertEquals(load_balancer.put('foo', 'bar'), '400')
+        
+    def test_put_does_not_wait_for_slow_replica(self):
+        """
+        Ensures a put returns without waiting on replicas beyond W
+        """
+        slow = threading.Event()
+        load_balancer = self._get_load_balancer(['200', '200', slow])
+        self.assertEquals(load_balancer.put('foo', 'bar'), '200')
+        slow.set()
+        
+    def test_get_quorum(self):
+        """
+        Ensures a get returns the value the read quorum holds
+        """
+        bar = [('foo', 'bar', '5', 'a=1')]
+        load_balancer = self._get_load_balancer([bar, bar, bar], read_quorum=3)
+        self.assertEquals(load_balancer.get('foo'), 'bar')
+        
+        load_balancer = self._get_load_balancer([bar, [], IOError()])
+        self.assertEquals(load_balancer.get('foo'), 'bar')
+        
+        load_balancer = self._get_load_balancer([bar, IOError(), IOError()])
+        self.assertEquals(load_balancer.get('foo'), None)
+        
+    def test_get_stale_replicas(self):
+        """
+        Ensures a get returns the newest version when the replicas disagree,
+        however many of them are stale
+        """
+        old = [('foo', 'old', '5', 'a=1')]
+        new = [('foo', 'new', '6', 'b=2|a=1')]
+        load_balancer = self._get_load_balancer([old, new, IOError()])
+        self.assertEquals(load_balancer.get('foo'), 'new')
+        
+        load_balancer = self._get_load_balancer([old, old, new], read_quorum=3)
+        self.assertEquals(load_balancer.get('foo'), 'new')
+        
+        # Concurrent writes are both kept, the latest written is returned
+        other = [('foo', 'other', '7', 'c=3|a=1')]
+        load_balancer = self._get_load_balancer([new, old, other], read_quorum=3)
+        self.assertEquals(load_balancer.get('foo'), 'other')
+        self.assertEquals(load_balancer.get('foo', True)['values'], ['new', 'other'])
+        
+    def test_get_with_context(self):
+        """
+        Ensures a get with context merges the replicas' siblings, keeping 
+        the copies of a write the replicas share once
+        """
+        one = ('foo', 'one', '5', 'a=2|x=1')
+        two = ('foo', 'two', '6', 'b=3|x=1')
+        load_balancer = self._get_load_balancer([[one, ('foo', 'old', '1', 'x=1')], 
+                                                 [one, two], IOError()])
+        result = load_balancer.get('foo', True)
+        self.assertEquals(result['values'], ['one', 'two'])
+        self.assertEquals(result['context'], 'a=2,b=3,x=1')
+        
+        load_balancer = self._get_load_balancer([[], [], IOError()])
+        self.assertEquals(load_balancer.get('foo', True), {'values': [], 'context': ''})
+        
+    def test_get_timeout(self):
+        """
+        Ensures a get fails when the quorum does not answer in time
+        """
+        slow = threading.Event()
+        load_balancer = self._get_load_balancer([slow, slow, [('foo', 'bar', '5', 'a=1')]], 
+                                                timeout=0.1)
+        self.assertEquals(load_balancer.get('foo'), None)
+        slow.set()
+        
+    def _get_batch_load_balancer(self, down):
+        """
+        Gets a load balancer whose storage nodes are in-memory dicts, with
+        the nodes in down raising on every call
+        """
+        servers = ['127.0.0.1:%s' % port for port in xrange(20000, 20003)]
+        load_balancer = LoadBalancer(servers, 30000)
+        stores = dict((server, {}) for server in servers)
+        def call(node, method, args):
+            if node in down:
+                raise IOError('%s is down' % node)
+            if method == 'coordinate_multi_put':
+                stores[node].update((key, (value, '1', '%s=1' % node)) for key, value in args[0])
+                return dict((key, ['1', '%s=1' % node]) for key, value in args[0])
+            if method == 'replica_multi_put':
+                stores[node].update((row[0], row[1:]) for row in args[0])
+                return dict((row[0], '200') for row in args[0])
+            return [(key,) + stores[node][key] for key in args[0] if key in stores[node]]
+        load_balancer._call = call
+        return load_balancer, servers, stores
+    
+    def test_multi_put_get(self):
+        """
+        Ensures batched puts reach the replicas of each key and batched gets 
+        read them back
+        """
+        load_balancer, servers, stores = self._get_batch_load_balancer([])
+        items = [('key%s' % i, 'value%s' % i) for i in xrange(50)]
+        codes = load_balancer.multi_put(items)
+        self.assertEquals(codes, dict((key, '200') for key, value in items))
+        for server in servers:
+            self.assertEquals(len(stores[server]), 50)
+        
+        results = load_balancer.multi_get([key for key, value in items] + ['missing'])
+        for key, value in items:
+            self.assertEquals(results[key], {'status': '200', 'value': value})
+        self.assertEquals(results['missing'], {'status': '200', 'value': None})
+        
+    def test_multi_get_stale_replicas(self):
+        """
+        Ensures batched gets return the newest version of each key when the
+        replicas disagree
+        """
+        load_balancer, servers, stores = self._get_batch_load_balancer([])
+        for server in servers:
+            stores[server]['foo'] = ('old', '5', 'a=1')
+            stores[server]['bar'] = ('bar', '5', 'a=1')
+        new_foo = ('new', '6', 'b=2|a=1')
+        stores[servers[0]]['foo'] = new_foo
+        stores[servers[2]]['baz'] = ('baz', '7', 'c=1')
+        
+        results = load_balancer.multi_get(['foo', 'bar', 'baz'])
+        self.assertEquals(results['foo'], {'status': '200', 'value': 'new'})
+        self.assertEquals(results['bar'], {'status': '200', 'value': 'bar'})
+        self.assertEquals(results['baz'], {'status': '200', 'value': 'baz'})
+        
+    def test_multi_put_quorum(self):
+        """
+        Ensures batched writes fail for keys whose write quorum is not met 
+        """
+        load_balancer, servers, stores = self._get_batch_load_balancer(
+            ['127.0.0.1:20000', '127.0.0.1:20001'])
+        codes = load_balancer.multi_put({'foo': 'bar', 'abc': '123'})
+        self.assertEquals(codes, {'foo': '400', 'abc': '400'})
+        results = load_balancer.multi_get(['foo'])
+        self.assertEquals(results['foo']['status'], '400')
+        
+    def test_membership(self):
+        """
+        Ensures nodes can be added and removed along with their connections
+        """
+        load_balancer = self._get_load_balancer(['200'] * 3)
+        moved = load_balancer.add_nodes(['127.0.0.1:20003'])
+        self.assertTrue(moved)
+        self.assertTrue('127.0.0.1:20003' in load_balancer.server_conns)
+        self.assertTrue('127.0.0.1:20003' in load_balancer.servers)
+        self.assertRaises(ValueError, load_balancer.add_nodes, 
+                          ['127.0.0.1:20003'])
+        self.assertTrue('127.0.0.1:20003' in load_balancer.server_conns)
+        
+        moved = load_balancer.remove_nodes(['127.0.0.1:20003'])
+        self.assertTrue(moved)
+        self.assertFalse('127.0.0.1:20003' in load_balancer.server_conns)
+        self.assertFalse('127.0.0.1:20003' in load_balancer.servers)
+        self.assertEquals(len(load_balancer.datastore_view.table.nodes), 3)
+        
+    def test_weights(self):
+        """
+        Ensures weighted nodes are connected to by name and can be reweighted
+        """
+        load_balancer = self._get_load_balancer(['200'] * 3)
+        load_balancer.add_nodes(['127.0.0.1:20003:2.5'])
+        self.assertTrue('127.0.0.1:20003' in load_balancer.server_conns)
+        self.assertTrue('127.0.0.1:20003' in load_balancer.servers)
+        weights = load_balancer.datastore_view.consistent_hash.weights
+        self.assertEquals(weights['127.0.0.1:20003'], 2.5)
+        
+        self.assertTrue(load_balancer.set_weights({'127.0.0.1:20003': 1}))
+        self.assertEquals(weights['127.0.0.1:20003'], 2.5)
+        weights = load_balancer.datastore_view.consistent_hash.weights
+        self.assertEquals(weights['127.0.0.1:20003'], 1)
+        self.assertEquals(load_balancer.set_weights({'127.0.0.1:20003': 1}), [])
+        
+    def _get_sloppy_load_balancer(self, down, **kwargs):
+        """
+        Gets a load balancer over four in-memory storage nodes, with the
+        nodes in down raising on every call, that records the calls made
+        """
+        servers = ['127.0.0.1:%s' % port for port in xrange(20000, 20004)]
+        load_balancer = LoadBalancer(servers, 30000, **kwargs)
+        stores = dict((server, {}) for server in servers)
+        hints = dict((server, {}) for server in servers)
+        calls = []
+        def call(node, method, args):
+            calls.append((node, method))
+            if node in down:
+                raise IOError('%s is down' % node)
+            if method == 'coordinate_put':
+                stores[node][args[0]] = args[1]
+                return ['1', '%s=1' % node]
+            if method == 'replica_put':
+                stores[node][args[0]] = args[1]
+                return '200'
+            if method == 'hinted_replica_put':
+                hints[node][args[0]] = (args[1], args[4])
+                return '200'
+            if method == 'coordinate_multi_put':
+                stores[node].update(args[0])
+                return dict((key, ['1', '%s=1' % node]) for key, value in args[0])
+            if method == 'replica_multi_put':
+                stores[node].update((key, value) for key, value, date, clock in args[0])
+                return dict((row[0], '200') for row in args[0])
+            if method == 'hinted_multi_put':
+                hints[node].update((key, (value, owner)) 
+                                   for key, value, owner, date, clock in args[0])
+                return dict((item[0], '200') for item in args[0])
+        load_balancer._call = call
+        return load_balancer, servers, stores, hints, calls
+    
+    def test_sloppy_quorum(self):
+        """
+        Ensures the write of a replica that fails goes to the next node on
+        the ring as a hint, and that later writes skip the failed node until
+        it is tried again
+        """
+        pref_list = LoadBalancer(['127.0.0.1:%s' % port for port in xrange(20000, 20004)],
+                                 30000).datastore_view.get_preference_list('foo', 4)
+        down = set(pref_list[:1])
+        load_balancer, servers, stores, hints, calls = self._get_sloppy_load_balancer(
+            down, write_quorum=3, down_interval=0.2)
+        
+        self.assertEquals(load_balancer.put('foo', 'bar'), '200')
+        self.assertEquals(stores[pref_list[1]], {'foo': 'bar'})
+        self.assertEquals(stores[pref_list[2]], {'foo': 'bar'})
+        self.assertEquals(hints[pref_list[3]], {'foo': ('bar', pref_list[0])})
+        self.assertTrue(load_balancer._is_down(pref_list[0]))
+        
+        del calls[:]
+        self.assertEquals(load_balancer.put('foo', 'baz'), '200')
+        self.assertEquals(sorted(calls), sorted([(pref_list[1], 'coordinate_put'), 
+                                                 (pref_list[2], 'replica_put'),
+                                                 (pref_list[3], 'hinted_replica_put')]))
+        
+        # One fallback cannot stand in for two replicas
+        down.add(pref_list[1])
+        self.assertEquals(load_balancer.put('foo', 'baz'), '400')
+        
+        threading.Event().wait(0.2)
+        del calls[:]
+        down.clear()
+        self.assertEquals(load_balancer.put('foo', 'qux'), '200')
+        self.assertEquals(calls[0], (pref_list[0], 'coordinate_put'))
+        self.assertEquals(sorted(node for node, method in calls if method == 'replica_put'),
+                          sorted(pref_list[1:3]))
+        self.assertFalse(load_balancer.down)
+        
+        load_balancer, servers, stores, hints, calls = self._get_sloppy_load_balancer(
+            set(pref_list[:1]), write_quorum=3, hinted_handoff=False)
+        self.assertEquals(load_balancer.put('foo', 'bar'), '400')
+        
+    def test_sloppy_multi_put(self):
+        """
+        Ensures batched writes for a replica that fails go to the next nodes
+        on the ring as hints
+        """
+        load_balancer, servers, stores, hints, calls = self._get_sloppy_load_balancer(
+            set(['127.0.0.1:20000']), write_quorum=3)
+        items = [('key%s' % i, 'value%s' % i) for i in xrange(50)]
+        codes = load_balancer.multi_put(items)
+        self.assertEquals(codes, dict((key, '200') for key, value in items))
+        
+        for key, value in items:
+            pref_list = load_balancer.datastore_view.get_preference_list(key, 4)
+            if '127.0.0.1:20000' in pref_list[:3]:
+                self.assertEquals(hints[pref_list[3]][key], (value, '127.0.0.1:20000'))
+            for node in pref_list[:3]:
+                if node != '127.0.0.1:20000':
+                    self.assertEquals(stores[node][key], value)
+        self.assertTrue(hints[servers[1]] or hints[servers[2]] or hints[servers[3]])
+        
+        del calls[:]
+        self.assertEquals(load_balancer.multi_put(items), codes)
+        self.assertFalse([node for node, method in calls if node == '127.0.0.1:20000'])
+            
+    def test_gossip(self):
+        """
+        Ensures a load balancer gossiping with an in-process cluster skips a
+        replica it suspects before calling it, and learns ring changes made
+        on a storage node
+        """
+        cluster = MockCluster(4)
+        load_balancer = LoadBalancer(cluster.servers, 30000, timeout=1.0)
+        load_balancer.server_conns = dict(cluster.peers)
+        cluster.add_observer(load_balancer.membership)
+        cluster.gossip(5)
+        self.assertEquals(load_balancer.membership_stats()['suspected'], [])
+        
+        stopped = cluster.nodes[0]
+        cluster.stop(stopped)
+        cluster.gossip(10)
+        self.assertTrue(load_balancer._is_down(stopped.my_name))
+        key = [key for key in ('key%s' % i for i in xrange(100)) if stopped.my_name in 
+               load_balancer.datastore_view.get_preference_list(key, 3)][0]
+        calls = len(cluster.peers[stopped.my_name].calls)
+        self.assertEquals(load_balancer.put(key, 'value'), '200')
+        self.assertEquals(load_balancer.get(key), 'value')
+        self.assertEquals(len(cluster.peers[stopped.my_name].calls), calls)
+        
+        cluster.nodes[1].remove_nodes([stopped.my_name])
+        cluster.gossip(3)
+        self.assertEquals(load_balancer.membership_stats()['ring_version'], 1)
+        self.assertFalse(stopped.my_name in load_balancer.datastore_view.table.nodes)
+        self.assertFalse(stopped.my_name in load_balancer.server_conns)
+        self.assertEquals(len(load_balancer.servers), 3)
+
+    def test_stats(self):
+        """
+        Ensures the RPC methods and the calls to each storage node are timed
+        and their errors counted, and the series of a node that left the 
+        ring removed
+        """
+        cluster = MockCluster(3)
+        load_balancer = LoadBalancer(cluster.servers, 30000, read_quorum=3, 
+                                     write_quorum=3, timeout=1.0)
+        load_balancer.server_conns = dict(cluster.peers)
+        functions = {}
+        class Server(object):
+            def register_function(self, func, name):
+                functions[name] = func
+        load_balancer._register_functions(Server())
+        self.assertEquals(functions['put']('foo', 'bar'), '200')
+        self.assertEquals(functions['get']('foo'), 'bar')
+        pref_list = load_balancer.datastore_view.get_preference_list('foo', 3)
+        stopped = pref_list[1]
+        cluster.stop([node for node in cluster.nodes if node.my_name == stopped][0])
+        functions['put']('foo', 'baz')
+        
+        stats = functions['stats']()
+        self.assertEquals(stats['histograms']['rpc']['method=put']['count'], 2)
+        self.assertEquals(stats['histograms']['rpc']['method=get']['count'], 1)
+        calls = stats['histograms']['node_call']
+        self.assertEquals(calls['method=coordinate_put,node=%s' % pref_list[0]]['count'], 2)
+        for node in pref_list[1:]:
+            self.assertEquals(calls['method=replica_put,node=%s' % node]['count'], 2)
+        errors = stats['counters']['node_call_errors']
+        self.assertEquals(sum(errors.values()), 1)
+        self.assertEquals(errors['method=replica_put,node=%s' % stopped], 1)
+        
+        functions['remove_nodes']([stopped])
+        self.assertFalse(stopped in str(functions['stats']()))
+
@@ -0,0 +1,362 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import hashlib
+import logging
+import struct
+import threading
+from bisect import bisect_left
+
+from dynamo.lib.merkle_tree import MerkleTree
+from dynamo.storage.datastore_view import in_range
+from dynamo.storage.handoff import get_versions
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class AntiEntropy(object):
+    """
+    Merkle trees over the ranges of the ring a storage node replicates, and
+    a background thread that synchronizes them with the other replicas.
+
+    A key's entry hash is a hash of its latest value, so replicas that
+    agree on a value agree on its hash whatever dates they wrote it at.
+    Puts update the trees as they are written.  The entry hashes are also
+    kept outside the trees, so the trees can be rebuilt without reading
+    the persistence layer when the node's ranges change; on start they are
+    read once, in key order, by the background thread.
+
+    Syncing a range with a replica walks both trees from the root, asking
+    the replica for the hashes of the children of the nodes that differ,
+    then exchanges the entry hashes of the differing leaves.  Keys whose
+    hashes differ are pulled from the replica and pushed to it, at most
+    max_keys per sync, and each side keeps the version with the later date.
+    Every node must use the same depth.
+    """
+    def __init__(self, persis, hash_function, name, connect, store, depth=10,
+                 interval=1.0, max_keys=1000, chunk_size=500):
+        """
+        :Parameters:
+            persis : PersistenceLayer
+                The persistence layer holding the keys
+            hash_function : HashFunction
+                The hash function of the ring
+            name : str
+                The name of this node, which is never synced with
+            connect : function
+                Called with a node name, returns a proxy for its RPCs
+            store : function
+                Called with (key, value, date, clock) rows pulled from a 
+                replica
+            depth : int
+                The number of levels below the root of each tree
+            interval : float
+                Seconds between syncs of one range with one replica
+            max_keys : int
+                Maximum number of keys pulled and pushed per sync
+            chunk_size : int
+                Number of keys read per chunk when loading the entry hashes
+        """
+        self.persis = persis
+        self.hash_function = hash_function
+        self.name = name
+        self.connect = connect
+        self.store = store
+        self.depth = depth
+        self.interval = interval
+        self.max_keys = max_keys
+        self.chunk_size = chunk_size
+        self.entries = {}
+        self.ranges = []
+        self.trees = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.syncs = 0
+        self.round_trips = 0
+        self.keys_pulled = 0
+        self.keys_pushed = 0
+        self.errors = 0
+        self._ends = []
+        self._next = 0
+
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def start(self):
+        """
+        Starts the sync thread
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='anti-entropy')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the sync thread after its current sync
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def set_ranges(self, ranges):
+        """
+        Replaces the trees with trees over new ranges, built from the entry
+        hashes
+        
+        :Parameters:
+            ranges : list(dict)
+                The ranges the node replicates, each with integer 'start'
+                and 'end' tokens and the 'nodes' replicating it
+        """
+        ranges = sorted(ranges, key=lambda r: r['end'])
+        trees = dict(((r['start'], r['end']),
+                      MerkleTree(r['start'], r['end'], self.hash_function.bits, self.depth))
+                     for r in ranges)
+        ends = [r['end'] for r in ranges]
+        with self.lock:
+            self.ranges = ranges
+            self.trees = trees
+            self._ends = ends
+            for key, entry_hash in self.entries.iteritems():
+                token = self.hash_function.hash(key)
+                tree = self._get_tree(token)
+                if tree is not None:
+                    tree.update(key, token, entry_hash)
+
+    def update(self, key, versions):
+        """
+        Updates the hash of a key that was written
+        
+        :Parameters:
+            key : str
+                The key
+            versions : list(tuple(str, str))
+                The (value, clock) pairs of its siblings, with encoded 
+                clocks
+        """
+        entry_hash = get_entry_hash(key, versions)
+        token = self.hash_function.hash(key)
+        with self.lock:
+            self.entries[key] = entry_hash
+            tree = self._get_tree(token)
+        if tree is not None:
+            tree.update(key, token, entry_hash)
+
+    def refresh(self, keys):
+        """
+        Updates the hashes of keys from their siblings in the persistence 
+        layer
+        
+        :Parameters:
+            keys : list(str)
+                The keys
+        """
+        for key, versions in _group_versions(get_versions(self.persis, keys)).iteritems():
+            self.update(key, versions)
+
+    def load(self):
+        """
+        Reads the entry hashes of every key.  Keys written meanwhile keep
+        the hashes their puts set.
+        """
+        after_key = None
+        while True:
+            if self.stopped.is_set():
+                return
+            keys = self.persis.scan_keys(after_key, self.chunk_size)
+            rows = get_versions(self.persis, keys)
+            for key, versions in _group_versions(rows).iteritems():
+                entry_hash = get_entry_hash(key, versions)
+                token = self.hash_function.hash(key)
+                with self.lock:
+                    if key in self.entries:
+                        continue
+                    self.entries[key] = entry_hash
+                    tree = self._get_tree(token)
+                if tree is not None:
+                    tree.update(key, token, entry_hash)
+            if len(keys) < self.chunk_size:
+                break
+            after_key = keys[-1]
+        logging.info('Loaded the entry hashes of %s keys' % len(self.entries))
+        self.loaded = True
+
+    def get_hashes(self, start, end, level, indexes):
+        """
+        Gets hashes of the tree of a range
+        
+        :rtype: list(long)
+        :returns: The hashes of the nodes of the level, None if this node
+                  has no tree over the range
+        """
+        tree = self.trees.get((start, end))
+        if tree is None or not self.loaded:
+            return None
+        return tree.get_hashes(level, indexes)
+
+    def get_keys(self, start, end, leaves):
+        """
+        Gets the entry hashes of leaves of the tree of a range
+        
+        :rtype: dict(str, long)
+        :returns: The entry hash of each key, None if this node has no tree
+                  over the range
+        """
+        tree = self.trees.get((start, end))
+        if tree is None or not self.loaded:
+            return None
+        return tree.get_keys(leaves)
+
+    def sync(self, start, end, node):
+        """
+        Synchronizes the tree of a range with a replica
+        
+        :Parameters:
+            start : long
+            end : long
+                The range
+            node : str
+                The replica
+        :rtype: tuple(list(str), list(str))
+        :returns: The keys pulled and pushed
+        """
+        tree = self.trees.get((start, end))
+        if tree is None:
+            return ([], [])
+        peer = self.connect(node)
+        start_hex, end_hex = '%x' % start, '%x' % end
+        
+        level, indexes = 0, [0]
+        while indexes:
+            hashes = peer.merkle_hashes(start_hex, end_hex, level, indexes)
+            self._count('round_trips', 1)
+            if hashes is None:
+                return ([], [])
+            indexes = tree.diff(level, indexes, [long(h, 16) for h in hashes])
+            if level == tree.depth:
+                break
+            level += 1
+        if not indexes:
+            return ([], [])
+        
+        theirs = peer.merkle_keys(start_hex, end_hex, indexes)
+        self._count('round_trips', 1)
+        if theirs is None:
+            return ([], [])
+        theirs = dict((key, long(h, 16)) for key, h in theirs)
+        ours = tree.get_keys(indexes)
+        pull = [key for key, h in theirs.iteritems() if ours.get(key) != h]
+        push = [key for key, h in ours.iteritems() if theirs.get(key) != h]
+        pull = pull[:self.max_keys]
+        push = push[:self.max_keys]
+        
+        if pull:
+            self.store(peer.get_versions(pull))
+            self._count('keys_pulled', len(pull))
+        if push:
+            rows = get_versions(self.persis, push)
+            if rows and peer.handoff_put(rows) != '200':
+                raise IOError('%s did not store %s keys' % (node, len(rows)))
+            self._count('keys_pushed', len(push))
+        self._count('syncs', 1)
+        return (pull, push)
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The number of ranges and keys and counters of the work
+                  done so far
+        """
+        with self.lock:
+            return {'ranges': len(self.ranges),
+                    'keys': len(self.entries),
+                    'loaded': self.loaded,
+                    'syncs': self.syncs,
+                    'round_trips': self.round_trips,
+                    'keys_pulled': self.keys_pulled,
+                    'keys_pushed': self.keys_pushed,
+                    'errors': self.errors}
+
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _run(self):
+        """
+        Sync thread loop, visiting each range and replica in turn
+        """
+        try:
+            self.load()
+        except:
+            logging.exception('Error loading the entry hashes')
+            self._count('errors', 1)
+        while not self.stopped.wait(self.interval):
+            pairs = [(r['start'], r['end'], node) for r in self.ranges
+                     for node in r['nodes'] if node != self.name]
+            if not pairs or not self.loaded:
+                continue
+            start, end, node = pairs[self._next % len(pairs)]
+            self._next += 1
+            try:
+                self.sync(start, end, node)
+            except:
+                logging.exception('Error syncing with %s' % node)
+                self._count('errors', 1)
+
+    def _get_tree(self, token):
+        """
+        Gets the tree of the range a token is in, None if the node does not
+        replicate it
+        """
+        if not self.ranges:
+            return None
+        r = self.ranges[bisect_left(self._ends, token) % len(self._ends)]
+        if not in_range(token, r['start'], r['end']):
+            return None
+        return self.trees[(r['start'], r['end'])]
+
+    def _count(self, name, n):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+_unpack_hash = struct.Struct('>Q').unpack_from
+
+_pack_lengths = struct.Struct('>II').pack
+
+def get_entry_hash(key, versions):
+    """
+    Hashes a key and its siblings for the Merkle trees
+
+    :Parameters:
+        key : str
+        versions : list(tuple(str, str))
+            The (value, clock) pairs of the siblings, with encoded clocks
+    :rtype: long
+    :returns: A 64 bit hash
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    digest = hashlib.md5(key)
+    for value, clock in sorted(versions, key=lambda version: version[1]):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        clock = clock or ''
+        digest.update(_pack_lengths(len(clock), len(value)))
+        digest.update(clock)
+        digest.update(value)
+    return _unpack_hash(digest.digest())[0]
+
+def _group_versions(rows):
+    """
+    Groups (key, value, date, clock) rows by key
+
+    :rtype: dict(str, list(tuple(str, str)))
+    :returns: The (value, clock) pairs of each key
+    """
+    versions = {}
+    for key, value, date, clock in rows:
+        versions.setdefault(key, []).append((value, clock))
+    return versions
@@ -1 +1,2 @@
-from datastore_view import DataStoreView
\ No newline at end of file
+from datastore_view import DataStoreView, parse_server, parse_servers
+from routing_table import RoutingTable, in_range, encode_ranges, decode_ranges
\ No newline at end of file
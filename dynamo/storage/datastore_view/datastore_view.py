@@ -1,9 +1,12 @@
 # ------------------------------------------------------
 # Imports
 # ------------------------------------------------------
+import exceptions
 import logging
+import threading
 
 from dynamo.lib.consistent_hash import ConsistentHash
+from dynamo.storage.datastore_view.routing_table import RoutingTable
 
 # ------------------------------------------------------
 # Implementation
@@ -11,20 +14,119 @@ from dynamo.lib.consistent_hash import ConsistentHash
 class DataStoreView(object):
     """
     A storage node/load balancers local view of the storage nodes ring.
+    
+    Single keys are routed through an immutable RoutingTable built from the
+    ring.  A membership change builds a new table and swaps it in with one
+    assignment, so a lookup sees either the old ring or the new one.
     """
-    def __init__(self, servers):
+    def __init__(self, servers, replicas=3, memo_size=0, hash_function='md5',
+                 partitions=0):
         """
         Parameters:
             servers : list(str)
                 A list of servers.  Each server name is in the 
-                format {host/ip}:port
+                format {host/ip}:port, optionally followed by :weight
+            replicas : int
+                Number of replicas whose preference lists are precomputed
+            memo_size : int
+                Number of keys whose ring position is memoized, 0 disables it
+            hash_function : str
+                The hash function of the ring, which every node must share
+            partitions : int
+                Number of equal partitions of the ring, which every node must
+                share.  0 places each node at random tokens instead.
         """
-        self.consistent_hash = ConsistentHash()
+        if partitions:
+            self.consistent_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3,
+                                                  hash_function=hash_function,
+                                                  partitions=partitions)
+        else:
+            self.consistent_hash = ConsistentHash(hash_function=hash_function)
+        self.replicas = replicas
+        self.memo_size = memo_size
+        self._lock = threading.Lock()
         
         logging.info('Adding servers %s' % servers)
-        for server in servers:
-            self.consistent_hash.add(server)
-               
+        self.consistent_hash.add_nodes(*parse_servers(servers))
+        self.table = RoutingTable(self.consistent_hash, replicas, memo_size)
+        
+    def add_nodes(self, nodes):
+        """
+        Adds a number of nodes to the ring
+        
+        :Parameters:
+            nodes : list(str)
+                The node names, each optionally followed by :weight
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  see RoutingTable.get_moved_ranges
+        """
+        with self._lock:
+            logging.info('Adding servers %s' % nodes)
+            self.consistent_hash.add_nodes(*parse_servers(nodes))
+            return self._rebuild()
+            
+    def remove_nodes(self, nodes):
+        """
+        Removes a number of nodes from the ring
+        
+        :Parameters:
+            nodes : list(str)
+                The node names
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  see RoutingTable.get_moved_ranges
+        """
+        with self._lock:
+            logging.info('Removing servers %s' % nodes)
+            self.consistent_hash.remove_nodes(nodes)
+            return self._rebuild()
+            
+    def set_weights(self, weights):
+        """
+        Changes the weights of nodes in the ring
+        
+        :Parameters:
+            weights : dict(str, float)
+                The new weight of each node
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  see RoutingTable.get_moved_ranges
+        """
+        with self._lock:
+            logging.info('Setting the weights %s' % weights)
+            self.consistent_hash.set_weights(weights)
+            return self._rebuild()
+
+    def set_members(self, weights):
+        """
+        Makes the ring hold exactly the given nodes, adding, removing and
+        reweighting nodes as needed, with one rebuild
+
+        :Parameters:
+            weights : dict(str, float)
+                The weight of each node that should be in the ring
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed,
+                  see RoutingTable.get_moved_ranges
+        """
+        with self._lock:
+            current = self.consistent_hash.weights
+            added = sorted(node for node in weights if node not in current)
+            removed = sorted(node for node in current if node not in weights)
+            changed = dict((node, weight) for node, weight in weights.iteritems()
+                           if node in current and current[node] != weight)
+            if not weights or not (added or removed or changed):
+                return []
+            logging.info('Setting the members %s' % weights)
+            if removed:
+                self.consistent_hash.remove_nodes(removed)
+            if added:
+                self.consistent_hash.add_nodes(added, weights)
+            if changed:
+                self.consistent_hash.set_weights(changed)
+            return self._rebuild()
+
     def get_node(self, key):
         """
         Gets the node responsible for a particular key
@@ -35,6 +137,95 @@ class DataStoreView(object):
         :rtype: str
         :returns: The node name responsible for the key
         """
-        node = self.consistent_hash.get_node(key)
-        return node
+        return self.table.get_node(key)
+    
+    def get_preference_list(self, key, n):
+        """
+        Gets the n distinct nodes that hold replicas of a key, in ring order
+        
+        :Parameters:
+            key : str
+                The key
+            n : int
+                The number of replicas
+        :rtype: tuple(str)
+        :returns: The node names responsible for the key
+        """
+        return self.table.get_preference_list(key, n)
+    
+    def get_nodes(self, keys):
+        """
+        Gets the node responsible for each of a batch of keys
+        
+        :Parameters:
+            keys : list(str)
+                The keys
+        :rtype: list(str)
+        :returns: The node name responsible for each key
+        """
+        return self.consistent_hash.get_nodes(keys)
+    
+    def group_keys(self, keys):
+        """
+        Groups a batch of keys by the node responsible for them
+        
+        :Parameters:
+            keys : list(str)
+                The keys
+        :rtype: dict(str, list(str))
+        :returns: A mapping from node name to its keys
+        """
+        return self.consistent_hash.group_keys(keys)
+    
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _rebuild(self):
+        """
+        Builds a routing table from the ring and swaps it in
+        
+        :rtype: list(dict)
+        :returns: The ranges whose preference lists changed
+        """
+        old_table = self.table
+        self.table = RoutingTable(self.consistent_hash, self.replicas, self.memo_size)
+        moved = self.table.get_moved_ranges(old_table)
+        logging.info('Ring version %s moved %s ranges' % (self.table.version, len(moved)))
+        return moved
+
+def parse_server(server):
+    """
+    Splits a server into its name and weight
+    
+    :Parameters:
+        server : str
+            The server in the format {host/ip}:port or {host/ip}:port:weight
+    :rtype: tuple(str, float)
+    :returns: The server name, {host/ip}:port, and its weight, 1 if it has
+              none
+    """
+    if server.count(':') < 2:
+        return server, 1
+    name, weight = server.rsplit(':', 1)
+    try:
+        return name, float(weight)
+    except exceptions.ValueError:
+        raise exceptions.ValueError('Bad weight in server %s' % server)
+
+def parse_servers(servers):
+    """
+    Splits servers into their names and weights
     
+    :Parameters:
+        servers : list(str)
+            The servers, see parse_server
+    :rtype: tuple(list(str), dict(str, float))
+    :returns: The server names and the weight of each
+    """
+    names = []
+    weights = {}
+    for server in servers:
+        name, weight = parse_server(server)
+        names.append(name)
+        weights[name] = weight
+    return names, weights
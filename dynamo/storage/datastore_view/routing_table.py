@@ -0,0 +1,284 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import exceptions
+from array import array
+from bisect import bisect_left
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class RoutingTable(object):
+    """
+    An immutable snapshot of a consistent hash ring.  
+    
+    The tokens are held as fixed width big endian strings, which sort like
+    the numbers they encode, so a key is routed by bisecting its raw digest 
+    without converting it to an integer.  A parallel array holds the
+    index of the node owning each token, and the preference list of every
+    ring position is computed up front for N replicas, so routing a key is
+    one md5 and one bisect and returns a shared tuple.
+    
+    A ring of equal partitions (ConsistentHash.STRATEGY3) is routed by 
+    shifting a key's hash down to its partition number instead.
+    
+    An optional memo maps recently routed keys to their ring positions.  
+    It is cleared once it holds memo_size keys and is dropped with the 
+    table, so it never outlives a membership change.
+    
+    Ranges of the ring are (start, end] pairs of integer tokens that wrap
+    past the top of the ring when start >= end.
+    """
+    def __init__(self, consistent_hash, replicas=3, memo_size=0):
+        """
+        :Parameters:
+            consistent_hash : ConsistentHash
+                The ring to take a snapshot of
+            replicas : int
+                Length of the precomputed preference lists
+            memo_size : int
+                Maximum number of memoized keys, 0 disables the memo
+        """
+        ring, sorted_keys, node_tokens = consistent_hash.snapshot()
+        self.version = consistent_hash.version
+        self.digest = consistent_hash.hash_function.digest
+        self.to_int = consistent_hash.hash_function.to_int
+        self.hash = consistent_hash.hash_function.hash
+        self.partition_shift = consistent_hash.partition_shift
+        self.nodes = tuple(sorted(node_tokens))
+        index = dict((node, i) for i, node in enumerate(self.nodes))
+        to_bytes = consistent_hash.hash_function.to_bytes
+        self.tokens = tuple(to_bytes(token) for token in sorted_keys)
+        self.node_index = array('I', [index[ring[token]] for token in sorted_keys])
+        self.replicas = min(replicas, len(self.nodes))
+        self.preference_lists = self._build_preference_lists(self.replicas)
+        self.memo_size = memo_size
+        self.memo = {}
+        
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of tokens in the table
+        """
+        return len(self.tokens)
+    
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def get_node(self, key):
+        """
+        Gets the node responsible for a key
+        
+        :Parameters:
+            key : str
+                The key
+        :rtype: str
+        :returns: The node name
+        """
+        return self.nodes[self.node_index[self._get_pos(key)]]
+    
+    def get_preference_list(self, key, n):
+        """
+        Gets the n distinct nodes that hold replicas of a key, in ring order
+        
+        :Parameters:
+            key : str
+                The key
+            n : int
+                The number of replicas
+        :rtype: tuple(str)
+        :returns: The node names, fewer than n if the ring has fewer nodes
+        """
+        pos = self._get_pos(key)
+        if n == self.replicas:
+            return self.preference_lists[pos]
+        if n < self.replicas:
+            return self.preference_lists[pos][:n]
+        return self._walk(pos, n)
+    
+    def get_moved_ranges(self, old_table):
+        """
+        Compares the preference lists of this table with those of an older
+        version of the ring.  Between two neighbouring tokens of either 
+        table every key has the same preference list in each, so only 
+        those ranges need comparing.
+        
+        :Parameters:
+            old_table : RoutingTable
+                The table before the membership change
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, in
+                  ring order, as dicts of start, end, old and new node lists
+        """
+        boundaries = sorted(set(self.tokens) | set(old_table.tokens))
+        moved = []
+        for i, boundary in enumerate(boundaries):
+            old_nodes = old_table._get_preference_list_at(boundary)
+            new_nodes = self._get_preference_list_at(boundary)
+            if old_nodes == new_nodes:
+                continue
+            start = self.to_int(boundaries[i - 1])
+            end = self.to_int(boundary)
+            last = moved[-1] if moved else None
+            if last and last['end'] == start and \
+                    (last['old'], last['new']) == (old_nodes, new_nodes):
+                last['end'] = end
+            else:
+                moved.append({'start': start, 'end': end, 
+                              'old': old_nodes, 'new': new_nodes})
+        
+        # Join the ranges either side of the top of the ring
+        if len(moved) > 1 and moved[-1]['end'] == moved[0]['start'] and \
+                (moved[-1]['old'], moved[-1]['new']) == (moved[0]['old'], moved[0]['new']):
+            moved[0]['start'] = moved.pop()['start']
+        return moved
+    
+    def get_ranges(self, node):
+        """
+        Gets the ranges of the ring a node holds replicas of.  Neighbouring
+        ranges with the same preference list are joined.
+        
+        :Parameters:
+            node : str
+                The node name
+        :rtype: list(dict)
+        :returns: The ranges in ring order, as dicts of start, end and the
+                  nodes of their preference list
+        """
+        ranges = []
+        for pos, pref_list in enumerate(self.preference_lists):
+            if node not in pref_list:
+                continue
+            start = self.to_int(self.tokens[pos - 1])
+            end = self.to_int(self.tokens[pos])
+            last = ranges[-1] if ranges else None
+            if last and last['end'] == start and last['nodes'] == list(pref_list):
+                last['end'] = end
+            else:
+                ranges.append({'start': start, 'end': end, 'nodes': list(pref_list)})
+        
+        # Join the ranges either side of the top of the ring
+        if len(ranges) > 1 and ranges[-1]['end'] == ranges[0]['start'] and \
+                ranges[-1]['nodes'] == ranges[0]['nodes']:
+            ranges[0]['start'] = ranges.pop()['start']
+        return ranges
+    
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _get_preference_list_at(self, digest):
+        """
+        Gets the preference list of the keys just below a token
+        
+        :Parameters:
+            digest : str
+                The token as a digest
+        :rtype: list(str)
+        :returns: The node names, empty if the table is
+        """
+        if not self.tokens:
+            return []
+        pos = bisect_left(self.tokens, digest)
+        if pos == len(self.tokens):
+            pos = 0
+        return list(self.preference_lists[pos])
+        
+    def _get_pos(self, key):
+        """
+        Gets the ring position of a key, the first token at or after its 
+        digest
+        """
+        if self.partition_shift is not None and self.tokens:
+            return self.hash(key) >> self.partition_shift
+        
+        memo = self.memo
+        if self.memo_size:
+            pos = memo.get(key)
+            if pos is not None:
+                return pos
+        
+        if not self.tokens:
+            raise exceptions.ValueError('ring is empty cannot get %s' % key)
+        pos = bisect_left(self.tokens, self.digest(key))
+        if pos == len(self.tokens):
+            pos = 0
+        
+        if self.memo_size:
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[key] = pos
+        return pos
+    
+    def _walk(self, pos, n):
+        """
+        Walks the ring clockwise from pos collecting n distinct nodes
+        
+        :rtype: tuple(str)
+        :returns: The node names
+        """
+        n = min(n, len(self.nodes))
+        node_index = self.node_index
+        num_tokens = len(node_index)
+        indexes = []
+        for i in xrange(num_tokens):
+            index = node_index[(pos + i) % num_tokens]
+            if index not in indexes:
+                indexes.append(index)
+                if len(indexes) == n:
+                    break
+        return tuple(self.nodes[index] for index in indexes)
+    
+    def _build_preference_lists(self, n):
+        """
+        Computes the preference list of every ring position.  Equal lists 
+        share one tuple.
+        
+        :rtype: tuple(tuple(str))
+        :returns: The preference list of each position
+        """
+        shared = {}
+        lists = []
+        for pos in xrange(len(self.tokens)):
+            pref_list = self._walk(pos, n)
+            lists.append(shared.setdefault(pref_list, pref_list))
+        return tuple(lists)
+
+def in_range(token, start, end):
+    """
+    Whether a token lies in the (start, end] range of the ring
+    
+    :Parameters:
+        token : long
+        start : long
+        end : long
+    :rtype: bool
+    :returns: True if the token is in the range
+    """
+    if start < end:
+        return start < token <= end
+    return token > start or token <= end
+
+def encode_ranges(ranges):
+    """
+    Converts the tokens of ranges to hex strings, since XML-RPC integers 
+    are 32 bits
+    
+    :Parameters:
+        ranges : list(dict)
+    :rtype: list(dict)
+    :returns: Copies of the ranges with hex string tokens
+    """
+    return [dict(moved, start='%x' % moved['start'], end='%x' % moved['end']) 
+            for moved in ranges]
+
+def decode_ranges(ranges):
+    """
+    Converts the hex string tokens of encoded ranges back to integers
+    
+    :Parameters:
+        ranges : list(dict)
+    :rtype: list(dict)
+    :returns: Copies of the ranges with integer tokens
+    """
+    return [dict(moved, start=long(moved['start'], 16), end=long(moved['end'], 16)) 
+            for moved in ranges]
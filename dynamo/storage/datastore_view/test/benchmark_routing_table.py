@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import timeit
+import uuid
+
+from dynamo.lib.consistent_hash import ConsistentHash
+from dynamo.storage.datastore_view import RoutingTable
+
+# ------------------------------------------------------
+# Config
+# ------------------------------------------------------
+NODE_COUNTS = [3, 100, 2000]
+NUM_KEYS = 20000
+REPLICAS = 3
+
+# ------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------
+def rate(func, keys):
+    start = timeit.default_timer()
+    for key in keys:
+        func(key, REPLICAS)
+    return len(keys) / (timeit.default_timer() - start)
+
+def run():
+    keys = [str(uuid.uuid4()) for i in xrange(NUM_KEYS)]
+    print '%8s %10s %16s %16s %16s' % ('nodes', 'build (s)', 'ring keys/s', 
+                                        'table keys/s', 'memo keys/s')
+    for num_nodes in NODE_COUNTS:
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(['10.0.%s.%s:20000' % (i // 256, i % 256) 
+                             for i in xrange(num_nodes)])
+        start = timeit.default_timer()
+        table = RoutingTable(cons_hash, REPLICAS)
+        build_time = timeit.default_timer() - start
+        memo_table = RoutingTable(cons_hash, REPLICAS, memo_size=NUM_KEYS)
+        rate(memo_table.get_preference_list, keys)
+        
+        print '%8d %10.3f %16.0f %16.0f %16.0f' % (
+            num_nodes, build_time, rate(cons_hash.get_preference_list, keys),
+            rate(table.get_preference_list, keys), 
+            rate(memo_table.get_preference_list, keys))
+
+if __name__ == '__main__':
+    run()
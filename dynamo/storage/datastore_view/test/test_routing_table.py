@@ -0,0 +1,227 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import uuid
+from unittest import TestCase
+
+from dynamo.lib.consistent_hash import ConsistentHash, HASH_FUNCTIONS
+from dynamo.storage.datastore_view import DataStoreView, RoutingTable, \
+    in_range, encode_ranges, decode_ranges, parse_server
+
+# ------------------------------------------------------
+# Tests
+# ------------------------------------------------------
+class TestRoutingTable(TestCase):
+    def setUp(self):
+        self.nodes = ['10.0.0.%s:20000' % i for i in xrange(8)]
+        self.keys = [str(uuid.uuid4()) for i in xrange(500)] + ['foo', '']
+        
+    def _assert_matches(self, cons_hash, table):
+        for key in self.keys:
+            self.assertEquals(table.get_node(key), cons_hash.get_node(key))
+            for n in xrange(1, 6):
+                self.assertEquals(list(table.get_preference_list(key, n)),
+                                  cons_hash.get_preference_list(key, n))
+    
+    def test_matches_consistent_hash(self):
+        """
+        Ensures the table routes keys like the ring it was built from
+        """
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(self.nodes)
+        self._assert_matches(cons_hash, RoutingTable(cons_hash, 3))
+        
+    def test_hash_functions(self):
+        """
+        Ensures tables of every hash width route keys like their ring
+        """
+        for name in HASH_FUNCTIONS:
+            cons_hash = ConsistentHash(hash_function=name)
+            cons_hash.add_nodes(self.nodes)
+            self._assert_matches(cons_hash, RoutingTable(cons_hash, 3))
+        
+    def test_partitions(self):
+        """
+        Ensures a ring of equal partitions is routed like the ring
+        """
+        for name in HASH_FUNCTIONS:
+            cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY3, 
+                                       hash_function=name, partitions=128)
+            cons_hash.add_nodes(self.nodes)
+            table = RoutingTable(cons_hash, 3)
+            self.assertTrue(table.partition_shift is not None)
+            self._assert_matches(cons_hash, table)
+        
+    def test_random_tokens(self):
+        """
+        Ensures randomly placed tokens of every width are routed like the ring
+        """
+        cons_hash = ConsistentHash(strategy=ConsistentHash.STRATEGY1)
+        cons_hash.add_nodes(self.nodes)
+        cons_hash.add_nodes(['small'])
+        cons_hash.ring[1] = 'small'
+        cons_hash.sorted_keys.insert(0, 1)
+        self._assert_matches(cons_hash, RoutingTable(cons_hash, 3))
+        
+    def test_shared_preference_lists(self):
+        """
+        Ensures equal preference lists are one tuple and fewer nodes than 
+        replicas are handled
+        """
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(self.nodes[:2])
+        table = RoutingTable(cons_hash, 3)
+        self.assertEquals(len(set(id(pref_list) for pref_list in table.preference_lists)), 2)
+        self.assertEquals(sorted(table.get_preference_list('foo', 3)), self.nodes[:2])
+        self._assert_matches(cons_hash, table)
+        
+    def test_memo(self):
+        """
+        Ensures memoized keys route the same and the memo stays bounded
+        """
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(self.nodes)
+        table = RoutingTable(cons_hash, 3, memo_size=100)
+        self._assert_matches(cons_hash, table)
+        self._assert_matches(cons_hash, table)
+        self.assertTrue(0 < len(table.memo) <= 100)
+        
+    def test_empty(self):
+        """
+        Ensures routing on an empty ring raises an error
+        """
+        table = RoutingTable(ConsistentHash())
+        self.assertRaises(ValueError, table.get_node, 'foo')
+        
+    def test_moved_ranges(self):
+        """
+        Ensures the moved ranges hold exactly the keys whose preference 
+        lists changed
+        """
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(self.nodes[:6])
+        old_table = RoutingTable(cons_hash, 3)
+        cons_hash.add_nodes(self.nodes[6:])
+        cons_hash.remove_nodes(self.nodes[:1])
+        table = RoutingTable(cons_hash, 3)
+        
+        moved = table.get_moved_ranges(old_table)
+        self.assertTrue(moved)
+        self.assertEquals(table.get_moved_ranges(table), [])
+        to_int = table.to_int
+        for key in self.keys:
+            token = to_int(table.digest(key))
+            ranges = [r for r in moved if in_range(token, r['start'], r['end'])]
+            old, new = old_table.get_preference_list(key, 3), table.get_preference_list(key, 3)
+            if old == new:
+                self.assertEquals(ranges, [])
+            else:
+                self.assertEquals(len(ranges), 1)
+                self.assertEquals(ranges[0]['old'], list(old))
+                self.assertEquals(ranges[0]['new'], list(new))
+        self.assertEquals(decode_ranges(encode_ranges(moved)), moved)
+        
+    def test_in_range(self):
+        """
+        Ensures ranges exclude their start, include their end and wrap 
+        around the ring
+        """
+        self.assertTrue(in_range(5, 1, 5))
+        self.assertFalse(in_range(1, 1, 5))
+        self.assertTrue(in_range(9, 8, 2))
+        self.assertTrue(in_range(0, 8, 2))
+        self.assertFalse(in_range(5, 8, 2))
+        self.assertTrue(in_range(5, 3, 3))
+        
+    def test_get_ranges(self):
+        """
+        Ensures a node's ranges hold exactly the keys it replicates
+        """
+        cons_hash = ConsistentHash()
+        cons_hash.add_nodes(self.nodes)
+        table = RoutingTable(cons_hash, 3)
+        ranges = table.get_ranges(self.nodes[0])
+        self.assertTrue(ranges)
+        for key in self.keys:
+            token = table.to_int(table.digest(key))
+            held = [r for r in ranges if in_range(token, r['start'], r['end'])]
+            pref_list = list(table.get_preference_list(key, 3))
+            if self.nodes[0] in pref_list:
+                self.assertEquals(len(held), 1)
+                self.assertEquals(held[0]['nodes'], pref_list)
+            else:
+                self.assertEquals(held, [])
+        
+        # A one node ring is one range
+        cons_hash = ConsistentHash(1)
+        cons_hash.add_nodes(self.nodes[:1])
+        ranges = RoutingTable(cons_hash, 3).get_ranges(self.nodes[0])
+        self.assertEquals(len(ranges), 1)
+        self.assertEquals(ranges[0]['start'], ranges[0]['end'])
+        self.assertEquals(RoutingTable(cons_hash, 3).get_ranges('missing'), [])
+        
+class TestDataStoreView(TestCase):
+    def test_membership_change(self):
+        """
+        Ensures adding and removing nodes swaps in a new table
+        """
+        view = DataStoreView(['10.0.0.1:20000', '10.0.0.2:20000'], memo_size=10)
+        table = view.table
+        view.get_node('foo')
+        
+        view.add_nodes(['10.0.0.3:20000'])
+        self.assertFalse(view.table is table)
+        self.assertEquals(len(view.table.nodes), 3)
+        self.assertEquals(view.table.memo, {})
+        keys = [str(i) for i in xrange(200)]
+        self.assertEquals([view.get_node(key) for key in keys], view.get_nodes(keys))
+        
+        view.remove_nodes(['10.0.0.3:20000'])
+        self.assertEquals(view.table.nodes, table.nodes)
+        self.assertEquals([view.get_node(key) for key in keys], 
+                          [table.get_node(key) for key in keys])
+        
+    def test_membership_moved_ranges(self):
+        """
+        Ensures membership changes report the ranges that moved
+        """
+        view = DataStoreView(['10.0.0.1:20000', '10.0.0.2:20000'], replicas=1)
+        moved = view.add_nodes(['10.0.0.3:20000'])
+        self.assertTrue(moved)
+        self.assertTrue(all(r['new'] == ['10.0.0.3:20000'] for r in moved))
+        self.assertEquals(view.remove_nodes(['10.0.0.4:20000']), [])
+        
+    def test_weighted_servers(self):
+        """
+        Ensures servers can be weighted and reweighted
+        """
+        self.assertEquals(parse_server('10.0.0.1:20000'), ('10.0.0.1:20000', 1))
+        self.assertEquals(parse_server('10.0.0.1:20000:2.5'), ('10.0.0.1:20000', 2.5))
+        self.assertRaises(ValueError, parse_server, '10.0.0.1:20000:big')
+        
+        view = DataStoreView(['10.0.0.1:20000:3', '10.0.0.2:20000'], replicas=1)
+        self.assertEquals(view.table.nodes, ('10.0.0.1:20000', '10.0.0.2:20000'))
+        self.assertEquals(len(view.consistent_hash.node_tokens['10.0.0.1:20000']), 15)
+        moved = view.set_weights({'10.0.0.2:20000': 3})
+        self.assertTrue(moved)
+        self.assertTrue(all(r['new'] == ['10.0.0.2:20000'] for r in moved))
+        
+    def test_set_members(self):
+        """
+        Ensures setting the members adds, removes and reweights nodes in one
+        change, and is a no-op when they match the ring
+        """
+        view = DataStoreView(['10.0.0.1:20000', '10.0.0.2:20000'], replicas=1)
+        version = view.table.version
+        self.assertEquals(view.set_members({'10.0.0.1:20000': 1, '10.0.0.2:20000': 1.0}), [])
+        self.assertEquals(view.table.version, version)
+        
+        moved = view.set_members({'10.0.0.1:20000': 2, '10.0.0.3:20000': 1})
+        self.assertTrue(moved)
+        self.assertEquals(view.table.nodes, ('10.0.0.1:20000', '10.0.0.3:20000'))
+        self.assertEquals(view.consistent_hash.weights['10.0.0.1:20000'], 2)
+        
+        other = DataStoreView(['10.0.0.1:20000:2', '10.0.0.3:20000'], replicas=1)
+        keys = [str(i) for i in xrange(200)]
+        self.assertEquals([view.get_node(key) for key in keys], 
+                          [other.get_node(key) for key in keys])
@@ -0,0 +1,358 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from dynamo.lib.vector_clock import VersionClock, reconcile
+from dynamo.storage.datastore_view import in_range
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class Handoff(object):
+    """
+    A background thread that streams keys to the nodes that took over their
+    ranges of the ring.
+    
+    Each membership change adds a plan of transfers, one per moved range,
+    naming the nodes that are new to the range's preference list.  The
+    thread walks the persistence layer's keys a chunk at a time, reads every
+    sibling of each key in a planned range with get_versions and sends them
+    to the range's new nodes in batches of at most max_batch_bytes, one batch
+    in flight at a time.  A failed send is retried after retry_interval
+    seconds from the same chunk.
+    
+    After each chunk the thread sleeps so that it sends at most max_rate
+    bytes per second and spends at most max_duty of its time working, which
+    bounds its share of the disk and of the node's RPC workers.  The plans
+    and the last key sent are checkpointed to checkpoint_path after every
+    chunk, so a restarted node resumes where it stopped.  Adding a plan
+    starts the walk over, since the new ranges may hold keys already passed.
+    """
+    def __init__(self, persis, hash_function, send, checkpoint_path=None,
+                 chunk_size=500, max_batch_bytes=4 * 1024 * 1024,
+                 max_rate=10 * 1024 * 1024, max_duty=0.5, retry_interval=5.0):
+        """
+        :Parameters:
+            persis : PersistenceLayer
+                The persistence layer to read keys from
+            hash_function : HashFunction
+                The hash function of the ring
+            send : function
+                Called with a node and a list of (key, value, date, clock) 
+                rows, one per sibling as encode_versions makes them, raises 
+                an exception if the node did not store them
+            checkpoint_path : str
+                File the progress is saved to, None keeps it in memory only
+            chunk_size : int
+                Number of keys read per chunk
+            max_batch_bytes : int
+                Maximum length of the values sent in one call
+            max_rate : int
+                Maximum bytes of values sent per second, 0 for no limit
+            max_duty : float
+                Maximum fraction of time spent handing off
+            retry_interval : float
+                Seconds to wait before retrying a chunk that failed
+        """
+        self.persis = persis
+        self.hash_function = hash_function
+        self.send = send
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = chunk_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_rate = max_rate
+        self.max_duty = max_duty
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.plans = []
+        self.after_key = None
+        self.keys_scanned = 0
+        self.keys_sent = 0
+        self.bytes_sent = 0
+        self.batches = 0
+        self.passes = 0
+        self.errors = 0
+        self.time_spent = 0.0
+        self._tables = []
+        self._load_checkpoint()
+
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def start(self):
+        """
+        Starts the handoff thread
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='handoff')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """
+        Stops the handoff thread after its current chunk
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+    
+    def add_plan(self, transfers):
+        """
+        Adds the transfers of a membership change and starts the walk over
+        
+        :Parameters:
+            transfers : list(dict)
+                The moved ranges to hand off, each with integer 'start' and
+                'end' tokens and the 'targets' to send its keys to
+        """
+        if not transfers:
+            return
+        with self.lock:
+            self.plans.append(sorted(transfers, key=lambda transfer: transfer['end']))
+            self.after_key = None
+            self._build_tables()
+            self._save_checkpoint()
+        self.wakeup.set()
+    
+    def transfer_chunk(self):
+        """
+        Hands off the keys of the next chunk
+        
+        :rtype: int
+        :returns: The bytes of values sent
+        """
+        with self.lock:
+            tables = self._tables
+            after_key = self.after_key
+        if not tables:
+            return 0
+        
+        keys = self.persis.scan_keys(after_key, self.chunk_size)
+        moving = {}
+        for key in keys:
+            targets = self._get_targets(tables, self.hash_function.hash(key))
+            if targets:
+                moving[key] = targets
+        
+        batches = {}
+        sent = 0
+        for row in get_versions(self.persis, list(moving)):
+            for node in moving[row[0]]:
+                batch, size = batches.get(node, ([], 0))
+                if batch and size + len(row[1]) > self.max_batch_bytes:
+                    self._send(node, batch)
+                    batch, size = [], 0
+                batch.append(row)
+                batches[node] = (batch, size + len(row[1]))
+                sent += len(row[1])
+        for node, (batch, size) in batches.iteritems():
+            self._send(node, batch)
+        
+        with self.lock:
+            # A plan added meanwhile restarted the walk
+            if tables is not self._tables:
+                return sent
+            self.keys_scanned += len(keys)
+            self.keys_sent += len(moving)
+            self.bytes_sent += sent
+            if len(keys) < self.chunk_size:
+                logging.info('Handed off %s plans' % len(self.plans))
+                self.passes += 1
+                self.plans = []
+                self.after_key = None
+                self._build_tables()
+            else:
+                self.after_key = keys[-1]
+            self._save_checkpoint()
+        return sent
+    
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The pending plans and counters of the work done so far
+        """
+        with self.lock:
+            return {'plans': len(self.plans),
+                    'keys_scanned': self.keys_scanned,
+                    'keys_sent': self.keys_sent,
+                    'bytes_sent': self.bytes_sent,
+                    'batches': self.batches,
+                    'passes': self.passes,
+                    'errors': self.errors,
+                    'time_spent': self.time_spent}
+
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _run(self):
+        """
+        Handoff thread loop
+        """
+        while not self.stopped.is_set():
+            if not self._tables:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            start = time.time()
+            try:
+                sent = self.transfer_chunk()
+            except:
+                logging.exception('Error handing off keys')
+                with self.lock:
+                    self.errors += 1
+                self.stopped.wait(self.retry_interval)
+                continue
+            elapsed = time.time() - start
+            with self.lock:
+                self.time_spent += elapsed
+            delay = elapsed / self.max_duty - elapsed
+            if self.max_rate:
+                delay = max(delay, float(sent) / self.max_rate - elapsed)
+            self.stopped.wait(delay)
+    
+    def _send(self, node, batch):
+        """
+        Sends a batch of rows to a node
+        """
+        self.send(node, batch)
+        with self.lock:
+            self.batches += 1
+    
+    def _get_targets(self, tables, token):
+        """
+        Gets the nodes a token's key is handed off to
+        
+        :Parameters:
+            tables : list(tuple(list(long), list(dict)))
+                The range ends and transfers of each plan, sorted by end
+            token : long
+                The key's token
+        :rtype: set(str)
+        :returns: The nodes to send the key to
+        """
+        targets = set()
+        for ends, transfers in tables:
+            # The only range that can hold the token is the first to end
+            # at or after it, or the one wrapping past the top of the ring
+            transfer = transfers[bisect_left(ends, token) % len(ends)]
+            if in_range(token, transfer['start'], transfer['end']):
+                targets.update(transfer['targets'])
+        return targets
+    
+    def _build_tables(self):
+        """
+        Builds the lookup tables of the plans
+        """
+        self._tables = [([transfer['end'] for transfer in plan], plan)
+                        for plan in self.plans]
+    
+    def _save_checkpoint(self):
+        """
+        Writes the plans and the last key handed off to the checkpoint file,
+        removing it once there is nothing left to hand off
+        """
+        if not self.checkpoint_path:
+            return
+        if not self.plans:
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            return
+        
+        plans = [[dict(transfer, start='%x' % transfer['start'],
+                       end='%x' % transfer['end']) for transfer in plan]
+                 for plan in self.plans]
+        after_key = self.after_key
+        if isinstance(after_key, unicode):
+            after_key = after_key.encode('utf-8')
+        if after_key is not None:
+            after_key = after_key.encode('hex')
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'plans': plans, 'after_key': after_key}, f)
+        os.rename(tmp_path, self.checkpoint_path)
+    
+    def _load_checkpoint(self):
+        """
+        Resumes from the checkpoint file if there is one
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+            self.plans = [[dict(transfer, start=long(transfer['start'], 16),
+                                end=long(transfer['end'], 16)) for transfer in plan]
+                          for plan in checkpoint['plans']]
+            if checkpoint['after_key'] is not None:
+                self.after_key = str(checkpoint['after_key']).decode('hex')
+            self._build_tables()
+            logging.info('Resuming the handoff of %s plans after key=%s' %
+                         (len(self.plans), self.after_key))
+        except:
+            logging.exception('Error loading the handoff checkpoint %s' %
+                              self.checkpoint_path)
+
+def get_versions(persis, keys):
+    """
+    Reads the siblings of keys to send to another node
+    
+    :Parameters:
+        persis : PersistenceLayer
+            The persistence layer to read from
+        keys : list(str)
+            The keys
+    :rtype: list(tuple(str, str, str, str))
+    :returns: A (key, value, date, clock) row for each sibling of the keys
+              that exist, see encode_versions
+    """
+    return encode_versions(dict((key, get_siblings(result)) for key, result 
+                                in persis.get_keys(keys).iteritems()))
+
+def encode_versions(siblings):
+    """
+    Converts the siblings of keys to rows that can be sent over RPC
+    
+    :Parameters:
+        siblings : dict(str, list(tuple(str, int, VersionClock)))
+            The (value, date, clock) siblings of each key
+    :rtype: list(tuple(str, str, str, str))
+    :returns: A (key, value, date, clock) row for each sibling, with the 
+              date as a string since XML-RPC integers are 32 bits and the 
+              clock None for a version written without one
+    """
+    rows = []
+    for key, versions in siblings.iteritems():
+        for value, date, clock in versions:
+            if isinstance(value, buffer):
+                value = str(value)
+            rows.append((key, value, str(date), clock.encode() if clock else None))
+    return rows
+
+def get_siblings(result):
+    """
+    Reduces the versions of a key read from the persistence layer to its
+    siblings
+    
+    :Parameters:
+        result : list(tuple(int, str, int, str))
+            The (id, value, date, clock) versions of the key
+    :rtype: list(tuple(str, int, VersionClock))
+    :returns: The (value, date, clock) siblings, oldest first
+    """
+    if len(result) == 1:
+        row_id, value, date, clock = result[0]
+        return [(value, date, VersionClock.decode(clock))]
+    return reconcile([(value, date, VersionClock.decode(clock)) 
+                      for row_id, value, date, clock in 
+                      sorted(result, key=lambda version: version[0])])
@@ -0,0 +1,307 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import logging
+import sqlite3
+import threading
+import time
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class HintStore(object):
+    """
+    A durable store of the writes this node took for replicas that were
+    down, and a background thread that replays them to those replicas once
+    they come back.
+
+    Hints are kept in a sqlite database of their own, apart from the node's
+    keys, so they are never read back as this node's values and survive a
+    restart.  Each hint keeps the date and vector clock it was written with
+    and is replayed with handoff_put, so a write the owner took since that
+    supersedes it still wins.
+    The store holds at most max_bytes of values.  Hints past that are
+    refused, so the load balancer moves on to the next node rather than
+    letting a long outage fill the disk.
+
+    The thread replays the hints of one owner at a time, oldest first, in
+    batches of at most max_batch_bytes with one batch in flight, and deletes
+    them once the owner stores them.  An owner that fails is retried after
+    retry_interval seconds, doubling up to max_retry_interval while it
+    stays down.  After each batch the thread sleeps so that it sends at most
+    max_rate bytes per second and spends at most max_duty of its time
+    replaying, so a node coming back is not swamped by its backlog on top of
+    its own traffic.
+    """
+    BUSY_TIMEOUT = 30.0
+    CREATE_SQL = ("CREATE TABLE IF NOT EXISTS hints (id integer primary key, "
+                  "owner varchar(255), key varchar(255), value blob, date integer, "
+                  "clock text)")
+    CREATE_INDEX_SQL = "CREATE INDEX IF NOT EXISTS hints_owner ON hints (owner, id)"
+    INSERT_SQL = "INSERT INTO hints(owner, key, value, date, clock) VALUES (?, ?, ?, ?, ?)"
+    SELECT_SQL = ("SELECT id, key, value, date, clock FROM hints WHERE owner=? "
+                  "ORDER BY id LIMIT ?")
+    DELETE_SQL = "DELETE FROM hints WHERE id=?"
+    OWNERS_SQL = "SELECT DISTINCT owner FROM hints"
+    SIZE_SQL = "SELECT COUNT(*), SUM(LENGTH(CAST(value AS BLOB))) FROM hints"
+
+    def __init__(self, path, send, max_bytes=256 * 1024 * 1024,
+                 max_batch_bytes=1024 * 1024, max_batch_rows=500,
+                 max_rate=10 * 1024 * 1024, max_duty=0.5, retry_interval=1.0,
+                 max_retry_interval=30.0):
+        """
+        :Parameters:
+            path : str
+                Path of the hint database, ':memory:' keeps it in memory
+            send : function
+                Called with an owner and a list of (key, value, date, clock)
+                rows.
+                Returns True if the owner stored them and False if they
+                should be dropped because the owner no longer takes them,
+                raises an exception if the owner failed.
+            max_bytes : int
+                Maximum length of the values held
+            max_batch_bytes : int
+                Maximum length of the values replayed in one call
+            max_batch_rows : int
+                Maximum number of hints replayed in one call
+            max_rate : int
+                Maximum bytes of values replayed per second, 0 for no limit
+            max_duty : float
+                Maximum fraction of time spent replaying
+            retry_interval : float
+                Seconds to wait before retrying an owner that failed
+            max_retry_interval : float
+                Longest wait between retries of an owner that stays down
+        """
+        self.path = path
+        self.send = send
+        self.max_bytes = max_bytes
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_rows = max_batch_rows
+        self.max_rate = max_rate
+        self.max_duty = max_duty
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.retries = {}
+        self.hints = 0
+        self.bytes = 0
+        self.hints_stored = 0
+        self.hints_refused = 0
+        self.hints_replayed = 0
+        self.hints_dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.time_spent = 0.0
+        self._next = 0
+
+        # Connections are used under the lock, from the RPC threads and the
+        # replay thread
+        self.conn = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT,
+                                    check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute(self.CREATE_SQL)
+        self.conn.execute(self.CREATE_INDEX_SQL)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(hints)")]
+        if 'clock' not in columns:
+            self.conn.execute("ALTER TABLE hints ADD COLUMN clock text")
+        self.conn.commit()
+        self.hints, self.bytes = self.conn.execute(self.SIZE_SQL).fetchone()
+        self.bytes = self.bytes or 0
+        if self.hints:
+            logging.info('Loaded %s hints holding %s bytes from %s' %
+                         (self.hints, self.bytes, path))
+
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def start(self):
+        """
+        Starts the replay thread
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='hint-replay')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the replay thread after its current batch
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """
+        Stops the replay thread and closes the database
+        """
+        self.stop()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def add(self, rows):
+        """
+        Stores hints in one transaction, unless they would take the store
+        past max_bytes
+
+        :Parameters:
+            rows : list(tuple(str, str, str, str, int))
+                (owner, key, value, clock, date) rows, the owner being the 
+                node each version is meant for and the clock and date those
+                the version was stamped with.  A row without a date is 
+                dated now.
+        :rtype: bool
+        :returns: True if the hints were stored, False if they were refused
+        """
+        now = int(time.time() * 1000000)
+        rows = [(row[0], row[1], 
+                 row[2].encode('utf-8') if isinstance(row[2], unicode) else row[2],
+                 row[3], row[4] if len(row) > 4 else now) for row in rows]
+        size = sum(len(value) for owner, key, value, clock, date in rows)
+        with self.lock:
+            if self.bytes + size > self.max_bytes:
+                self.hints_refused += len(rows)
+                return False
+            with self.conn:
+                self.conn.executemany(self.INSERT_SQL, [(owner, key, value, date, clock)
+                                                        for owner, key, value, clock, date in rows])
+            self.hints += len(rows)
+            self.bytes += size
+            self.hints_stored += len(rows)
+            for row in rows:
+                self.retries.setdefault(row[0], (0, time.time() + self.retry_interval))
+        return True
+
+    def replay_batch(self, owner):
+        """
+        Replays the oldest hints of an owner
+
+        :Parameters:
+            owner : str
+                The node the hints are meant for
+        :rtype: int
+        :returns: The bytes of values sent
+        """
+        with self.lock:
+            cursor = self.conn.execute(self.SELECT_SQL, (owner, self.max_batch_rows))
+            ids = []
+            rows = []
+            size = 0
+            for row_id, key, value, date, clock in cursor:
+                if rows and size + len(value) > self.max_batch_bytes:
+                    break
+                ids.append(row_id)
+                rows.append((key, value, str(date), clock))
+                size += len(value)
+        if not rows:
+            return 0
+
+        delivered = self.send(owner, rows)
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(self.DELETE_SQL, [(row_id,) for row_id in ids])
+            self.hints -= len(ids)
+            self.bytes -= size
+            self.batches += 1
+            if delivered:
+                self.hints_replayed += len(ids)
+            else:
+                self.hints_dropped += len(ids)
+        return size if delivered else 0
+
+    def get_owners(self):
+        """
+        :rtype: list(str)
+        :returns: The nodes there are hints for
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute(self.OWNERS_SQL)]
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The hints and bytes held, the owners they are for and
+                  counters of the work done so far
+        """
+        with self.lock:
+            return {'hints': self.hints,
+                    'bytes': self.bytes,
+                    'owners': len(self.retries),
+                    'hints_stored': self.hints_stored,
+                    'hints_refused': self.hints_refused,
+                    'hints_replayed': self.hints_replayed,
+                    'hints_dropped': self.hints_dropped,
+                    'batches': self.batches,
+                    'errors': self.errors,
+                    'time_spent': self.time_spent}
+
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _run(self):
+        """
+        Replay thread loop, visiting the owners that are due in turn
+        """
+        now = time.time()
+        for owner in self.get_owners():
+            self.retries.setdefault(owner, (0, now))
+        while not self.stopped.is_set():
+            owner = self._get_due_owner(time.time())
+            if owner is None:
+                self.stopped.wait(self.retry_interval / 4)
+                continue
+
+            start = time.time()
+            try:
+                sent = self.replay_batch(owner)
+            except:
+                logging.exception('Error replaying hints to %s' % owner)
+                with self.lock:
+                    self.errors += 1
+                    failures = self.retries[owner][0] + 1
+                    delay = min(self.retry_interval * 2 ** (failures - 1),
+                                self.max_retry_interval)
+                    self.retries[owner] = (failures, time.time() + delay)
+                continue
+
+            elapsed = time.time() - start
+            with self.lock:
+                self.time_spent += elapsed
+                if self._has_hints(owner):
+                    self.retries[owner] = (0, 0)
+                else:
+                    logging.info('Replayed the hints for %s' % owner)
+                    del self.retries[owner]
+            delay = elapsed / self.max_duty - elapsed
+            if self.max_rate:
+                delay = max(delay, float(sent) / self.max_rate - elapsed)
+            self.stopped.wait(delay)
+
+    def _get_due_owner(self, now):
+        """
+        Gets the next owner whose hints are due to be replayed, taking the
+        owners in turn
+
+        :rtype: str
+        :returns: The owner, None if none is due
+        """
+        with self.lock:
+            due = sorted(owner for owner, (failures, retry_at) in self.retries.iteritems()
+                         if retry_at <= now)
+        if not due:
+            return None
+        self._next += 1
+        return due[self._next % len(due)]
+
+    def _has_hints(self, owner):
+        """
+        Whether there are hints left for an owner.  Called with the lock held.
+        """
+        return self.conn.execute(self.SELECT_SQL, (owner, 1)).fetchone() is not None
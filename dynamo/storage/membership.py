@@ -0,0 +1,402 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import hashlib
+import logging
+import random
+import threading
+import time
+
+from dynamo.lib.failure_detector import PhiAccrualFailureDetector
+from dynamo.storage.datastore_view import parse_servers
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class Membership(object):
+    """
+    The membership of the ring as this node knows it, spread to the other
+    nodes by gossip, and a failure detector fed by the heartbeats the gossip
+    carries.
+
+    Every interval the node bumps its own heartbeat and gossips with one
+    other member, visiting them in a shuffled order, over the gossip RPC of
+    the storage nodes.  A round sends the heartbeats this node knows of and
+    a digest of its members; the peer merges the heartbeats, keeping the
+    latest of each node, and answers with its own, adding its members if
+    the digests differ.  If the merged members still differ from the
+    peer's, they are pushed back in a second call.  A node's heartbeats
+    reach every member in O(log n) rounds.
+
+    Each member carries the ring version it was last changed at.  A change
+    made on this node, by add_nodes, remove_nodes or set_weights, stamps
+    the nodes it changed with the next ring version, and when two nodes
+    know different states of a member the higher version wins, a removal
+    winning ties.  Removed nodes are kept as tombstones so a stale state
+    cannot bring them back.  Whenever the members change, on_change is
+    called with the weight of each node in the ring.
+
+    A node's phi rises while its heartbeats stop advancing, see
+    PhiAccrualFailureDetector.  Once per round the nodes past the threshold
+    are cached in suspected, which requests check before routing to a node.
+
+    A load balancer takes part without a name: it pulls heartbeats and
+    members from the storage nodes and pushes its own membership changes,
+    but has no heartbeat and is never gossiped to.
+
+    Times are read from clock, time.time unless a test swaps in its own.
+    """
+    JOINED = 'joined'
+    LEFT = 'left'
+
+    def __init__(self, name, servers, connect, on_change, interval=1.0,
+                 threshold=8.0, min_std_deviation=0.5, acceptable_pause=0.0,
+                 max_samples=200):
+        """
+        :Parameters:
+            name : str
+                The name of this node, None for a load balancer
+            servers : list(str)
+                The nodes known at start, each in the format {host/ip}:port
+                optionally followed by :weight.  They are the members at
+                ring version 0.
+            connect : function
+                Called with a node name, returns a proxy for its RPCs
+            on_change : function
+                Called with a dict of the weight of each member whenever
+                the members change
+            interval : float
+                Seconds between gossip rounds, 0 disables the gossip thread
+            threshold : float
+                The phi past which a node is suspected
+            min_std_deviation : float
+                Smallest standard deviation of the heartbeat intervals, in
+                seconds
+            acceptable_pause : float
+                Seconds of missed heartbeats that raise no suspicion
+            max_samples : int
+                Number of heartbeat intervals kept for each node
+        """
+        self.name = name
+        self.clock = time.time
+        self.connect = connect
+        self.on_change = on_change
+        self.interval = interval
+        self.detector = PhiAccrualFailureDetector(threshold, max_samples,
+                                                  min_std_deviation, acceptable_pause,
+                                                  interval or 1.0)
+        self.generation = int(time.time())
+        self.heartbeat = 0
+        self.heartbeats = {}
+        self.suspected = frozenset()
+        self.members = {}
+        names, weights = parse_servers(servers)
+        for node in names:
+            self.members[node] = (0, self.JOINED, float(weights[node]))
+        self.ring_version = 0
+        self.digest = None
+        self._update_digest()
+        self.applied = self._get_weights()
+        self.lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.rounds = 0
+        self.errors = 0
+        self._order = []
+        self._random = random.Random()
+
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def start(self):
+        """
+        Starts the gossip thread
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='gossip')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the gossip thread after its current round
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def gossip_round(self, now=None):
+        """
+        Runs one gossip round
+
+        :Parameters:
+            now : float
+                The current time, defaults to clock()
+        :rtype: str
+        :returns: The node gossiped with, None if there was none
+        """
+        node = self.start_round(now)
+        if node is None:
+            return None
+        try:
+            peer = self.connect(node)
+            push = self.finish_round(peer.gossip(self.get_state()), now)
+            if push is not None:
+                self.merge(peer.gossip(push), now)
+        except Exception, e:
+            self.fail_round(node, e)
+        return node
+
+    def start_round(self, now=None):
+        """
+        Starts a gossip round: bumps this node's heartbeat, refreshes the
+        suspected nodes and picks the node to gossip with.  The round is
+        sent with get_state and its reply passed to finish_round.
+
+        :rtype: str
+        :returns: The node to gossip with, None if there is none
+        """
+        now = now if now is not None else self.clock()
+        with self.lock:
+            self.rounds += 1
+            if self.name is not None:
+                self.heartbeat += 1
+                self.heartbeats[self.name] = (self.generation, self.heartbeat)
+            for node in self._get_peers():
+                if node not in self.detector:
+                    self.detector.heartbeat(node, now)
+            self._refresh_suspected(now)
+            return self._next_peer()
+
+    def finish_round(self, reply, now=None):
+        """
+        Merges the reply of the node gossiped with
+
+        :rtype: dict
+        :returns: The state to push back to the node if its members still
+                  differ, None if they agree
+        """
+        self.merge(reply, now)
+        if reply.get('digest') != self.digest:
+            return self.get_state(True)
+        return None
+
+    def fail_round(self, node, error):
+        """
+        Records a gossip round that failed
+        """
+        logging.info('Error gossiping with node=%s: %s' % (node, error))
+        with self.lock:
+            self.errors += 1
+
+    def handle(self, state, now=None):
+        """
+        Handles a gossip round started by another node
+
+        :Parameters:
+            state : dict
+                The other node's state, see get_state
+        :rtype: dict
+        :returns: This node's state, with its members if they differ from
+                  the other node's
+        """
+        self.merge(state, now)
+        return self.get_state(state.get('digest') != self.digest)
+
+    def get_state(self, with_members=False):
+        """
+        :Parameters:
+            with_members : bool
+                Whether to include the members
+        :rtype: dict
+        :returns: The ring version, the digest of the members, the
+                  [node, generation, heartbeat] of each member heard from
+                  and with members their [node, version, status, weight]
+        """
+        with self.lock:
+            state = {'ring_version': self.ring_version,
+                     'digest': self.digest,
+                     'heartbeats': [[node, generation, heartbeat] for node,
+                                    (generation, heartbeat) in self.heartbeats.iteritems()]}
+            if with_members:
+                state['members'] = [[node, version, status, weight] for node,
+                                    (version, status, weight) in self.members.iteritems()]
+        return state
+
+    def merge(self, state, now=None):
+        """
+        Merges the state of another node into this node's
+
+        :Parameters:
+            state : dict
+                The other node's state, see get_state
+            now : float
+                The current time, defaults to clock()
+        """
+        now = now if now is not None else self.clock()
+        changed = False
+        with self.lock:
+            for node, version, status, weight in state.get('members', ()):
+                member = (int(version), status, float(weight))
+                if member > self.members.get(node, (-1,)):
+                    self.members[node] = member
+                    changed = True
+            if changed:
+                self._update_digest()
+
+            revived = False
+            for node, generation, heartbeat in state.get('heartbeats', ()):
+                if node == self.name or not self._is_member(node):
+                    continue
+                last = self.heartbeats.get(node)
+                if last is not None and (generation, heartbeat) <= last:
+                    continue
+                if last is not None and generation != last[0]:
+                    logging.info('node=%s restarted' % node)
+                    self.detector.remove(node)
+                self.heartbeats[node] = (generation, heartbeat)
+                self.detector.heartbeat(node, now)
+                revived = revived or node in self.suspected
+            if revived:
+                self._refresh_suspected(now)
+        if changed:
+            self._apply()
+
+    def record(self, weights=None, left=()):
+        """
+        Records a membership change made on this node, stamping the nodes it
+        changed with the next ring version
+
+        :Parameters:
+            weights : dict(str, float)
+                The weight of each node added or reweighted
+            left : list(str)
+                The nodes removed
+        """
+        with self.lock:
+            version = self.ring_version + 1
+            for node, weight in (weights or {}).iteritems():
+                self.members[node] = (version, self.JOINED, float(weight))
+            for node in left:
+                self.members[node] = (version, self.LEFT, 0.0)
+            self._update_digest()
+        self._apply()
+
+    def is_suspected(self, node):
+        """
+        :rtype: bool
+        :returns: True if the node was past the phi threshold at the last
+                  round
+        """
+        return node in self.suspected
+
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: The ring version, the members and tombstones, the phi of
+                  each node, the suspected nodes and counters of the rounds
+        """
+        now = self.clock()
+        with self.lock:
+            return {'ring_version': self.ring_version,
+                    'members': len(self._get_weights()),
+                    'left': len(self.members) - len(self._get_weights()),
+                    'phi': dict((node, round(self.detector.phi(node, now), 2))
+                                for node in self._get_peers()),
+                    'suspected': sorted(self.suspected),
+                    'rounds': self.rounds,
+                    'errors': self.errors}
+
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _run(self):
+        """
+        Gossip thread loop
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.gossip_round()
+            except:
+                logging.exception('Error in a gossip round')
+
+    def _apply(self):
+        """
+        Calls on_change with the members if they changed since the last
+        call.  Calls are serialized so they are made in the order of the
+        changes.
+        """
+        with self.apply_lock:
+            with self.lock:
+                weights = self._get_weights()
+                if weights == self.applied:
+                    return
+                self.applied = weights
+            logging.info('Ring version %s has %s members' %
+                         (self.ring_version, len(weights)))
+            self.on_change(weights)
+
+    def _is_member(self, node):
+        member = self.members.get(node)
+        return member is not None and member[1] == self.JOINED
+
+    def _get_weights(self):
+        """
+        Gets the weight of each member.  Called with the lock held.
+        """
+        return dict((node, weight) for node, (version, status, weight)
+                    in self.members.iteritems() if status == self.JOINED)
+
+    def _get_peers(self):
+        """
+        Gets the members other than this node.  Called with the lock held.
+        """
+        return [node for node in self._get_weights() if node != self.name]
+
+    def _next_peer(self):
+        """
+        Gets the next member to gossip with, passing over suspected members
+        unless every member is.  Called with the lock held.
+        """
+        peers = set(self._get_peers())
+        if not peers:
+            return None
+        if peers - self.suspected:
+            peers -= self.suspected
+        self._order = [node for node in self._order if node in peers]
+        if not self._order:
+            self._order = sorted(peers)
+            self._random.shuffle(self._order)
+        return self._order.pop()
+
+    def _refresh_suspected(self, now):
+        """
+        Caches the members past the phi threshold.  Called with the lock
+        held.
+        """
+        suspected = frozenset(node for node in self._get_peers()
+                              if not self.detector.is_available(node, now))
+        for node in suspected - self.suspected:
+            logging.info('Suspecting node=%s, phi=%.1f' %
+                         (node, self.detector.phi(node, now)))
+        for node in self.suspected - suspected:
+            logging.info('node=%s is no longer suspected' % node)
+        self.suspected = suspected
+
+    def _update_digest(self):
+        """
+        Recomputes the ring version and the digest of the members.  Called
+        with the lock held.
+        """
+        digest = hashlib.md5()
+        for node, (version, status, weight) in sorted(self.members.iteritems()):
+            digest.update('%s %s %s %r\n' % (node, version, status, weight))
+        self.digest = digest.hexdigest()
+        self.ring_version = max([version for version, status, weight
+                                 in self.members.itervalues()] or [0])
+        for node in [node for node in self.heartbeats if not self._is_member(node)]:
+            del self.heartbeats[node]
+        for node in [node for node in self.detector.histories if not self._is_member(node)]:
+            self.detector.remove(node)
@@ -0,0 +1,111 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import logging
+import threading
+import time
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class Compactor(object):
+    """
+    A background thread that compacts a persistence layer a chunk at a time.
+    After each chunk the thread sleeps for at least interval seconds, and 
+    for longer if the chunk was slow, so compaction never uses more than
+    max_duty of the persistence layer's time.
+    """
+    def __init__(self, persis, chunk_size=500, interval=1.0, max_duty=0.1):
+        """
+        :Parameters:
+            persis : PersistenceLayer
+                The persistence layer to compact
+            chunk_size : int
+                Number of keys compacted per chunk
+            interval : float
+                Minimum seconds between chunks
+            max_duty : float
+                Maximum fraction of time spent compacting
+        """
+        self.persis = persis
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.max_duty = max_duty
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats_lock = threading.Lock()
+        self.chunks = 0
+        self.passes = 0
+        self.keys_scanned = 0
+        self.rows_reclaimed = 0
+        self.time_spent = 0.0
+        self.errors = 0
+        
+    # ------------------------------------------------------
+    # Public methods
+    # ------------------------------------------------------
+    def start(self):
+        """
+        Starts the compaction thread
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='compactor')
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        """
+        Stops the compaction thread after its current chunk
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            
+    def compact_chunk(self):
+        """
+        Compacts one chunk and updates the stats
+        
+        :rtype: float
+        :returns: The seconds spent compacting
+        """
+        start = time.time()
+        result = self.persis.compact(self.chunk_size)
+        elapsed = time.time() - start
+        with self.stats_lock:
+            self.chunks += 1
+            self.passes += 1 if result['finished_pass'] else 0
+            self.keys_scanned += result['keys']
+            self.rows_reclaimed += result['rows']
+            self.time_spent += elapsed
+        return elapsed
+    
+    def stats(self):
+        """
+        :rtype: dict
+        :returns: Counters of the work done so far
+        """
+        with self.stats_lock:
+            return {'chunks': self.chunks,
+                    'passes': self.passes,
+                    'keys_scanned': self.keys_scanned,
+                    'rows_reclaimed': self.rows_reclaimed,
+                    'time_spent': self.time_spent,
+                    'errors': self.errors}
+        
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _run(self):
+        """
+        Compaction thread loop
+        """
+        while not self.stopped.is_set():
+            try:
+                elapsed = self.compact_chunk()
+            except:
+                logging.exception('Error compacting')
+                with self.stats_lock:
+                    self.errors += 1
+                elapsed = 0
+            self.stopped.wait(max(self.interval, elapsed / self.max_duty - elapsed))
@@ -0,0 +1,558 @@
+# ------------------------------------------------------
+# Imports
+# ------------------------------------------------------
+import logging
+import mmap
+from bisect import bisect_right
+import os
+import struct
+import threading
+import time
+import zlib
+
+from dynamo.storage.persistence.persistence_layer import PersistenceLayer
+
+# ------------------------------------------------------
+# Implementation
+# ------------------------------------------------------
+class LogPersistenceLayer(PersistenceLayer):
+    """
+    A log structured persistence layer in the style of Bitcask.
+    
+    Records are appended to the active segment file of a directory and an
+    in-memory index maps each key to the segment, offset and length of its 
+    latest record, so a put is one sequential write and a get is one 
+    positioned read.  Once the active segment grows past max_segment_size a
+    new one is started.  Only the latest version of each key is reachable;
+    compact() copies the live records out of older segments and deletes 
+    them.
+    
+    Each record is a header of (crc32, id, date, key length, value length) 
+    followed by the key and value.  The crc covers everything after it and 
+    is checked on every read.  A torn write at the end of the active segment
+    is truncated away when the layer is opened.  The siblings of a key are
+    kept in one record, flagged by the top bit of the value length, whose
+    value is a (date, clock length, value length) header followed by the 
+    clock and value of each sibling.  Records written by earlier versions 
+    without the flag hold a single value without a clock.
+    
+    With mmap_reads values are returned as read-only buffers over memory 
+    mapped segments instead of copies, so large values reach the RPC layer
+    without being copied.  A buffer holds a reference to its mapping and 
+    segments never unmap explicitly, so a view stays valid after compaction
+    deletes its segment.
+    
+    The latencies of reads, puts and appends, recorded as commits, go to
+    the metrics given, see PersistenceLayer.TIMED_OPS.
+    """
+    HEADER = struct.Struct('>IQqII')
+    SIBLING = struct.Struct('>qII')
+    SIBLINGS = 0x80000000
+    SEGMENT_FORMAT = '%09d.data'
+    
+    def __init__(self, name, conn_str=None, max_segment_size=64 * 1024 * 1024,
+                 sync=False, mmap_reads=True, metrics=None):
+        """
+        :Parameters:
+            name : Name of the server
+            conn_str : Directory of the segment files, defaults to /tmp/{name}-log
+            max_segment_size : Size in bytes after which a new segment is started
+            sync : Whether to fsync the active segment after every write
+            mmap_reads : Whether to return values as buffers over mapped segments
+            metrics : The Metrics to record latencies in, None keeps them to 
+                      the layer
+        """
+        self.name = name
+        if not conn_str:
+            self.conn_str = '/tmp/%s-log' % self.name
+        else:
+            self.conn_str = conn_str
+        self.max_segment_size = max_segment_size
+        self.sync = sync
+        self.mmap_reads = mmap_reads
+        self.index = {}
+        self.segments = {}
+        self.active = None
+        self.write_fd = None
+        self.last_id = 0
+        self.write_lock = threading.RLock()
+        self.initialized = False
+        self._merge_position = None
+        self._scan_order = None
+        self._init_metrics(metrics)
+        
+    def __del__(self):
+        """
+        Destructor closes the segment files
+        """
+        self.close()
+        
+    def init_persistence(self):
+        """
+        Opens the segment files and rebuilds the index from them
+        """
+        logging.info('Opening log segments in %s' % self.conn_str)
+        if not os.path.isdir(self.conn_str):
+            os.makedirs(self.conn_str)
+        
+        seg_ids = sorted(int(filename.split('.')[0]) 
+                         for filename in os.listdir(self.conn_str)
+                         if filename.endswith('.data'))
+        for seg_id in seg_ids:
+            segment = _Segment(self._segment_path(seg_id), seg_id)
+            self.segments[seg_id] = segment
+            end = self._load_segment(segment)
+            if end < segment.size:
+                if seg_id == seg_ids[-1]:
+                    logging.error('Truncating a torn write at %s:%s' % (segment.path, end))
+                    segment.truncate(end)
+                else:
+                    logging.error('Corrupt record at %s:%s' % (segment.path, end))
+        
+        if seg_ids:
+            self._open_active(seg_ids[-1])
+        else:
+            self._open_active(0)
+        self.initialized = True
+        
+    def close(self):
+        """
+        Closes the segment files
+        """
+        with self.write_lock:
+            if self.write_fd is not None:
+                os.close(self.write_fd)
+                self.write_fd = None
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+            self.active = None
+            self.index = {}
+            self.initialized = False
+        
+    def get_key(self, key):
+        """
+        Reads a key.  Only the latest version of a key, or its siblings, are
+        kept.
+        
+        :Parameters:
+            key : str      
+        :rtype: list(tuple)
+        :returns A list of the (id, blob, date, clock) tuples of the key, 
+                 empty if the key does not exist.  The blobs are buffers if
+                 mmap_reads is set.
+        """
+        start = time.time()
+        result = self._read(key)
+        self.op_times['get_key'].record_since(start)
+        return result
+    
+    def get_keys(self, keys):
+        """
+        Reads a number of keys
+        
+        :Parameters:
+            keys : list(str)
+        :rtype: dict(str, list(tuple))
+        :returns A mapping from each key to a list of its (id, blob, date, 
+                 clock) tuples
+        """
+        start = time.time()
+        result = dict((key, self._read(key)) for key in keys)
+        self.op_times['get_keys'].record_since(start)
+        return result
+    
+    def put_siblings(self, items):
+        """
+        Appends a record holding the siblings of each of a number of keys 
+        with one write, replacing their earlier records
+        
+        :Parameters:
+            items : list(tuple(str, list(tuple(str, int, str))))
+                (key, siblings) pairs, each sibling a (data, date, clock) 
+                tuple with its date in microseconds and its encoded clock
+        :rtype: bool
+        :returns: True once the records are written
+        """
+        start = time.time()
+        try:
+            with self.write_lock:
+                records = []
+                for key, siblings in items:
+                    self.last_id += 1
+                    records.append((_encode(key), 
+                                    self._encode_siblings(self.last_id, key, siblings)))
+                self._append(records)
+            result = True
+        except:
+            self.op_errors['put_siblings'].add()
+            logging.exception('Error putting the siblings of %s keys' % len(items))
+            result = False
+        self.op_times['put_siblings'].record_since(start)
+        return result
+    
+    def scan_keys(self, after_key=None, max_keys=500):
+        """
+        Lists the keys in key order, a chunk at a time.  Starting over sorts
+        a snapshot of the index that later chunks bisect into, so keys 
+        written during a scan may be missed.
+        
+        :Parameters:
+            after_key : str
+                The last key of the previous chunk, None to start over
+            max_keys : int
+                Maximum number of keys to list
+        :rtype: list(str)
+        :returns: Up to max_keys keys following after_key
+        """
+        order = self._scan_order
+        if after_key is None or order is None:
+            order = self._scan_order = sorted(self.index.keys())
+        pos = 0 if after_key is None else bisect_right(order, _encode(after_key))
+        keys = order[pos:pos + max_keys]
+        if len(keys) < max_keys:
+            self._scan_order = None
+        return keys
+    
+    def compact(self, max_keys=500):
+        """
+        Merges up to max_keys records of the oldest segment that holds 
+        superseded records.  Live records are copied to the active segment
+        and the segment is deleted once all of its records are merged.  A 
+        segment being merged is finished before another is picked, even if
+        an older one gains superseded records meanwhile.
+        
+        :Parameters:
+            max_keys : int
+                Maximum number of records to merge
+        :rtype: dict
+        :returns: The number of records scanned and superseded records 
+                  dropped, and whether no segment is left to merge
+        """
+        with self.write_lock:
+            segment, start = self._merge_segment()
+            if segment is None:
+                return {'keys': 0, 'rows': 0, 'finished_pass': True}
+            
+            scanned = dropped = 0
+            live = []
+            end = start
+            for offset, length, record in segment.scan(start):
+                row_id, date, key, versions = self._decode(record, segment, offset)
+                entry = self.index.get(key)
+                if entry is not None and entry[0] == segment.seg_id and entry[1] == offset:
+                    live.append((key, record))
+                else:
+                    dropped += 1
+                scanned += 1
+                end = offset + length
+                if scanned >= max_keys:
+                    break
+            if live:
+                self._append(live)
+            
+            if end >= segment.size:
+                self._remove_segment(segment)
+                self._merge_position = None
+            elif not scanned:
+                # A corrupt record stops the scan, so the rest of the 
+                # segment is kept until it is reopened
+                logging.error('Corrupt record at %s:%s, not merging the rest of it' % 
+                              (segment.path, end))
+                segment.dead = 0
+                self._merge_position = None
+            else:
+                self._merge_position = (segment.seg_id, end)
+            finished_pass = self._merge_segment()[0] is None
+            
+        return {'keys': scanned, 'rows': dropped, 'finished_pass': finished_pass}
+    
+    # ------------------------------------------------------
+    # Private methods
+    # ------------------------------------------------------
+    def _segment_path(self, seg_id):
+        return os.path.join(self.conn_str, self.SEGMENT_FORMAT % seg_id)
+    
+    def _read(self, key):
+        """
+        Reads the versions of a key, see get_key
+        """
+        key = _encode(key)
+        while True:
+            entry = self.index.get(key)
+            if entry is None:
+                return []
+            segment = self.segments.get(entry[0])
+            record = None
+            if segment is not None:
+                if self.mmap_reads:
+                    record = segment.view(entry[1], entry[2])
+                else:
+                    record = segment.read(entry[1], entry[2])
+            if record is None:
+                # A segment merged away since the lookup has had its live 
+                # records indexed elsewhere, so the lookup is retried
+                if self.index.get(key) is entry:
+                    raise IOError('Segment %s of key=%s is missing' % (entry[0], key))
+                continue
+            row_id, date, record_key, versions = self._decode(record, segment, entry[1])
+            return [(row_id, value, date, clock) for value, date, clock in versions]
+    
+    def _open_active(self, seg_id):
+        """
+        Makes seg_id the segment that records are appended to
+        """
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+        path = self._segment_path(seg_id)
+        self.write_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        if seg_id not in self.segments:
+            self.segments[seg_id] = _Segment(path, seg_id)
+        self.active = self.segments[seg_id]
+        
+    def _load_segment(self, segment):
+        """
+        Adds the records of a segment to the index
+        
+        :rtype: int
+        :returns: The offset after the last valid record
+        """
+        end = 0
+        for offset, length, record in segment.scan(0, check=True):
+            row_id, date, key_len, value_len = self.HEADER.unpack_from(record)[1:]
+            key = record[self.HEADER.size:self.HEADER.size + key_len]
+            self._index(key, (segment.seg_id, offset, length, date))
+            self.last_id = max(self.last_id, row_id)
+            end = offset + length
+        return end
+    
+    def _index(self, key, entry):
+        """
+        Points the index at a key's new record and counts the bytes of the
+        record it replaces as dead
+        """
+        old = self.index.get(key)
+        if old is not None and old[0] in self.segments:
+            self.segments[old[0]].dead += old[2]
+        self.index[key] = entry
+        
+    def _append(self, records):
+        """
+        Writes encoded records to the active segment and indexes them
+        
+        :Parameters:
+            records : list(tuple(str, str))
+                (key, record) pairs
+        """
+        if self.active.size and \
+                self.active.size + sum(len(record) for key, record in records) > \
+                self.max_segment_size:
+            self._open_active(self.active.seg_id + 1)
+        
+        data = ''.join(record for key, record in records)
+        start = time.time()
+        written = 0
+        try:
+            while written < len(data):
+                written += os.write(self.write_fd, buffer(data, written))
+            if self.sync:
+                os.fsync(self.write_fd)
+        except:
+            self.op_errors['commit'].add()
+            raise
+        self.op_times['commit'].record_since(start)
+        
+        offset = self.active.size
+        for key, record in records:
+            date = self.HEADER.unpack_from(record)[2]
+            self._index(key, (self.active.seg_id, offset, len(record), date))
+            offset += len(record)
+        self.active.size = offset
+        
+    def _merge_segment(self):
+        """
+        :rtype: tuple(_Segment, int)
+        :returns: The segment being merged and the offset its merge has 
+                  reached, or the next segment to merge from its start, 
+                  (None, 0) if there is none
+        """
+        if self._merge_position is not None:
+            seg_id, offset = self._merge_position
+            if seg_id in self.segments:
+                return self.segments[seg_id], offset
+            self._merge_position = None
+        return self._merge_candidate(), 0
+    
+    def _merge_candidate(self):
+        """
+        :rtype: _Segment
+        :returns: The oldest inactive segment holding superseded records
+        """
+        for seg_id in sorted(self.segments):
+            segment = self.segments[seg_id]
+            if segment is not self.active and segment.dead:
+                return segment
+        return None
+    
+    def _remove_segment(self, segment):
+        del self.segments[segment.seg_id]
+        segment.close()
+        os.remove(segment.path)
+        
+    def _encode_siblings(self, row_id, key, siblings):
+        """
+        Encodes a record holding the siblings of a key, dated by the latest
+        """
+        key = _encode(key)
+        parts = []
+        for data, date, clock in siblings:
+            data = _encode(data)
+            clock = clock or ''
+            parts.append(self.SIBLING.pack(int(date), len(clock), len(data)) + clock + data)
+        data = ''.join(parts)
+        latest = max(int(sibling[1]) for sibling in siblings)
+        body = self.HEADER.pack(0, row_id, latest, len(key), 
+                                len(data) | self.SIBLINGS)[4:] + key + data
+        return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+    
+    def _decode(self, record, segment, offset):
+        """
+        Checks a record's crc and splits it into its fields
+        
+        :rtype: tuple(int, int, str, list(tuple(str, int, str)))
+        :returns: The record's id, date, key and (value, date, clock) 
+                  versions.  The values are buffers if the record is.
+        """
+        crc, row_id, date, key_len, value_len = self.HEADER.unpack_from(record)
+        if zlib.crc32(buffer(record, 4)) & 0xffffffff != crc:
+            raise IOError('Corrupt record at %s:%s' % (segment.path, offset))
+        start = self.HEADER.size
+        key = record[start:start + key_len]
+        start += key_len
+        if not value_len & self.SIBLINGS:
+            return (row_id, date, key, [(self._slice(record, start, value_len), date, None)])
+        
+        versions = []
+        end = start + (value_len & ~self.SIBLINGS)
+        while start < end:
+            sibling_date, clock_len, sibling_len = self.SIBLING.unpack_from(record, start)
+            start += self.SIBLING.size
+            clock = record[start:start + clock_len] or None
+            start += clock_len
+            versions.append((self._slice(record, start, sibling_len), sibling_date, clock))
+            start += sibling_len
+        return (row_id, date, key, versions)
+    
+    def _slice(self, record, start, length):
+        """
+        Gets part of a record, as a buffer without copying if the record is
+        one
+        """
+        if isinstance(record, buffer):
+            return buffer(record, start, length)
+        return record[start:start + length]
+
+class _Segment(object):
+    """
+    A segment file open for positioned reads and, once a view is asked for,
+    mapped into memory.  The mapping is replaced rather than closed when the
+    file has grown, and dropped rather than closed when the segment is, 
+    because closing it would invalidate buffers still being sent.
+    """
+    def __init__(self, path, seg_id):
+        self.path = path
+        self.seg_id = seg_id
+        self.fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0644)
+        self.size = os.fstat(self.fd).st_size
+        self.dead = 0
+        self.lock = threading.Lock()
+        self.mm = None
+        
+    def view(self, offset, length):
+        """
+        Gets a read-only buffer over length bytes at offset without copying 
+        them
+        
+        :rtype: buffer
+        :returns: The buffer, or None if the segment has been closed
+        """
+        with self.lock:
+            if self.fd is None:
+                return None
+            if self.mm is None or len(self.mm) < offset + length:
+                self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+                if len(self.mm) < offset + length:
+                    raise IOError('Short read at %s:%s' % (self.path, offset))
+            return buffer(self.mm, offset, length)
+        
+    def read(self, offset, length):
+        """
+        Reads length bytes at offset
+        
+        :rtype: str
+        :returns: The bytes, or None if the segment has been closed
+        """
+        with self.lock:
+            if self.fd is None:
+                return None
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            chunks = []
+            while length:
+                chunk = os.read(self.fd, length)
+                if not chunk:
+                    raise IOError('Short read at %s:%s' % (self.path, offset))
+                chunks.append(chunk)
+                length -= len(chunk)
+            return ''.join(chunks)
+        
+    def scan(self, offset, check=False):
+        """
+        Iterates over the records from offset to the first incomplete or, if 
+        check, corrupt record
+        
+        :rtype: generator
+        :returns: (offset, length, record) tuples
+        """
+        header = LogPersistenceLayer.HEADER
+        f = open(self.path, 'rb')
+        try:
+            f.seek(offset)
+            while True:
+                head = f.read(header.size)
+                if len(head) < header.size:
+                    return
+                crc, row_id, date, key_len, value_len = header.unpack(head)
+                value_len &= ~LogPersistenceLayer.SIBLINGS
+                rest = f.read(key_len + value_len)
+                if len(rest) < key_len + value_len:
+                    return
+                record = head + rest
+                if check and zlib.crc32(buffer(record, 4)) & 0xffffffff != crc:
+                    return
+                yield offset, len(record), record
+                offset += len(record)
+        finally:
+            f.close()
+            
+    def truncate(self, size):
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+                self.mm = None
+
+def _encode(value):
+    """
+    Encodes unicode keys and values as utf-8
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
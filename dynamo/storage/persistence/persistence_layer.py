@@ -3,6 +3,8 @@
 # ------------------------------------------------------
 from exceptions import NotImplementedError
 
+from dynamo.lib.metrics import Metrics
+
 # ------------------------------------------------------
 # Implementation
 # ------------------------------------------------------
@@ -10,6 +12,9 @@ class PersistenceLayer(object):
     """
     An abstract persistence layer class
     """
+    # Operations whose latencies are recorded in the persistence histogram
+    TIMED_OPS = ('get_key', 'get_keys', 'put_siblings', 'commit')
+    
     def init_persistence(self):
         """
         Initializes the persistence layer
@@ -29,6 +34,73 @@ class PersistenceLayer(object):
         :Parameters:
             key : str      
         :rtype: list(tuple)
-        :returns A list of (blob, datetime) tuples for the key
+        :returns A list of (id, blob, date, clock) tuples for the key, the
+                 clock None for versions written without one
+        """
+        raise NotImplementedError('get_key must be implemented')
+    
+    def get_keys(self, keys):
+        """
+        Reads a number of keys from the db.
+        
+        :Parameters:
+            keys : list(str)
+        :rtype: dict(str, list(tuple))
+        :returns A mapping from each key to its list of (id, blob, date, 
+                 clock) tuples
+        """
+        raise NotImplementedError('get_keys must be implemented')
+    
+    def put_siblings(self, items):
+        """
+        Replaces every version of a number of keys with their siblings, the
+        versions that supersede the rest, atomically.
+        
+        :Parameters:
+            items : list(tuple(str, list(tuple(str, int, str))))
+                (key, siblings) pairs, each sibling a (data, date, clock) 
+                tuple with its date in microseconds and its encoded clock
+        :rtype: bool
+        :returns True if the keys were written
+        """
+        raise NotImplementedError('put_siblings must be implemented')
+    
+    def scan_keys(self, after_key, max_keys):
+        """
+        Lists the keys in key order, a chunk at a time.
+        
+        :Parameters:
+            after_key : str
+                The last key of the previous chunk, None to start over
+            max_keys : int
+        :rtype: list(str)
+        :returns Up to max_keys keys following after_key
+        """
+        raise NotImplementedError('scan_keys must be implemented')
+    
+    def compact(self, max_keys):
+        """
+        Deletes the superseded versions of up to max_keys keys.
+        
+        :Parameters:
+            max_keys : int
+        :rtype: dict
+        :returns The number of keys scanned and rows deleted, and whether 
+                 every key has now been compacted once
+        """
+        raise NotImplementedError('compact must be implemented')
+
+    def _init_metrics(self, metrics):
+        """
+        Creates the latency histogram and error counter of each of 
+        TIMED_OPS, labelled with the op
+        
+        :Parameters:
+            metrics : Metrics
+                The metrics of the server, None to keep them to the layer
         """
-        raise NotImplementedError('get_key must be implemented')            
\ No newline at end of file
+        self.metrics = metrics or Metrics()
+        self.op_times = dict((op, self.metrics.histogram('persistence', op=op)) 
+                             for op in self.TIMED_OPS)
+        self.op_errors = dict((op, self.metrics.counter('persistence_errors', op=op)) 
+                              for op in self.TIMED_OPS)
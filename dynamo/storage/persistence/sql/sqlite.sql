@@ -2,5 +2,11 @@ CREATE TABLE IF NOT EXISTS key_values (
     id integer primary key,
     key varchar(255), 
     value blob(1024), 
-    date timestamp
+    date integer,
+    clock text
+);
+
+CREATE INDEX IF NOT EXISTS key_values_key_date ON key_values (
+    key, 
+    date
 );
@@ -5,6 +5,8 @@ import logging
 import sqlite3
 import os
 import datetime
+import threading
+import time
 
 from dynamo.storage.persistence.persistence_layer import PersistenceLayer
 
@@ -13,21 +15,105 @@ from dynamo.storage.persistence.persistence_layer import PersistenceLayer
 # ------------------------------------------------------
 class SqlitePersistenceLayer(PersistenceLayer):
     """
-    A rudimentary sqlite persistence layer
+    A rudimentary sqlite persistence layer.  
+    
+    Each thread gets its own connection to the database file so the layer can
+    be used from a multithreaded server.  An in-memory database only exists 
+    within a single connection, so it is shared between threads and guarded
+    by a lock instead.
+    
+    By default every put is committed on its own with sqlite's default 
+    journaling.  For write heavy nodes the journal mode (e.g. WAL), the 
+    synchronous level (e.g. NORMAL) and group commit can be configured.  With
+    group commit the first put to arrive waits group_commit_window seconds,
+    then writes the puts that arrived in the meantime in one transaction.
+    Every put still returns only once it has been committed.
+    
+    The latencies of reads, puts and commits are recorded in the metrics 
+    given, see PersistenceLayer.TIMED_OPS.  A put's includes its wait for a
+    group commit.
     """
     SQL_FILE = 'sql/sqlite.sql'
+    MEMORY = ':memory:'
+    BUSY_TIMEOUT = 30.0
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+    
+    # sqlite allows at most 999 parameters per statement
+    MAX_PARAMS = 999
+    
+    # Rows converted per transaction when migrating text dates
+    MIGRATION_CHUNK = 10000
     
-    def __init__(self, name, conn_str=None):
+    # Statements are kept as constants so each connection's statement cache
+    # reuses their prepared form
+    STATEMENT_CACHE_SIZE = 200
+    SELECT_SQL = "SELECT id,value,date,clock FROM key_values WHERE key=?"
+    INSERT_SQL = "INSERT INTO key_values(key, value, date, clock) VALUES (?, ?, ?, ?)"
+    DELETE_KEY_SQL = "DELETE FROM key_values WHERE key=?"
+    COMPACT_KEYS_SQL = ("SELECT DISTINCT key FROM key_values WHERE key > ? "
+                        "ORDER BY key LIMIT ?")
+    SCAN_KEYS_SQL = "SELECT DISTINCT key FROM key_values ORDER BY key LIMIT ?"
+    SCAN_KEYS_AFTER_SQL = ("SELECT DISTINCT key FROM key_values WHERE key > ? "
+                           "ORDER BY key LIMIT ?")
+    # Versions with clocks are only replaced by put_siblings, so compaction
+    # deletes the versions written without one, keeping the latest unless
+    # the key has a version with a clock
+    COMPACT_DELETE_SQL = ("DELETE FROM key_values WHERE key = ? AND clock IS NULL "
+                          "AND id != (SELECT id FROM key_values WHERE key = ? "
+                          "ORDER BY clock IS NULL, date DESC, id DESC LIMIT 1)")
+    
+    def __init__(self, name, conn_str=None, journal_mode=None, synchronous=None,
+                 group_commit_window=0, metrics=None):
         """
         :Parameters:
             name : Name of the server
+            conn_str : Path of the database, defaults to /tmp/{name}
+            journal_mode : sqlite journal mode, None keeps sqlite's default
+            synchronous : sqlite synchronous level, None keeps sqlite's default
+            group_commit_window : Seconds to gather puts into one transaction,
+                                  0 commits every put on its own
+            metrics : The Metrics to record latencies in, None keeps them to
+                      the layer
         """        
         self.name = name
         if not conn_str:
             self.conn_str = '/tmp/%s' % self.name
         else:
             self.conn_str = conn_str
-        self.conn = None
+        if journal_mode is not None and journal_mode.upper() not in self.JOURNAL_MODES:
+            raise ValueError('Unknown journal mode %s' % journal_mode)
+        if synchronous is not None and synchronous.upper() not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError('Unknown synchronous level %s' % synchronous)
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.group_commit_window = group_commit_window
+        self._group_lock = threading.Lock()
+        self._group_batch = None
+        self._compact_cursor = ''
+        self.initialized = False
+        self.shared = self.conn_str == self.MEMORY
+        self.lock = threading.RLock() if self.shared else _NullLock()
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._init_metrics(metrics)
+        
+    @property
+    def conn(self):
+        """
+        The calling thread's connection, None until the layer is initialized
+        """
+        if not self.initialized:
+            return None
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.shared:
+                conn = self._conns[0]
+            else:
+                conn = self._connect()
+            self._local.conn = conn
+        return conn
         
     def __del__(self):
         """
@@ -40,7 +126,8 @@ class SqlitePersistenceLayer(PersistenceLayer):
         Initializes the persistence layer.
         """
         logging.info('Conncting to sqlite db %s' % self.conn_str)
-        self.conn = sqlite3.connect(self.conn_str)
+        self._local.conn = self._connect()
+        self.initialized = True
 
         try:
             f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
@@ -59,13 +146,20 @@ class SqlitePersistenceLayer(PersistenceLayer):
         except:
             logging.error('Error loading %s' % self.SQL_FILE)
         
+        self._migrate_dates()
+        self._migrate_clocks()
+        
     def close(self):
         """
         Closes the db connection
         """
-        if self.conn:
-            self.conn.close()
-            
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self.initialized = False
+        self._local = threading.local()
+
     def get_key(self, key):
         """
         Reads a key from the db.
@@ -73,48 +167,298 @@ class SqlitePersistenceLayer(PersistenceLayer):
         :Parameters:
             key : str      
         :rtype: list(tuple)
-        :returns A list of (id, blob, datetime) tuples for the key
+        :returns A list of (id, blob, date, clock) tuples for the key, with
+                 dates in microseconds since the epoch and clocks None for
+                 versions written without one
         """
         if not self.conn:
             logging.info('SQLite connection not open')
             return []
         
+        start = time.time()
         try:
-            cur = self.conn.cursor()
-            cur.execute("SELECT id,value,date FROM key_values WHERE key=?", (key,))
-            result = [row for row in cur]
+            with self.lock:
+                cur = self.conn.cursor()
+                cur.execute(self.SELECT_SQL, (key,))
+                result = [row for row in cur]
         except:
+            self.op_errors['get_key'].add()
             logging.error('Error getting key=%s' % key)
             raise
             result = []
             
+        self.op_times['get_key'].record_since(start)
         return result
     
-    def put_key(self, key, data):
+    def get_keys(self, keys):
         """
-        Puts a key in the database
+        Reads a number of keys from the db with one IN query per MAX_PARAMS 
+        keys.
         
         :Parameters:
-            key : str
-                The key name
-            data : str
-                The data string
+            keys : list(str)
+        :rtype: dict(str, list(tuple))
+        :returns A mapping from each key to its list of (id, blob, date, 
+                 clock) tuples
         """
+        result = dict((key, []) for key in keys)
         if not self.conn:
             logging.info('SQLite connection not open')
+            return result
+        
+        keys = list(result)
+        start = time.time()
+        try:
+            with self.lock:
+                cur = self.conn.cursor()
+                for i in xrange(0, len(keys), self.MAX_PARAMS):
+                    chunk = keys[i:i + self.MAX_PARAMS]
+                    cur.execute("SELECT key,id,value,date,clock FROM key_values WHERE key IN (%s)"
+                                % ','.join('?' * len(chunk)), chunk)
+                    for row in cur:
+                        result[row[0]].append(row[1:])
+        except:
+            self.op_errors['get_keys'].add()
+            logging.error('Error getting %s keys' % len(keys))
+            raise
+        
+        self.op_times['get_keys'].record_since(start)
+        return result
+    
+    def put_siblings(self, items):
+        """
+        Replaces every version of a number of keys with their siblings in a
+        single transaction
 
+        :Parameters:
+            items : list(tuple(str, list(tuple(str, int, str))))
+                (key, siblings) pairs, each sibling a (data, date, clock)
+                tuple with its date in microseconds and its encoded clock
+        :rtype: bool
+        :returns: True if every key was written, False if none were
+        """
+        if not self.conn:
+            logging.info('SQLite connection not open')
+
+        start = time.time()
         try:
-            now = datetime.datetime.now()
-            cur = self.conn.cursor()
-            cur.execute("INSERT INTO key_values(key, value, date) VALUES (?, ?, ?)",
-                        (key, data, now))
-            self.conn.commit()
-            result = True
+            rows = [(key, data, int(date), clock)
+                    for key, siblings in items for data, date, clock in siblings]
+            result = self._write(rows, [key for key, siblings in items])
         except:
-            logging.error('Error putting key=%s, data=%s' % (key, data))
+            self.op_errors['put_siblings'].add()
+            logging.error('Error putting the siblings of %s keys' % len(items))
             result = False
-            
+
+        self.op_times['put_siblings'].record_since(start)
         return result
+
+    def scan_keys(self, after_key=None, max_keys=500):
+        """
+        Lists the keys in key order, a chunk at a time, off the key index
+        
+        :Parameters:
+            after_key : str
+                The last key of the previous chunk, None to start over
+            max_keys : int
+                Maximum number of keys to list
+        :rtype: list(str)
+        :returns: Up to max_keys keys following after_key
+        """
+        if not self.conn:
+            logging.info('SQLite connection not open')
+            return []
+        
+        with self.lock:
+            if after_key is None:
+                cur = self.conn.execute(self.SCAN_KEYS_SQL, (max_keys,))
+            else:
+                cur = self.conn.execute(self.SCAN_KEYS_AFTER_SQL, (after_key, max_keys))
+            return [row[0] for row in cur]
+            
+    def compact(self, max_keys=500):
+        """
+        Deletes the superseded versions of the next max_keys keys, in key 
+        order, keeping only the latest version of each, or its siblings if 
+        it has versions with clocks.  Successive calls walk the whole table 
+        and then start over, so each call is one short transaction.
         
+        :Parameters:
+            max_keys : int
+                Maximum number of keys to compact
+        :rtype: dict
+        :returns: The number of keys scanned and rows deleted, and whether 
+                  the call finished a pass over the table
+        """
+        if not self.conn:
+            logging.info('SQLite connection not open')
+            return {'keys': 0, 'rows': 0, 'finished_pass': False}
+        
+        with self.lock:
+            try:
+                keys = [row[0] for row in 
+                        self.conn.execute(self.COMPACT_KEYS_SQL, 
+                                          (self._compact_cursor, max_keys))]
+                before = self.conn.total_changes
+                self.conn.executemany(self.COMPACT_DELETE_SQL, 
+                                      [(key, key) for key in keys])
+                rows = self.conn.total_changes - before
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+            
+        finished_pass = len(keys) < max_keys
+        self._compact_cursor = '' if finished_pass else keys[-1]
+        return {'keys': len(keys), 'rows': rows, 'finished_pass': finished_pass}
+    
+    def _migrate_dates(self):
+        """
+        Converts dates written as text by earlier versions, e.g. 
+        "2011-01-02 03:04:05.678901", to microseconds since the epoch.  The 
+        text dates are local times, with the fraction left off when zero.
+        """
+        with self.lock:
+            try:
+                while True:
+                    rows = self.conn.execute("SELECT id, date FROM key_values "
+                                             "WHERE typeof(date) = 'text' LIMIT ?",
+                                             (self.MIGRATION_CHUNK,)).fetchall()
+                    if not rows:
+                        break
+                    logging.info('Migrating %s text dates' % len(rows))
+                    self.conn.executemany("UPDATE key_values SET date = ? WHERE id = ?",
+                                          [(self._parse_text_date(date), row_id)
+                                           for row_id, date in rows])
+                    self.conn.commit()
+            except:
+                self.conn.rollback()
+                logging.error('Error migrating text dates')
+                raise
+    
+    def _migrate_clocks(self):
+        """
+        Adds the clock column to tables created by earlier versions.  Their
+        versions were written without clocks.
+        """
+        with self.lock:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(key_values)")]
+            if columns and 'clock' not in columns:
+                logging.info('Adding the clock column')
+                self.conn.execute("ALTER TABLE key_values ADD COLUMN clock text")
+                self.conn.commit()
+    
+    def _parse_text_date(self, date_str):
+        """
+        Parses a text date written by earlier versions
+        
+        :Parameters:
+            date_str : str
+                A date formatted by str(datetime)
+        :rtype: int
+        :returns: The date in microseconds since the epoch
+        """
+        seconds, _, fraction = date_str.partition('.')
+        date = datetime.datetime.strptime(seconds, "%Y-%m-%d %H:%M:%S")
+        micros = int((fraction + '000000')[:6])
+        return int(time.mktime(date.timetuple())) * 1000000 + micros
+    
+    def _write(self, rows, replaced=()):
+        """
+        Writes (key, data, date, clock) rows, through a group commit if 
+        enabled
         
-    
\ No newline at end of file
+        :Parameters:
+            rows : list(tuple)
+                The rows to insert
+            replaced : list(str)
+                Keys whose versions are deleted before the rows are inserted
+        :rtype: bool
+        :returns: True once the rows are committed
+        """
+        if not self.group_commit_window:
+            return self._insert(rows, replaced)
+        
+        with self._group_lock:
+            batch = self._group_batch
+            leader = batch is None
+            if leader:
+                batch = self._group_batch = _CommitBatch()
+            batch.rows.extend(rows)
+            batch.replaced.extend(replaced)
+        
+        if leader:
+            time.sleep(self.group_commit_window)
+            with self._group_lock:
+                self._group_batch = None
+            try:
+                batch.result = self._insert(batch.rows, batch.replaced)
+            except:
+                logging.error('Error committing a group of %s rows' % len(batch.rows))
+                batch.result = False
+            batch.done.set()
+        else:
+            batch.done.wait()
+        return batch.result
+    
+    def _insert(self, rows, replaced=()):
+        """
+        Deletes the versions of the replaced keys and inserts (key, data, 
+        date, clock) rows in one transaction
+        
+        :rtype: bool
+        :returns: True once the rows are committed
+        """
+        with self.lock:
+            start = time.time()
+            try:
+                if replaced:
+                    self.conn.executemany(self.DELETE_KEY_SQL, [(key,) for key in replaced])
+                self.conn.executemany(self.INSERT_SQL, rows)
+                self.conn.commit()
+            except:
+                self.op_errors['commit'].add()
+                self.conn.rollback()
+                raise
+        self.op_times['commit'].record_since(start)
+        return True
+    
+    def _connect(self):
+        """
+        Opens a new connection to the database
+        
+        :rtype: sqlite3.Connection
+        :returns: The connection
+        """
+        # Connections are only used by the thread that opened them, but close()
+        # may be called from any thread
+        conn = sqlite3.connect(self.conn_str, timeout=self.BUSY_TIMEOUT,
+                               check_same_thread=False,
+                               cached_statements=self.STATEMENT_CACHE_SIZE)
+        if self.journal_mode:
+            conn.execute('PRAGMA journal_mode=%s' % self.journal_mode.upper())
+        if self.synchronous:
+            conn.execute('PRAGMA synchronous=%s' % self.synchronous.upper())
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+class _CommitBatch(object):
+    """
+    Rows waiting to be written by a group commit
+    """
+    def __init__(self):
+        self.rows = []
+        self.replaced = []
+        self.result = None
+        self.done = threading.Event()
+        
+class _NullLock(object):
+    """
+    A lock that does nothing, used when every thread has its own connection
+    """
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import logging
+import shutil
+import tempfile
+import threading
+import timeit
+import xmlrpclib
+
+from dynamo.lib.rpc import create_server
+from dynamo.storage.persistence.log_persistence_layer import LogPersistenceLayer
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+
+# --------------------------------------------
+# Config
+# --------------------------------------------
+logging.basicConfig(level=logging.ERROR)
+
+VALUE_SIZES = [1024, 64 * 1024, 1024 * 1024]
+NUM_KEYS = 20
+NUM_OPS = 50
+
+# --------------------------------------------
+# Benchmark
+# --------------------------------------------
+def timed(func):
+    start = timeit.default_timer()
+    func()
+    return timeit.default_timer() - start
+
+def layers(path):
+    yield 'sqlite', SqlitePersistenceLayer('benchmark', path + '/sqlite.db')
+    yield 'log', LogPersistenceLayer('benchmark', path + '/copy', mmap_reads=False)
+    yield 'log+mmap', LogPersistenceLayer('benchmark', path + '/mmap')
+    
+def serve(persis):
+    """
+    Serves get from the layer on an XML-RPC server thread
+    """
+    server = create_server(0)
+    server.logRequests = False
+    server.register_function(lambda key: persis.get_key(key)[0][1], 'get')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def rss_kb():
+    """
+    Gets the resident set size of this process on Linux
+    """
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+def run():
+    print '%10s %10s %14s %14s %12s' % ('layer', 'value', 'local ms/get', 
+                                         'rpc ms/get', 'rss kb')
+    path = tempfile.mkdtemp()
+    try:
+        for size in VALUE_SIZES:
+            value = 'v' * size
+            for name, persis in layers(path):
+                persis.init_persistence()
+                persis.put_siblings([('key%s' % i, [(value, 1, 'benchmark=1')]) 
+                                     for i in xrange(NUM_KEYS)])
+                keys = ['key%s' % (i % NUM_KEYS) for i in xrange(NUM_OPS)]
+                local_time = timed(lambda: [persis.get_key(key) for key in keys])
+                
+                server = serve(persis)
+                proxy = xmlrpclib.ServerProxy('http://127.0.0.1:%s' % 
+                                              server.server_address[1])
+                rpc_time = timed(lambda: [proxy.get(key) for key in keys])
+                server.shutdown()
+                server.server_close()
+                rss = rss_kb()
+                persis.close()
+                print '%10s %10d %14.3f %14.3f %12d' % (
+                    name, size, local_time * 1000 / NUM_OPS, rpc_time * 1000 / NUM_OPS,
+                    rss)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+
+# --------------------------------------------
+# Config
+# --------------------------------------------
+logging.basicConfig(level=logging.ERROR)
+
+TABLE_SIZES = [1000, 10000, 100000]
+NUM_OPS = 200
+NUM_WRITERS = 8
+MODES = [('default', {}),
+         ('wal', {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}),
+         ('wal+group', {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                        'group_commit_window': 0.002})]
+
+# --------------------------------------------
+# Benchmark
+# --------------------------------------------
+def timed(func):
+    start = timeit.default_timer()
+    func()
+    return timeit.default_timer() - start
+
+def put(persis, items):
+    """
+    Puts a single version of each (key, value) pair, as a storage node does
+    """
+    date = int(time.time() * 1000000)
+    return persis.put_siblings([(key, [(value, date, 'benchmark=1')]) 
+                                for key, value in items])
+
+def concurrent_puts(persis):
+    def writer(num):
+        for i in xrange(NUM_OPS // NUM_WRITERS):
+            put(persis, [('new-%s-%s' % (num, i), 'value')])
+    threads = [threading.Thread(target=writer, args=(i,)) 
+               for i in xrange(NUM_WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run():
+    print '%10s %10s %14s %14s %14s' % ('mode', 'rows', 'puts/s', 
+                                         '%s writers/s' % NUM_WRITERS, 'gets/s')
+    for name, options in MODES:
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        persis = SqlitePersistenceLayer('benchmark', path, **options)
+        persis.init_persistence()
+        rows = 0
+        for size in TABLE_SIZES:
+            put(persis, [('key%s' % i, 'value%s' % i) for i in xrange(rows, size)])
+            rows = size
+            
+            put_time = timed(lambda: [put(persis, [('key%s' % i, 'value')]) 
+                                      for i in xrange(NUM_OPS)])
+            concurrent_time = timed(lambda: concurrent_puts(persis))
+            keys = ['key%s' % random.randint(0, size - 1) for i in xrange(NUM_OPS)]
+            get_time = timed(lambda: [persis.get_key(key) for key in keys])
+            print '%10s %10d %14.0f %14.0f %14.0f' % (name, size, NUM_OPS / put_time,
+                                                      NUM_OPS / concurrent_time,
+                                                      NUM_OPS / get_time)
+        persis.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import time
+from unittest import TestCase
+
+from dynamo.storage.persistence.compactor import Compactor
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestCompactor(TestCase):
+    def setUp(self):
+        self.persis = SqlitePersistenceLayer('test_layer', ':memory:')
+        self.persis.init_persistence()
+        self.persis._write([('key%s' % j, 'data%s' % i, i, None) 
+                            for i in xrange(3) for j in xrange(10)])
+        
+    def tearDown(self):
+        self.persis.close()
+        
+    def test_compact_chunk(self):
+        """
+        Ensures chunks update the stats
+        """
+        compactor = Compactor(self.persis, chunk_size=6)
+        compactor.compact_chunk()
+        compactor.compact_chunk()
+        stats = compactor.stats()
+        self.assertEquals(stats['chunks'], 2)
+        self.assertEquals(stats['passes'], 1)
+        self.assertEquals(stats['keys_scanned'], 10)
+        self.assertEquals(stats['rows_reclaimed'], 20)
+        self.assertTrue(stats['time_spent'] > 0)
+        
+    def test_background_thread(self):
+        """
+        Ensures the background thread compacts the whole table
+        """
+        compactor = Compactor(self.persis, chunk_size=3, interval=0.001)
+        compactor.start()
+        deadline = time.time() + 5
+        while compactor.stats()['passes'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        compactor.stop()
+        
+        self.assertEquals(compactor.stats()['rows_reclaimed'], 20)
+        self.assertEquals(self.persis.conn.execute(
+            "SELECT COUNT(*) FROM key_values").fetchone()[0], 10)
@@ -0,0 +1,307 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from unittest import TestCase
+
+from dynamo.lib.metrics import Metrics
+from dynamo.storage.persistence.log_persistence_layer import LogPersistenceLayer
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestLogPersistenceLayer(TestCase):
+    """
+    Tests the log structured persistence layer
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.persis = self._open()
+        
+    def tearDown(self):
+        self.persis.close()
+        shutil.rmtree(self.dir)
+        
+    def _open(self, **kwargs):
+        persis = LogPersistenceLayer('test_layer', self.dir, **kwargs)
+        persis.init_persistence()
+        return persis
+    
+    def _reopen(self, **kwargs):
+        self.persis.close()
+        self.persis = self._open(**kwargs)
+        
+    def _segments(self):
+        return sorted(os.listdir(self.dir))
+    
+    def _put(self, key, data, date=1):
+        """
+        Puts a single version of a key
+        """
+        return self.persis.put_siblings([(key, [(data, date, None)])])
+    
+    def _latest(self, key):
+        """
+        Gets the id and value of a key's latest version, copying the value
+        """
+        row_id, value, date, clock = max(self.persis.get_key(key), 
+                                         key=lambda row: (row[2], row[0]))
+        return (row_id, str(value))
+        
+    def test_simple_get(self):
+        """
+        Tests a put and a get
+        """
+        self.assertTrue(self._put('foo', 'this is my data'))
+        result = self.persis.get_key('foo')
+        self.assertEquals(len(result), 1)
+        self.assertEquals((result[0][0], str(result[0][1])), (1, 'this is my data'))
+        self.assertEquals(self.persis.get_key('bar'), [])
+        self.assertEquals(self.persis.get_key('bar'), [])
+        
+    def test_replace(self):
+        """
+        Ensures that only the latest version of a key is kept
+        """
+        self._put('foo', 'one')
+        self._put('foo', 'two')
+        self.assertEquals(self._latest('foo'), (2, 'two'))
+        self.assertEquals(len(self.persis.get_key('foo')), 1)
+        
+    def test_get_keys(self):
+        """
+        Tests putting and getting a batch of keys
+        """
+        self.persis.put_siblings([(key, [(data, 1, None)]) for key, data in 
+                                  [('foo', 'a'), ('bar', 'b'), (u'baz\xe9', u'c\xe9')]])
+        result = self.persis.get_keys(['foo', 'bar', u'baz\xe9', 'missing'])
+        self.assertEquals(str(result['foo'][0][1]), 'a')
+        self.assertEquals(str(result['bar'][0][1]), 'b')
+        self.assertEquals(str(result[u'baz\xe9'][0][1]), u'c\xe9'.encode('utf-8'))
+        self.assertEquals(result['missing'], [])
+        
+    def test_metrics(self):
+        """
+        Ensures reads, sibling puts and appends are timed in the metrics given
+        """
+        metrics = Metrics()
+        self._reopen(metrics=metrics)
+        self.persis.put_siblings([('foo', [('a', 1, None)])])
+        self.persis.put_siblings([('bar', [('b', 1, None)])])
+        self.persis.get_key('foo')
+        self.persis.get_keys(['foo', 'bar'])
+        self.assertEquals(dict((labels, stats['count']) for labels, stats in 
+                               metrics.snapshot()['histograms']['persistence'].items()),
+                          {'op=get_key': 1, 'op=get_keys': 1, 'op=put_siblings': 2,
+                           'op=commit': 2})
+        
+    def test_reopen(self):
+        """
+        Ensures that the index is rebuilt from the segments
+        """
+        self._put('foo', 'one')
+        self._put('foo', 'two')
+        self._put('bar', 'three')
+        self._reopen()
+        
+        self.assertEquals(self._latest('foo'), (2, 'two'))
+        self.assertEquals(self._latest('bar'), (3, 'three'))
+        self._put('baz', 'four')
+        self.assertEquals(self._latest('baz')[0], 4)
+        
+    def test_torn_write(self):
+        """
+        Ensures that a partially written record is truncated on open
+        """
+        self._put('foo', 'one')
+        self._put('bar', 'two')
+        path = os.path.join(self.dir, self._segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(size - 1)
+        self._reopen()
+        
+        self.assertEquals(self._latest('foo')[1], 'one')
+        self.assertEquals(self.persis.get_key('bar'), [])
+        self._put('bar', 'three')
+        self._reopen()
+        self.assertEquals(self._latest('bar')[1], 'three')
+        
+    def test_corrupt_record(self):
+        """
+        Ensures that reading a corrupt record raises an error
+        """
+        self._put('foo', 'this is my data')
+        path = os.path.join(self.dir, self._segments()[-1])
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write('X')
+        self.assertRaises(IOError, self.persis.get_key, 'foo')
+        
+    def test_segment_rollover(self):
+        """
+        Ensures that a new segment is started when the active one is full
+        """
+        self._reopen(max_segment_size=200)
+        for i in range(20):
+            self._put('key%s' % i, 'x' * 50)
+        self.assertTrue(len(self._segments()) > 5)
+        for i in range(20):
+            self.assertEquals(self._latest('key%s' % i)[1], 'x' * 50)
+            
+    def test_compact(self):
+        """
+        Ensures that merging drops superseded records and deletes segments
+        """
+        self._reopen(max_segment_size=200)
+        for version in range(5):
+            for i in range(4):
+                self._put('key%s' % i, 'value %s %s' % (i, version))
+        num_segments = len(self._segments())
+        
+        result = {'finished_pass': False}
+        dropped = 0
+        while not result['finished_pass']:
+            result = self.persis.compact(max_keys=3)
+            dropped += result['rows']
+        self.assertEquals(dropped, 16)
+        self.assertTrue(len(self._segments()) < num_segments)
+        
+        self._reopen(max_segment_size=200)
+        for i in range(4):
+            self.assertEquals(self._latest('key%s' % i)[1], 
+                              'value %s 4' % i)
+        self.assertEquals(self.persis.compact()['finished_pass'], True)
+        
+    def test_compact_older_segment(self):
+        """
+        Ensures a merge finishes its segment before an older segment that 
+        gained superseded records meanwhile, and that segment's live 
+        records are kept
+        """
+        self._reopen(max_segment_size=200)
+        self._put('cold', 'x')
+        self._put('a', 'x')
+        self.persis.put_siblings([('b', [('x' * 100, 1, None)]), 
+                                  ('c', [('x' * 100, 1, None)])])
+        self._put('b', 'y' * 100)
+        self.assertEquals(self._segments(), ['000000000.data', '000000001.data', 
+                                             '000000002.data'])
+        
+        self.assertEquals(self.persis.compact(max_keys=1)['rows'], 1)
+        self._put('a', 'y')
+        while not self.persis.compact(max_keys=1)['finished_pass']:
+            pass
+        self.assertEquals(self._latest('cold'), (1, 'x'))
+        self.assertEquals(self._latest('a')[1], 'y')
+        self._reopen(max_segment_size=200)
+        self.assertEquals(self._latest('cold'), (1, 'x'))
+        self.assertEquals(self._latest('c')[1], 'x' * 100)
+        
+    def test_missing_segment(self):
+        """
+        Ensures reading a key whose segment is gone raises an error
+        """
+        self._put('foo', 'bar')
+        self.persis._remove_segment(self.persis.active)
+        self.assertRaises(IOError, self.persis.get_key, 'foo')
+        
+    def test_concurrent_puts(self):
+        """
+        Ensures that puts and merges from many threads are all applied
+        """
+        self._reopen(max_segment_size=1024)
+        def put_keys(thread_id):
+            for i in range(50):
+                self._put('%s-%s' % (thread_id, i % 10), str(i))
+                
+        threads = [threading.Thread(target=put_keys, args=(t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self.persis.compact(max_keys=10)
+        for thread in threads:
+            thread.join()
+            
+        for t in range(4):
+            for i in range(10):
+                self.assertEquals(self._latest('%s-%s' % (t, i))[1], 
+                                  str(40 + i))
+                
+    def test_views(self):
+        """
+        Ensures values are buffers over the segments that stay readable 
+        after compaction deletes their segment
+        """
+        self._reopen(max_segment_size=100)
+        self._put('foo', 'x' * 60)
+        view = self.persis.get_key('foo')[0][1]
+        self.assertTrue(isinstance(view, buffer))
+        self._put('foo', 'y' * 60)
+        self._put('bar', 'z' * 60)
+        while not self.persis.compact()['finished_pass']:
+            pass
+        self.assertEquals(len(self._segments()), 2)
+        self.assertEquals(str(view), 'x' * 60)
+        self.assertEquals(self._latest('foo')[1], 'y' * 60)
+        
+    def test_copied_reads(self):
+        """
+        Ensures values are strings when reads are not memory mapped
+        """
+        self._reopen(mmap_reads=False)
+        self._put('foo', 'bar')
+        self.assertEquals(self.persis.get_key('foo')[0][1], 'bar')
+        
+    def test_put_siblings(self):
+        """
+        Ensures siblings are kept together in one record that replaces the 
+        key's versions and survives a reopen and compaction
+        """
+        self._reopen(max_segment_size=200)
+        self._put('foo', 'old')
+        self.assertTrue(self.persis.put_siblings([('foo', [('one', 5, 'a=1'), 
+                                                           ('two', 7, 'b=1')])]))
+        siblings = [(str(value), date, clock) 
+                    for row_id, value, date, clock in self.persis.get_key('foo')]
+        self.assertEquals(siblings, [('one', 5, 'a=1'), ('two', 7, 'b=1')])
+        
+        self._put('bar', 'x' * 150)
+        while not self.persis.compact()['finished_pass']:
+            pass
+        self._reopen(max_segment_size=200)
+        self.assertEquals([(str(value), date, clock) 
+                           for row_id, value, date, clock in self.persis.get_key('foo')],
+                          siblings)
+        
+    def test_single_value_records(self):
+        """
+        Ensures records holding a single value, as written by earlier 
+        versions, are read and replaced by siblings
+        """
+        self.persis.close()
+        body = LogPersistenceLayer.HEADER.pack(0, 1, 5, 3, 3)[4:] + 'foo' + 'old'
+        with open(os.path.join(self.dir, LogPersistenceLayer.SEGMENT_FORMAT % 0), 'ab') as f:
+            f.write(struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body)
+        self.persis = self._open()
+        self.assertEquals([(row_id, str(value), date, clock) 
+                           for row_id, value, date, clock in self.persis.get_key('foo')],
+                          [(1, 'old', 5, None)])
+        
+        self._put('foo', 'new', 6)
+        self.assertEquals(self._latest('foo'), (2, 'new'))
+        
+    def test_scan_keys(self):
+        """
+        Ensures keys are listed in order a chunk at a time
+        """
+        self.persis.put_siblings([('key%s' % i, [('data', 1, None)]) for i in xrange(5)])
+        self.assertEquals(self.persis.scan_keys(None, 3), ['key0', 'key1', 'key2'])
+        self._put('key10', 'data')
+        self.assertEquals(self.persis.scan_keys('key2', 3), ['key3', 'key4'])
+        self.assertEquals(self.persis.scan_keys('key0', 2), ['key1', 'key10'])
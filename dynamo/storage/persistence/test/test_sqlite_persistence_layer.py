@@ -1,6 +1,11 @@
 # --------------------------------------------
 # Imports
 # --------------------------------------------
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
 from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
@@ -19,11 +24,25 @@ class TestSqlitePersistenceLayer(TestCase):
     def tearDown(self):
         self.persis.conn.close()
         
+    def _put(self, key, data, date=1):
+        """
+        Puts a single version of a key
+        """
+        return self.persis.put_siblings([(key, [(data, date, None)])])
+    
+    def _put_unmerged(self, items):
+        """
+        Adds versions without clocks to the ones stored, as earlier versions
+        of the layer did
+        """
+        date = int(time.time() * 1000000)
+        return self.persis._write([(key, data, date, None) for key, data in items])
+        
     def test_simple_put(self):
         """
         Tests a put
         """
-        self.persis.put_key('foo', 'this is my data')
+        self._put('foo', 'this is my data')
 
         result = self.persis.conn.execute("SELECT * FROM key_values")
         rows = [row for row in result]
@@ -37,7 +56,7 @@ class TestSqlitePersistenceLayer(TestCase):
         """
         Tests a get
         """
-        self.persis.put_key('foo', 'this is my data')
+        self._put('foo', 'this is my data')
         result = self.persis.get_key('foo')
         self.assertEquals(len(result), 1)        
         self.assertEquals(result[0][0:2], (1, 'this is my data'))
@@ -47,8 +66,8 @@ class TestSqlitePersistenceLayer(TestCase):
         Ensures that we can put multiple values for the same key in the
         persistence layer.
         """
-        self.persis.put_key('foo', 'this is my data')
-        self.persis.put_key('foo', 'this is my data #2')        
+        self.persis.put_siblings([('foo', [('this is my data', 1, 'a=1'), 
+                                           ('this is my data #2', 1, 'b=1')])])
 
         result = self.persis.conn.execute("SELECT * FROM key_values")
         rows = [row for row in result]
@@ -59,8 +78,8 @@ class TestSqlitePersistenceLayer(TestCase):
         Ensures that we can get multiple values for the same key in the
         persistence layer.
         """
-        self.persis.put_key('foo', 'this is my data')
-        self.persis.put_key('foo', 'this is my data #2')        
+        self.persis.put_siblings([('foo', [('this is my data', 1, 'a=1'), 
+                                           ('this is my data #2', 1, 'b=1')])])
 
         result = self.persis.get_key('foo')
         self.assertEquals(len(result), 2)
@@ -72,5 +91,246 @@ class TestSqlitePersistenceLayer(TestCase):
             row = row[0:2]           
             self.assertTrue(row in expected_rows)
             expected_rows.remove(row)
-            
+    def test_get_keys(self):
+        """
+        Ensures a batch read returns every version of each key, including
+        batches larger than one statement's parameter limit
+        """
+        self.persis.put_siblings([('key%s' % i, [('data%s' % i, 1, None)]) 
+                                  for i in xrange(1500)])
+        self._put_unmerged([('key1', 'data1b')])
+        
+        keys = ['key%s' % i for i in xrange(1500)] + ['missing']
+        result = self.persis.get_keys(keys)
+        self.assertEquals(len(result), 1501)
+        self.assertEquals(result['missing'], [])
+        self.assertEquals([row[1] for row in result['key1']], ['data1', 'data1b'])
+        self.assertEquals([row[1] for row in result['key1499']], ['data1499'])
+    def test_key_index(self):
+        """
+        Ensures key lookups use the (key, date) index
+        """
+        plan = self.persis.conn.execute("EXPLAIN QUERY PLAN " + 
+                                        SqlitePersistenceLayer.SELECT_SQL, ('foo',))
+        self.assertTrue('key_values_key_date' in ' '.join(str(row) for row in plan))
+        
+    def test_invalid_pragmas(self):
+        """
+        Ensures unknown journal modes and synchronous levels are rejected
+        """
+        self.assertRaises(ValueError, SqlitePersistenceLayer, 'test', ':memory:',
+                          journal_mode='fast')
+        self.assertRaises(ValueError, SqlitePersistenceLayer, 'test', ':memory:',
+                          synchronous='sometimes')
+    def test_compact(self):
+        """
+        Ensures compaction keeps only the latest version of each key and 
+        walks the table in chunks
+        """
+        for i in xrange(3):
+            self._put_unmerged([('key%s' % j, 'data%s' % i) for j in xrange(5)])
+        self._put_unmerged([('single', 'data')])
+        
+        result = self.persis.compact(4)
+        self.assertEquals(result, {'keys': 4, 'rows': 8, 'finished_pass': False})
+        result = self.persis.compact(4)
+        self.assertEquals(result, {'keys': 2, 'rows': 2, 'finished_pass': True})
+        result = self.persis.compact(4)
+        self.assertEquals(result, {'keys': 4, 'rows': 0, 'finished_pass': False})
+        
+        for j in xrange(5):
+            self.assertEquals([row[1] for row in self.persis.get_key('key%s' % j)], 
+                              ['data2'])
+        self.assertEquals(len(self.persis.get_key('single')), 1)
+    def test_integer_dates(self):
+        """
+        Ensures dates are stored as microseconds since the epoch, including
+        dates sent as strings
+        """
+        now = int(time.time() * 1000000)
+        self._put('foo', 'this is my data', str(now))
+        date = self.persis.get_key('foo')[0][2]
+        self.assertTrue(isinstance(date, (int, long)))
+        self.assertEquals(date, now)
+        
+    def test_put_siblings(self):
+        """
+        Ensures siblings replace every version of their key, keep their 
+        dates and clocks, and are all kept by compaction
+        """
+        self._put_unmerged([('foo', 'old'), ('foo', 'older')])
+        self.assertTrue(self.persis.put_siblings([('foo', [('one', 5, 'a=1'), ('two', 7, 'b=1')]),
+                                                  ('bar', [('three', 6, 'a=2')])]))
+        self.assertEquals(sorted(row[1:] for row in self.persis.get_key('foo')),
+                          [('one', 5, 'a=1'), ('two', 7, 'b=1')])
+        self.assertEquals([row[1:] for row in self.persis.get_key('bar')], [('three', 6, 'a=2')])
+        
+        # Versions written without a clock since are compacted away
+        self._put_unmerged([('foo', 'stale')])
+        self.assertEquals(self.persis.compact(10)['rows'], 1)
+        self.assertEquals(len(self.persis.get_key('foo')), 2)
+        
+    def test_scan_keys(self):
+        """
+        Ensures keys are listed in order a chunk at a time
+        """
+        self.persis.put_siblings([('key%s' % i, [('data', 1, None)]) for i in xrange(5)] + 
+                                 [('', [('empty', 1, None)])])
+        self._put_unmerged([('key1', 'data2')])
+        self.assertEquals(self.persis.scan_keys(None, 3), ['', 'key0', 'key1'])
+        self.assertEquals(self.persis.scan_keys('key1', 3), ['key2', 'key3', 'key4'])
+        self.assertEquals(self.persis.scan_keys('key4', 3), [])
+        
+class TestSqlitePersistenceLayerMigration(TestCase):
+    """
+    Tests migrating a database written with text dates
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        
+    def tearDown(self):
+        os.remove(self.path)
+        
+    def test_migrate_text_dates(self):
+        """
+        Ensures text dates, with and without fractional seconds, are 
+        converted in place
+        """
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE key_values (id integer primary key, "
+                     "key varchar(255), value blob(1024), date timestamp)")
+        conn.executemany("INSERT INTO key_values(key, value, date) VALUES (?, ?, ?)",
+                         [('foo', 'old', '2011-01-02 03:04:05.500000'),
+                          ('foo', 'new', '2011-01-02 03:04:06'),
+                          ('bar', 'bar', '2011-01-02 03:04:05.000001')])
+        conn.commit()
+        conn.close()
+        
+        persis = SqlitePersistenceLayer('test_layer', self.path)
+        persis.init_persistence()
+        dates = dict((row[1], row[2]) for row in persis.get_key('foo') + 
+                     persis.get_key('bar'))
+        persis.close()
+        
+        self.assertEquals(dates['new'] - dates['old'], 500000)
+        self.assertEquals(dates['old'] - dates['bar'], 499999)
+        self.assertEquals(dates['new'] % 1000000, 0)
+        
+    def test_migrate_clocks(self):
+        """
+        Ensures the clock column is added to a table without one, with the 
+        existing versions left without clocks
+        """
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE key_values (id integer primary key, "
+                     "key varchar(255), value blob(1024), date integer)")
+        conn.execute("INSERT INTO key_values(key, value, date) VALUES ('foo', 'old', 5)")
+        conn.commit()
+        conn.close()
+        
+        persis = SqlitePersistenceLayer('test_layer', self.path)
+        persis.init_persistence()
+        self.assertEquals(persis.get_key('foo'), [(1, 'old', 5, None)])
+        persis.put_siblings([('foo', [('new', 6, 'a=1')])])
+        persis.close()
+        
+        persis = SqlitePersistenceLayer('test_layer', self.path)
+        persis.init_persistence()
+        self.assertEquals([row[1:] for row in persis.get_key('foo')], [('new', 6, 'a=1')])
+        persis.close()
 
+class TestSqlitePersistenceLayerThreads(TestCase):
+    """
+    Tests the sqlite persistence layer from several threads
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.persis = SqlitePersistenceLayer('test_layer', self.path)
+        self.persis.init_persistence()
+        
+    def tearDown(self):
+        self.persis.close()
+        os.remove(self.path)
+        
+    def test_connection_per_thread(self):
+        """
+        Ensures each thread gets its own connection
+        """
+        conns = []
+        thread = threading.Thread(target=lambda: conns.append(self.persis.conn))
+        thread.start()
+        thread.join()
+        self.assertTrue(conns[0] is not None)
+        self.assertTrue(conns[0] is not self.persis.conn)
+        
+    def test_concurrent_puts(self):
+        """
+        Ensures puts from many threads all land in the database
+        """
+        def put(thread_num):
+            for i in xrange(20):
+                self.assertTrue(self.persis.put_siblings(
+                    [('foo%s-%s' % (thread_num, i), [(str(i), 1, None)])]))
+                
+        threads = [threading.Thread(target=put, args=(i,)) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        result = self.persis.conn.execute("SELECT COUNT(*) FROM key_values")
+        self.assertEquals(result.fetchone()[0], 160)
+        self.assertEquals(self.persis.get_key('foo3-19')[0][1], '19')
+        
+class TestSqlitePersistenceLayerTuned(TestCase):
+    """
+    Tests the sqlite persistence layer with WAL journaling and group commit
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.persis = SqlitePersistenceLayer('test_layer', self.path, journal_mode='wal',
+                                             synchronous='normal', 
+                                             group_commit_window=0.05)
+        self.persis.init_persistence()
+        
+    def tearDown(self):
+        self.persis.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        
+    def test_pragmas(self):
+        """
+        Ensures the journal mode and synchronous level are applied
+        """
+        conn = self.persis.conn
+        self.assertEquals(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEquals(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        
+    def test_group_commit(self):
+        """
+        Ensures concurrent puts are committed together and all land
+        """
+        inserts = []
+        insert = self.persis._insert
+        def counting_insert(rows, replaced=()):
+            inserts.append(len(rows))
+            return insert(rows, replaced)
+        self.persis._insert = counting_insert
+        
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(
+                       self.persis.put_siblings([('foo%s' % i, [('data', 1, None)])])))
+                   for i in xrange(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEquals(results, [True] * 16)
+        self.assertEquals(sum(inserts), 16)
+        self.assertTrue(len(inserts) < 16)
+        self.assertEquals(len(self.persis.get_key('foo7')), 1)
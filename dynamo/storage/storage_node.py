@@ -2,14 +2,27 @@
 # ------------------------------------------------------
 # Imports
 # ------------------------------------------------------
+import exceptions
 import logging
 import xmlrpclib
 import socket
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+import threading
+import time
 from optparse import OptionParser
-from datetime import datetime, timedelta
 
-from dynamo.storage.datastore_view import DataStoreView
+from dynamo.lib.consistent_hash import HASH_FUNCTIONS
+from dynamo.lib.lru_cache import LRUCache
+from dynamo.lib.metrics import Metrics, MetricsServer
+from dynamo.lib.rpc import create_server, create_binary_server, ConnectionPool, \
+    PooledServerProxy
+from dynamo.lib.vector_clock import VectorClock, VersionClock, reconcile, get_context
+from dynamo.storage.anti_entropy import AntiEntropy
+from dynamo.storage.datastore_view import DataStoreView, encode_ranges, parse_servers
+from dynamo.storage.handoff import Handoff, encode_versions, get_siblings
+from dynamo.storage.hints import HintStore
+from dynamo.storage.membership import Membership
+from dynamo.storage.persistence.compactor import Compactor
+from dynamo.storage.persistence.log_persistence_layer import LogPersistenceLayer
 from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
 
 # ------------------------------------------------------
@@ -23,28 +36,152 @@ logging.basicConfig(level=logging.INFO)
 class StorageNode(object):
     """
     A storage node. 
+    
+    Every version of a key carries a vector clock.  A put stamps its value 
+    with this node's dot and the context the client read, and replaces the
+    versions the context has seen; versions it has not seen are kept as 
+    siblings and returned together until a put with their merged context 
+    resolves them.  A put without a context replaces every version this node
+    holds, so clients that never read contexts keep last write wins.  The 
+    writes to one key are serialized by a striped lock, so the siblings are
+    read, pruned and written back as one step.
+    
+    Through a load balancer a write is stamped once, by the coordinator of 
+    its key with coordinate_put, and the stamped version is sent to the 
+    other replicas with replica_put, so every replica holds the same dot 
+    for the write rather than one each.  The read cache holds the 
+    siblings of a key rather than one value, so the versions load balancers
+    reconcile replicas by are served from it as well.
+    
+    Nodes gossip their heartbeats and the ring's membership with each 
+    other, see membership.Membership, so a membership change made on one
+    node reaches the rest and hands off the ranges that moved on each.
+    
+    The latency and errors of every RPC method and persistence operation,
+    the bytes of the values read and written and the read cache's counters
+    are kept in metrics, returned by the stats RPC and optionally served to
+    Prometheus on metrics_port.
     """
     GET = 'GET'
     PUT = 'PUT'
+    PERSISTENCE_LAYERS = {'sqlite': SqlitePersistenceLayer,
+                          'log': LogPersistenceLayer}
+    CACHE_MAX_VALUE = 64 * 1024
+    KEY_LOCKS = 64
+    RPC_METHODS = ('get', 'put', 'multi_get', 'multi_put', 'coordinate_put',
+                   'coordinate_multi_put', 'replica_put', 'replica_multi_put',
+                   'compaction_stats', 'cache_stats', 'add_nodes', 
+                   'remove_nodes', 'set_weights', 'handoff_put', 
+                   'handoff_stats', 'hinted_replica_put', 
+                   'hinted_multi_put', 'hint_stats', 'merkle_hashes', 
+                   'merkle_keys', 'get_versions', 'anti_entropy_stats', 
+                   'gossip', 'membership_stats', 'stats')
     
-    def __init__(self, servers, port):
+    def __init__(self, servers, port, replicas=3, threads=0, queue_size=64,
+                 persistence_options=None, compaction_interval=1.0,
+                 persistence='sqlite', cache_entries=10000, 
+                 cache_bytes=64 * 1024 * 1024, hash_function='md5',
+                 handoff_options=None, anti_entropy_options=None, partitions=0,
+                 binary_port=None, hint_options=None, max_clock_entries=10,
+                 gossip_options=None, metrics_port=None):
         """
         Parameters:
             servers : list(str)
                 A list of servers.  Each server name is in the 
-                format {host/ip}:port
+                format {host/ip}:port, optionally followed by :weight.  
+                This node is added with weight 1 unless it is listed.
             port : int
                 Port number to start on
+            replicas : int
+                Number of storage nodes each key is replicated to
+            threads : int
+                Number of RPC worker threads, 0 serves one request at a time
+            queue_size : int
+                Number of connections that can wait for a worker thread
+            persistence_options : dict
+                Keyword arguments for the persistence layer
+            compaction_interval : float
+                Seconds between compaction chunks, 0 disables compaction
+            persistence : str
+                Persistence layer to store keys in, sqlite or log
+            cache_entries : int
+                Number of keys whose siblings are kept in the read cache, 0 
+                disables it
+            cache_bytes : int
+                Total length of the values kept in the read cache
+            hash_function : str
+                The hash function of the ring, which every node must share
+            handoff_options : dict
+                Keyword arguments for the handoff of moved ranges, see 
+                handoff.Handoff
+            anti_entropy_options : dict
+                Keyword arguments for the replica synchronization, see 
+                anti_entropy.AntiEntropy.  An interval of 0 disables it.
+            partitions : int
+                Number of equal partitions of the ring, which every node must
+                share, 0 for random tokens
+            binary_port : int
+                Port to also serve the binary protocol on, None disables it
+            hint_options : dict
+                Keyword arguments for the store of hints taken for replicas
+                that were down, see hints.HintStore.  A max_bytes of 0 
+                refuses every hint.
+            max_clock_entries : int
+                Maximum number of nodes in the vector clock of a version.
+                The entries of the oldest writes are dropped past it.
+            gossip_options : dict
+                Keyword arguments for the gossip of membership and 
+                heartbeats, see membership.Membership.  An interval of 0 
+                disables it.
+            metrics_port : int
+                Port to serve the metrics to Prometheus on, None disables it
         """
         self.port = int(port)
         self.server = None
+        self.binary_port = binary_port
+        self.binary_server = None
+        self.replicas = replicas
+        self.threads = threads
+        self.queue_size = queue_size
+        if persistence not in self.PERSISTENCE_LAYERS:
+            raise exceptions.ValueError('Unknown persistence layer %s' % persistence)
+        self.persistence = persistence
+        self.persistence_options = persistence_options or {}
+        self.compaction_interval = compaction_interval
+        self.compactor = None
+        self.handoff = None
+        self.handoff_options = handoff_options or {}
+        self.anti_entropy = None
+        self.anti_entropy_options = anti_entropy_options or {}
+        self.hints = None
+        self.hint_options = hint_options or {}
+        self.max_clock_entries = max_clock_entries
+        self.key_locks = [threading.Lock() for i in xrange(self.KEY_LOCKS)]
+        self.counter_lock = threading.Lock()
+        self.last_counter = 0
+        self.peer_conns = {}
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.bytes_read = self.metrics.counter('bytes_read')
+        self.bytes_written = self.metrics.counter('bytes_written')
+        self.cache = None
+        if cache_entries:
+            self.cache = LRUCache(cache_entries, cache_bytes, self.CACHE_MAX_VALUE, 
+                                  _siblings_size)
+            self.metrics.add_source('cache', self.cache.stats)
         if servers is None:
             servers = []
         
         # Add myself to the servers list
         self.my_name = str(self)
-        servers.append(self.my_name)
-        self.datastore_view = DataStoreView(servers)
+        if self.my_name not in parse_servers(servers)[0]:
+            servers.append(self.my_name)
+        self.datastore_view = DataStoreView(servers, replicas, 
+                                            hash_function=hash_function,
+                                            partitions=partitions)
+        self.membership = Membership(self.my_name, servers, self._get_peer, 
+                                     self._set_members, **(gossip_options or {}))
 
         # Load the persistence layer
         self._load_persistence_layer()
@@ -53,8 +190,20 @@ class StorageNode(object):
         """
         Destructor
         """
+        if self.compactor:
+            self.compactor.stop()
+        if self.handoff:
+            self.handoff.stop()
+        if self.anti_entropy:
+            self.anti_entropy.stop()
+        if self.hints:
+            self.hints.close()
+        if self.membership:
+            self.membership.stop()
         if self.persis:
             self.persis.close()    
+        if self.metrics_server:
+            self.metrics_server.stop()
         if self.server:
             self.server.server_close()
         
@@ -77,41 +226,60 @@ class StorageNode(object):
         """
         Main storage node loop
         """
-        self.server = SimpleXMLRPCServer(('', self.port), allow_none=True)
-        self.server.register_function(self.get, "get")
-        self.server.register_function(self.put, "put")  
+        self.server = create_server(self.port, self.threads, self.queue_size)
+        self._register_functions(self.server)
+        if self.binary_port is not None:
+            self.binary_server = create_binary_server(self.binary_port, self.threads, 
+                                                      self.queue_size)
+            self._register_functions(self.binary_server)
+            self.binary_server.start()
+        
+        if self.compaction_interval:
+            self.compactor = Compactor(self.persis, interval=self.compaction_interval)
+            self.compactor.start()
+        self._start_handoff()
+        if self.anti_entropy_options.get('interval', 1.0):
+            self._start_anti_entropy()
+        if self.hint_options.get('max_bytes', 1):
+            self._start_hints()
+        if self.membership.interval:
+            self.membership.start()
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
         self.server.serve_forever()
 
     # ------------------------------------------------------
     # RPC methods
     # ------------------------------------------------------             
-    def get(self, key):
+    def get(self, key, with_context=False):
         """
         Gets a key
         
         :Parameters:
             key : str
                 The key value
+            with_context : bool
+                Whether to return every sibling with the context to put 
+                back, rather than only the latest sibling's value
+        :rtype: str or dict
+        :returns: The latest value, or with_context a {'values': values, 
+                  'context': context} dict.  None if this node is not 
+                  responsible for the key.
         """
         logging.debug('Getting key=%s' % key)
         # Make sure I am supposed to have this key
-        respon_node = self.datastore_view.get_node(key)
-        if respon_node != self.my_name:
-            logging.info("I'm not responsible for %s (%s vs %s)" % (key, 
-                                                                    respon_node, 
-                                                                    self.my_name))
+        if not self._is_responsible(key):
+            logging.info("I'm not responsible for %s (%s)" % (key, self.my_name))
             return None
         
-        # Read it from the database
-        result = self.persis.get_key(key)
+        siblings = self._read_siblings([key])[key]
+        self.bytes_read.add(_siblings_size(siblings))
+        if with_context:
+            return {'values': [value for value, date, clock in siblings],
+                    'context': get_context(siblings).encode()}
         
-        # If the contexts don't line up then return the most recent
-        value = None
-        if len(result) == 1:
-            value = result[0][1]
-        else:
-            value = self._reconcile_conflict(result)[0]
-
+        value = _latest_value(siblings)
         logging.debug('Returning value=%s' % value)        
         return value
     
@@ -125,99 +293,981 @@ class StorageNode(object):
             value : str
                 The value
             context : str
-                Should be only be None for now.  In the future an application will be
-                able to add a custom context string
+                The context returned by a get with context, whose versions 
+                the value replaces.  None replaces every version.
                 
         :rtype: str
         :returns 200 if the operation succeeded, 400 otherwise
         """
         # Make sure I am supposed to have this key
-        if self.datastore_view.get_node(key) != self.my_name:
+        if not self._is_responsible(key):
             logging.info("I'm not responsible for %s" % key)
             return None
         
+        self.bytes_written.add(_size(value))
         res_code = None
         try:
-            # Read it from the database
-            result = self.persis.put_key(key, value)
-            res_code = '200'
+            if context is not None:
+                context = VectorClock.decode(context)
+            result = self._coordinate({key: (value, context)})
+            res_code = '200' if result is not None else '400'
         except:
             logging.error('Error putting key=%s value=%s into the persistence layer' % 
                           (key, value))
             res_code = '400'
         
         return res_code
+    
+    def multi_get(self, keys):
+        """
+        Gets a number of keys with one read of the persistence layer
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: dict(str, str)
+        :returns: The value of each key this node is responsible for, None for
+                  keys it does not have
+        """
+        siblings = self._read_siblings([key for key in keys if self._is_responsible(key)])
+        self.bytes_read.add(sum(_siblings_size(versions) for versions in siblings.itervalues()))
+        return dict((key, _latest_value(versions)) 
+                    for key, versions in siblings.iteritems())
+    
+    def multi_put(self, items):
+        """
+        Puts a number of key values in one transaction.  Each value 
+        replaces every version of its key, as a put without a context does.
+        
+        :Parameters:
+            items : list(tuple(str, str))
+                (key, value) pairs
+        :rtype: dict(str, str)
+        :returns: 200 for each key written, 400 if the write failed and None 
+                  for keys this node is not responsible for
+        """
+        codes = {}
+        responsible = {}
+        for key, value in items:
+            if self._is_responsible(key):
+                responsible[key] = value
+            else:
+                codes[key] = None
+        self.bytes_written.add(sum(_size(value) for value in responsible.itervalues()))
+        
+        res_code = '400'
+        try:
+            if self._coordinate(dict((key, (value, None)) for key, value 
+                                     in responsible.iteritems())) is not None:
+                res_code = '200'
+        except:
+            logging.error('Error putting %s keys into the persistence layer' % 
+                          len(responsible))
+        for key in responsible:
+            codes[key] = res_code
+        return codes
+    
+    def coordinate_put(self, key, value, context=None):
+        """
+        Takes a write as the coordinator of its key.  The write is stamped
+        with this node's dot and stored as put does, and its version 
+        returned for the load balancer to send to the other replicas with
+        replica_put.
+        
+        :Parameters:
+            key : str
+                The key name
+            value : str
+                The value
+            context : str
+                The context returned by a get with context, None to replace
+                every version this node holds
+        :rtype: list(str)
+        :returns: The [date, clock] of the version, the date in microseconds
+                  as a string.  None if the write failed or this node is not
+                  responsible for the key.
+        """
+        return self.coordinate_multi_put([(key, value, context)])[key]
+    
+    def coordinate_multi_put(self, items):
+        """
+        Takes a number of writes as the coordinator of their keys, in one 
+        transaction
+        
+        :Parameters:
+            items : list(tuple(str, str))
+                (key, value) pairs, optionally followed by the context the 
+                client read
+        :rtype: dict(str, list(str))
+        :returns: The [date, clock] of each key's version, None for keys 
+                  whose write failed or this node is not responsible for
+        """
+        versions = {}
+        writes = {}
+        for item in items:
+            key, value = item[:2]
+            versions[key] = None
+            if not self._is_responsible(key):
+                logging.info("I'm not responsible for %s" % key)
+                continue
+            context = item[2] if len(item) > 2 else None
+            writes[key] = (value, VectorClock.decode(context) 
+                                  if context is not None else None)
+        self.bytes_written.add(sum(_size(value) for value, context in writes.itervalues()))
+        
+        try:
+            stamped = self._coordinate(writes)
+        except:
+            logging.exception('Error coordinating %s writes' % len(writes))
+            stamped = None
+        if stamped is not None:
+            for key, (value, date, clock) in stamped.iteritems():
+                versions[key] = [str(date), clock.encode()]
+        return versions
+    
+    def replica_put(self, key, value, date, clock):
+        """
+        Stores a version of a key stamped by the coordinator of the write,
+        merging it into the key's siblings
+        
+        :Parameters:
+            key : str
+                The key name
+            value : str
+                The value
+            date : str
+                The date of the version in microseconds
+            clock : str
+                The encoded clock of the version
+        :rtype: str
+        :returns: 200 if the version was written, 400 if the write failed 
+                  and None if this node is not responsible for the key
+        """
+        return self.replica_multi_put([(key, value, date, clock)])[key]
+    
+    def replica_multi_put(self, rows):
+        """
+        Stores a number of versions stamped by the coordinators of their 
+        writes in one transaction
+        
+        :Parameters:
+            rows : list(tuple(str, str, str, str))
+                (key, value, date, clock) rows
+        :rtype: dict(str, str)
+        :returns: 200 for each key written, 400 if the write failed and None 
+                  for keys this node is not responsible for
+        """
+        codes = {}
+        versions = {}
+        for key, value, date, clock in rows:
+            if self._is_responsible(key):
+                versions.setdefault(key, []).append((value, int(date), 
+                                                     VersionClock.decode(clock)))
+            else:
+                logging.info("I'm not responsible for %s" % key)
+                codes[key] = None
+        self.bytes_written.add(sum(_size(value) for key_versions in versions.itervalues()
+                                   for value, date, clock in key_versions))
+        
+        res_code = '400'
+        try:
+            if self._update_siblings(versions, lambda key, siblings: 
+                                     self._merge_versions(siblings, versions[key])):
+                res_code = '200'
+        except:
+            logging.error('Error putting %s versions into the persistence layer' % 
+                          len(rows))
+        for key in versions:
+            codes[key] = res_code
+        return codes
+         
+    def compaction_stats(self):
+        """
+        Gets the background compaction counters
+        
+        :rtype: dict
+        :returns: Chunks and passes run, keys scanned, rows reclaimed, seconds
+                  spent and errors.  Empty if compaction is disabled.
+        """
+        if self.compactor is None:
+            return {}
+        return self.compactor.stats()
+         
+    def add_nodes(self, nodes):
+        """
+        Adds storage nodes to this node's view of the ring and starts handing
+        off the keys of the ranges they took over
+        
+        :Parameters:
+            nodes : list(str)
+                The node names, each in the format {host/ip}:port optionally
+                followed by :weight
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        moved = self.datastore_view.add_nodes(nodes)
+        self._ranges_moved(moved)
+        self.membership.record(weights=parse_servers(nodes)[1])
+        return encode_ranges(moved)
+    
+    def remove_nodes(self, nodes):
+        """
+        Removes storage nodes from this node's view of the ring and starts 
+        handing off the keys of the ranges that moved
+        
+        :Parameters:
+            nodes : list(str)
+                The node names
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        moved = self.datastore_view.remove_nodes(nodes)
+        self._ranges_moved(moved)
+        self._close_peers(nodes)
+        self.membership.record(left=nodes)
+        return encode_ranges(moved)
+    
+    def set_weights(self, weights):
+        """
+        Changes the weights of storage nodes in this node's view of the ring
+        and starts handing off the keys of the ranges that moved
+        
+        :Parameters:
+            weights : dict(str, float)
+                The new weight of each node
+        :rtype: list(dict)
+        :returns: The ranges of the ring whose preference lists changed, 
+                  with their tokens as hex strings
+        """
+        moved = self.datastore_view.set_weights(weights)
+        self._ranges_moved(moved)
+        self.membership.record(weights=weights)
+        return encode_ranges(moved)
+    
+    def handoff_put(self, rows):
+        """
+        Merges versions of keys handed off by another node into their 
+        siblings here, keeping their original dates and clocks so writes 
+        made here that supersede them still win
+        
+        :Parameters:
+            rows : list(tuple(str, str, str, str))
+                (key, value, date, clock) rows with dates in microseconds and
+                encoded clocks, None for versions written without one
+        :rtype: str
+        :returns: 200 if the versions were written, 400 if the write failed
+                  and None if this node is not responsible for all the keys
+        """
+        versions = {}
+        for row in rows:
+            key = row[0]
+            if not self._is_responsible(key):
+                logging.info("I'm not responsible for handed off key %s" % key)
+                return None
+            clock = row[3] if len(row) > 3 else None
+            versions.setdefault(key, []).append((row[1], int(row[2]), 
+                                                 VersionClock.decode(clock)))
+            
+        res_code = '400'
+        try:
+            if self._update_siblings(versions, lambda key, siblings: 
+                                     self._merge_versions(siblings, versions[key])):
+                res_code = '200'
+        except:
+            logging.error('Error putting %s handed off keys into the persistence '
+                          'layer' % len(rows))
+        return res_code
+    
+    def hinted_replica_put(self, key, value, date, clock, owner):
+        """
+        Stores a version stamped by the coordinator of a write for a replica
+        that is down, to be replayed to it once it is back.  The load 
+        balancer sends these to the nodes after a key's preference list.
+        
+        :Parameters:
+            key : str
+                The key name
+            value : str
+                The value
+            date : str
+                The date of the version in microseconds
+            clock : str
+                The encoded clock of the version
+            owner : str
+                The node the version is meant for
+        :rtype: str
+        :returns: 200 if the hint was stored, 400 if the hint store is full
+                  or disabled
+        """
+        return self.hinted_multi_put([(key, value, owner, date, clock)])[key]
+    
+    def hinted_multi_put(self, items):
+        """
+        Stores a number of versions for replicas that are down in one 
+        transaction
+        
+        :Parameters:
+            items : list(tuple(str, str, str, str, str))
+                (key, value, owner, date, clock) rows, the version's date 
+                and clock as the coordinator of the write stamped them
+        :rtype: dict(str, str)
+        :returns: 200 for each key if the hints were stored, 400 otherwise
+        """
+        res_code = '400'
+        try:
+            rows = [(owner, key, value, clock, int(date)) 
+                    for key, value, owner, date, clock in items]
+            if self.hints is not None and self.hints.add(rows):
+                res_code = '200'
+            else:
+                logging.info('Refusing %s hints' % len(items))
+        except:
+            logging.exception('Error storing %s hints' % len(items))
+        return dict((item[0], res_code) for item in items)
+    
+    def merkle_hashes(self, start, end, level, indexes):
+        """
+        Gets hashes of this node's Merkle tree over a range of the ring
+        
+        :Parameters:
+            start : str
+            end : str
+                The range's tokens as hex strings
+            level : int
+                The level of the tree, 0 for the root
+            indexes : list(int)
+                The nodes of the level
+        :rtype: list(str)
+        :returns: The hash of each node as a hex string, None if this node 
+                  has no tree over the range
+        """
+        if self.anti_entropy is None:
+            return None
+        hashes = self.anti_entropy.get_hashes(long(start, 16), long(end, 16), 
+                                              level, indexes)
+        if hashes is None:
+            return None
+        return ['%x' % entry_hash for entry_hash in hashes]
+    
+    def merkle_keys(self, start, end, leaves):
+        """
+        Gets the hashes of the keys in leaves of this node's Merkle tree 
+        over a range of the ring
+        
+        :Parameters:
+            start : str
+            end : str
+                The range's tokens as hex strings
+            leaves : list(int)
+                The leaves
+        :rtype: list(tuple(str, str))
+        :returns: (key, hash) pairs with the hashes as hex strings, None if
+                  this node has no tree over the range
+        """
+        if self.anti_entropy is None:
+            return None
+        keys = self.anti_entropy.get_keys(long(start, 16), long(end, 16), leaves)
+        if keys is None:
+            return None
+        return [(key, '%x' % entry_hash) for key, entry_hash in keys.iteritems()]
+    
+    def get_versions(self, keys):
+        """
+        Gets the siblings of keys with their dates and clocks, for another 
+        replica to merge with handoff_put or a load balancer to reconcile
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: list(tuple(str, str, str, str))
+        :returns: (key, value, date, clock) rows for the keys this node has
+        """
+        siblings = self._read_siblings(keys)
+        self.bytes_read.add(sum(_siblings_size(versions) for versions in siblings.itervalues()))
+        return encode_versions(siblings)
+    
+    def anti_entropy_stats(self):
+        """
+        Gets the replica synchronization counters
+        
+        :rtype: dict
+        :returns: Ranges and keys hashed, whether the hashes are loaded, and
+                  syncs, round trips, keys pulled and pushed and errors.
+                  Empty if it is disabled.
+        """
+        if self.anti_entropy is None:
+            return {}
+        return self.anti_entropy.stats()
+    
+    def handoff_stats(self):
+        """
+        Gets the handoff counters
+        
+        :rtype: dict
+        :returns: Plans pending, keys scanned and sent, bytes and batches 
+                  sent, passes, errors and seconds spent.  Empty if the node
+                  is not running.
+        """
+        if self.handoff is None:
+            return {}
+        return self.handoff.stats()
+         
+    def gossip(self, state):
+        """
+        Takes part in a gossip round started by another node
+        
+        :Parameters:
+            state : dict
+                The other node's heartbeats and members, see 
+                Membership.get_state
+        :rtype: dict
+        :returns: This node's heartbeats, and its members if they differ
+        """
+        return self.membership.handle(state)
+    
+    def membership_stats(self):
+        """
+        Gets the gossip counters
+        
+        :rtype: dict
+        :returns: The ring version, the members, the phi of each other 
+                  member and the suspected ones, see Membership.stats
+        """
+        return self.membership.stats()
+    
+    def hint_stats(self):
+        """
+        Gets the hint store counters
+        
+        :rtype: dict
+        :returns: Hints and bytes held, owners they are for, hints stored,
+                  refused, replayed and dropped, batches, errors and seconds
+                  spent.  Empty if the store is disabled.
+        """
+        if self.hints is None:
+            return {}
+        return self.hints.stats()
+         
+    def stats(self):
+        """
+        Gets the latency histograms and counters of the node
+        
+        :rtype: dict
+        :returns: The count, sum, min, max and quantiles in seconds of the 
+                  latencies of each RPC method and persistence operation,
+                  the errors of each and the bytes read and written, see 
+                  Metrics.snapshot, and the read cache counters
+        """
+        return self.metrics.snapshot()
+         
+    def cache_stats(self):
+        """
+        Gets the read cache counters
+        
+        :rtype: dict
+        :returns: Hits, misses, evictions, invalidations, entries and bytes
+                  cached.  Empty if the cache is disabled.
+        """
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
          
     # ------------------------------------------------------
     # Private methods
     # ------------------------------------------------------  
-    def _reconcile_conflict(self, result):
-        """
-        Reconciles the conflict between a number of values.  Note
-        that currently this defaults to taking the last written value.
-        In the future this will be expanded to allow application specific
-        conflict resolution
-        
-        :Parameters:
-            result : list(tuples)
-                A list of result tuples from the persistence layer in the form
-                [(id, "value", "date"), ...]
-        :rtype: tuple(int, str)
-        :returns An id, string tuple of the chosen version
-        """
-        last_result = None
-        last_date = None
-        for res in result:
-            if last_result is None:
-                last_result = res[1]
-                last_date = self._parse_date(res[2])  
-            else:
-                date = self._parse_date(res[2])
-                if date > last_date:
-                    last_date = date
-                    last_result = res[1]
- 
-        return (last_result, last_date)
-
-    def _load_persistence_layer(self):
+    def _read_siblings(self, keys):
         """
-        Loads the persistence layer
+        Reads the siblings of keys, from the read cache for the keys it 
+        holds and with one read of the persistence layer for the rest
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+        :rtype: dict(str, list(tuple(str, int, VersionClock)))
+        :returns: The (value, date, clock) siblings of each key, oldest 
+                  first and empty for keys that do not exist
         """
-        # Setup my persistence layer
-        self.persis = SqlitePersistenceLayer(self.my_name)
-        self.persis.init_persistence()  
+        siblings = {}
+        tokens = {}
+        missing = []
+        for key in keys:
+            if self.cache is not None:
+                versions = self.cache.get(key)
+                if versions is not LRUCache.MISSING:
+                    siblings[key] = versions
+                    continue
+                tokens[key] = self.cache.reserve(key)
+            missing.append(key)
         
-    def _parse_date(self, datestr):
+        if len(missing) == 1:
+            result = {missing[0]: self.persis.get_key(missing[0])}
+        else:
+            result = self.persis.get_keys(missing)
+        for key in missing:
+            versions = get_siblings(result[key])
+            if self.cache is not None:
+                versions = self._fill_cache(key, versions, tokens[key])
+            siblings[key] = versions
+        return siblings
+    
+    def _fill_cache(self, key, siblings, token):
         """
-        Parses an iso formatted date
+        Caches the siblings read for a key.  Buffers are copied if the 
+        siblings are small enough to cache, since caching one would keep its
+        segment mapped; larger siblings are returned uncached.
         
         :Parameters:
-            datestr : str
-                An iso formatted date
-        :rtype: datetime
-        :returns A date object
+            key : str
+                The key name
+            siblings : list(tuple(str, int, VersionClock))
+                The siblings read, empty if the key does not exist
+            token : object
+                The token from reserving the key before the read
+        :rtype: list(tuple(str, int, VersionClock))
+        :returns: The siblings to return
         """
-        date_str, micros = datestr.split('.')
-        date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-        date += timedelta(microseconds=float(micros))
+        if _siblings_size(siblings) <= self.cache.max_value_bytes:
+            siblings = [(str(value) if isinstance(value, buffer) else value, date, clock)
+                        for value, date, clock in siblings]
+        self.cache.fill(key, siblings, token)
+        return siblings
+    
+    def _update_siblings(self, keys, update):
+        """
+        Reads the siblings of keys, lets update change them and writes back
+        those that changed in one transaction, holding the keys' locks 
+        throughout.  The keys' cached values and entry hashes follow.
+        
+        :Parameters:
+            keys : list(str)
+                The key names
+            update : function
+                Called with a key and its (value, date, clock) siblings, 
+                returns its new siblings or None to leave them
+        :rtype: bool
+        :returns: True if the changed keys were written
+        """
+        locks = sorted(set(hash(key) % self.KEY_LOCKS for key in keys))
+        for index in locks:
+            self.key_locks[index].acquire()
+        try:
+            result = self.persis.get_keys(list(keys))
+            items = []
+            for key in keys:
+                siblings = update(key, get_siblings(result[key]))
+                if siblings is not None:
+                    items.append((key, [(value, date, clock.encode() if clock else None)
+                                        for value, date, clock in siblings]))
+            if not items:
+                return True
+            if not self.persis.put_siblings(items):
+                return False
+            if self.anti_entropy is not None:
+                for key, siblings in items:
+                    self.anti_entropy.update(key, [(value, clock) 
+                                                   for value, date, clock in siblings])
+            return True
+        finally:
+            for index in locks:
+                self.key_locks[index].release()
+            if self.cache is not None:
+                for key in keys:
+                    self.cache.invalidate(key)
+    
+    def _coordinate(self, writes):
+        """
+        Stamps writes with this node's dot and adds them to the siblings of 
+        their keys in one transaction
+        
+        :Parameters:
+            writes : dict(str, tuple(str, VectorClock))
+                The value written to each key and the context the client 
+                read, None to replace every sibling
+        :rtype: dict(str, tuple(str, int, VersionClock))
+        :returns: The (value, date, clock) version of each key, None if the
+                  write failed
+        """
+        versions = {}
+        def update(key, siblings):
+            value, context = writes[key]
+            version, siblings = self._make_version(siblings, value, context)
+            versions[key] = version
+            return reconcile(siblings + [version], self.max_clock_entries)
+        if not self._update_siblings(writes, update):
+            return None
+        return versions
+    
+    def _make_version(self, siblings, value, context):
+        """
+        Stamps a version written by a client
+        
+        :Parameters:
+            siblings : list(tuple(str, int, VersionClock))
+                The key's (value, date, clock) siblings
+            value : str
+                The value written
+            context : VectorClock
+                The context the client read, None to replace every sibling
+        :rtype: tuple(tuple(str, int, VersionClock), list)
+        :returns: The (value, date, clock) version and the siblings it does 
+                  not supersede
+        """
+        if context is None:
+            context = get_context(siblings)
+        siblings = [sibling for sibling in siblings 
+                    if sibling[2] is not None and not sibling[2].seen_by(context)]
+        floor = context.get(self.my_name)
+        for sibling in siblings:
+            clock = sibling[2]
+            floor = max(floor, clock.past.get(self.my_name),
+                        clock.counter if clock.node == self.my_name else 0)
+        clock = self._stamp(context, floor)
+        return (value, self._now(), clock), siblings
+    
+    def _merge_versions(self, siblings, versions):
+        """
+        Merges versions from another node into the siblings of a key
         
-        return date
+        :Parameters:
+            siblings : list(tuple(str, int, VersionClock))
+                The key's (value, date, clock) siblings
+            versions : list(tuple(str, int, VersionClock))
+                The versions received
+        :rtype: list(tuple(str, int, VersionClock))
+        :returns: The new siblings, None if they did not change
+        """
+        merged = reconcile(siblings + versions, self.max_clock_entries)
+        if [(date, clock) for value, date, clock in merged] == \
+                [(date, clock) for value, date, clock in siblings]:
+            return None
+        return merged
+    
+    def _stamp(self, context, floor):
+        """
+        Makes the clock of a write this node takes
         
+        :Parameters:
+            context : VectorClock
+                The versions the write supersedes
+            floor : long
+                The highest counter of this node the key's versions hold
+        :rtype: VersionClock
+        :returns: The clock, with this node's next counter as its dot
+        """
+        # Counters are taken from the time so they also order the entries 
+        # by age for truncation, and never go back past one already used
+        with self.counter_lock:
+            counter = max(self._now(), floor + 1, self.last_counter + 1)
+            self.last_counter = counter
+        return VersionClock(self.my_name, counter, 
+                            context.truncate(self.max_clock_entries - 1))
+    
+    def _now(self):
+        """
+        :rtype: int
+        :returns: The current time in microseconds since the epoch
+        """
+        return int(time.time() * 1000000)
+    
+    def _start_handoff(self):
+        """
+        Starts the thread handing off moved ranges, which resumes a handoff 
+        interrupted by a restart
+        """
+        options = dict(self.handoff_options)
+        options.setdefault('checkpoint_path', '/tmp/%s-handoff' % self.my_name)
+        self.handoff = Handoff(self.persis, 
+                               self.datastore_view.consistent_hash.hash_function,
+                               self._send_handoff, **options)
+        self.handoff.start()
+        
+    def _start_anti_entropy(self):
+        """
+        Starts the thread synchronizing this node's ranges with the other 
+        replicas
+        """
+        self.anti_entropy = AntiEntropy(self.persis, 
+                                        self.datastore_view.consistent_hash.hash_function,
+                                        self.my_name, self._get_peer, 
+                                        self.handoff_put, **self.anti_entropy_options)
+        self.anti_entropy.set_ranges(self.datastore_view.table.get_ranges(self.my_name))
+        self.anti_entropy.start()
+        
+    def _start_hints(self):
+        """
+        Opens the hint store and starts replaying the hints it holds, which
+        resumes a replay interrupted by a restart
+        """
+        options = dict(self.hint_options)
+        path = options.pop('path', '/tmp/%s-hints' % self.my_name)
+        self.hints = HintStore(path, self._send_hints, **options)
+        self.hints.start()
+        
+    def _register_functions(self, server):
+        """
+        Registers the RPC methods with a server
+        """
+        for method in self.RPC_METHODS:
+            server.register_function(self.metrics.timed('rpc', getattr(self, method), 
+                                                        method=method), method)
+        
+    def _ranges_moved(self, moved):
+        """
+        Hands off the keys of moved ranges and rebuilds the Merkle trees 
+        over the ranges this node now replicates
+        """
+        if self.handoff is not None:
+            self.handoff.add_plan(self._plan_handoff(moved))
+        if self.anti_entropy is not None:
+            self.anti_entropy.set_ranges(self.datastore_view.table.get_ranges(self.my_name))
+    
+    def _set_members(self, weights):
+        """
+        Swaps in a ring of the members gossip agreed on and hands off the 
+        ranges that moved
+        
+        :Parameters:
+            weights : dict(str, float)
+                The weight of each member
+        """
+        moved = self.datastore_view.set_members(weights)
+        if moved:
+            self._ranges_moved(moved)
+        self._close_peers([node for node in self.peer_conns if node not in weights])
+        
+    def _close_peers(self, nodes):
+        """
+        Closes the connections to nodes that left the ring
+        """
+        for node in nodes:
+            conn = self.peer_conns.pop(node, None)
+            if conn is not None:
+                conn.pool.close()
+    
+    def _plan_handoff(self, moved):
+        """
+        Picks the moved ranges this node hands off.  The first node of a 
+        range's old preference list sends its keys to the nodes new to it.
+        
+        :Parameters:
+            moved : list(dict)
+                The moved ranges of a membership change
+        :rtype: list(dict)
+        :returns: The ranges with the nodes to send their keys to
+        """
+        transfers = []
+        for moved_range in moved:
+            old = moved_range['old']
+            if not old or old[0] != self.my_name:
+                continue
+            targets = [node for node in moved_range['new'] if node not in old]
+            if targets:
+                transfers.append({'start': moved_range['start'], 
+                                  'end': moved_range['end'],
+                                  'targets': targets})
+        return transfers
+    
+    def _send_handoff(self, node, rows):
+        """
+        Sends handed off rows to a node.  Nodes that have since left the 
+        ring are skipped.
+        
+        :Parameters:
+            node : str
+                The node name
+            rows : list(tuple(str, str, str, str))
+                (key, value, date, clock) rows
+        """
+        if node not in self.datastore_view.table.nodes:
+            logging.info('Skipping the handoff to %s, which left the ring' % node)
+            return
+        res_code = self._get_peer(node).handoff_put(rows)
+        if res_code != '200':
+            raise IOError('%s did not store %s handed off keys: %s' % 
+                          (node, len(rows), res_code))
+    
+    def _send_hints(self, owner, rows):
+        """
+        Replays hinted rows to the node they were meant for.  Hints for a 
+        node that has since left the ring, or that no longer holds the keys,
+        are dropped; the keys' current replicas took the writes or get them
+        from anti-entropy.
+        
+        :Parameters:
+            owner : str
+                The node name
+            rows : list(tuple(str, str, str, str))
+                (key, value, date, clock) rows
+        :rtype: bool
+        :returns: True if the node stored the rows, False if they were 
+                  dropped
+        """
+        if owner not in self.datastore_view.table.nodes:
+            logging.info('Dropping %s hints for %s, which left the ring' % 
+                         (len(rows), owner))
+            return False
+        res_code = self._get_peer(owner).handoff_put(rows)
+        if res_code is None:
+            logging.info('Dropping %s hints for %s, which no longer holds '
+                         'their keys' % (len(rows), owner))
+            return False
+        if res_code != '200':
+            raise IOError('%s did not store %s hints: %s' % 
+                          (owner, len(rows), res_code))
+        return True
+    
+    def _get_peer(self, node):
+        """
+        Gets the proxy for another storage node's RPCs, which the handoff,
+        anti-entropy and hint replay threads share
+        
+        :Parameters:
+            node : str
+                The node name
+        :rtype: PooledServerProxy
+        :returns: The proxy
+        """
+        conn = self.peer_conns.get(node)
+        if conn is None:
+            host, port = node.rsplit(':', 1)
+            conn = PooledServerProxy(ConnectionPool(host, port, max_size=2))
+            self.peer_conns[node] = conn
+        return conn
+    
+    def _is_responsible(self, key):
+        """
+        Whether this node holds one of the replicas of a key
+        
+        :Parameters:
+            key : str
+                The key name
+        :rtype: bool
+        :returns: True if this node is in the key's preference list
+        """
+        respon_nodes = self.datastore_view.get_preference_list(key, self.replicas)
+        return self.my_name in respon_nodes
+    
+    def _load_persistence_layer(self):
+        """
+        Loads the persistence layer
+        """
+        # Setup my persistence layer
+        persistence_layer = self.PERSISTENCE_LAYERS[self.persistence]
+        self.persis = persistence_layer(self.my_name, metrics=self.metrics, 
+                                        **self.persistence_options)
+        self.persis.init_persistence()
+
+def _size(value):
+    """
+    Gets the length of a value, 0 for a key that does not exist
+    """
+    return len(value) if value is not None else 0
+
+def _siblings_size(siblings):
+    """
+    Gets the total length of the values of a key's siblings
+    """
+    return sum(len(value) for value, date, clock in siblings)
+
+def _latest_value(siblings):
+    """
+    Chooses the value a get without context returns, the latest written of
+    a key's siblings, None if it has none
+    """
+    if not siblings:
+        return None
+    return siblings[-1][0]
+
 # ------------------------------------------------------
 # Main
 # ------------------------------------------------------
 def parse_args():
     parser = OptionParser()
     parser.add_option('-s', '--server', dest='servers',
-                      help='List of storage nodes(one per server)',
+                      help='List of storage nodes(one per server), each host:port or host:port:weight',
                       action='append', default=[])
     parser.add_option('-p', '--port', dest='port', default=25000,
                       help='Port to start the storage node on')
+    parser.add_option('-n', '--replicas', dest='replicas', default=3, type='int',
+                      help='Number of storage nodes each key is replicated to')
+    parser.add_option('-t', '--threads', dest='threads', default=0, type='int',
+                      help='Number of RPC worker threads, 0 serves one request at a time')
+    parser.add_option('-q', '--accept-queue', dest='queue_size', default=64, 
+                      type='int', help='Connections that can wait for a worker thread')
+    parser.add_option('--compaction-interval', dest='compaction_interval', 
+                      default=1.0, type='float', 
+                      help='Seconds between version compaction chunks, 0 disables it')
+    parser.add_option('--persistence', dest='persistence', default='sqlite',
+                      choices=['sqlite', 'log'],
+                      help='Persistence layer, sqlite or log (append-only segments)')
+    parser.add_option('--segment-size-mb', dest='segment_size_mb', default=64, 
+                      type='int', help='Size of a log segment before a new one is started')
+    parser.add_option('--fsync', dest='fsync', default=False, action='store_true',
+                      help='fsync the log after every write')
+    parser.add_option('--cache-entries', dest='cache_entries', default=10000, 
+                      type='int', help='Values kept in the read cache, 0 disables it')
+    parser.add_option('--cache-mb', dest='cache_mb', default=64, type='int',
+                      help='Megabytes of values kept in the read cache')
+    parser.add_option('--hash', dest='hash_function', default='md5',
+                      choices=sorted(HASH_FUNCTIONS),
+                      help='Hash function of the ring, the same on every node')
+    parser.add_option('--binary-port', dest='binary_port', default=None, type='int',
+                      help='Port to also serve the binary protocol on')
+    parser.add_option('--partitions', dest='partitions', default=0, type='int',
+                      help='Equal partitions of the ring, a power of two and the same on every node, 0 for random tokens')
+    parser.add_option('--handoff-rate-mb', dest='handoff_rate_mb', default=10, 
+                      type='float', 
+                      help='Megabytes per second sent when handing off moved keys, 0 for no limit')
+    parser.add_option('--anti-entropy-interval', dest='anti_entropy_interval', 
+                      default=1.0, type='float', 
+                      help='Seconds between Merkle tree syncs with a replica, 0 disables them')
+    parser.add_option('--hint-store-mb', dest='hint_store_mb', default=256, 
+                      type='float', 
+                      help='Megabytes of writes held for replicas that are down, 0 refuses them')
+    parser.add_option('--hint-rate-mb', dest='hint_rate_mb', default=10, 
+                      type='float', 
+                      help='Megabytes per second replayed to replicas that came back, 0 for no limit')
+    parser.add_option('--gossip-interval', dest='gossip_interval', default=1.0, 
+                      type='float', 
+                      help='Seconds between gossip rounds with another node, 0 disables them')
+    parser.add_option('--phi-threshold', dest='phi_threshold', default=8.0, 
+                      type='float', 
+                      help='Suspicion level past which a node is taken to be down')
+    parser.add_option('--metrics-port', dest='metrics_port', default=None, type='int',
+                      help='Port to serve the metrics to Prometheus on')
+    parser.add_option('--journal-mode', dest='journal_mode', default=None,
+                      help='sqlite journal mode, e.g. WAL')
+    parser.add_option('--synchronous', dest='synchronous', default=None,
+                      help='sqlite synchronous level, e.g. NORMAL')
+    parser.add_option('--group-commit-ms', dest='group_commit_ms', default=0, 
+                      type='float', help='Milliseconds to gather puts into one commit')
 
     options, args = parser.parse_args()
     return options
 
 if __name__ == '__main__':
     options = parse_args()
-    storage_node = StorageNode(options.servers, options.port)
+    if options.persistence == 'log':
+        persistence_options = {'max_segment_size': options.segment_size_mb * 1024 * 1024,
+                               'sync': options.fsync}
+    else:
+        persistence_options = {'journal_mode': options.journal_mode,
+                               'synchronous': options.synchronous,
+                               'group_commit_window': options.group_commit_ms / 1000.0}
+    storage_node = StorageNode(options.servers, options.port, options.replicas,
+                               options.threads, options.queue_size, 
+                               persistence_options, options.compaction_interval,
+                               options.persistence, options.cache_entries,
+                               options.cache_mb * 1024 * 1024, 
+                               options.hash_function,
+                               {'max_rate': int(options.handoff_rate_mb * 1024 * 1024)},
+                               {'interval': options.anti_entropy_interval},
+                               options.partitions, options.binary_port,
+                               {'max_bytes': int(options.hint_store_mb * 1024 * 1024),
+                                'max_rate': int(options.hint_rate_mb * 1024 * 1024)},
+                               gossip_options={'interval': options.gossip_interval,
+                                               'threshold': options.phi_threshold},
+                               metrics_port=options.metrics_port)
     storage_node.run()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import logging
+import os
+import socket
+import threading
+import time
+import xmlrpclib
+import uuid
+
+from dynamo.storage.storage_node import StorageNode
+
+# --------------------------------------------
+# Config
+# --------------------------------------------
+logging.basicConfig(level=logging.ERROR)
+
+CLIENT_COUNTS = [1, 8, 64]
+DURATION = 5.0
+SERVER_THREADS = 16
+
+# --------------------------------------------
+# Load test
+# --------------------------------------------
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_storage_node(threads):
+    """
+    Starts a storage node with a fresh database in a background thread
+    
+    :rtype: StorageNode
+    :returns: The running storage node
+    """
+    storage_node = StorageNode([], get_free_port(), replicas=1, threads=threads,
+                               queue_size=128)
+    if os.path.exists(storage_node.persis.conn_str):
+        storage_node.persis.close()
+        os.remove(storage_node.persis.conn_str)
+        storage_node._load_persistence_layer()
+    thread = threading.Thread(target=storage_node.run)
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.2)
+    return storage_node
+
+def client(url, deadline, counts):
+    """
+    Alternates puts and gets until the deadline
+    """
+    proxy = xmlrpclib.ServerProxy(url)
+    key = str(uuid.uuid4())
+    requests = 0
+    while time.time() < deadline:
+        proxy.put(key, 'value %s' % requests)
+        proxy.get(key)
+        requests += 2
+    counts.append(requests)
+    
+def run_load(url, num_clients):
+    """
+    Runs num_clients concurrent clients for DURATION seconds
+    
+    :rtype: float
+    :returns: Requests per second
+    """
+    counts = []
+    deadline = time.time() + DURATION
+    clients = [threading.Thread(target=client, args=(url, deadline, counts))
+               for i in xrange(num_clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return sum(counts) / DURATION
+
+def run():
+    print '%10s %10s %12s' % ('threads', 'clients', 'requests/s')
+    for threads in [0, SERVER_THREADS]:
+        storage_node = start_storage_node(threads)
+        url = 'http://127.0.0.1:%s' % storage_node.port
+        for num_clients in CLIENT_COUNTS:
+            print '%10d %10d %12.0f' % (threads, num_clients, 
+                                        run_load(url, num_clients))
+        storage_node.server.shutdown()
+        storage_node.server.server_close()
+        storage_node.persis.close()
+        os.remove(storage_node.persis.conn_str)
+
+if __name__ == '__main__':
+    run()
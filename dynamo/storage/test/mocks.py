@@ -1,8 +1,10 @@
 # --------------------------------------------
 # Imports
 # --------------------------------------------
-from dynamite.storage.storage_node import StorageNode
-from dynamite.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+import socket
+
+from dynamo.storage.storage_node import StorageNode
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
 
 # --------------------------------------------
 # Mocking functions
@@ -16,7 +18,104 @@ def get_mock_storage_node():
     """
     StorageNode._load_persistence_layer = lambda obj: None
     sn = StorageNode([], 1111111)
-    sn.persis = SqlitePersistenceLayer('test1', ':memory:')
+    sn.persis = SqlitePersistenceLayer('test1', ':memory:', metrics=sn.metrics)
     sn.persis.init_persistence()
     
-    return sn
\ No newline at end of file
+    return sn
+
+class MockPeer(object):
+    """
+    Stands in for the RPC proxy of a storage node in a MockCluster, calling
+    the node's methods directly.  Calls to a stopped node raise IOError.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.stopped = False
+        self.calls = []
+        self.pool = self
+        
+    def __getattr__(self, method):
+        func = getattr(self.node, method)
+        def call(*args):
+            self.calls.append(method)
+            if self.stopped:
+                raise IOError('%s is stopped' % self.node.my_name)
+            return func(*args)
+        return call
+    
+    def close(self):
+        pass
+
+class MockCluster(object):
+    """
+    A cluster of storage nodes in one process, each with an in-memory sqlite
+    persistence layer, that reach each other through MockPeers.  Gossip 
+    rounds are run by hand on a simulated clock, one second apart.
+    """
+    def __init__(self, num_nodes, replicas=3, port=1111120, **gossip_options):
+        """
+        :Parameters:
+            num_nodes : int
+                Number of storage nodes
+            replicas : int
+                Number of storage nodes each key is replicated to
+            port : int
+                Port of the first node, which names it
+            gossip_options : dict
+                Keyword arguments for each node's Membership
+        """
+        StorageNode._load_persistence_layer = lambda obj: None
+        self.replicas = replicas
+        self.gossip_options = gossip_options
+        self.now = 1000.0
+        self.nodes = []
+        self.peers = {}
+        self.observers = []
+        host = socket.gethostbyname(socket.gethostname())
+        self.servers = ['%s:%s' % (host, port + i) for i in xrange(num_nodes)]
+        for i in xrange(num_nodes):
+            self.add_node(port + i, self.servers)
+            
+    def add_node(self, port, servers):
+        """
+        Starts a storage node that knows of servers
+        
+        :rtype: StorageNode
+        :returns: The node
+        """
+        node = StorageNode(list(servers), port, replicas=self.replicas,
+                           gossip_options=self.gossip_options)
+        node.persis = SqlitePersistenceLayer(node.my_name, ':memory:')
+        node.persis.init_persistence()
+        node.membership.clock = lambda: self.now
+        self.peers[node.my_name] = MockPeer(node)
+        self.nodes.append(node)
+        for other in self.nodes:
+            other.peer_conns.update(self.peers)
+        return node
+    
+    def add_observer(self, membership):
+        """
+        Runs the rounds of a load balancer's membership with the nodes'
+        """
+        membership.clock = lambda: self.now
+        self.observers.append(membership)
+    
+    def stop(self, node):
+        self.peers[node.my_name].stopped = True
+        
+    def start(self, node):
+        self.peers[node.my_name].stopped = False
+        
+    def gossip(self, rounds=1):
+        """
+        Runs gossip rounds on every node that is not stopped and on the 
+        observers
+        """
+        for i in xrange(rounds):
+            self.now += 1.0
+            for node in self.nodes:
+                if not self.peers[node.my_name].stopped:
+                    node.membership.gossip_round()
+            for membership in self.observers:
+                membership.gossip_round()
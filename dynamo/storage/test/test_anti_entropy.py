@@ -0,0 +1,111 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import threading
+from unittest import TestCase
+
+from dynamo.storage.anti_entropy import get_entry_hash
+from dynamo.storage.datastore_view import DataStoreView
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+from dynamo.storage.storage_node import StorageNode
+from dynamo.storage.test.mocks import get_mock_storage_node
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestAntiEntropy(TestCase):
+    def setUp(self):
+        self.node = get_mock_storage_node()
+        self.replica = StorageNode([], 1111112)
+        self.replica.persis = SqlitePersistenceLayer('test2', ':memory:')
+        self.replica.persis.init_persistence()
+        servers = [self.node.my_name, self.replica.my_name]
+        for sn in (self.node, self.replica):
+            sn.replicas = 2
+            sn.datastore_view = DataStoreView(servers, 2)
+            sn.peer_conns = {self.node.my_name: self.node, 
+                             self.replica.my_name: self.replica}
+        
+        self.keys = ['key%s' % i for i in xrange(300)]
+        for sn in (self.node, self.replica):
+            sn.persis.put_siblings([(key, [('value', 1, None)]) for key in self.keys[:-10]])
+            
+    def tearDown(self):
+        for sn in (self.node, self.replica):
+            if sn.anti_entropy:
+                sn.anti_entropy.stop()
+        
+    def _start(self, sn, **kwargs):
+        sn.anti_entropy_options = dict(kwargs, interval=kwargs.get('interval', 60))
+        sn._start_anti_entropy()
+        for i in xrange(500):
+            if sn.anti_entropy.loaded:
+                break
+            threading.Event().wait(0.01)
+        
+    def _sync_all(self):
+        pulled, pushed = [], []
+        for r in self.node.anti_entropy.ranges:
+            result = self.node.anti_entropy.sync(r['start'], r['end'], self.replica.my_name)
+            pulled.extend(result[0])
+            pushed.extend(result[1])
+        return sorted(pulled), sorted(pushed)
+        
+    def test_entry_hash(self):
+        """
+        Ensures entry hashes depend on the key and its siblings' values and
+        clocks, but not their types or order
+        """
+        self.assertEquals(get_entry_hash('foo', [('bar', None)]), 
+                          get_entry_hash(u'foo', [(buffer('bar'), None)]))
+        self.assertNotEquals(get_entry_hash('foo', [('bar', None)]), 
+                             get_entry_hash('foo', [('baz', None)]))
+        self.assertNotEquals(get_entry_hash('foo', [('bar', None)]), 
+                             get_entry_hash('fo', [('obar', None)]))
+        self.assertNotEquals(get_entry_hash('foo', [('bar', 'a=1')]), 
+                             get_entry_hash('foo', [('bar', 'a=2')]))
+        self.assertEquals(get_entry_hash('foo', [('bar', 'a=1'), ('baz', 'b=1')]), 
+                          get_entry_hash('foo', [('baz', 'b=1'), ('bar', 'a=1')]))
+        
+    def test_sync(self):
+        """
+        Ensures replicas exchange only the keys they disagree on and then 
+        agree
+        """
+        self._start(self.node)
+        self._start(self.replica)
+        self.assertEquals(self.node.anti_entropy.stats()['keys'], 290)
+        self.assertEquals(self._sync_all(), ([], []))
+        
+        self.node.put('key295', 'only here')
+        self.replica.multi_put([('key296', 'only there'), ('key297', 'v')])
+        self.node.put('key0', 'older')
+        self.replica.put('key0', 'newer')
+        
+        pulled, pushed = self._sync_all()
+        self.assertEquals(pulled, ['key0', 'key296', 'key297'])
+        self.assertEquals(pushed, ['key0', 'key295'])
+        
+        for sn in (self.node, self.replica):
+            self.assertEquals(sn.get('key0'), 'newer')
+            self.assertEquals(sn.get('key295'), 'only here')
+            self.assertEquals(sn.get('key296'), 'only there')
+        for r in self.node.anti_entropy.ranges:
+            key = (r['start'], r['end'])
+            self.assertEquals(self.node.anti_entropy.trees[key].root, 
+                              self.replica.anti_entropy.trees[key].root)
+        self.assertEquals(self._sync_all(), ([], []))
+        
+    def test_unloaded_replica(self):
+        """
+        Ensures a replica whose hashes are not loaded is not synced with
+        """
+        self._start(self.node)
+        self.replica.anti_entropy_options = {'interval': 60}
+        self.replica.persis.scan_keys = lambda *args: []
+        self.replica._start_anti_entropy()
+        self.replica.anti_entropy.loaded = False
+        self.assertEquals(self._sync_all(), ([], []))
+        stats = self.node.anti_entropy.stats()
+        self.assertEquals(stats['syncs'], 0)
+        self.assertTrue(stats['round_trips'] > 0)
@@ -0,0 +1,134 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from dynamo.lib.consistent_hash import get_hash_function
+from dynamo.storage.handoff import Handoff
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestHandoff(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.dir, 'handoff')
+        self.persis = SqlitePersistenceLayer('test_layer', ':memory:')
+        self.persis.init_persistence()
+        self.keys = ['key%s' % i for i in xrange(100)]
+        self.persis.put_siblings([(key, [('old', 1, None), ('value', 2, None)]) 
+                                  for key in self.keys])
+        self.hash_function = get_hash_function('md5')
+        self.sent = []
+        
+        # Hand off the lower half of the ring, and a range wrapping past 
+        # the top of it
+        top = 2 ** 128
+        self.plan = [{'start': 0, 'end': top / 4, 'targets': ['a', 'b']},
+                     {'start': top / 2, 'end': 0, 'targets': ['b']}]
+        
+    def tearDown(self):
+        self.persis.close()
+        shutil.rmtree(self.dir)
+        
+    def _get_handoff(self, **kwargs):
+        kwargs.setdefault('checkpoint_path', self.checkpoint_path)
+        return Handoff(self.persis, self.hash_function, self._send, **kwargs)
+        
+    def _send(self, node, rows):
+        self.sent.extend((node, row) for row in rows)
+        
+    def _expected(self):
+        top = 2 ** 128
+        expected = set()
+        for key in self.keys:
+            token = self.hash_function.hash(key)
+            if 0 < token <= top / 4:
+                expected.add(('a', key))
+            if token <= top / 4 or token > top / 2:
+                expected.add(('b', key))
+        return expected
+    
+    def test_transfer(self):
+        """
+        Ensures the latest version of every key in a planned range is sent 
+        to the range's targets, and nothing else
+        """
+        handoff = self._get_handoff(chunk_size=30)
+        handoff.add_plan(self.plan)
+        self.assertTrue(os.path.exists(self.checkpoint_path))
+        for i in xrange(4):
+            handoff.transfer_chunk()
+        
+        self.assertEquals(set((node, row[0]) for node, row in self.sent), 
+                          self._expected())
+        self.assertEquals(set(row[1] for node, row in self.sent), set(['value']))
+        self.assertTrue(all(isinstance(row[2], str) for node, row in self.sent))
+        stats = handoff.stats()
+        self.assertEquals(stats['plans'], 0)
+        self.assertEquals(stats['passes'], 1)
+        self.assertEquals(stats['keys_scanned'], 100)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+        self.assertEquals(handoff.transfer_chunk(), 0)
+        
+    def test_batches(self):
+        """
+        Ensures batches are split at max_batch_bytes
+        """
+        handoff = self._get_handoff(max_batch_bytes=10)
+        handoff.add_plan(self.plan)
+        handoff.transfer_chunk()
+        
+        # Two 5 byte values fit in a batch
+        expected = self._expected()
+        batches = sum((len([key for node, key in expected if node == target]) + 1) / 2
+                      for target in ['a', 'b'])
+        self.assertEquals(handoff.stats()['batches'], batches)
+        
+    def test_resume(self):
+        """
+        Ensures a new handoff resumes from the checkpoint
+        """
+        handoff = self._get_handoff(chunk_size=30)
+        handoff.add_plan(self.plan)
+        handoff.transfer_chunk()
+        first = set((node, row[0]) for node, row in self.sent)
+        
+        self.sent = []
+        handoff = self._get_handoff(chunk_size=30)
+        self.assertEquals(handoff.stats()['plans'], 1)
+        for i in xrange(3):
+            handoff.transfer_chunk()
+        rest = set((node, row[0]) for node, row in self.sent)
+        self.assertEquals(first & rest, set())
+        self.assertEquals(first | rest, self._expected())
+        
+    def test_failed_send(self):
+        """
+        Ensures a chunk whose send failed is retried
+        """
+        handoff = self._get_handoff(retry_interval=0.01)
+        def send(node, rows):
+            send.calls += 1
+            if send.calls == 1:
+                raise IOError()
+            self._send(node, rows)
+        send.calls = 0
+        handoff.send = send
+        handoff.add_plan(self.plan)
+        handoff.start()
+        try:
+            for i in xrange(500):
+                if handoff.stats()['passes']:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            handoff.stop()
+        self.assertEquals(handoff.stats()['errors'], 1)
+        self.assertEquals(set((node, row[0]) for node, row in self.sent), 
+                          self._expected())
@@ -0,0 +1,143 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from dynamo.storage.hints import HintStore
+
+# --------------------------------------------
+# Config
+# --------------------------------------------
+logging.basicConfig(level=logging.CRITICAL)
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestHintStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hints')
+        self.sent = []
+        self.down = set()
+        self.left = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _send(self, owner, rows):
+        if owner in self.down:
+            raise IOError('%s is down' % owner)
+        if owner in self.left:
+            return False
+        self.sent.extend((owner, row) for row in rows)
+        return True
+
+    def _get_store(self, **kwargs):
+        return HintStore(self.path, self._send, **kwargs)
+
+    def test_replay(self):
+        """
+        Ensures each owner is sent its hints in order, in bounded batches
+        with the dates they were written at, and that they are then deleted
+        """
+        store = self._get_store(max_batch_bytes=10)
+        self.assertTrue(store.add([('a', 'key%s' % i, 'value', 'a=%x' % i) for i in xrange(5)]))
+        self.assertTrue(store.add([('b', 'key', 'other', None)]))
+        self.assertEquals(sorted(store.get_owners()), ['a', 'b'])
+        self.assertEquals(store.stats()['hints'], 6)
+        self.assertEquals(store.stats()['bytes'], 30)
+
+        self.assertEquals(store.replay_batch('a'), 10)
+        self.assertEquals([row[:2] for owner, row in self.sent],
+                          [('key0', 'value'), ('key1', 'value')])
+        self.assertTrue(all(owner == 'a' and int(row[2]) > 0 for owner, row in self.sent))
+        self.assertEquals([row[3] for owner, row in self.sent], ['a=0', 'a=1'])
+        while store.replay_batch('a'):
+            pass
+        self.assertEquals([row[0] for owner, row in self.sent],
+                          ['key%s' % i for i in xrange(5)])
+        self.assertEquals(store.get_owners(), ['b'])
+        self.assertEquals(store.stats()['hints'], 1)
+        self.assertEquals(store.stats()['bytes'], 5)
+        self.assertEquals(store.stats()['hints_replayed'], 5)
+        store.close()
+
+    def test_failed_replay(self):
+        """
+        Ensures hints are kept when their owner fails and dropped when it
+        no longer takes them
+        """
+        store = self._get_store()
+        store.add([('a', 'foo', 'bar', None), ('b', 'foo', 'bar', None)])
+        self.down.add('a')
+        self.assertRaises(IOError, store.replay_batch, 'a')
+        self.assertEquals(store.stats()['hints'], 2)
+
+        self.left.add('b')
+        self.assertEquals(store.replay_batch('b'), 0)
+        self.assertEquals(store.get_owners(), ['a'])
+        self.assertEquals(store.stats()['hints_dropped'], 1)
+        store.close()
+
+    def test_max_bytes(self):
+        """
+        Ensures hints that would take the store past its size are refused
+        as a whole, and fit again once others are replayed
+        """
+        store = self._get_store(max_bytes=12)
+        self.assertTrue(store.add([('a', 'foo', '12345', None), ('a', 'bar', '12345', None)]))
+        self.assertFalse(store.add([('a', 'baz', '12345', None)]))
+        self.assertFalse(store.add([('b', 'baz', '1', None), ('b', 'qux', '12', None)]))
+        self.assertEquals(store.stats()['hints_refused'], 3)
+        self.assertEquals(store.get_owners(), ['a'])
+
+        store.replay_batch('a')
+        self.assertTrue(store.add([('a', 'baz', '12345', None)]))
+        store.close()
+
+    def test_durable(self):
+        """
+        Ensures hints survive reopening the store
+        """
+        store = self._get_store()
+        store.add([('a', 'foo', 'bar', None), ('a', u'caf\xe9', 'bar\0baz', None)])
+        store.close()
+
+        store = self._get_store()
+        self.assertEquals(store.stats()['hints'], 2)
+        self.assertEquals(store.stats()['bytes'], 10)
+        store.replay_batch('a')
+        self.assertEquals([row[:2] for owner, row in self.sent],
+                          [('foo', 'bar'), (u'caf\xe9'.encode('utf-8'), 'bar\0baz')])
+        store.close()
+
+    def test_replay_thread(self):
+        """
+        Ensures the thread retries an owner that is down until it comes back
+        """
+        store = self._get_store(retry_interval=0.01, max_retry_interval=0.05)
+        self.down.add('a')
+        store.add([('a', 'key%s' % i, 'value', None) for i in xrange(10)])
+        store.start()
+        try:
+            for i in xrange(500):
+                if store.stats()['errors'] >= 2:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEquals(self.sent, [])
+
+            self.down.remove('a')
+            for i in xrange(500):
+                if not store.stats()['hints']:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            store.close()
+        self.assertEquals(len(self.sent), 10)
+        self.assertEquals(store.stats()['hints_replayed'], 10)
+        self.assertEquals(store.stats()['owners'], 0)
@@ -0,0 +1,113 @@
+# --------------------------------------------
+# Imports
+# --------------------------------------------
+import logging
+from unittest import TestCase
+
+from dynamo.storage.membership import Membership
+from dynamo.storage.test.mocks import MockCluster
+
+# --------------------------------------------
+# Config
+# --------------------------------------------
+logging.basicConfig(level=logging.ERROR)
+
+# --------------------------------------------
+# Tests
+# --------------------------------------------
+class TestMembership(TestCase):
+    def test_merge(self):
+        """
+        Ensures members changed at a higher ring version win, a removal wins
+        a tie, and on_change is only called when the members change
+        """
+        changes = []
+        a = Membership('a:1', ['a:1', 'b:1', 'c:1'], None, changes.append)
+        b = Membership('b:1', ['a:1', 'b:1', 'c:1'], None, lambda weights: None)
+        self.assertEquals(a.digest, b.digest)
+
+        a.record(weights={'d:1': 2})
+        b.record(left=['d:1'])
+        self.assertEquals(changes, [{'a:1': 1, 'b:1': 1, 'c:1': 1, 'd:1': 2}])
+        b.merge(a.get_state(True))
+        a.merge(b.get_state(True))
+        self.assertEquals(a.digest, b.digest)
+        self.assertEquals(a.ring_version, 1)
+        self.assertEquals(changes[-1], {'a:1': 1, 'b:1': 1, 'c:1': 1})
+
+        a.record(weights={'c:1': 3})
+        b.merge(a.get_state(True))
+        b.merge(Membership('c:1', ['a:1', 'b:1', 'c:1', 'd:1'], None, None).get_state(True))
+        self.assertEquals(b.applied, {'a:1': 1, 'b:1': 1, 'c:1': 3})
+        self.assertEquals(len(changes), 3)
+
+    def test_heartbeats(self):
+        """
+        Ensures every node hears the heartbeats of every other and suspects
+        none while they all run
+        """
+        cluster = MockCluster(5)
+        cluster.gossip(20)
+        for node in cluster.nodes:
+            stats = node.membership.stats()
+            self.assertEquals(stats['members'], 5)
+            self.assertEquals(stats['suspected'], [])
+            self.assertEquals(sorted(node.membership.heartbeats), sorted(cluster.servers))
+            self.assertTrue(all(phi < 8 for phi in stats['phi'].values()))
+
+    def test_suspect(self):
+        """
+        Ensures a node that stops is suspected by every other within a few
+        rounds, and no longer once it is back
+        """
+        cluster = MockCluster(5)
+        cluster.gossip(10)
+        stopped = cluster.nodes[0]
+        cluster.stop(stopped)
+        cluster.gossip(10)
+        for node in cluster.nodes[1:]:
+            self.assertEquals(node.membership.stats()['suspected'], [stopped.my_name])
+            self.assertTrue(node.membership.stats()['phi'][stopped.my_name] > 8)
+
+        # Nodes do not gossip with suspected nodes, but hear from them
+        calls = len(cluster.peers[stopped.my_name].calls)
+        cluster.gossip(1)
+        self.assertEquals(len(cluster.peers[stopped.my_name].calls), calls)
+        cluster.start(stopped)
+        cluster.gossip(2)
+        for node in cluster.nodes[1:]:
+            self.assertFalse(node.membership.is_suspected(stopped.my_name))
+
+    def test_ring_changes(self):
+        """
+        Ensures a membership change made on one node reaches the rings of
+        the others, including a node that was down when it was made
+        """
+        cluster = MockCluster(5)
+        removed, down = cluster.nodes[4], cluster.nodes[3]
+        cluster.stop(down)
+        cluster.nodes[0].remove_nodes([removed.my_name])
+        cluster.nodes[1].set_weights({cluster.nodes[2].my_name: 2})
+        cluster.gossip(5)
+        cluster.start(down)
+        cluster.gossip(5)
+        for node in cluster.nodes[:4]:
+            self.assertEquals(node.membership.ring_version, 1)
+            self.assertFalse(removed.my_name in node.datastore_view.table.nodes)
+            self.assertEquals(node.datastore_view.consistent_hash.weights[
+                cluster.nodes[2].my_name], 2)
+            self.assertEquals(node.membership.stats()['left'], 1)
+
+    def test_join(self):
+        """
+        Ensures a node started with some of the members as seeds joins the
+        ring of every node
+        """
+        cluster = MockCluster(3)
+        cluster.gossip(2)
+        joined = cluster.add_node(1111130, cluster.servers[:1])
+        cluster.gossip(5)
+        for node in cluster.nodes:
+            self.assertEquals(len(node.datastore_view.table.nodes), 4)
+            self.assertTrue(joined.my_name in node.datastore_view.table.nodes)
+            self.assertEquals(node.membership.digest, joined.membership.digest)
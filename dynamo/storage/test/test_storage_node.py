@@ -2,8 +2,18 @@
 # Imports
 # --------------------------------------------
 import logging
+import shutil
+import tempfile
+import threading
+import xmlrpclib
 from unittest import TestCase
 
+from dynamo.lib.vector_clock import VersionClock
+from dynamo.storage.datastore_view import DataStoreView
+from dynamo.storage.hints import HintStore
+from dynamo.storage.persistence.log_persistence_layer import LogPersistenceLayer
+from dynamo.storage.persistence.sqlite_persistence_layer import SqlitePersistenceLayer
+from dynamo.storage.storage_node import StorageNode
 from dynamo.storage.test.mocks import get_mock_storage_node
 
 # --------------------------------------------
@@ -49,3 +59,271 @@ class TestStorageNode(TestCase):
         result = self.sn.get("foo")
         self.assertEquals(result, "bar3")
         
+    def test_siblings(self):
+        """
+        Ensures two puts from the same context are both kept as siblings
+        until a put with their merged context resolves them, and that a put
+        without a context replaces them
+        """
+        self.sn.put("foo", "bar")
+        context = self.sn.get("foo", True)['context']
+        self.assertEquals(self.sn.put("foo", "one", context), '200')
+        self.assertEquals(self.sn.put("foo", "two", context), '200')
+        result = self.sn.get("foo", True)
+        self.assertEquals(result['values'], ['one', 'two'])
+        self.assertEquals(self.sn.get("foo"), "two")
+        
+        self.sn.put("foo", "merged", result['context'])
+        self.assertEquals(self.sn.get("foo", True)['values'], ['merged'])
+        
+        self.sn.put("foo", "three", context)
+        self.assertEquals(self.sn.get("foo", True)['values'], ['merged', 'three'])
+        self.sn.put("foo", "blind")
+        self.assertEquals(self.sn.get("foo", True)['values'], ['blind'])
+        
+    def test_handoff_put_merge(self):
+        """
+        Ensures handed off versions are merged with the siblings here, 
+        keeping copies of the same write once and concurrent writes apart, 
+        even with equal values
+        """
+        self.sn.put("foo", "bar")
+        versions = [(str(value), date, clock) 
+                    for row_id, value, date, clock in self.sn.persis.get_key("foo")]
+        self.assertEquals(self.sn.handoff_put([("foo", "bar", versions[0][1], versions[0][2]),
+                                               ("foo", "old", '1', 'other:1=2')]), '200')
+        self.assertEquals(self.sn.get("foo", True)['values'], ['old', 'bar'])
+        self.sn.handoff_put([("foo", "bar", versions[0][1], 'other:1=1')])
+        self.assertEquals(self.sn.get("foo", True)['values'], ['old', 'bar', 'bar'])
+        
+        context = self.sn.get("foo", True)['context']
+        self.sn.handoff_put([("foo", "new", '2', 'other:1=3|%s' % context)])
+        self.assertEquals(self.sn.get("foo", True)['values'], ['new'])
+        self.assertEquals(self.sn.get("foo"), 'new')
+        
+    def test_replica_ownership(self):
+        """
+        Ensures a node accepts keys for which it holds any of the N replicas
+        and rejects the rest.
+        """
+        self.sn.datastore_view = DataStoreView(['10.0.0.1:20000', '10.0.0.2:20000',
+                                                self.sn.my_name])
+        self.sn.replicas = 2
+        for i in xrange(50):
+            key = 'key%s' % i
+            pref_list = self.sn.datastore_view.get_preference_list(key, 2)
+            if self.sn.my_name in pref_list:
+                self.assertEquals(self.sn.put(key, 'bar'), '200')
+                self.assertEquals(self.sn.get(key), 'bar')
+            else:
+                self.assertEquals(self.sn.put(key, 'bar'), None)
+        
+    def test_multi_put_get(self):
+        """
+        Ensures batched puts and gets round trip and reconcile versions
+        """
+        codes = self.sn.multi_put([('foo', 'bar'), ('abc', '123')])
+        self.assertEquals(codes, {'foo': '200', 'abc': '200'})
+        self.assertEquals(self.sn.multi_put([('foo', 'bar2')]), {'foo': '200'})
+        
+        result = self.sn.multi_get(['foo', 'abc', 'missing'])
+        self.assertEquals(result, {'foo': 'bar2', 'abc': '123', 'missing': None})
+        
+    def test_get_without_fractional_seconds(self):
+        """
+        Ensures versions whose dates have no fractional seconds are read
+        """
+        self.sn.put("foo", "bar")
+        self.sn.put("foo", "bar2")
+        self.sn.persis.conn.execute("UPDATE key_values SET date = 1000000")
+        self.assertEquals(self.sn.get("foo"), "bar2")
+        self.assertEquals(self.sn.multi_get(["foo"]), {"foo": "bar2"})
+        
+    def test_read_cache(self):
+        """
+        Ensures gets and the versions load balancers read are served from 
+        the cache until a put invalidates them
+        """
+        self.sn.put("foo", "bar")
+        self.assertEquals(self.sn.get("foo"), "bar")
+        self.sn.persis.conn.execute("UPDATE key_values SET value = 'other'")
+        self.assertEquals(self.sn.get("foo"), "bar")
+        self.assertEquals(self.sn.multi_get(["foo"]), {"foo": "bar"})
+        self.assertEquals([row[:2] for row in self.sn.get_versions(["foo"])], 
+                          [("foo", "bar")])
+        
+        self.sn.put("foo", "bar2")
+        self.assertEquals(self.sn.get("foo"), "bar2")
+        self.sn.multi_put([("foo", "bar3")])
+        self.assertEquals(self.sn.multi_get(["foo", "missing"]), 
+                          {"foo": "bar3", "missing": None})
+        self.assertEquals(self.sn.get("missing"), None)
+        
+        stats = self.sn.cache_stats()
+        self.assertEquals((stats['hits'], stats['misses']), (4, 4))
+        
+    def test_stats(self):
+        """
+        Ensures the RPC methods and persistence operations are timed, their
+        errors, the bytes of the values and the cache hits counted, and the
+        stats can be sent over XML-RPC
+        """
+        functions = {}
+        class Server(object):
+            def register_function(self, func, name):
+                functions[name] = func
+        self.sn._register_functions(Server())
+        functions['put']("foo", "bar")
+        functions['get']("foo")
+        functions['get']("foo")
+        functions['get']("missing")
+        self.assertRaises(TypeError, functions['get'])
+        
+        stats = functions['stats']()
+        histograms = stats['histograms']
+        self.assertEquals(histograms['rpc']['method=get']['count'], 4)
+        self.assertEquals(histograms['rpc']['method=put']['count'], 1)
+        self.assertTrue(0 < histograms['rpc']['method=put']['p50'] < 1)
+        self.assertEquals(histograms['persistence']['op=get_key']['count'], 2)
+        self.assertEquals(histograms['persistence']['op=put_siblings']['count'], 1)
+        self.assertEquals(histograms['persistence']['op=commit']['count'], 1)
+        self.assertEquals(stats['counters']['rpc_errors']['method=get'], 1)
+        self.assertEquals(stats['counters']['bytes_read'], {'': 6})
+        self.assertEquals(stats['counters']['bytes_written'], {'': 3})
+        self.assertEquals(stats['cache']['hits'], 1)
+        xmlrpclib.dumps((stats,), allow_none=True)
+        
+    def test_read_cache_concurrent_put(self):
+        """
+        Ensures a value read before a put is not cached after it
+        """
+        self.sn.put("foo", "bar")
+        get_key = self.sn.persis.get_key
+        def racing_get_key(key):
+            result = get_key(key)
+            self.sn.put("foo", "bar2")
+            return result
+        self.sn.persis.get_key = racing_get_key
+        self.assertEquals(self.sn.get("foo"), "bar")
+        
+        self.sn.persis.get_key = get_key
+        self.assertEquals(self.sn.get("foo"), "bar2")
+        
+    def test_log_persistence(self):
+        """
+        Ensures puts and gets work on the log structured persistence layer
+        """
+        log_dir = tempfile.mkdtemp()
+        try:
+            self.sn.persis = LogPersistenceLayer('test1', log_dir)
+            self.sn.persis.init_persistence()
+            self.sn.put("foo", "bar")
+            self.sn.put("foo", "bar2")
+            self.assertEquals(str(self.sn.get("foo")), "bar2")
+            self.assertEquals(self.sn.multi_put([("abc", "123")]), {"abc": "200"})
+            result = self.sn.multi_get(["foo", "abc", "missing"])
+            self.assertEquals(dict((key, value and str(value)) 
+                                   for key, value in result.items()),
+                              {"foo": "bar2", "abc": "123", "missing": None})
+            self.sn.persis.close()
+        finally:
+            shutil.rmtree(log_dir)
+            
+    def test_handoff(self):
+        """
+        Ensures a node that joins the ring is sent the keys it took over
+        """
+        self.sn.replicas = 1
+        self.sn.datastore_view = DataStoreView([self.sn.my_name], 1)
+        keys = ['key%s' % i for i in xrange(100)]
+        self.sn.multi_put([(key, 'value%s' % key) for key in keys])
+        
+        new_node = StorageNode([self.sn.my_name], 1111112, replicas=1)
+        new_node.persis = SqlitePersistenceLayer('test2', ':memory:')
+        new_node.persis.init_persistence()
+        not_moved = [key for key in keys 
+                     if new_node.datastore_view.get_node(key) != new_node.my_name]
+        self.assertEquals(new_node.handoff_put([(not_moved[0], 'stale', '1')]), None)
+        
+        self.sn.handoff_options = {'checkpoint_path': None}
+        self.sn._start_handoff()
+        self.sn.peer_conns[new_node.my_name] = new_node
+        try:
+            moved = self.sn.add_nodes([new_node.my_name])
+            self.assertTrue(moved)
+            for i in xrange(500):
+                if self.sn.handoff_stats()['passes']:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            self.sn.handoff.stop()
+        
+        moved_keys = [key for key in keys 
+                      if new_node.datastore_view.get_node(key) == new_node.my_name]
+        self.assertTrue(moved_keys)
+        self.assertEquals(self.sn.handoff_stats()['keys_sent'], len(moved_keys))
+        for key in moved_keys:
+            self.assertEquals(new_node.get(key), 'value%s' % key)
+            self.assertEquals(self.sn.get(key), None)
+            
+    def test_coordinate_put(self):
+        """
+        Ensures a write stamped by its coordinator is stored with the same 
+        clock by the other replicas, and that distinct writes of the same
+        value are kept apart
+        """
+        replica = StorageNode([self.sn.my_name], 1111112)
+        replica.persis = SqlitePersistenceLayer('test2', ':memory:')
+        replica.persis.init_persistence()
+        
+        date, clock = self.sn.coordinate_put('foo', 'one')
+        self.assertEquals(VersionClock.decode(clock).node, self.sn.my_name)
+        self.assertEquals(replica.replica_put('foo', 'one', date, clock), '200')
+        self.assertEquals(replica.get_versions(['foo']), self.sn.get_versions(['foo']))
+        
+        context = replica.get('foo', True)['context']
+        date, clock = self.sn.coordinate_put('foo', 'two', context)
+        self.assertEquals(replica.replica_multi_put([('foo', 'two', date, clock)]), 
+                          {'foo': '200'})
+        self.assertEquals(replica.get('foo', True)['values'], ['two'])
+        
+        context = replica.get('foo', True)['context']
+        self.sn.coordinate_put('foo', 'same', context)
+        date, clock = replica.coordinate_multi_put([('foo', 'same', context)])['foo']
+        self.assertEquals(self.sn.replica_put('foo', 'same', date, clock), '200')
+        self.assertEquals(self.sn.get('foo', True)['values'], ['same', 'same'])
+        
+    def test_hinted_put(self):
+        """
+        Ensures a node stores writes for a replica that is down apart from
+        its own keys, and replays them without overwriting newer writes
+        """
+        self.assertEquals(self.sn.hinted_replica_put('foo', 'bar', '5', 'a=1', 'other:1'), 
+                          '400')
+        
+        owner = StorageNode([self.sn.my_name], 1111112, replicas=1)
+        owner.persis = SqlitePersistenceLayer('test2', ':memory:')
+        owner.persis.init_persistence()
+        self.sn.replicas = 1
+        self.sn.datastore_view = DataStoreView([self.sn.my_name, owner.my_name], 1)
+        keys = [key for key in ('key%s' % i for i in xrange(100))
+                if owner.datastore_view.get_node(key) == owner.my_name][:3]
+        
+        self.sn.hints = HintStore(':memory:', self.sn._send_hints)
+        self.sn.peer_conns[owner.my_name] = owner
+        self.assertEquals(self.sn.hinted_replica_put(keys[0], 'old', '5', 'a=1', 
+                                                     owner.my_name), '200')
+        self.assertEquals(self.sn.hinted_multi_put([(keys[1], 'value', owner.my_name, '6', 'a=2'),
+                                                    (keys[2], 'value', 'gone:1', '7', 'a=3')]),
+                          {keys[1]: '200', keys[2]: '200'})
+        self.assertEquals(self.sn.get(keys[0]), None)
+        self.assertEquals(self.sn.hint_stats()['hints'], 3)
+        
+        owner.put(keys[0], 'new')
+        self.sn.hints.replay_batch(owner.my_name)
+        self.sn.hints.replay_batch('gone:1')
+        self.assertEquals(owner.get(keys[0]), 'new')
+        self.assertEquals(owner.get(keys[1]), 'value')
+        self.assertEquals(self.sn.hint_stats()['hints_replayed'], 2)
+        self.assertEquals(self.sn.hint_stats()['hints_dropped'], 1)
+        self.sn.hints.close()
@@ -8,7 +8,14 @@ setup(name = 'dynamo',
                       ['sql/*.sql']},
       packages = ['dynamo',
                   'dynamo.lib',
-                  'dynamo.lib.consistent_hash',                  
+                  'dynamo.lib.consistent_hash',
+                  'dynamo.lib.failure_detector',
+                  'dynamo.lib.lru_cache',
+                  'dynamo.lib.merkle_tree',
+                  'dynamo.lib.metrics',
+                  'dynamo.lib.rpc',
+                  'dynamo.lib.thread_pool',
+                  'dynamo.lib.vector_clock',
                   'dynamo.load_balancer',
                   'dynamo.storage',
                   'dynamo.storage.datastore_view',